@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Admission control for the write endpoints
+Every guarded request is admitted or shed before it touches SQLite. The
+signals are this worker's in-flight guarded requests and an exponentially
+weighted average of the database time they measured (statement time
+includes waiting for the write lock). The average decays while idle, so a
+shedding worker starts admitting again by itself.
+
+Low-priority requests (metric ingestion) are shed with 503 and Retry-After
+when in-flight requests reach ADMISSION_MAX_WRITES minus the
+ADMISSION_RESERVED_WRITES slots kept for critical ones, or when the average
+is above ADMISSION_LATENCY_BUDGET_MS. They also wait at most
+ADMISSION_LOCK_TIMEOUT seconds for the SQLite write lock, which sheds them
+when another process holds it. Critical requests (contact submissions) are
+never shed. Decisions are exported with the runtime metrics.
+"""
+import os
+import math
+import time
+import logging
+import threading
+from functools import wraps
+
+from flask import jsonify
+
+import database
+
+logger = logging.getLogger(__name__)
+
+CRITICAL = 'critical'
+LOW = 'low'
+PRIORITIES = (CRITICAL, LOW)
+
+# Seconds for the idle latency average to halve
+DECAY_HALF_LIFE = 1.0
+SMOOTHING = 0.2
+MAX_RETRY_AFTER = 30
+
+
+def is_busy(error):
+    """True for the sqlite3.OperationalError raised when the write lock wait timed out"""
+    message = str(error).lower()
+    return 'locked' in message or 'busy' in message
+
+
+class AdmissionControl:
+    """In-flight counts and DB latency of guarded requests, and the shed/admit decision"""
+
+    def __init__(self, max_in_flight=None, reserved=None, latency_budget_ms=None, lock_timeout=None):
+        self.max_in_flight = max_in_flight or int(os.getenv('ADMISSION_MAX_WRITES', '8'))
+        self.reserved = reserved if reserved is not None else int(os.getenv('ADMISSION_RESERVED_WRITES', '2'))
+        self.latency_budget = (latency_budget_ms or float(os.getenv('ADMISSION_LATENCY_BUDGET_MS', '250'))) / 1000
+        self.lock_timeout = lock_timeout or float(os.getenv('ADMISSION_LOCK_TIMEOUT', '1.0'))
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.in_flight = {priority: 0 for priority in PRIORITIES}
+        self.admitted = {priority: 0 for priority in PRIORITIES}
+        self.shed = {}
+        self._latency = 0.0
+        self._sampled_at = time.monotonic()
+        database.add_query_listener(self.on_query)
+
+    def on_query(self, connection, sql, params, seconds, phase):
+        """Query listener: database time of the guarded request on this thread"""
+        if getattr(self._local, 'active', False):
+            self._local.db_time += seconds
+
+    def latency(self, now=None):
+        """Average DB time per guarded request, decayed by the time since the last sample"""
+        idle = (now or time.monotonic()) - self._sampled_at
+        return self._latency * 0.5 ** (max(idle, 0.0) / DECAY_HALF_LIFE)
+
+    def observe(self, seconds):
+        with self._lock:
+            now = time.monotonic()
+            self._latency = self.latency(now) * (1 - SMOOTHING) + seconds * SMOOTHING
+            self._sampled_at = now
+
+    def _shed_reason(self, priority):
+        if priority == CRITICAL:
+            return None
+        if sum(self.in_flight.values()) >= self.max_in_flight - self.reserved:
+            return 'concurrency'
+        if self.latency() > self.latency_budget:
+            return 'latency'
+        return None
+
+    def enter(self, priority):
+        """Admit a request; returns None when it was admitted, else the shed reason"""
+        with self._lock:
+            reason = self._shed_reason(priority)
+            if reason is None:
+                self.in_flight[priority] += 1
+                self.admitted[priority] += 1
+            else:
+                self.shed[(priority, reason)] = self.shed.get((priority, reason), 0) + 1
+        if reason is None:
+            self._local.active = True
+            self._local.db_time = 0.0
+        return reason
+
+    def leave(self, priority):
+        self._local.active = False
+        db_time = self._local.db_time
+        with self._lock:
+            self.in_flight[priority] -= 1
+        if db_time:
+            self.observe(db_time)
+
+    def record_shed(self, priority, reason):
+        """Count a request shed after admission (e.g. the write lock wait timed out)"""
+        with self._lock:
+            self.shed[(priority, reason)] = self.shed.get((priority, reason), 0) + 1
+
+    def retry_after(self):
+        """Seconds a shed client should wait: about how far the average is over budget"""
+        return max(1, min(MAX_RETRY_AFTER, math.ceil(self.latency() / self.latency_budget)))
+
+    def shed_response(self, priority, reason):
+        logger.warning(f"Shedding {priority}-priority request ({reason}); latency {self.latency() * 1000:.0f} ms, "
+                       f"in flight {sum(self.in_flight.values())}")
+        response = jsonify({'error': 'Server busy, retry later', 'reason': reason})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(self.retry_after())
+        return response
+
+    def limit(self, priority):
+        """Decorator admitting (or shedding) a Flask view"""
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority: {priority}")
+
+        def decorator(view):
+            @wraps(view)
+            def guarded(*args, **kwargs):
+                reason = self.enter(priority)
+                if reason is not None:
+                    return self.shed_response(priority, reason)
+                try:
+                    return view(*args, **kwargs)
+                finally:
+                    self.leave(priority)
+            return guarded
+        return decorator
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': dict(self.in_flight),
+                'admitted': dict(self.admitted),
+                'shed': {f"{priority}:{reason}": count for (priority, reason), count in sorted(self.shed.items())},
+                'db_latency_ms': round(self.latency() * 1000, 3),
+                'max_in_flight': self.max_in_flight,
+                'reserved': self.reserved,
+                'latency_budget_ms': self.latency_budget * 1000,
+            }
+
+    def render_prometheus(self, prefix='hhbc'):
+        """Admission metrics as Prometheus text lines (collected by runtime_stats)"""
+        with self._lock:
+            admitted = dict(self.admitted)
+            shed = dict(self.shed)
+            in_flight = dict(self.in_flight)
+        lines = [
+            f"# HELP {prefix}_admission_admitted_total Guarded requests admitted by priority.",
+            f"# TYPE {prefix}_admission_admitted_total counter",
+        ]
+        lines += [f'{prefix}_admission_admitted_total{{priority="{p}"}} {admitted[p]}' for p in PRIORITIES]
+        lines += [
+            f"# HELP {prefix}_admission_shed_total Requests shed with 503 by priority and reason.",
+            f"# TYPE {prefix}_admission_shed_total counter",
+        ]
+        lines += [f'{prefix}_admission_shed_total{{priority="{p}",reason="{r}"}} {count}'
+                  for (p, r), count in sorted(shed.items())]
+        lines += [
+            f"# HELP {prefix}_admission_in_flight Guarded requests being served by priority.",
+            f"# TYPE {prefix}_admission_in_flight gauge",
+        ]
+        lines += [f'{prefix}_admission_in_flight{{priority="{p}"}} {in_flight[p]}' for p in PRIORITIES]
+        lines += [
+            f"# HELP {prefix}_admission_db_latency_seconds Decaying average DB time of guarded requests.",
+            f"# TYPE {prefix}_admission_db_latency_seconds gauge",
+            f"{prefix}_admission_db_latency_seconds {self.latency():.6f}",
+        ]
+        return lines
+
+
+admission_control = AdmissionControl()
@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+"""
+In-memory columnar analytics engine for the metrics table
+Keeps every metric event (hot partitions and archived months) in NumPy arrays:
+epoch timestamps, dictionary-encoded dimensions and 64-bit hashes of the
+session and user ids. Each query first pulls rows added since the last one
+(per partition, by id), then answers filters with vectorized masks and
+group-bys with bincount. Counts are sums of sample_weight; the weight column
+is only allocated once a sampled row (weight != 1) shows up.
+
+Enabled with ANALYTICS_ENGINE=memory; needs numpy. Every process (each
+serve.py worker) builds its own copy on first use.
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+import threading
+from datetime import datetime
+
+try:
+    import numpy as np
+except ImportError:  # optional dependency, only needed with ANALYTICS_ENGINE=memory
+    np = None
+
+from flask import jsonify
+
+import archive
+import database
+import json_keys
+import lookups
+import partitions
+
+logger = logging.getLogger(__name__)
+
+# Dictionary-encoded columns; with the promoted custom_data keys (see dimensions())
+# these are also the analytics filter and group_by names
+DIMENSIONS = ('event_type', 'page_url', 'device_type', 'browser', 'country')
+# High-cardinality ids kept only as hashes (distinct counts)
+HASHED = ('session_id', 'user_id')
+
+NULL_TIMESTAMP = -2 ** 63
+FETCH_SIZE = 65536
+
+
+def dimensions():
+    return DIMENSIONS + tuple(key for key in partitions.promoted_keys() if key not in DIMENSIONS)
+
+
+def column_sql(name):
+    """SQL expression for a dimension in the metrics tables (promoted keys are indexed columns)"""
+    if name in lookups.LOOKUP_COLUMNS or name in partitions.promoted_keys():
+        return name
+    return json_keys.expression(name)
+
+
+def parse_filters(args):
+    """Dimension filters and the optional group_by from query args; ValueError when invalid"""
+    names = dimensions()
+    filters = {name: args[name] for name in names if args.get(name)}
+    group_by = args.get('group_by') or None
+    if group_by is not None and group_by not in names:
+        raise ValueError(f"group_by must be one of {', '.join(names)}")
+    return filters, group_by
+
+
+class _Column:
+    """Growable NumPy array; unsigned code columns widen when a code no longer fits"""
+
+    def __init__(self, dtype):
+        self.data = np.empty(1024, dtype=dtype)
+        self.size = 0
+
+    def append(self, values):
+        if len(values) == 0:
+            return
+        if self.data.dtype.kind == 'u' and int(values.max()) > np.iinfo(self.data.dtype).max:
+            self.data = self.data.astype(np.min_scalar_type(int(values.max())))
+        needed = self.size + len(values)
+        if needed > len(self.data):
+            grown = np.empty(max(needed, len(self.data) * 2), dtype=self.data.dtype)
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+        self.data[self.size:needed] = values
+        self.size = needed
+
+    def view(self):
+        return self.data[:self.size]
+
+
+class _Dictionary:
+    """Value <-> code mapping; code 0 is NULL"""
+
+    def __init__(self):
+        self.values = [None]
+        self.index = {None: 0}
+
+    def code(self, value):
+        code = self.index.get(value)
+        if code is None:
+            code = self.index[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def encode(self, values):
+        index = self.index
+        return np.fromiter((index[v] if v in index else self.code(v) for v in values),
+                           dtype=np.uint32, count=len(values))
+
+    def lut(self, dictionary):
+        """Code translation table for another dictionary's codes"""
+        return np.array([self.code(v) for v in dictionary], dtype=np.uint32)
+
+
+def _epoch(value):
+    if isinstance(value, datetime):
+        value = partitions.format_timestamp(value)
+    return archive.parse_timestamp(value.replace('T', ' ', 1))
+
+
+def _hashes(values):
+    return np.fromiter((0 if v is None else hash(v) for v in values), dtype=np.int64, count=len(values))
+
+
+class MetricsEngine:
+    """Column arrays for one database (plus its archive directory)"""
+
+    def __init__(self, db_path, archive_dir=None):
+        self.db_path = db_path
+        self.archive_dir = archive_dir or archive.default_directory(db_path)
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.dimensions = dimensions()
+        self.timestamps = _Column(np.int64)
+        self.codes = {name: _Column(np.uint8) for name in self.dimensions}
+        self.dictionaries = {name: _Dictionary() for name in self.dimensions}
+        self.hashes = {name: _Column(np.int64) for name in HASHED}
+        self.weights = None
+        # Highest id loaded per partition month, and the archive files loaded (path -> version)
+        self.max_ids = {}
+        self.archived = {}
+        self.rows = 0
+        self.loaded_at = None
+
+    def _append(self, timestamps, dimensions, hashed, weights):
+        if self.weights is None and np.any(weights != 1):
+            self.weights = _Column(np.float32)
+            self.weights.append(np.ones(self.rows, dtype=np.float32))
+        if self.weights is not None:
+            self.weights.append(weights)
+        self.timestamps.append(timestamps)
+        for name in self.dimensions:
+            self.codes[name].append(dimensions[name])
+        for name in HASHED:
+            self.hashes[name].append(hashed[name])
+        self.rows += len(timestamps)
+
+    def _load_archive(self, store, conn, files):
+        """Append archived row groups of the given (not yet loaded) files"""
+        paths = {f.path for f in files}
+        names = ('timestamp', 'sample_weight') + self.dimensions + HASHED
+        for archive_file, _, columns in store.groups(names, conn):
+            if archive_file.path not in paths:
+                continue
+            _, timestamps = columns['timestamp']
+            dimensions = {}
+            for name in self.dimensions:
+                dictionary, codes = columns[name]
+                dimensions[name] = self.dictionaries[name].lut(dictionary)[np.frombuffer(codes, dtype=codes.typecode)]
+            hashed = {}
+            for name in HASHED:
+                dictionary, codes = columns[name]
+                hashed[name] = _hashes(dictionary)[np.frombuffer(codes, dtype=codes.typecode)]
+            _, weights = columns['sample_weight']
+            self._append(np.frombuffer(timestamps, dtype=np.int64), dimensions, hashed,
+                         np.frombuffer(weights, dtype=np.float64).astype(np.float32))
+        for archive_file in files:
+            self.archived[archive_file.path] = archive_file.version
+
+    def _load_partition(self, conn, month):
+        table = partitions.partition_name(month)
+        cursor = conn.execute(f'''
+            SELECT id, COALESCE(CAST(strftime('%s', timestamp) AS INTEGER), {NULL_TIMESTAMP}),
+                   {', '.join(column_sql(name) for name in self.dimensions)}, {', '.join(HASHED)}, sample_weight
+            FROM ({partitions.compat_select(table)}) WHERE id > ? ORDER BY id
+        ''', (self.max_ids.get(month, 0),))
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            columns = list(zip(*rows))
+            self._append(
+                np.array(columns[1], dtype=np.int64),
+                {name: self.dictionaries[name].encode(columns[2 + i]) for i, name in enumerate(self.dimensions)},
+                {name: _hashes(columns[2 + len(self.dimensions) + i]) for i, name in enumerate(HASHED)},
+                np.array(columns[-1], dtype=np.float32),
+            )
+            self.max_ids[month] = columns[0][-1]
+
+    def refresh(self, conn):
+        """Load rows added since the last refresh; rebuild when partitions were dropped or archived"""
+        store = archive.store_for(self.archive_dir)
+        months = partitions.metrics_partitions.months(conn)
+        files = store.files(conn)
+        current = {f.path: f.version for f in files}
+        if (any(month not in months for month in self.max_ids)
+                or any(current.get(path) != version for path, version in self.archived.items())
+                or self.dimensions != dimensions()):
+            logger.info("Metrics partitions or dimensions changed, rebuilding the analytics engine")
+            self._reset()
+        started = time.perf_counter()
+        before = self.rows
+        new_files = [f for f in files if f.path not in self.archived]
+        if new_files:
+            self._load_archive(store, conn, new_files)
+        for month in months:
+            self._load_partition(conn, month)
+        if self.rows - before > FETCH_SIZE:
+            logger.info(f"Analytics engine loaded {self.rows - before} events in {time.perf_counter() - started:.2f}s")
+        self.loaded_at = time.time()
+
+    def snapshot(self, conn):
+        """Refresh, then return a consistent read-only view for one query"""
+        with self._lock:
+            self.refresh(conn)
+            return _Snapshot(self)
+
+    def stats(self):
+        with self._lock:
+            arrays = [self.timestamps] + list(self.codes.values()) + list(self.hashes.values())
+            if self.weights is not None:
+                arrays.append(self.weights)
+            used = sum(column.view().nbytes for column in arrays)
+            allocated = sum(column.data.nbytes for column in arrays)
+            return {
+                'rows': self.rows,
+                'bytes_used': used,
+                'bytes_allocated': allocated,
+                'bytes_per_million_events': round(used / self.rows * 1_000_000) if self.rows else None,
+                'dictionary_sizes': {name: len(d.values) - 1 for name, d in self.dictionaries.items()},
+                'column_dtypes': {name: str(c.data.dtype) for name, c in self.codes.items()},
+                'weighted': self.weights is not None,
+                'partitions': len(self.max_ids),
+                'archive_files': len(self.archived),
+                'loaded_at': self.loaded_at,
+            }
+
+
+class _Snapshot:
+    """Arrays as of one refresh; later appends do not affect it"""
+
+    def __init__(self, engine):
+        self.timestamps = engine.timestamps.view()
+        self.codes = {name: column.view() for name, column in engine.codes.items()}
+        self.hashes = {name: column.view() for name, column in engine.hashes.items()}
+        self.weights = engine.weights.view() if engine.weights is not None else None
+        # Dictionaries only grow, so sharing them is safe
+        self.dictionaries = {name: (d.values, d.index) for name, d in engine.dictionaries.items()}
+
+    def mask(self, start=None, end=None, filters=None):
+        """Boolean row mask for [start, end) and {dimension: value}, or None for all rows"""
+        mask = None
+        if start is not None:
+            mask = self.timestamps >= _epoch(start)
+        if end is not None:
+            below = (self.timestamps < _epoch(end)) & (self.timestamps != NULL_TIMESTAMP)
+            mask = below if mask is None else mask & below
+        for name, value in (filters or {}).items():
+            code = self.dictionaries[name][1].get(value)
+            matches = self.codes[name] == code if code is not None else np.zeros(len(self.timestamps), dtype=bool)
+            mask = matches if mask is None else mask & matches
+        return mask
+
+    def _weights(self, mask):
+        if self.weights is None:
+            return None
+        return self.weights if mask is None else self.weights[mask]
+
+    def count_by(self, name, mask=None, limit=None):
+        """[(value, count)] for a dimension, largest first (ties by value), NULL excluded"""
+        codes = self.codes[name] if mask is None else self.codes[name][mask]
+        weights = self._weights(mask)
+        counts = np.bincount(codes, weights=weights, minlength=len(self.dictionaries[name][0]))
+        counts[0] = 0
+        values = self.dictionaries[name][0]
+        number = int if weights is None else float
+        ranked = sorted(((values[code], number(counts[code])) for code in np.flatnonzero(counts)),
+                        key=lambda item: (-item[1], str(item[0])))
+        return ranked if limit is None else ranked[:limit]
+
+    def count_value(self, name, value, mask=None):
+        code = self.dictionaries[name][1].get(value)
+        if code is None:
+            return 0
+        codes = self.codes[name] if mask is None else self.codes[name][mask]
+        weights = self._weights(mask)
+        if weights is not None:
+            return float(weights[codes == code].sum(dtype=np.float64))
+        return int(np.count_nonzero(codes == code))
+
+    def distinct(self, name, mask=None):
+        hashes = self.hashes[name] if mask is None else self.hashes[name][mask]
+        unique = np.unique(hashes)
+        return int(len(unique) - np.count_nonzero(unique == 0))  # 0 is NULL
+
+    def count(self, mask=None):
+        weights = self._weights(mask)
+        if weights is not None:
+            return float(weights.sum(dtype=np.float64))
+        return len(self.timestamps) if mask is None else int(np.count_nonzero(mask))
+
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def enabled():
+    return os.getenv('ANALYTICS_ENGINE', '').lower() == 'memory'
+
+
+def engine_for(db_path):
+    """Shared engine for a database when ANALYTICS_ENGINE=memory, else None"""
+    if not enabled():
+        return None
+    if np is None:
+        logger.warning("ANALYTICS_ENGINE=memory needs numpy; falling back to SQL")
+        return None
+    with _engines_lock:
+        engine = _engines.get(db_path)
+        if engine is None:
+            engine = _engines[db_path] = MetricsEngine(db_path)
+        return engine
+
+
+def init_app(app, auth_required, db_path):
+    """Register /internal/analytics-engine (memory use and load state); db_path is a callable"""
+
+    @app.route('/internal/analytics-engine', methods=['GET'])
+    @auth_required
+    def analytics_engine_report():
+        """Rows, bytes per million events and dictionary sizes of the in-memory engine"""
+        engine = engine_for(db_path())
+        if engine is None:
+            return jsonify({'enabled': False, 'numpy': np is not None})
+        return jsonify(dict(engine.stats(), enabled=True))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load the metrics into the in-memory engine and report its size')
+    parser.add_argument('--db', default=os.getenv('DATABASE_URL', 'consultoria.db').replace('sqlite:///', ''),
+                        help='SQLite database file')
+    parser.add_argument('--dir', help='archive directory (default: METRICS_ARCHIVE_DIR or <db dir>/archive)')
+    args = parser.parse_args()
+    if np is None:
+        parser.error('numpy is not installed')
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    engine = MetricsEngine(args.db, args.dir)
+    conn = database.connect(args.db)
+    try:
+        started = time.perf_counter()
+        snapshot = engine.snapshot(conn)
+        loaded = time.perf_counter() - started
+        started = time.perf_counter()
+        snapshot.count_by('page_url', snapshot.mask(filters={'event_type': 'page_view'}), limit=10)
+        query = time.perf_counter() - started
+    finally:
+        conn.close()
+    stats = engine.stats()
+    print(f"📊 {stats['rows']:,} events loaded in {loaded:.2f}s")
+    print(f"   {stats['bytes_used'] / 2 ** 20:.1f} MiB used, {stats['bytes_allocated'] / 2 ** 20:.1f} MiB allocated")
+    print(f"   {(stats['bytes_per_million_events'] or 0) / 2 ** 20:.1f} MiB per million events")
+    print(f"   top pages: {query * 1000:.1f} ms")
+    print(f"   dictionaries: {stats['dictionary_sizes']}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,14 @@
+import click
 from flask import Flask, jsonify
-from flask_migrate import Migrate
 from flask_cors import CORS
-from flask_jwt_extended import JWTManager
+from flask_jwt_extended import JWTManager, jwt_required
 from datetime import datetime
 import os
 from dotenv import load_dotenv
 from models import db
+import database
+import query_log
+import runtime_stats
 
 load_dotenv()
 
@@ -19,10 +22,19 @@ app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'your-secret-key-here')
 
 # Initialize extensions
 db.init_app(app)
-migrate = Migrate(app, db)
+migrate = None
+# Flask-Migrate pulls in alembic (slow to import); it is only needed by the `flask db` commands
+if click.get_current_context(silent=True) is not None:
+    from flask_migrate import Migrate
+    migrate = Migrate(app, db)
 cors = CORS(app)
 jwt = JWTManager(app)
 
+# Runtime statistics at /internal/metrics and the slow-query log at /internal/queries
+database.instrument_sqlalchemy()
+runtime_stats.init_app(app, jwt_required())
+query_log.init_app(app, jwt_required())
+
 # Import models
 from models import *
 
@@ -3,19 +3,39 @@
 Production-ready Flask backend for HHBC Consultancy
 Enhanced security, configuration, and Docker support
 """
+import io
 import os
+import csv
 import sys
-import json
 import sqlite3
 import logging
 from datetime import datetime, timedelta
 from functools import wraps
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 import jwt
 from werkzeug.security import check_password_hash, generate_password_hash
 from dotenv import load_dotenv
 
+import admission
+import archive
+import analytics_engine
+import bot_filter
+import dashboard_snapshots
+import database
+import idempotency
+import ingest
+import jobs
+import json_keys
+import lead_counters
+import live_stream
+import partitions
+import profiling
+import query_log
+import runtime_stats
+import sampling
+import storage
+
 # Load environment variables
 load_dotenv()
 
@@ -37,130 +57,135 @@ app.config['JWT_EXPIRATION_HOURS'] = int(os.getenv('JWT_EXPIRATION_HOURS', '24')
 cors_origins = os.getenv('CORS_ORIGINS', 'http://localhost:3000,http://localhost:5000').split(',')
 CORS(app, origins=[origin.strip() for origin in cors_origins], supports_credentials=True)
 
+# Ingest load shedding; its decisions are exported with the runtime metrics
+runtime_stats.add_collector(admission.admission_control.render_prometheus)
+
+# Background job outcomes of this process, exported with the runtime metrics
+runtime_stats.add_collector(jobs.runner.render_prometheus)
+
+# Open dashboard streams and the updates pushed to them
+runtime_stats.add_collector(live_stream.hub.render_prometheus)
+
 # Database setup
 DB_PATH = os.getenv('DATABASE_URL', 'consultoria.db').replace('sqlite:///', '')
 
-def init_db():
-    """Initialize SQLite database with tables"""
+# Bump when the DDL below changes; stored in PRAGMA user_version
+# Version 2: metrics split into monthly partitions (see partitions.py)
+# Version 3: repetitive metric strings interned in lookup tables (see lookups.py)
+# Version 4: idempotency keys for ingestion (see idempotency.py)
+# Version 5: daily bot event counters (see bot_filter.py)
+# Version 6: sample_weight on metrics partitions (see sampling.py)
+# Version 7: background jobs table (see jobs.py)
+# Version 8: precomputed dashboard snapshots (see dashboard_snapshots.py)
+# Version 9: contact_requests.updated_at index for changed-row queries
+# Version 10: contact_requests.created_at index for newest-first pages
+# Version 11: trigger-maintained lead counters per status and day (see lead_counters.py)
+# Version 12: contact_requests.responded_at and notes
+# Version 13: mark of the latest metrics write into an older month (see partitions.py)
+SCHEMA_VERSION = 13
+
+def _storage():
+    """Repositories over DB_PATH (storage.py)"""
+    return storage.SQLiteStorage(DB_PATH)
+
+
+
+def _transaction(conn):
+    """Run startup work in one connection and one write transaction"""
+    if conn is not None:
+        return conn, False
+    conn = _storage().connect()
+    # Only takes effect on a new database file; lets retention hand dropped partitions back to the OS
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.execute('BEGIN IMMEDIATE')
+    return conn, True
+
+
+def _finish(conn, owned, ok):
+    if not owned:
+        return
+    if ok:
+        conn.commit()
+    else:
+        conn.rollback()
+    conn.close()
+
+
+def init_db(conn=None):
+    """Initialize SQLite database with tables, skipping DDL when the schema version is current"""
+    conn, owned = _transaction(conn)
+    ok = False
     try:
-        conn = sqlite3.connect(DB_PATH)
         cursor = conn.cursor()
-        
-        # Create metrics table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS metrics (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                event_type TEXT NOT NULL,
-                page_url TEXT,
-                user_id TEXT,
-                session_id TEXT,
-                device_type TEXT,
-                browser TEXT,
-                ip_address TEXT,
-                referrer TEXT,
-                custom_data TEXT,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Create contact_requests table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS contact_requests (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                email TEXT NOT NULL,
-                phone TEXT,
-                company TEXT,
-                subject TEXT NOT NULL,
-                message TEXT NOT NULL,
-                status TEXT DEFAULT 'new',
-                ip_address TEXT,
-                user_agent TEXT,
-                referrer TEXT,
-                custom_data TEXT,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Create user_sessions table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_sessions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                session_id TEXT UNIQUE NOT NULL,
-                user_id TEXT,
-                ip_address TEXT,
-                user_agent TEXT,
-                device_type TEXT,
-                browser TEXT,
-                first_seen DATETIME DEFAULT CURRENT_TIMESTAMP,
-                last_seen DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Create admin_users table for production
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS admin_users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                email TEXT,
-                is_active BOOLEAN DEFAULT 1,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                last_login DATETIME
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
-        logger.info("Database initialized successfully")
-        
+        version = cursor.execute('PRAGMA user_version').fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            logger.info(f"Database schema is current (version {version})")
+        else:
+            _storage().create_schema(conn)
+            idempotency.idempotency_keys.create(conn)
+            bot_filter.bot_filter.create(conn)
+            jobs.SQLiteBroker.create(conn)
+            dashboard_snapshots.create(conn)
+            lead_counters.create(conn)
+            # Counters start from the leads already stored
+            lead_counters.reconcile(conn)
+            cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+            logger.info(f"Database initialized successfully (schema version {SCHEMA_VERSION})")
+        # Promoted custom_data keys are configuration, so they are checked on every start
+        json_keys.apply(conn, 'contact_requests', json_keys.promoted_keys('contact_requests'))
+        partitions.metrics_partitions.promote_keys(conn)
+        ok = True
+
     except Exception as e:
         logger.error(f"Database initialization error: {str(e)}")
         raise
+    finally:
+        _finish(conn, owned, ok)
 
-def create_default_admin():
+def create_default_admin(conn=None):
     """Create default admin user from environment variables"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # Check if admin already exists
-        cursor.execute("SELECT COUNT(*) FROM admin_users WHERE username = ?", 
-                      (os.getenv('ADMIN_USERNAME', 'admin'),))
+        conn, owned = _transaction(conn)
+    except Exception as e:
+        logger.error(f"Error creating admin user: {str(e)}")
+        return
+    ok = False
+    try:
+        admins = _storage().admins
+        username = os.getenv('ADMIN_USERNAME', 'admin')
         
-        if cursor.fetchone()[0] == 0:
+        # Check if admin already exists (hashing the password is the slow part)
+        if not admins.exists(conn, username):
             # Create default admin
-            username = os.getenv('ADMIN_USERNAME', 'admin')
             password = os.getenv('ADMIN_PASSWORD', 'admin123')
-            password_hash = generate_password_hash(password)
-            
-            cursor.execute('''
-                INSERT INTO admin_users (username, password_hash, email)
-                VALUES (?, ?, ?)
-            ''', (username, password_hash, f"{username}@example.com"))
+            admins.create(conn, username, generate_password_hash(password), f"{username}@example.com")
             
-            conn.commit()
             logger.info(f"Default admin user created: {username}")
         else:
             logger.info("Admin user already exists")
-        
-        conn.close()
+        ok = True
         
     except Exception as e:
         logger.error(f"Error creating admin user: {str(e)}")
+    finally:
+        _finish(conn, owned, ok)
 
-def create_sample_data():
+def create_sample_data(conn=None):
     """Create sample data for demonstration"""
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn, owned = _transaction(conn)
+    except Exception as e:
+        logger.error(f"Error creating sample data: {str(e)}")
+        return
+    ok = False
+    try:
         cursor = conn.cursor()
         
         # Check if data already exists
         cursor.execute("SELECT COUNT(*) FROM metrics")
         if cursor.fetchone()[0] > 0:
             logger.info("Sample data already exists")
-            conn.close()
+            ok = True
             return
         
         # Insert sample metrics
@@ -170,10 +195,8 @@ def create_sample_data():
             ('form_submit', '/contacto', 'user_456', 'session_def', 'mobile', 'Safari', '192.168.1.2', 'https://hhbc.com/contacto', '{"form_type": "contact", "success": true}')
         ]
         
-        cursor.executemany('''
-            INSERT INTO metrics (event_type, page_url, user_id, session_id, device_type, browser, ip_address, referrer, custom_data)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', sample_metrics)
+        metric_fields = ('event_type', 'page_url', 'user_id', 'session_id', 'device_type', 'browser', 'ip_address', 'referrer', 'custom_data')
+        _storage().metrics.insert_many(conn, [dict(zip(metric_fields, row)) for row in sample_metrics])
         
         # Insert sample contact requests
         sample_contacts = [
@@ -181,17 +204,34 @@ def create_sample_data():
             ('María Rodríguez', 'maria.rodriguez@email.com', '+56987654321', 'Inversiones ABC', 'Análisis de Negocio', 'Necesitamos un análisis detallado de nuestro modelo de negocio actual y recomendaciones para optimizarlo.', 'in_progress', '192.168.1.3', 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36', 'https://hhbc.com/contacto', '{"urgency": "medium", "budget_range": "$5k-$20k"}')
         ]
         
-        cursor.executemany('''
-            INSERT INTO contact_requests (name, email, phone, company, subject, message, status, ip_address, user_agent, referrer, custom_data)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', sample_contacts)
+        contact_fields = ('name', 'email', 'phone', 'company', 'subject', 'message', 'status', 'ip_address', 'user_agent', 'referrer', 'custom_data')
+        for row in sample_contacts:
+            _storage().contacts.create(conn, dict(zip(contact_fields, row)))
         
-        conn.commit()
-        conn.close()
+        ok = True
         logger.info("Sample data created successfully")
         
     except Exception as e:
         logger.error(f"Error creating sample data: {str(e)}")
+    finally:
+        _finish(conn, owned, ok)
+
+def startup(sample_data=False):
+    """Schema, default admin and (optionally) sample data in a single connection and transaction"""
+    conn, owned = _transaction(None)
+    ok = False
+    try:
+        init_db(conn)
+        create_default_admin(conn)
+        if sample_data:
+            create_sample_data(conn)
+        retention = int(os.getenv('METRICS_RETENTION_MONTHS', '0') or 0)
+        if retention > 0:
+            partitions.metrics_partitions.apply_retention(conn, retention)
+        idempotency.idempotency_keys.prune(conn)
+        ok = True
+    finally:
+        _finish(conn, owned, ok)
 
 # Authentication decorators
 def require_auth(f):
@@ -222,6 +262,36 @@ def require_auth(f):
     
     return decorated_function
 
+# Per-route latency histograms, exported at /internal/metrics (admin auth or METRICS_TOKEN)
+runtime_stats.init_app(app, require_auth)
+
+# Admin-only request profiling; the WSGI app is only wrapped while it is enabled
+profiling.init_app(app, require_auth)
+
+# Statement fingerprints and plans of slow queries, at /internal/queries
+query_log.init_app(app, require_auth)
+
+# Size and load state of the optional in-memory analytics engine, at /internal/analytics-engine
+analytics_engine.init_app(app, require_auth, lambda: DB_PATH)
+
+# Per-rule hits of the ingest bot filter, at /internal/bot-filter
+bot_filter.init_app(app, require_auth, lambda: DB_PATH)
+
+# Hot-reloadable per-event-type sampling policy, at /internal/sampling
+sampling.init_app(app, require_auth, lambda: DB_PATH)
+
+# Retention, archiving, exports and VACUUM as background jobs, at /internal/jobs
+jobs.init_app(app, require_auth, lambda: DB_PATH)
+
+# Precomputed 7d/30d/90d/all analytics for the dashboard, at /internal/dashboard-snapshots
+dashboard_snapshots.init_app(app, require_auth, lambda: DB_PATH)
+
+# Server-sent metrics deltas and new leads for the dashboards, at /metrics/stream
+live_stream.init_app(app, require_auth, lambda: DB_PATH)
+
+# Lead counts per status and day from trigger-maintained counters, at /contact/summary
+lead_counters.init_app(app, require_auth, lambda: DB_PATH)
+
 # Routes
 @app.route('/')
 def index():
@@ -238,7 +308,7 @@ def health_check():
     """Health check endpoint for Docker and monitoring"""
     try:
         # Test database connection
-        conn = sqlite3.connect(DB_PATH)
+        conn = database.connect(DB_PATH)
         cursor = conn.cursor()
         cursor.execute("SELECT 1")
         conn.close()
@@ -269,23 +339,15 @@ def login():
             return jsonify({'error': 'Username and password are required'}), 400
         
         # Verify credentials against database
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT password_hash FROM admin_users 
-            WHERE username = ? AND is_active = 1
-        ''', (username,))
-        
-        result = cursor.fetchone()
+        store = _storage()
+        conn = store.connect()
+        user = store.admins.find(conn, username)
         conn.close()
         
-        if not result:
+        if not user:
             return jsonify({'error': 'Invalid credentials'}), 401
         
-        stored_password_hash = result[0]
-        
-        if not check_password_hash(stored_password_hash, password):
+        if not check_password_hash(user['password_hash'], password):
             return jsonify({'error': 'Invalid credentials'}), 401
         
         # Create JWT token
@@ -306,111 +368,349 @@ def login():
         logger.error(f"Login error: {str(e)}")
         return jsonify({'error': 'Internal server error'}), 500
 
+def _idempotent_response(body, status, replayed):
+    """JSON response; replays of an earlier request carry Idempotent-Replayed"""
+    response = jsonify(body)
+    response.status_code = status
+    if replayed:
+        response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+BOT_RESPONSE = ingest.BOT_RESPONSE
+
+TRACKED_RESPONSE = ingest.TRACKED_RESPONSE
+
+def _sampling_policy():
+    return sampling.policy_for(sampling.default_path(DB_PATH))
+
+def _filtered_as_bot(conn, events):
+    """Run the bot filter before anything is written; True when the events must be skipped"""
+    rule = bot_filter.bot_filter.check(request.headers.get('User-Agent'), request.remote_addr, events)
+    # Counted bot events reach the database in one batch per flush interval
+    bot_filter.bot_filter.flush_due(conn)
+    if rule is None:
+        return False
+    logger.debug(f"Bot event filtered by rule {rule}: {request.headers.get('User-Agent')}")
+    return True
+
+def _write_connection():
+    """Connection for low-priority writes: gives up on a held write lock after ADMISSION_LOCK_TIMEOUT"""
+    return _storage().connect(timeout=admission.admission_control.lock_timeout)
+
 # Metrics endpoints
 @app.route('/metrics/track', methods=['POST'])
+@admission.admission_control.limit(admission.LOW)
 def track_metric():
-    """Track user events and metrics"""
+    """Track user events and metrics
+
+    Retries are deduplicated by the Idempotency-Key header or an event_id field;
+    event types with a sampling rate below 1 are mostly dropped here (sampling.py)
+    """
     try:
         data = request.get_json()
         
-        # Validate required fields
-        if not data.get('event_type'):
-            return jsonify({'error': 'event_type is required'}), 400
+        # Validation rules shared with ingest_server.py
+        try:
+            key = ingest.parse_track(data, request.headers)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        # Insert metric into database
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
+        # Sampled-out events are answered like stored ones, before any database work
+        weight = _sampling_policy().weight(data.get('event_type'))
+        if weight is None:
+            return jsonify(TRACKED_RESPONSE), 201
         
-        cursor.execute('''
-            INSERT INTO metrics (event_type, page_url, user_id, session_id, device_type, browser, ip_address, referrer, custom_data)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            data.get('event_type'),
-            data.get('page_url'),
-            data.get('user_id'),
-            data.get('session_id'),
-            data.get('device_type'),
-            data.get('browser'),
-            request.remote_addr,
-            data.get('referrer'),
-            json.dumps(data.get('custom_data', {})) if data.get('custom_data') else None
-        ))
+        # Insert metric into the current month's partition (strings resolved to lookup ids)
+        conn = _write_connection()
         
-        conn.commit()
-        conn.close()
+        event = ingest.metric_event(data, request.remote_addr, datetime.utcnow(), weight)
         
-        logger.info(f"Metric tracked: {data.get('event_type')} for user {data.get('user_id')}")
-        return jsonify({'message': 'Metric tracked successfully'}), 201
+        def write():
+            _storage().metrics.insert(conn, event)
+            return TRACKED_RESPONSE, 201
         
+        try:
+            if _filtered_as_bot(conn, round(weight)):
+                return jsonify(BOT_RESPONSE), 202
+            body, status, replayed = idempotency.idempotency_keys.run(conn, 'metrics', key, write)
+        finally:
+            conn.close()
+        
+        if replayed:
+            logger.info(f"Duplicate metric ignored: idempotency key {key}")
+        else:
+            live_stream.hub.publish_events([event])
+            logger.info(f"Metric tracked: {data.get('event_type')} for user {data.get('user_id')}")
+        return _idempotent_response(body, status, replayed)
+        
+    except sqlite3.OperationalError as e:
+        if not admission.is_busy(e):
+            logger.error(f"Error tracking metric: {str(e)}")
+            return jsonify({'error': 'Internal server error'}), 500
+        admission.admission_control.record_shed(admission.LOW, 'locked')
+        return admission.admission_control.shed_response(admission.LOW, 'locked')
     except Exception as e:
         logger.error(f"Error tracking metric: {str(e)}")
         return jsonify({'error': 'Internal server error'}), 500
 
-@app.route('/metrics/analytics', methods=['GET'])
-@require_auth
-def get_analytics():
-    """Get analytics data"""
+MAX_BATCH_EVENTS = ingest.MAX_BATCH_EVENTS
+
+@app.route('/metrics/track/batch', methods=['POST'])
+@admission.admission_control.limit(admission.LOW)
+def track_metrics_batch():
+    """Track up to MAX_BATCH_EVENTS events in one transaction
+
+    Body: {"events": [...]}. An event whose event_id was already tracked (by
+    either endpoint) is skipped and counted in duplicates, events dropped by
+    sampling are counted in sampled_out; an Idempotency-Key header replays the
+    whole batch response.
+    """
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
+        try:
+            events, event_keys, batch_key = ingest.parse_batch(request.get_json(), request.headers)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        # Get metrics summary
-        cursor.execute('''
-            SELECT 
-                COUNT(*) as total_events,
-                COUNT(DISTINCT session_id) as unique_sessions,
-                COUNT(DISTINCT user_id) as unique_users,
-                COUNT(CASE WHEN event_type = 'page_view' THEN 1 END) as page_views,
-                COUNT(CASE WHEN event_type = 'form_submit' THEN 1 END) as form_submissions
-            FROM metrics
-            WHERE timestamp >= datetime('now', '-30 days')
-        ''')
-        
-        summary = cursor.fetchone()
-        
-        # Get top pages
-        cursor.execute('''
-            SELECT page_url, COUNT(*) as views
-            FROM metrics
-            WHERE event_type = 'page_view' AND page_url IS NOT NULL
-            GROUP BY page_url
-            ORDER BY views DESC
-            LIMIT 10
-        ''')
-        
-        top_pages = cursor.fetchall()
-        
-        # Get device breakdown
-        cursor.execute('''
-            SELECT device_type, COUNT(*) as count
-            FROM metrics
-            WHERE device_type IS NOT NULL
-            GROUP BY device_type
-            ORDER BY count DESC
-        ''')
-        
-        device_breakdown = cursor.fetchall()
+        kept = ingest.sample(_sampling_policy(), events, event_keys)
         
-        conn.close()
+        conn = _write_connection()
         
-        return jsonify({
-            'summary': {
-                'total_events': summary[0] or 0,
-                'unique_sessions': summary[1] or 0,
-                'unique_users': summary[2] or 0,
-                'page_views': summary[3] or 0,
-                'form_submissions': summary[4] or 0
-            },
-            'top_pages': [{'page': page[0], 'views': page[1]} for page in top_pages],
-            'device_breakdown': [{'device': device[0], 'count': device[1]} for device in device_breakdown]
-        })
+        stored = []
+        
+        def write():
+            stored.extend(ingest.store_events(conn, _storage().metrics, kept, request.remote_addr, datetime.utcnow()))
+            return ingest.batch_response(events, kept, len(stored)), 201
+        
+        try:
+            if _filtered_as_bot(conn, round(sum(weight for _, _, weight in kept))):
+                return jsonify(BOT_RESPONSE), 202
+            body, status, replayed = idempotency.idempotency_keys.run(conn, 'metrics_batch', batch_key, write)
+        finally:
+            conn.close()
+        
+        if not replayed:
+            live_stream.hub.publish_events(stored)
+        logger.info(f"Metric batch: {body.get('tracked')} tracked, {body.get('duplicates')} duplicates"
+                    f"{' (replayed)' if replayed else ''}")
+        return _idempotent_response(body, status, replayed)
+        
+    except sqlite3.OperationalError as e:
+        if not admission.is_busy(e):
+            logger.error(f"Error tracking metric batch: {str(e)}")
+            return jsonify({'error': 'Internal server error'}), 500
+        admission.admission_control.record_shed(admission.LOW, 'locked')
+        return admission.admission_control.shed_response(admission.LOW, 'locked')
+    except Exception as e:
+        logger.error(f"Error tracking metric batch: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+def _sql_analytics(conn, since, start, end, filters, group_by, after_id=None):
+    """
+    Analytics from the metrics repository (SQLite partitions merged with archived months);
+    with after_id only the events stored after that mark, every page included
+    """
+    metrics = _storage().metrics
+    summary = metrics.summary(conn, since, end, filters, after_id=after_id)
+    if filters.get('event_type', 'page_view') == 'page_view':
+        top_pages = metrics.count_by(conn, 'page_url', start, end, {**filters, 'event_type': 'page_view'},
+                                     limit=10 if after_id is None else None, after_id=after_id)
+    else:
+        top_pages = []
+    device_breakdown = metrics.count_by(conn, 'device_type', start, end, filters, after_id=after_id)
+    event_types = metrics.count_by(conn, 'event_type', start, end, filters, after_id=after_id)
+    groups = metrics.count_by(conn, group_by, start, end, filters, after_id=after_id) if group_by else None
+    return summary, top_pages, device_breakdown, event_types, groups
+
+def _engine_analytics(engine, conn, since, start, end, filters, group_by):
+    """The same analytics from the in-memory engine (analytics_engine.py)"""
+    snapshot = engine.snapshot(conn)
+    recent = snapshot.mask(since, end, filters)
+    summary = {
+        'total_events': snapshot.count(recent),
+        'unique_sessions': snapshot.distinct('session_id', recent),
+        'unique_users': snapshot.distinct('user_id', recent),
+        'page_views': snapshot.count_value('event_type', 'page_view', recent),
+        'form_submissions': snapshot.count_value('event_type', 'form_submit', recent),
+    }
+    selected = snapshot.mask(start, end, filters)
+    if filters.get('event_type', 'page_view') == 'page_view':
+        pages = snapshot.mask(start, end, {**filters, 'event_type': 'page_view'})
+        top_pages = snapshot.count_by('page_url', pages, limit=10)
+    else:
+        top_pages = []
+    device_breakdown = snapshot.count_by('device_type', selected)
+    event_types = snapshot.count_by('event_type', selected)
+    groups = snapshot.count_by(group_by, selected) if group_by else None
+    return summary, top_pages, device_breakdown, event_types, groups
+
+def _read_analytics(conn, start, end, requested, filters, group_by, after_id=None):
+    """
+    The /metrics/analytics body, read in conn's open transaction; returns
+    (result, whether a standard range had no fresh snapshot)
+    """
+    metrics = _storage().metrics
+    standard = None if filters or group_by or after_id is not None else dashboard_snapshots.match(start, end, requested)
+    snapshot = dashboard_snapshots.load(conn, standard) if standard else None
+    if snapshot is not None:
+        summary, top_pages, device_breakdown, event_types, freshness = snapshot
+        groups = None
+    else:
+        if requested is not None:
+            start = dashboard_snapshots.range_start(requested)
+        since = start or partitions.format_timestamp(datetime.utcnow() - timedelta(days=30))
+        engine = analytics_engine.engine_for(DB_PATH) if after_id is None else None
+        if engine is not None:
+            summary, top_pages, device_breakdown, event_types, groups = _engine_analytics(
+                engine, conn, since, start, end, filters, group_by)
+        else:
+            summary, top_pages, device_breakdown, event_types, groups = _sql_analytics(
+                conn, start if after_id is not None else since, start, end, filters, group_by, after_id)
+        next_token = metrics.high_water(conn)
+    
+    # Event counts are sums of sample weights (estimates for sampled event types)
+    result = {
+        'summary': {
+            'total_events': round(summary['total_events']),
+            'unique_sessions': summary['unique_sessions'],
+            'unique_users': summary['unique_users'],
+            'page_views': round(summary['page_views']),
+            'form_submissions': round(summary['form_submissions'])
+        },
+        'top_pages': [{'page': page[0], 'views': round(page[1])} for page in top_pages],
+        'device_breakdown': [{'device': device[0], 'count': round(device[1])} for device in device_breakdown],
+        'event_types': [{'event_type': value, 'count': round(count)} for value, count in event_types]
+    }
+    if groups is not None:
+        result['groups'] = [{group_by: value, 'count': round(count)} for value, count in groups]
+    if snapshot is not None:
+        result['snapshot'] = freshness
+    else:
+        result['next'] = str(next_token)
+    if after_id is not None:
+        # Distinct counts do not add up across deltas
+        del result['summary']['unique_sessions'], result['summary']['unique_users']
+        result['since'] = str(after_id)
+    return result, bool(standard) and snapshot is None
+
+@app.route('/metrics/analytics', methods=['GET'])
+@require_auth
+def get_analytics():
+    """Get analytics data (hot partitions plus archived months)
+    
+    Optional: start_date/end_date or range=7d|30d|90d|all, dimension filters
+    (event_type, page_url, device_type, browser, country) and group_by=<dimension>.
+    The dashboard's standard ranges without filters are served from
+    dashboard_snapshots.py while fresh, with their as_of time under 'snapshot'.
+    Live answers carry a 'next' token; since=<token> returns only what the
+    events stored after it add (no unique counts), from an id range scan.
+    Tokens older than archived events or than a write into an older month
+    (storage low_water()) get 410: reload the full analytics
+    """
+    try:
+        filters, group_by = analytics_engine.parse_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        start, end = parse_date_range(request.args)
+    except ValueError:
+        return jsonify({'error': 'Invalid date format'}), 400
+    requested = request.args.get('range')
+    if requested is not None and (requested not in dashboard_snapshots.RANGES or start or end):
+        return jsonify({'error': f"range must be one of {', '.join(dashboard_snapshots.RANGES)}, without dates"}), 400
+    after_id = request.args.get('since')
+    if after_id is not None:
+        if not after_id.isdigit():
+            return jsonify({'error': 'since must be a next token from an earlier response'}), 400
+        after_id = int(after_id)
+    
+    try:
+        conn = _storage().connect()
+        # One read transaction, so the next token matches the rows that were counted
+        conn.execute('BEGIN')
+        try:
+            if after_id is not None and after_id < _storage().metrics.low_water(conn):
+                return jsonify({'error': 'since token expired (events were archived or backfilled below it); fetch the full analytics'}), 410
+            result, stale = _read_analytics(conn, start, end, requested, filters, group_by, after_id)
+        finally:
+            conn.rollback()
+            conn.close()
+        if stale:
+            # Missing or stale: make sure the recurring refresh job is queued
+            dashboard_snapshots.schedule()
+        return jsonify(result)
         
     except Exception as e:
         logger.error(f"Error getting analytics: {str(e)}")
         return jsonify({'error': 'Internal server error'}), 500
 
+def parse_date_range(args):
+    """start_date/end_date query args (ISO dates or datetimes) as stored-format [start, end) bounds"""
+    bounds = []
+    for name in ('start_date', 'end_date'):
+        value = args.get(name)
+        if not value:
+            bounds.append(None)
+            continue
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00')).replace(tzinfo=None)
+        if name == 'end_date' and len(value) == 10:
+            parsed += timedelta(days=1)  # a plain end date includes that whole day
+        bounds.append(partitions.format_timestamp(parsed))
+    return bounds
+
+@app.route('/metrics/export', methods=['GET'])
+@require_auth
+def export_metrics():
+    """
+    Stream metrics as CSV, archived months included (start_date, end_date, columns);
+    with background=1 the file is written by a metrics.export job instead (202)
+    """
+    try:
+        start, end = parse_date_range(request.args)
+        columns = request.args.get('columns')
+        columns = [c.strip() for c in columns.split(',')] if columns else list(archive.COLUMN_NAMES)
+        unknown = [c for c in columns if c not in archive.COLUMN_NAMES]
+        if unknown:
+            return jsonify({'error': f"Unknown columns: {', '.join(unknown)}"}), 400
+    except ValueError:
+        return jsonify({'error': 'Invalid date format'}), 400
+    
+    if request.args.get('background') in ('1', 'true'):
+        try:
+            job = jobs.runner.submit('metrics.export', {'start': start, 'end': end, 'columns': columns}, 'low')
+        except Exception as e:
+            logger.error(f"Error queueing metrics export: {str(e)}")
+            return jsonify({'error': 'Internal server error'}), 500
+        response = jsonify(jobs.public(job))
+        response.status_code = 202
+        response.headers['Location'] = f"/internal/jobs/{job['id']}"
+        return response
+    
+    db_path = DB_PATH
+    
+    def generate():
+        conn = database.connect(db_path)
+        try:
+            out = io.StringIO()
+            writer = csv.writer(out)
+            writer.writerow(columns)
+            for row in archive.metrics_rows(conn, archive.default_directory(db_path), columns, start, end):
+                writer.writerow(row)
+                if out.tell() > 65536:
+                    yield out.getvalue()
+                    out.seek(0)
+                    out.truncate()
+            yield out.getvalue()
+        finally:
+            conn.close()
+    
+    return Response(generate(), mimetype='text/csv',
+                    headers={'Content-Disposition': 'attachment; filename=metrics.csv'})
+
 # Contact form endpoints
+CONTACT_STATUSES = lead_counters.STATUSES
+
 @app.route('/contact/submit', methods=['POST'])
+@admission.admission_control.limit(admission.CRITICAL)
 def submit_contact_form():
     """Handle contact form submissions"""
     try:
@@ -428,37 +728,49 @@ def submit_contact_form():
         if not re.match(email_pattern, data.get('email', '')):
             return jsonify({'error': 'Invalid email format'}), 400
         
+        try:
+            key = idempotency.request_key(request.headers, data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
         # Insert contact request into database
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
+        store = _storage()
+        conn = store.connect()
+        
+        def write():
+            contact_id = store.contacts.create(conn, {
+                'name': data.get('name'),
+                'email': data.get('email'),
+                'phone': data.get('phone'),
+                'company': data.get('company'),
+                'subject': data.get('subject'),
+                'message': data.get('message'),
+                'status': 'new',
+                'ip_address': request.remote_addr,
+                'user_agent': request.headers.get('User-Agent'),
+                'referrer': request.headers.get('Referer'),
+                'custom_data': data.get('custom_data')
+            })
+            return {
+                'message': 'Contact form submitted successfully',
+                'contact_id': contact_id,
+                'status': 'new'
+            }, 201
         
-        cursor.execute('''
-            INSERT INTO contact_requests (name, email, phone, company, subject, message, status, ip_address, user_agent, referrer, custom_data)
-            VALUES (?, ?, ?, ?, ?, ?, 'new', ?, ?, ?, ?)
-        ''', (
-            data.get('name'),
-            data.get('email'),
-            data.get('phone'),
-            data.get('company'),
-            data.get('subject'),
-            data.get('message'),
-            request.remote_addr,
-            request.headers.get('User-Agent'),
-            request.headers.get('Referer'),
-            json.dumps(data.get('custom_data', {})) if data.get('custom_data') else None
-        ))
-        
-        contact_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        try:
+            body, status, replayed = idempotency.idempotency_keys.run(conn, 'contact', key, write)
+        finally:
+            conn.close()
         
-        logger.info(f"Contact form submitted by {data.get('name')} ({data.get('email')})")
+        if replayed:
+            logger.info(f"Duplicate contact form ignored: idempotency key {key}")
+        else:
+            live_stream.hub.publish_lead({'id': body['contact_id'], 'name': data.get('name'), 'company': data.get('company'),
+                                          'subject': data.get('subject'), 'status': 'new',
+                                          'created_at': datetime.utcnow().strftime(partitions.TIMESTAMP_FORMAT)})
+            logger.info(f"Contact form submitted by {data.get('name')} ({data.get('email')})")
         
-        return jsonify({
-            'message': 'Contact form submitted successfully',
-            'contact_id': contact_id,
-            'status': 'new'
-        }), 201
+        return _idempotent_response(body, status, replayed)
         
     except Exception as e:
         logger.error(f"Error submitting contact form: {str(e)}")
@@ -467,36 +779,48 @@ def submit_contact_form():
 @app.route('/contact/requests', methods=['GET'])
 @require_auth
 def get_contact_requests():
-    """Get all contact requests"""
+    """Get all contact requests
+    
+    Optional: filters on the promoted custom_data keys (CONTACT_JSON_KEYS,
+    e.g. urgency=high) and group_by=<key> for counts per value. The response
+    carries a 'next' token; since=<token> returns only the rows created or
+    updated since (rows changed within that second may repeat)
+    """
+    keys = json_keys.promoted_keys('contact_requests')
+    filters = {key: request.args[key] for key in keys if request.args.get(key)}
+    group_by = request.args.get('group_by') or None
+    if group_by is not None and group_by not in keys:
+        return jsonify({'error': f"group_by must be one of {', '.join(keys)}"}), 400
+    changed_since = request.args.get('since') or None
+    if changed_since is not None:
+        if group_by is not None:
+            return jsonify({'error': 'since cannot be combined with group_by'}), 400
+        try:
+            changed_since = partitions.format_timestamp(datetime.fromisoformat(changed_since))
+        except ValueError:
+            return jsonify({'error': 'since must be a next token from an earlier response'}), 400
+    
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT id, name, email, phone, company, subject, message, status, created_at, updated_at
-            FROM contact_requests
-            ORDER BY created_at DESC
-        ''')
-        
-        requests = cursor.fetchall()
-        conn.close()
-        
-        contact_requests = []
-        for req in requests:
-            contact_requests.append({
-                'id': req[0],
-                'name': req[1],
-                'email': req[2],
-                'phone': req[3],
-                'company': req[4],
-                'subject': req[5],
-                'message': req[6],
-                'status': req[7],
-                'created_at': req[8],
-                'updated_at': req[9]
-            })
+        store = _storage()
+        conn = store.connect()
+        conn.execute('BEGIN')
+        try:
+            contact_requests = store.contacts.list(conn, filters, changed_since=changed_since)
+            next_token = store.contacts.high_water(conn) or changed_since
+            
+            groups = None
+            if group_by:
+                groups = [{group_by: value, 'count': count} for value, count in store.contacts.count_by(conn, group_by, filters)]
+        finally:
+            conn.rollback()
+            conn.close()
         
-        return jsonify({'contact_requests': contact_requests})
+        result = {'contact_requests': contact_requests, 'next': next_token}
+        if groups is not None:
+            result['groups'] = groups
+        if changed_since is not None:
+            result['since'] = changed_since
+        return jsonify(result)
         
     except Exception as e:
         logger.error(f"Error getting contact requests: {str(e)}")
@@ -505,7 +829,7 @@ def get_contact_requests():
 @app.route('/contact/requests/<int:request_id>/status', methods=['PUT'])
 @require_auth
 def update_contact_status(request_id):
-    """Update contact request status"""
+    """Update contact request status (optional notes; responded_at is set when it becomes resolved)"""
     try:
         data = request.get_json()
         new_status = data.get('status')
@@ -513,20 +837,13 @@ def update_contact_status(request_id):
         if not new_status:
             return jsonify({'error': 'status is required'}), 400
         
-        valid_statuses = ['new', 'in_progress', 'resolved', 'closed']
-        if new_status not in valid_statuses:
+        if new_status not in CONTACT_STATUSES:
             return jsonify({'error': 'Invalid status'}), 400
         
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            UPDATE contact_requests 
-            SET status = ?, updated_at = CURRENT_TIMESTAMP
-            WHERE id = ?
-        ''', (new_status, request_id))
+        store = _storage()
+        conn = store.connect()
         
-        if cursor.rowcount == 0:
+        if not store.contacts.update_statuses(conn, [(request_id, new_status, data.get('notes') or None)]):
             conn.close()
             return jsonify({'error': 'Contact request not found'}), 404
         
@@ -540,27 +857,167 @@ def update_contact_status(request_id):
         logger.error(f"Error updating contact status: {str(e)}")
         return jsonify({'error': 'Internal server error'}), 500
 
+MAX_BULK_UPDATES = 500
+
+@app.route('/contact/requests', methods=['PATCH'])
+@require_auth
+def update_contact_statuses():
+    """Update the status of many contact requests in one transaction
+    
+    Body: {"changes": [{"id": 1, "status": "resolved", "notes": "..."}, ...]},
+    at most MAX_BULK_UPDATES, each id once. Notes are optional and
+    responded_at is set when a request becomes resolved, as with the single
+    update. Valid changes to existing requests are applied by one executemany;
+    the response has a result per change, in order (updated, not_found, invalid)
+    """
+    data = request.get_json(silent=True)
+    changes = data.get('changes') if isinstance(data, dict) else None
+    if not isinstance(changes, list) or not changes:
+        return jsonify({'error': 'changes must be a non-empty list'}), 400
+    if len(changes) > MAX_BULK_UPDATES:
+        return jsonify({'error': f'At most {MAX_BULK_UPDATES} changes per request'}), 400
+    if not all(isinstance(change, dict) for change in changes):
+        return jsonify({'error': 'Each change must be an object'}), 400
+    # Bad ids are reported per change; only well-formed ones must be unique
+    is_id = lambda value: isinstance(value, int) and not isinstance(value, bool)
+    ids = [change.get('id') for change in changes if is_id(change.get('id'))]
+    if len(set(ids)) != len(ids):
+        return jsonify({'error': 'Each id may appear only once'}), 400
+    
+    results = []
+    valid = []
+    for change in changes:
+        contact_id, new_status, notes = change.get('id'), change.get('status'), change.get('notes')
+        if not is_id(contact_id):
+            error = 'id must be an integer'
+        elif new_status not in CONTACT_STATUSES:
+            error = 'status is required' if not new_status else 'Invalid status'
+        elif notes is not None and not isinstance(notes, str):
+            error = 'notes must be a string'
+        else:
+            error = None
+            valid.append((contact_id, new_status, notes or None))
+        results.append({'id': contact_id, 'result': 'invalid', 'error': error} if error else
+                       {'id': contact_id, 'status': new_status})
+    
+    try:
+        store = _storage()
+        conn = store.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            previous = store.contacts.update_statuses(conn, valid) if valid else {}
+            conn.commit()
+        finally:
+            conn.close()
+    except Exception as e:
+        logger.error(f"Error updating contact statuses: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+    
+    for result in results:
+        if result.get('result') == 'invalid':
+            continue
+        if result['id'] in previous:
+            result.update(result='updated', previous_status=previous[result['id']])
+        else:
+            result.update(result='not_found', error='Contact request not found')
+            del result['status']
+    counts = {name: sum(1 for r in results if r['result'] == name) for name in ('updated', 'not_found', 'invalid')}
+    logger.info(f"Contact statuses bulk update: {counts['updated']} updated, {counts['not_found']} not found, "
+                f"{counts['invalid']} invalid")
+    return jsonify({**counts, 'results': results})
+
+# Dashboard endpoints
+BOOTSTRAP_PAGE_SIZE = 20
+MAX_BOOTSTRAP_PAGE_SIZE = 100
+
+@app.route('/dashboard/bootstrap', methods=['GET'])
+@require_auth
+def dashboard_bootstrap():
+    """Everything a dashboard needs on mount, in one request
+    
+    Analytics of range=7d|30d|90d|all (default all, as /metrics/analytics),
+    the first page of leads (limit, offset), lead counts per status and the
+    freshness of the analytics, all read from one connection in one read
+    transaction so they describe the same moment. The 'next' tokens continue
+    with since= on /metrics/analytics and /contact/requests
+    """
+    requested = request.args.get('range', 'all')
+    if requested not in dashboard_snapshots.RANGES:
+        return jsonify({'error': f"range must be one of {', '.join(dashboard_snapshots.RANGES)}"}), 400
+    try:
+        limit = int(request.args.get('limit', BOOTSTRAP_PAGE_SIZE))
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return jsonify({'error': 'limit and offset must be integers'}), 400
+    if not 1 <= limit <= MAX_BOOTSTRAP_PAGE_SIZE or offset < 0:
+        return jsonify({'error': f'limit must be between 1 and {MAX_BOOTSTRAP_PAGE_SIZE}, offset at least 0'}), 400
+    
+    try:
+        store = _storage()
+        conn = store.connect()
+        conn.execute('BEGIN')
+        try:
+            read_at = partitions.format_timestamp().replace(' ', 'T')
+            analytics, stale = _read_analytics(conn, None, None, requested, {}, None)
+            leads = store.contacts.list(conn, limit=limit, offset=offset)
+            status_counts = lead_counters.status_counts(conn)
+            contacts_next = store.contacts.high_water(conn)
+        finally:
+            conn.rollback()
+            conn.close()
+        if stale:
+            dashboard_snapshots.schedule()
+        
+        snapshot = analytics.get('snapshot')
+        return jsonify({
+            'analytics': analytics,
+            'leads': {'contact_requests': leads, 'total': sum(status_counts.values()),
+                      'limit': limit, 'offset': offset, 'next': contacts_next},
+            'status_counts': status_counts,
+            'freshness': {
+                'read_at': read_at,
+                'analytics_source': 'snapshot' if snapshot else 'live',
+                'analytics_as_of': snapshot['as_of'] if snapshot else read_at,
+            }
+        })
+        
+    except Exception as e:
+        logger.error(f"Error getting dashboard bootstrap: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
 if __name__ == '__main__':
     print("🚀 Starting HHBC Consultancy Backend - Production Ready...")
     
     try:
         # Initialize database
-        init_db()
-        create_default_admin()
-        create_sample_data()
+        startup(sample_data=True)
         
         print("✅ Backend ready!")
         print("📊 API Endpoints:")
         print("   GET  / - API status")
         print("   GET  /health - Health check")
         print("   POST /auth/login - User authentication")
-        print("   POST /metrics/track - Track user events")
+        print("   POST /metrics/track - Track user events (Idempotency-Key or event_id deduplicates retries)")
+        print("   POST /metrics/track/batch - Track up to 500 events at once")
         print("   GET  /metrics/analytics - Get analytics (Auth required)")
+        print("   GET  /metrics/export - Export metrics as CSV, archive included (Auth required)")
+        print("   GET  /metrics/stream - Live metrics deltas and new leads, server-sent events (Auth required)")
         print("   POST /contact/submit - Submit contact form")
         print("   GET  /contact/requests - Get contact requests (Auth required)")
         print("   PUT  /contact/requests/<id>/status - Update status (Auth required)")
+        print("   PATCH /contact/requests - Update up to 500 statuses in one transaction (Auth required)")
+        print("   GET  /contact/summary - Leads per status and per day, from counters (Auth required)")
+        print("   GET  /dashboard/bootstrap - Analytics, first page of leads and status counts in one call (Auth required)")
+        print("   GET  /internal/metrics - Runtime statistics (Prometheus format, Auth or METRICS_TOKEN required)")
+        print("   GET  /internal/profiling - Request profiling control (Auth required)")
+        print("   GET  /internal/queries - Slow-query log and plans (Auth required)")
+        print("   GET  /internal/analytics-engine - In-memory analytics engine size (Auth required)")
+        print("   GET  /internal/bot-filter - Bot filter hits per rule (Auth required)")
+        print("   GET|PUT /internal/sampling - Per-event-type sampling rates (Auth required)")
+        print("   GET|POST /internal/jobs - Background jobs: queue, status and progress (Auth required)")
+        print("   GET|POST /internal/dashboard-snapshots - Dashboard snapshot freshness and refresh (Auth required)")
         print("")
-        print("🌐 Starting production server on http://0.0.0.0:5000")
+        print("🌐 Starting production server on http://0.0.0.0:5000 (use serve.py for multiple workers)")
         
         # Production server configuration
         from werkzeug.serving import WSGIRequestHandler
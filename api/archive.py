@@ -0,0 +1,609 @@
+#!/usr/bin/env python3
+"""
+Cold-tier archive for metrics partitions
+Closed monthly partitions (see partitions.py) are moved out of SQLite into
+immutable columnar files, one per month. Each file is split into row groups
+sorted by timestamp; a month archived again (its partition was recreated by
+a backfill) gets the new rows appended as further row groups, with ids above
+the archived ones. Every column chunk is zlib-compressed, text columns are
+dictionary-encoded, and a JSON footer describes the schema, chunk offsets and
+per-row-group min/max statistics. Readers load only the columns they need and
+skip row groups (or whole files) outside the requested time range.
+
+File layout:
+    b'HCOL' version(1 byte) | column chunks ... | footer JSON | footer length (uint32 LE) | b'HCOL'
+"""
+import os
+import sys
+import json
+import math
+import zlib
+import time
+import struct
+import logging
+import argparse
+import calendar
+import itertools
+from array import array
+from collections import Counter
+from datetime import datetime
+
+import database
+import partitions
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'HCOL'
+FORMAT_VERSION = 1
+FILE_SUFFIX = '.hcol'
+ROW_GROUP_SIZE = 65536
+NULL_INT = -2 ** 63
+
+# (name, type); int64 and timestamp are stored as plain int64 arrays, float64 as plain doubles
+# (NaN is NULL), strings are dictionary-encoded
+METRICS_SCHEMA = [
+    ('id', 'int64'),
+    ('event_type', 'string'),
+    ('page_url', 'string'),
+    ('user_id', 'string'),
+    ('session_id', 'string'),
+    ('device_type', 'string'),
+    ('browser', 'string'),
+    ('ip_address', 'string'),
+    ('referrer', 'string'),
+    ('custom_data', 'string'),
+    ('timestamp', 'timestamp'),
+    ('sample_weight', 'float64'),
+]
+COLUMN_NAMES = [name for name, _ in METRICS_SCHEMA]
+
+# Columns that files written before they existed read as a constant
+DEFAULTS = {'sample_weight': 1.0}
+
+# Any other column name read from an archive is taken from that key of custom_data
+# (e.g. country, form_type), like the promoted keys of json_keys.py
+JSON_SOURCE = 'custom_data'
+
+
+_day_epochs = {}
+
+
+def parse_timestamp(value):
+    """Epoch seconds for 'YYYY-MM-DD HH:MM:SS[.ffffff]' (UTC); NULL_INT for None"""
+    if value is None:
+        return NULL_INT
+    day = value[:10]
+    base = _day_epochs.get(day)
+    if base is None:
+        base = _day_epochs[day] = calendar.timegm(time.strptime(day, '%Y-%m-%d'))
+    if len(value) < 19 or value[10] not in ' T':
+        if len(value) == 10:
+            return base
+        raise ValueError(f"Unsupported timestamp format: {value!r}")
+    return base + int(value[11:13]) * 3600 + int(value[14:16]) * 60 + int(value[17:19])
+
+
+def format_timestamp(epoch):
+    if epoch == NULL_INT:
+        return None
+    return datetime.utcfromtimestamp(epoch).strftime(partitions.TIMESTAMP_FORMAT)
+
+
+def _bound(value):
+    """Normalize a range bound (datetime or timestamp string) to the stored text format"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return value.replace('T', ' ', 1)
+    return value.strftime(partitions.TIMESTAMP_FORMAT)
+
+
+def json_value(raw, key):
+    """Value of key in a JSON object string, None when missing or not an object"""
+    if not raw:
+        return None
+    try:
+        data = json.loads(raw)
+    except ValueError:
+        return None
+    return data.get(key) if isinstance(data, dict) else None
+
+
+def _derive(dictionary, codes, key):
+    """Re-encode a dictionary-encoded JSON column as the values of one of its keys"""
+    index = {}
+    derived = []
+    lut = []
+    for raw in dictionary:
+        value = json_value(raw, key)
+        code = index.get(value)
+        if code is None:
+            code = index[value] = len(derived)
+            derived.append(value)
+        lut.append(code)
+    return derived, array(codes.typecode, (lut[code] for code in codes))
+
+
+def _codes_typecode(size):
+    if size <= 0xFF:
+        return 'B'
+    if size <= 0xFFFF:
+        return 'H'
+    return 'I'
+
+
+def _encode_column(kind, values):
+    """Compressed chunk bytes plus footer metadata for one column of one row group"""
+    if kind == 'string':
+        index = {}
+        dictionary = []
+        codes = array(_codes_typecode(len(set(values))))
+        for value in values:
+            code = index.get(value)
+            if code is None:
+                code = index[value] = len(dictionary)
+                dictionary.append(value)
+            codes.append(code)
+        dict_bytes = json.dumps(dictionary, ensure_ascii=False).encode('utf-8')
+        payload = struct.pack('<I', len(dict_bytes)) + dict_bytes + codes.tobytes()
+        meta = {'encoding': 'dictionary', 'codes': codes.typecode, 'dictionary_size': len(dictionary)}
+    elif kind == 'float64':
+        payload = array('d', (math.nan if v is None else v for v in values)).tobytes()
+        meta = {'encoding': 'plain'}
+    else:
+        ints = array('q', (NULL_INT if v is None else v for v in values))
+        payload = ints.tobytes()
+        meta = {'encoding': 'plain'}
+    return zlib.compress(payload, 6), meta
+
+
+def _decode_column(kind, meta, data):
+    payload = zlib.decompress(data)
+    if kind == 'string':
+        (dict_len,) = struct.unpack_from('<I', payload)
+        dictionary = json.loads(payload[4:4 + dict_len].decode('utf-8'))
+        codes = array(meta['codes'])
+        codes.frombytes(payload[4 + dict_len:])
+        return dictionary, codes
+    if kind == 'float64':
+        floats = array('d')
+        floats.frombytes(payload)
+        return None, floats
+    ints = array('q')
+    ints.frombytes(payload)
+    return None, ints
+
+
+def _write_group(f, group, footer):
+    ts_index = COLUMN_NAMES.index('timestamp')
+    columns = list(zip(*group))
+    timestamps = [parse_timestamp(v) for v in columns[ts_index]]
+    present = [t for t in timestamps if t != NULL_INT]
+    ids = [v for v in columns[0] if v is not None]
+    chunks = {}
+    for (name, kind), values in zip(METRICS_SCHEMA, columns):
+        data, meta = _encode_column(kind, timestamps if kind == 'timestamp' else values)
+        meta.update({'offset': f.tell(), 'length': len(data)})
+        f.write(data)
+        chunks[name] = meta
+    footer['row_groups'].append({
+        'rows': len(group),
+        'stats': {
+            'timestamp': {
+                'min': format_timestamp(min(present)) if present else None,
+                'max': format_timestamp(max(present)) if present else None,
+                'nulls': len(timestamps) - len(present),
+            },
+            'id': {'min': min(ids) if ids else None, 'max': max(ids) if ids else None},
+        },
+        'chunks': chunks,
+    })
+    footer['rows'] += len(group)
+
+
+def _copy_group(f, archive_file, group, footer):
+    """Append a row group of another file unchanged (chunks are copied, not decoded)"""
+    chunks = {}
+    with open(archive_file.path, 'rb') as source:
+        for name, meta in group['chunks'].items():
+            source.seek(meta['offset'])
+            data = source.read(meta['length'])
+            chunks[name] = dict(meta, offset=f.tell())
+            f.write(data)
+    footer['row_groups'].append(dict(group, chunks=chunks))
+    footer['rows'] += group['rows']
+
+
+def write_file(path, rows, partition=None, keep=None):
+    """
+    Write metrics rows (an iterable of tuples in METRICS_SCHEMA order, sorted
+    by timestamp) to a columnar file, after the row groups of the ArchiveFile
+    `keep` if given; returns the footer
+    """
+    tmp_path = path + '.tmp'
+    footer = {
+        'format': 'hhbc-columnar',
+        'version': FORMAT_VERSION,
+        'table': 'metrics',
+        'partition': partition,
+        'created_at': datetime.utcnow().strftime(partitions.TIMESTAMP_FORMAT),
+        'compression': 'zlib',
+        'columns': [{'name': name, 'type': kind} for name, kind in METRICS_SCHEMA],
+        'rows': 0,
+        'row_groups': [],
+    }
+    rows = iter(rows)
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC + bytes([FORMAT_VERSION]))
+        if keep is not None:
+            for group in keep.footer['row_groups']:
+                _copy_group(f, keep, group, footer)
+        while True:
+            group = list(itertools.islice(rows, ROW_GROUP_SIZE))
+            if not group:
+                break
+            _write_group(f, group, footer)
+        footer_bytes = json.dumps(footer, separators=(',', ':')).encode('utf-8')
+        f.write(footer_bytes)
+        f.write(struct.pack('<I', len(footer_bytes)) + MAGIC)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return footer
+
+
+class ArchiveFile:
+    """One archived partition: footer metadata plus on-demand column reads"""
+
+    def __init__(self, path, footer=None, version=None):
+        self.path = path
+        if footer is None:
+            with open(path, 'rb') as f:
+                if f.read(4) != MAGIC:
+                    raise ValueError(f"{path} is not a columnar archive file")
+                f.seek(-8, os.SEEK_END)
+                length, magic = struct.unpack('<I4s', f.read(8))
+                if magic != MAGIC:
+                    raise ValueError(f"{path} is truncated")
+                f.seek(-8 - length, os.SEEK_END)
+                footer = json.loads(f.read(length).decode('utf-8'))
+        self.footer = footer
+        self.version = version if version is not None else os.stat(path).st_mtime_ns
+        self.kinds = {c['name']: c['type'] for c in self.footer['columns']}
+        self.partition = self.footer.get('partition')
+        stats = [g['stats']['timestamp'] for g in self.footer['row_groups']]
+        self.min_timestamp = min((s['min'] for s in stats if s['min']), default=None)
+        self.max_timestamp = max((s['max'] for s in stats if s['max']), default=None)
+        self.has_nulls = any(s['nulls'] for s in stats)
+
+    @property
+    def rows(self):
+        return self.footer['rows']
+
+    @property
+    def max_id(self):
+        return max((g['stats']['id']['max'] for g in self.footer['row_groups'] if g['stats']['id']['max'] is not None),
+                   default=None)
+
+    def below_id(self, limit):
+        """The file restricted to row groups of ids below limit (the others are still in SQLite)"""
+        groups = [g for g in self.footer['row_groups'] if g['stats']['id']['max'] is not None and g['stats']['id']['max'] < limit]
+        if len(groups) == len(self.footer['row_groups']):
+            return self
+        footer = dict(self.footer, row_groups=groups, rows=sum(g['rows'] for g in groups))
+        return ArchiveFile(self.path, footer, (self.version, limit))
+
+    def overlaps(self, start, end):
+        if self.has_nulls or self.min_timestamp is None:
+            return True
+        return (start is None or self.max_timestamp >= start) and (end is None or self.min_timestamp < end)
+
+    def row_groups(self, start=None, end=None):
+        """(index, fully_inside) for row groups whose timestamp range overlaps [start, end)"""
+        for index, group in enumerate(self.footer['row_groups']):
+            stats = group['stats']['timestamp']
+            if stats['min'] is None or stats['nulls']:
+                yield index, start is None and end is None
+                continue
+            if (start is not None and stats['max'] < start) or (end is not None and stats['min'] >= end):
+                continue
+            yield index, (start is None or stats['min'] >= start) and (end is None or stats['max'] < end)
+
+    def read(self, index, names):
+        """Decoded (dictionary, values) per requested column; only those chunks are read"""
+        chunks = self.footer['row_groups'][index]['chunks']
+        stored = {name if name in self.kinds else JSON_SOURCE for name in names
+                  if name in self.kinds or name not in DEFAULTS}
+        result = {}
+        with open(self.path, 'rb') as f:
+            for name in sorted(stored):
+                meta = chunks[name]
+                f.seek(meta['offset'])
+                result[name] = _decode_column(self.kinds[name], meta, f.read(meta['length']))
+        for name in names:
+            if name in self.kinds:
+                continue
+            if name in DEFAULTS:
+                rows = self.footer['row_groups'][index]['rows']
+                result[name] = (None, array('d', [DEFAULTS[name]]) * rows)
+            else:
+                result[name] = _derive(*result[JSON_SOURCE], name)
+        return result
+
+
+def _row_mask(columns, start, end, fully_inside):
+    """Row positions of a row group that fall inside [start, end), or None for all"""
+    if fully_inside:
+        return None
+    _, timestamps = columns['timestamp']
+    lo = parse_timestamp(start) if start is not None else None
+    hi = parse_timestamp(end) if end is not None else None
+    return [
+        i for i, t in enumerate(timestamps)
+        if t != NULL_INT and (lo is None or t >= lo) and (hi is None or t < hi)
+    ]
+
+
+def _where_rows(columns, where, mask):
+    """Row positions (within mask) whose columns equal the where values, or None for all"""
+    keep = mask
+    for name, value in where.items():
+        dictionary, codes = columns[name]
+        if value not in dictionary:
+            return []
+        wanted = dictionary.index(value)
+        rows = range(len(codes)) if keep is None else keep
+        keep = [i for i in rows if codes[i] == wanted]
+    return keep
+
+
+class ArchiveStore:
+    """Columnar archive files in one directory, with cached footers and per-row-group aggregates"""
+
+    MAX_CACHED_AGGREGATES = 4096
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._files = {}
+        self._aggregates = {}
+
+    def files(self, conn=None):
+        """
+        Archive files, oldest first. While a month's partition is still present in
+        conn, only the row groups with ids below the partition's are read from its
+        file: the partition wins over rows being archived (until the drop commits)
+        and the rows archived earlier stay visible
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        hot = set(partitions.partition_name(m) for m in partitions.metrics_partitions.months(conn)) if conn else set()
+        found = []
+        for entry in sorted(os.scandir(self.directory), key=lambda e: e.name):
+            if not entry.name.endswith(FILE_SUFFIX):
+                continue
+            stat = entry.stat()
+            key = (stat.st_mtime_ns, stat.st_size)
+            cached = self._files.get(entry.path)
+            if cached is None or cached[0] != key:
+                cached = self._files[entry.path] = (key, ArchiveFile(entry.path))
+            archive_file = cached[1]
+            if archive_file.partition in hot:
+                first = conn.execute(f"SELECT MIN(id) FROM {archive_file.partition}").fetchone()[0]
+                if first is not None:
+                    archive_file = archive_file.below_id(first)
+            if archive_file.rows or archive_file.partition not in hot:
+                found.append(archive_file)
+        return found
+
+    def files_for_range(self, start=None, end=None, conn=None):
+        start, end = _bound(start), _bound(end)
+        return [f for f in self.files(conn) if f.overlaps(start, end)]
+
+    def _groups(self, start, end, conn):
+        start, end = _bound(start), _bound(end)
+        for archive_file in self.files_for_range(start, end, conn):
+            for index, fully_inside in archive_file.row_groups(start, end):
+                yield archive_file, index, fully_inside, start, end
+
+    def _cached(self, key, compute):
+        value = self._aggregates.get(key)
+        if value is None:
+            if len(self._aggregates) >= self.MAX_CACHED_AGGREGATES:
+                self._aggregates.clear()
+            value = self._aggregates[key] = compute()
+        return value
+
+    def count_by(self, column, start=None, end=None, where=None, conn=None):
+        """
+        Counter of column values over [start, end), optionally where {column: value};
+        rows count as their sample_weight
+        """
+        where = where or {}
+        total = Counter()
+        names = sorted({column, 'timestamp', 'sample_weight', *where})
+        for archive_file, index, fully_inside, lo, hi in self._groups(start, end, conn):
+            def compute():
+                columns = archive_file.read(index, names)
+                dictionary, codes = columns[column]
+                _, weights = columns['sample_weight']
+                keep = _where_rows(columns, where, _row_mask(columns, lo, hi, fully_inside))
+                if not weights or (min(weights) == 1 and max(weights) == 1):
+                    counts = Counter(codes if keep is None else (codes[i] for i in keep))
+                else:
+                    counts = Counter()
+                    for i in (range(len(codes)) if keep is None else keep):
+                        counts[codes[i]] += weights[i]
+                if dictionary is None:
+                    return counts
+                return Counter({dictionary[code]: n for code, n in counts.items()})
+            if fully_inside:
+                key = (archive_file.path, archive_file.version, index, column, tuple(sorted(where.items())))
+                total.update(self._cached(key, compute))
+            else:
+                total.update(compute())
+        return total
+
+    def distinct(self, column, start=None, end=None, where=None, conn=None):
+        values = set()
+        where = where or {}
+        for archive_file, index, fully_inside, lo, hi in self._groups(start, end, conn):
+            columns = archive_file.read(index, sorted({column, 'timestamp', *where}))
+            dictionary, codes = columns[column]
+            keep = _where_rows(columns, where, _row_mask(columns, lo, hi, fully_inside))
+            if keep is None:
+                values.update(dictionary)
+            else:
+                values.update(dictionary[codes[i]] for i in keep)
+        values.discard(None)
+        return values
+
+    def groups(self, names, conn=None):
+        """(archive_file, row group index, decoded columns) for every archived row group"""
+        for archive_file, index, _, _, _ in self._groups(None, None, conn):
+            yield archive_file, index, archive_file.read(index, names)
+
+    def rows(self, columns=None, start=None, end=None, conn=None):
+        """Yield row tuples (in `columns` order) from archived row groups in time order"""
+        columns = list(columns or COLUMN_NAMES)
+        names = sorted(set(columns) | {'timestamp'})
+        for archive_file, index, fully_inside, lo, hi in self._groups(start, end, conn):
+            data = archive_file.read(index, names)
+            mask = _row_mask(data, lo, hi, fully_inside)
+            decoded = []
+            for name in columns:
+                dictionary, values = data[name]
+                if dictionary is not None:
+                    decoded.append([dictionary[code] for code in values])
+                elif archive_file.kinds.get(name) == 'timestamp':
+                    decoded.append([format_timestamp(v) for v in values])
+                elif values.typecode == 'd':
+                    decoded.append([None if math.isnan(v) else v for v in values])
+                else:
+                    decoded.append([None if v == NULL_INT else v for v in values])
+            positions = range(archive_file.footer['row_groups'][index]['rows']) if mask is None else mask
+            for i in positions:
+                yield tuple(col[i] for col in decoded)
+
+
+def merge_counts(rows, counts, limit=None):
+    """Add (value, count) rows from SQL to archive counts; non-null values, largest first, ties by value"""
+    merged = Counter(counts)
+    for value, count in rows:
+        merged[value] += count
+    merged.pop(None, None)
+    ranked = sorted(merged.items(), key=lambda item: (-item[1], str(item[0])))
+    return ranked if limit is None else ranked[:limit]
+
+
+_stores = {}
+
+
+def store_for(directory):
+    """Shared ArchiveStore per directory, so footer and aggregate caches survive across requests"""
+    store = _stores.get(directory)
+    if store is None:
+        store = _stores[directory] = ArchiveStore(directory)
+    return store
+
+
+def archive_partition(conn, directory, month):
+    """
+    Write one partition to a columnar file and drop it from SQLite; returns the
+    footer. An existing file of the month keeps its rows, the partition's are
+    appended
+    """
+    table = partitions.partition_name(month)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, table + FILE_SUFFIX)
+    existing = ArchiveFile(path) if os.path.exists(path) else None
+    count, first = conn.execute(f"SELECT COUNT(*), MIN(id) FROM {table}").fetchone()
+    if existing is not None and existing.max_id is not None and first is not None and first <= existing.max_id:
+        # Rows of a partition dropped before retention kept its id sequence; readers could not tell them apart
+        raise RuntimeError(f"{table} reuses ids already in {path}; not archiving it again")
+    cursor = conn.execute(f"SELECT {', '.join(COLUMN_NAMES)} FROM ({partitions.compat_select(table)}) "
+                          f"ORDER BY timestamp, id")
+
+    def fetch():
+        while True:
+            batch = cursor.fetchmany(ROW_GROUP_SIZE)
+            if not batch:
+                return
+            yield from batch
+
+    footer = write_file(path, fetch(), partition=table, keep=existing)
+    expected = count + (existing.rows if existing is not None else 0)
+    if ArchiveFile(path).rows != expected:
+        raise RuntimeError(f"Archive verification failed for {table}")
+    # Until the drop commits, readers take the partition's rows from SQLite, not the file (ArchiveStore.files)
+    partitions.metrics_partitions.drop(conn, [month])
+    logger.info(f"Archived {count} rows of {table} to {path} ({os.path.getsize(path)} bytes"
+                f"{f', {existing.rows} rows archived before' if existing is not None else ''})")
+    return footer
+
+
+def archive_before(conn, directory, month):
+    """Archive every closed partition older than month (never the current one)"""
+    cutoff = min(partitions.month_of(month), partitions.month_of())
+    archived = []
+    for candidate in partitions.metrics_partitions.months(conn):
+        if candidate >= cutoff:
+            break
+        conn.execute('SAVEPOINT metrics_archive')
+        try:
+            archive_partition(conn, directory, candidate)
+            conn.execute('RELEASE metrics_archive')
+        except Exception as e:
+            conn.execute('ROLLBACK TO metrics_archive')
+            conn.execute('RELEASE metrics_archive')
+            logger.error(f"Could not archive {partitions.partition_name(candidate)}: {str(e)}")
+            continue
+        archived.append(partitions.partition_name(candidate))
+    return archived
+
+
+def metrics_rows(conn, directory, columns, start=None, end=None):
+    """Rows of `columns` in [start, end): archived months first, then the SQLite partitions, by timestamp"""
+    yield from store_for(directory).rows(columns, start, end, conn=conn)
+    yield from conn.execute(f'''
+        SELECT {', '.join(columns)} FROM {partitions.metrics_partitions.source(conn, start, end)}
+        WHERE (? IS NULL OR timestamp >= ?) AND (? IS NULL OR timestamp < ?)
+        ORDER BY timestamp, id
+    ''', (start, start, end, end))
+
+
+def default_directory(db_path):
+    return os.getenv('METRICS_ARCHIVE_DIR') or os.path.join(os.path.dirname(os.path.abspath(db_path)), 'archive')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Move closed metrics partitions to columnar archive files')
+    parser.add_argument('command', choices=['list', 'run'])
+    parser.add_argument('--db', default=os.getenv('DATABASE_URL', 'consultoria.db').replace('sqlite:///', ''),
+                        help='SQLite database file')
+    parser.add_argument('--dir', help='archive directory (default: METRICS_ARCHIVE_DIR or <db dir>/archive)')
+    parser.add_argument('--hot-months', type=int, default=int(os.getenv('METRICS_HOT_MONTHS', '4') or 4),
+                        help='months kept in SQLite, including the current one')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    directory = args.dir or default_directory(args.db)
+
+    conn = database.connect(args.db)
+    try:
+        if args.command == 'run':
+            started = time.perf_counter()
+            conn.execute('BEGIN IMMEDIATE')
+            archived = archive_before(conn, directory, partitions.months_back(args.hot_months - 1))
+            conn.commit()
+            conn.executescript('PRAGMA incremental_vacuum;')  # execute() frees a single page
+            print(f"📦 Archived {len(archived)} partitions in {time.perf_counter() - started:.1f}s: "
+                  f"{', '.join(archived) or '-'}")
+        for archive_file in store_for(directory).files():
+            print(f"   {os.path.basename(archive_file.path):<24}{archive_file.rows:>12,} rows "
+                  f"{os.path.getsize(archive_file.path):>14,} bytes  "
+                  f"{archive_file.min_timestamp} .. {archive_file.max_timestamp}")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+"""
+HTTP load-testing benchmark for the HHBC Consultancy backend
+Seeds a scratch database, serves app_production.app over a local socket and
+reports throughput and latency percentiles per endpoint
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import sqlite3
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import http.client
+import multiprocessing
+from datetime import datetime
+from urllib.parse import urlparse
+
+# Endpoints exercised by the workload: name -> (method, path, requires auth)
+ENDPOINTS = {
+    'track': ('POST', '/metrics/track', False),
+    'submit': ('POST', '/contact/submit', False),
+    'analytics': ('GET', '/metrics/analytics', True),
+    'requests': ('GET', '/contact/requests', True),
+}
+
+DEFAULT_MIX = 'track=70,submit=5,analytics=15,requests=10'
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_results')
+
+EVENT_TYPES = ['page_view', 'page_view', 'page_view', 'click', 'scroll', 'form_submit']
+PAGES = ['/', '/servicios', '/contacto', '/nosotros', '/servicios/legal', '/servicios/it', '/servicios/contable']
+DEVICES = ['desktop', 'mobile', 'tablet']
+BROWSERS = ['Chrome', 'Safari', 'Firefox', 'Edge']
+# http.client sends no User-Agent, which the bot filter (bot_filter.py) would count instead of storing
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36'
+
+
+def parse_mix(mix):
+    """Parse 'name=weight,...' into a list of (endpoint, weight)"""
+    weights = []
+    for part in mix.split(','):
+        name, _, weight = part.strip().partition('=')
+        if name not in ENDPOINTS:
+            raise ValueError(f"Unknown endpoint in mix: {name}")
+        weights.append((name, float(weight or 1)))
+    return weights
+
+
+def seed_database(db_path, metrics, contacts, seed, days=90):
+    """Create the schema and bulk-load synthetic metrics and contacts"""
+    import generate_data
+    import app_production
+
+    generate_data.generate(db_path, metrics, contacts, schema='raw', seed=seed, days=days)
+    app_production.create_default_admin()
+
+
+def _serve(db_path, port_queue, threaded):
+    """Child process: run app_production.app on an ephemeral local port"""
+    os.environ['DATABASE_URL'] = db_path
+    import logging
+    from werkzeug.serving import make_server, WSGIRequestHandler
+    import app_production
+
+    logging.getLogger().setLevel(logging.WARNING)
+    app_production.logger.setLevel(logging.WARNING)
+
+    class QuietRequestHandler(WSGIRequestHandler):
+        def log_request(self, code='-', size='-'):
+            pass
+
+    server = make_server('127.0.0.1', 0, app_production.app, threaded=threaded,
+                         request_handler=QuietRequestHandler)
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_prefork_server(db_path, workers, threads=1):
+    """Start serve.py (pre-forking master + workers) on a free local port"""
+    port = _free_port()
+    env = dict(os.environ, DATABASE_URL=db_path)
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'serve.py'),
+           '--bind', f'127.0.0.1:{port}', '--workers', str(workers), '--threads', str(threads),
+           '--no-access-log']
+    proc = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return proc, f"http://127.0.0.1:{port}"
+
+
+def start_server(db_path, threaded=True):
+    """Start the backend in a separate process so it does not share our GIL"""
+    port_queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_serve, args=(db_path, port_queue, threaded), daemon=True)
+    proc.start()
+    port = port_queue.get(timeout=30)
+    return proc, f"http://127.0.0.1:{port}"
+
+
+def stop_server(proc):
+    proc.terminate()
+    if isinstance(proc, subprocess.Popen):
+        proc.wait(timeout=60)
+    else:
+        proc.join()
+
+
+def wait_until_ready(base_url, timeout=30):
+    """Poll /health until the server answers"""
+    url = urlparse(base_url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection(url.hostname, url.port, timeout=2)
+            conn.request('GET', '/health')
+            if conn.getresponse().status == 200:
+                conn.close()
+                return
+        except OSError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"Server at {base_url} did not become ready")
+
+
+def login(base_url, username, password):
+    """Obtain a JWT for the authenticated endpoints"""
+    url = urlparse(base_url)
+    conn = http.client.HTTPConnection(url.hostname, url.port, timeout=10)
+    conn.request('POST', '/auth/login', body=json.dumps({'username': username, 'password': password}),
+                  headers={'Content-Type': 'application/json'})
+    response = conn.getresponse()
+    body = json.loads(response.read() or b'{}')
+    conn.close()
+    if response.status != 200:
+        raise RuntimeError(f"Login failed ({response.status}): {body}")
+    return body['access_token']
+
+
+def build_request(name, rng, token):
+    """Return (method, path, body, headers) for one workload request"""
+    method, path, needs_auth = ENDPOINTS[name]
+    headers = {'User-Agent': USER_AGENT}
+    body = None
+    if needs_auth:
+        headers['Authorization'] = f"Bearer {token}"
+    if name == 'track':
+        body = {
+            'event_type': rng.choice(EVENT_TYPES),
+            'page_url': rng.choice(PAGES),
+            'user_id': f"user_{rng.randint(1, 5000)}",
+            'session_id': f"session_{rng.randint(1, 20000)}",
+            'device_type': rng.choice(DEVICES),
+            'browser': rng.choice(BROWSERS),
+            'referrer': 'https://google.com',
+        }
+    elif name == 'submit':
+        n = rng.randint(1, 10 ** 6)
+        body = {
+            'name': f"Cliente {n}",
+            'email': f"cliente{n}@example.com",
+            'subject': 'Consultoría',
+            'message': 'Mensaje generado por el benchmark de carga.',
+            'custom_data': {'form_type': 'contact', 'urgency': 'medium'},
+        }
+    if body is not None:
+        headers['Content-Type'] = 'application/json'
+        body = json.dumps(body)
+    return method, path, body, headers
+
+
+def _worker(base_url, mix, token, deadline, seed, samples, lock):
+    """Issue requests until the deadline, recording (endpoint, seconds, status)"""
+    url = urlparse(base_url)
+    rng = random.Random(seed)
+    names = [name for name, _ in mix]
+    weights = [weight for _, weight in mix]
+    conn = http.client.HTTPConnection(url.hostname, url.port, timeout=30)
+    local = []
+    while time.monotonic() < deadline:
+        name = rng.choices(names, weights)[0]
+        method, path, body, headers = build_request(name, rng, token)
+        start = time.perf_counter()
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            status = 0
+        local.append((name, time.perf_counter() - start, status))
+    conn.close()
+    with lock:
+        samples.extend(local)
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(int(round(pct / 100.0 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def summarize(samples, elapsed):
+    """Aggregate raw samples into per-endpoint RPS and latency percentiles"""
+    by_endpoint = {}
+    for name, seconds, status in samples:
+        by_endpoint.setdefault(name, []).append((seconds, status))
+    by_endpoint['all'] = [(seconds, status) for _, seconds, status in samples]
+
+    results = {}
+    for name, values in by_endpoint.items():
+        latencies = sorted(seconds for seconds, _ in values)
+        errors = sum(1 for _, status in values if status == 0 or status >= 500)
+        results[name] = {
+            'requests': len(values),
+            'errors': errors,
+            'rps': round(len(values) / elapsed, 2) if elapsed else 0.0,
+            'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0.0,
+            'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+            'max_ms': round(latencies[-1] * 1000, 3) if latencies else 0.0,
+        }
+    return results
+
+
+def run_workload(base_url, mix, token, duration, concurrency, seed, warmup=1.0):
+    """Drive the mixed workload with `concurrency` client threads"""
+    if warmup:
+        _worker(base_url, mix, token, time.monotonic() + warmup, seed - 1, [], threading.Lock())
+
+    samples = []
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+    threads = [
+        threading.Thread(target=_worker, args=(base_url, mix, token, deadline, seed + i, samples, lock))
+        for i in range(concurrency)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return summarize(samples, elapsed), elapsed
+
+
+def git_commit():
+    """Current commit hash, so results can be compared across commits"""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results):
+    print(f"{'endpoint':<12}{'requests':>10}{'errors':>8}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name in sorted(results, key=lambda n: (n == 'all', n)):
+        r = results[name]
+        print(f"{name:<12}{r['requests']:>10}{r['errors']:>8}{r['rps']:>10.1f}"
+              f"{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}{r['p99_ms']:>10.2f}")
+
+
+def print_comparison(results, baseline_path):
+    """Print RPS and p99 deltas against a previously saved run"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\nComparison against {baseline_path} (commit {baseline['meta'].get('commit')}):")
+    for name, r in sorted(results.items()):
+        base = baseline['results'].get(name)
+        if not base:
+            continue
+        rps_delta = (r['rps'] - base['rps']) / base['rps'] * 100 if base['rps'] else 0.0
+        p99_delta = (r['p99_ms'] - base['p99_ms']) / base['p99_ms'] * 100 if base['p99_ms'] else 0.0
+        print(f"   {name:<12} rps {base['rps']:>9.1f} -> {r['rps']:>9.1f} ({rps_delta:+.1f}%)"
+              f"   p99 {base['p99_ms']:>8.2f} -> {r['p99_ms']:>8.2f} ms ({p99_delta:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-test the HHBC backend API')
+    parser.add_argument('--metrics', type=int, default=10000, help='metric rows to seed')
+    parser.add_argument('--contacts', type=int, default=500, help='contact requests to seed')
+    parser.add_argument('--days', type=int, default=90, help='days of seeded history')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of measured load')
+    parser.add_argument('--concurrency', type=int, default=8, help='client threads')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='endpoint weights, e.g. track=70,analytics=30')
+    parser.add_argument('--seed', type=int, default=42, help='RNG seed for data and workload')
+    parser.add_argument('--db', help='database file to use (default: temporary file)')
+    parser.add_argument('--url', help='benchmark an already running server instead of starting one')
+    parser.add_argument('--username', default=os.getenv('ADMIN_USERNAME', 'admin'))
+    parser.add_argument('--password', default=os.getenv('ADMIN_PASSWORD', 'admin123'))
+    parser.add_argument('--output', help='where to write the JSON results')
+    parser.add_argument('--compare', help='previous JSON results to compare against')
+    parser.add_argument('--label', help='free-form label stored with the results')
+    parser.add_argument('--server', choices=('threaded', 'prefork'), default='threaded',
+                        help='threaded Werkzeug dev server or the serve.py pre-forking server')
+    parser.add_argument('--workers', type=int, default=4, help='worker processes for --server prefork')
+    parser.add_argument('--threads', type=int, default=1, help='threads per worker for --server prefork')
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    server = None
+    tmpdir = None
+
+    if args.url:
+        base_url = args.url.rstrip('/')
+    else:
+        db_path = args.db
+        if not db_path:
+            tmpdir = tempfile.TemporaryDirectory(prefix='hhbc-bench-')
+            db_path = os.path.join(tmpdir.name, 'benchmark.db')
+        print(f"🌱 Seeding {args.metrics} metrics and {args.contacts} contacts into {db_path}")
+        seed_start = time.perf_counter()
+        seed_database(db_path, args.metrics, args.contacts, args.seed, args.days)
+        print(f"   done in {time.perf_counter() - seed_start:.1f}s")
+        if args.server == 'prefork':
+            server, base_url = start_prefork_server(db_path, args.workers, args.threads)
+        else:
+            server, base_url = start_server(db_path)
+
+    try:
+        wait_until_ready(base_url)
+        token = login(base_url, args.username, args.password)
+        print(f"🚀 Running {args.duration}s of load against {base_url} with {args.concurrency} clients")
+        results, elapsed = run_workload(base_url, mix, token, args.duration, args.concurrency, args.seed)
+    finally:
+        if server is not None:
+            stop_server(server)
+        if tmpdir is not None:
+            tmpdir.cleanup()
+
+    print_results(results)
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(),
+            'commit': git_commit(),
+            'label': args.label,
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'target': args.url or f'app_production (local, {args.server})',
+            'server': None if args.url else args.server,
+            'workers': args.workers if args.server == 'prefork' and not args.url else None,
+            'seed_metrics': None if args.url else args.metrics,
+            'seed_contacts': None if args.url else args.contacts,
+            'duration': args.duration,
+            'elapsed': round(elapsed, 3),
+            'concurrency': args.concurrency,
+            'mix': dict(mix),
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        output = os.path.join(RESULTS_DIR, f"{stamp}-{report['meta']['commit'] or 'nogit'}.json")
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\n💾 Results saved to {output}")
+
+    if args.compare:
+        print_comparison(results, args.compare)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Bot and crawler filtering for metric ingestion
+Runs before anything is written: the request's User-Agent is matched against
+one compiled regular expression (one named group per rule) and its address
+against known crawler IP ranges. Both lookups are memoized, so repeated
+clients cost a dict hit.
+
+BOT_EVENTS decides what happens to a match:
+    count (default) - nothing is stored in metrics; bot_event_counts gets +1
+                      for (day, rule)
+    drop            - nothing is stored at all
+    keep            - filtering disabled
+Per-rule hit counts of this process are reported at /internal/bot-filter.
+
+In count mode the counts are added up in memory and written to
+bot_event_counts in one transaction at most every BOT_COUNTS_FLUSH_INTERVAL
+seconds (and at exit), so a crawler burst does not turn into a write per
+request on the hot (day, rule) row. A crash loses at most one interval.
+"""
+import os
+import re
+import time
+import atexit
+import logging
+import threading
+import ipaddress
+from datetime import datetime
+from functools import lru_cache
+
+from flask import jsonify
+
+import database
+
+logger = logging.getLogger(__name__)
+
+# (rule, pattern) over the lowercased User-Agent; specific crawlers before the generic words,
+# which also cover what utils.parse_user_agent calls 'bot'
+USER_AGENT_RULES = [
+    ('googlebot', r'googlebot|google-inspectiontool|adsbot-google|mediapartners-google'),
+    ('bingbot', r'bingbot|bingpreview|msnbot'),
+    ('yandex', r'yandex(?:bot|images|metrika)'),
+    ('baidu', r'baiduspider'),
+    ('duckduckbot', r'duckduckbot'),
+    ('applebot', r'applebot'),
+    ('social_preview', r'facebookexternalhit|facebookcatalog|twitterbot|linkedinbot|slackbot|whatsapp|telegrambot|discordbot'),
+    ('seo_tool', r'ahrefsbot|semrushbot|mj12bot|dotbot|petalbot|bytespider|dataforseobot'),
+    ('ai_crawler', r'gptbot|ccbot|claudebot|anthropic-ai|perplexitybot|amazonbot'),
+    ('monitoring', r'uptimerobot|pingdom|statuscake|site24x7|lighthouse|pagespeed'),
+    ('headless', r'headlesschrome|phantomjs|puppeteer|playwright|selenium'),
+    ('http_library', r'^(?:curl|wget|python-requests|python-urllib|aiohttp|httpx|go-http-client|java|okhttp|axios|node-fetch|libwww-perl|scrapy)\b'),
+    ('generic', r'bot\b|crawler|spider|scraper|crawl'),
+]
+
+# Published crawler ranges (Google, Bing, Apple, Yandex, Baidu); extend with BOT_IP_RANGES
+IP_RULES = [
+    ('googlebot', ('66.249.64.0/19', '2001:4860:4801::/48')),
+    ('bingbot', ('157.55.39.0/24', '207.46.13.0/24', '40.77.167.0/24', '13.66.139.0/24', '52.167.144.0/24')),
+    ('applebot', ('17.241.208.0/20', '17.22.237.0/24')),
+    ('yandex', ('5.255.253.0/24', '213.180.203.0/24', '77.88.5.0/24')),
+    ('baidu', ('180.76.15.0/24', '220.181.108.0/24')),
+]
+
+MODES = ('count', 'drop', 'keep')
+
+_USER_AGENT_RE = re.compile('|'.join(f'(?P<{rule}>{pattern})' for rule, pattern in USER_AGENT_RULES))
+
+
+def _ip_networks():
+    networks = []
+    for rule, ranges in IP_RULES:
+        networks.extend((rule, ipaddress.ip_network(cidr)) for cidr in ranges)
+    for cidr in os.getenv('BOT_IP_RANGES', '').split(','):
+        if cidr.strip():
+            try:
+                networks.append(('ip_range', ipaddress.ip_network(cidr.strip(), strict=False)))
+            except ValueError:
+                logger.warning(f"Ignoring invalid network {cidr!r} in BOT_IP_RANGES")
+    return networks
+
+
+@lru_cache(maxsize=4096)
+def user_agent_rule(user_agent):
+    """Rule matching a User-Agent string, or None for a browser"""
+    if not user_agent or not user_agent.strip():
+        return 'empty_user_agent'
+    match = _USER_AGENT_RE.search(user_agent.lower())
+    return match.lastgroup if match else None
+
+
+class BotFilter:
+    """Classifies ingest requests and counts hits per rule"""
+
+    def __init__(self, mode=None, flush_interval=None):
+        mode = (mode or os.getenv('BOT_EVENTS', 'count')).strip().lower()
+        if mode not in MODES:
+            logger.warning(f"Unknown BOT_EVENTS {mode!r}, using 'count'")
+            mode = 'count'
+        self.mode = mode
+        self.flush_interval = float(flush_interval if flush_interval is not None
+                                    else os.getenv('BOT_COUNTS_FLUSH_INTERVAL', '10'))
+        self.networks = _ip_networks()
+        self.ip_rule = lru_cache(maxsize=4096)(self._ip_rule)
+        self.hits = {}
+        self.checked = 0
+        # {(day, rule): events} not yet written to bot_event_counts
+        self._pending = {}
+        self._flushed_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _ip_rule(self, ip):
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        for rule, network in self.networks:
+            if address.version == network.version and address in network:
+                return rule
+        return None
+
+    def classify(self, user_agent, ip):
+        """Rule name for automated traffic, or None"""
+        return user_agent_rule(user_agent) or (self.ip_rule(ip) if ip else None)
+
+    def check(self, user_agent, ip, events=1):
+        """
+        Classify one ingest request carrying `events` events; returns the
+        matched rule (the caller must not store the events) or None. In count
+        mode the events are added to the pending counts (see flush_due())
+        """
+        if self.mode == 'keep':
+            return None
+        rule = self.classify(user_agent, ip)
+        with self._lock:
+            self.checked += 1
+            if rule is not None:
+                self.hits[rule] = self.hits.get(rule, 0) + events
+                if self.mode == 'count':
+                    key = (datetime.utcnow().strftime('%Y-%m-%d'), rule)
+                    self._pending[key] = self._pending.get(key, 0) + events
+        return rule
+
+    def pending(self):
+        """{(day, rule): events} counted but not written yet"""
+        with self._lock:
+            return dict(self._pending)
+
+    def flush(self, conn):
+        """
+        Write the pending counts to bot_event_counts and commit, on a
+        connection without an open transaction; returns the (day, rule) rows
+        written. On an error the counts stay pending
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._flushed_at = time.monotonic()
+        if not pending:
+            return 0
+        try:
+            conn.executemany('''
+                INSERT INTO bot_event_counts (day, rule, count) VALUES (?, ?, ?)
+                ON CONFLICT (day, rule) DO UPDATE SET count = count + excluded.count
+            ''', [(day, rule, count) for (day, rule), count in pending.items()])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            with self._lock:
+                for key, count in pending.items():
+                    self._pending[key] = self._pending.get(key, 0) + count
+            raise
+        return len(pending)
+
+    def flush_due(self, conn):
+        """flush() once BOT_COUNTS_FLUSH_INTERVAL has passed since the last one; never raises"""
+        with self._lock:
+            if not self._pending or time.monotonic() - self._flushed_at < self.flush_interval:
+                return 0
+        try:
+            return self.flush(conn)
+        except Exception as e:
+            logger.warning(f"Could not write bot event counts (kept for the next flush): {str(e)}")
+            return 0
+
+    def create(self, conn):
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS bot_event_counts (
+                day TEXT NOT NULL,
+                rule TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (day, rule)
+            ) WITHOUT ROWID
+        ''')
+
+    def stats(self):
+        with self._lock:
+            hits = dict(sorted(self.hits.items(), key=lambda item: -item[1]))
+            checked = self.checked
+            pending = len(self._pending)
+        return {
+            'mode': self.mode,
+            'requests_checked': checked,
+            'pending_counts': pending,
+            'hits': hits,
+            'user_agent_cache': user_agent_rule.cache_info()._asdict(),
+            'ip_cache': self.ip_rule.cache_info()._asdict(),
+        }
+
+
+bot_filter = BotFilter()
+
+
+def init_app(app, auth_required, db_path):
+    """
+    Register /internal/bot-filter (per-rule hits and daily counts) and the
+    write of pending counts at exit; db_path is a callable
+    """
+
+    def flush_at_exit():
+        if not bot_filter.pending():
+            return
+        conn = database.connect(db_path())
+        try:
+            bot_filter.flush(conn)
+        except Exception as e:
+            logger.warning(f"Could not write bot event counts at exit: {str(e)}")
+        finally:
+            conn.close()
+
+    atexit.register(flush_at_exit)
+
+    @app.route('/internal/bot-filter', methods=['GET'])
+    @auth_required
+    def bot_filter_report():
+        """Hits per rule in this process and the last 30 days of bot_event_counts"""
+        try:
+            conn = database.connect(db_path())
+            try:
+                rows = conn.execute('''
+                    SELECT day, rule, count FROM bot_event_counts
+                    WHERE day >= date('now', '-30 days')
+                ''').fetchall()
+            finally:
+                conn.close()
+            # Stored counts plus those still pending in this process
+            daily = {(day, rule): count for day, rule, count in rows}
+            for key, count in bot_filter.pending().items():
+                daily[key] = daily.get(key, 0) + count
+            daily = sorted(daily.items(), key=lambda item: (item[0][0], item[1]), reverse=True)
+            return jsonify(dict(bot_filter.stats(),
+                                daily=[{'day': day, 'rule': rule, 'count': count} for (day, rule), count in daily]))
+        except Exception as e:
+            logger.error(f"Error reading bot filter stats: {str(e)}")
+            return jsonify({'error': 'Internal server error'}), 500
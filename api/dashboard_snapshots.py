@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+Precomputed analytics for the dashboard's standard date ranges
+MetricsDashboard asks /metrics/analytics for the last 7, 30 or 90 days or
+for everything, without other filters. Those four answers are materialized
+in dashboard_snapshots by a recurring dashboard.refresh job (every
+DASHBOARD_SNAPSHOT_INTERVAL seconds) and served as they are, with their
+as_of time, while they are younger than DASHBOARD_SNAPSHOT_MAX_AGE.
+
+Refreshes are incremental. Each snapshot keeps its full page, device and
+event type counters, adds the events that entered its window since the last
+refresh and subtracts the ones that left it. The distinct session and user
+counts of the summary cannot be maintained that way and are recomputed, once
+per summary window (`all` has the 30-day summary, like the live path). A
+full rebuild runs every DASHBOARD_SNAPSHOT_REBUILD_HOURS and whenever
+retention or archiving changed which months are stored. Snapshots end
+LAG_SECONDS before the refresh, so events still being committed are counted
+by the next one instead of being skipped.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+from datetime import datetime, timedelta
+
+from flask import jsonify, request
+
+import archive
+import database
+import jobs
+import partitions
+import storage
+
+logger = logging.getLogger(__name__)
+
+# Range name -> days; None is everything
+RANGES = {'7d': 7, '30d': 30, '90d': 90, 'all': None}
+
+# Summary window when no start is given (the live path's default)
+SUMMARY_DAYS = 30
+
+LAG_SECONDS = 10
+
+# How far a start_date/end_date pair may be from an exact standard range and still match it
+# (the dashboard computes them in local time, so a DST change moves the span by an hour)
+MATCH_END_SECONDS = 300
+MATCH_SPAN_SECONDS = 3660
+
+# Breakdown -> (dimension, filters); event counts are sums of sample weights
+BREAKDOWNS = {
+    'top_pages': ('page_url', {'event_type': 'page_view'}),
+    'device_breakdown': ('device_type', {}),
+    'event_types': ('event_type', {}),
+}
+TOP_PAGES = 10
+
+
+def interval():
+    return float(os.getenv('DASHBOARD_SNAPSHOT_INTERVAL', '300') or 300)
+
+
+def max_age():
+    return float(os.getenv('DASHBOARD_SNAPSHOT_MAX_AGE', '900') or 900)
+
+
+def rebuild_seconds():
+    return float(os.getenv('DASHBOARD_SNAPSHOT_REBUILD_HOURS', '24') or 24) * 3600
+
+
+def create(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS dashboard_snapshots (
+            range TEXT PRIMARY KEY,
+            start TEXT,
+            as_of TEXT NOT NULL,
+            summary TEXT NOT NULL,
+            counters TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            computed_at REAL NOT NULL,
+            rebuilt_at REAL NOT NULL,
+            duration_ms REAL NOT NULL
+        )
+    ''')
+
+
+def range_start(name, now=None):
+    """Start of a standard range as a stored timestamp (the range is open-ended); None for all"""
+    days = RANGES[name]
+    if days is None:
+        return None
+    return partitions.format_timestamp((now or datetime.utcnow()) - timedelta(days=days))
+
+
+def match(start, end, requested=None, now=None):
+    """
+    Standard range asked for by range=<name>, or by a start/end pair (parsed
+    bounds) spanning one and ending now; None for custom ranges
+    """
+    if requested is not None:
+        return requested if requested in RANGES and start is None and end is None else None
+    if start is None and end is None:
+        return 'all'
+    if start is None or end is None:
+        return None
+    now = now or datetime.utcnow()
+    start, end = archive.parse_timestamp(start), archive.parse_timestamp(end)
+    if abs(end - now.timestamp()) > MATCH_END_SECONDS:
+        return None
+    for name, days in RANGES.items():
+        if days is not None and abs(end - start - days * 86400) <= MATCH_SPAN_SECONDS:
+            return name
+    return None
+
+
+def fingerprint(conn):
+    """Changes when retention or archiving changed which months are stored"""
+    months = partitions.metrics_partitions.months(conn)
+    files = archive.store_for(archive.default_directory(conn.path)).files(conn)
+    return json.dumps([months[:1], sorted(os.path.basename(f.path) for f in files)])
+
+
+def _apply(counter, rows, sign):
+    for value, count in rows:
+        total = counter.get(value, 0) + sign * count
+        if abs(total) < 1e-9:
+            counter.pop(value, None)
+        else:
+            counter[value] = total
+
+
+def _ranked(counter, limit=None):
+    return archive.merge_counts(counter.items(), {}, limit=limit)
+
+
+def refresh(conn, now=None, full=False):
+    """Bring every snapshot up to now - LAG_SECONDS; returns {range: 'full' | 'delta'}"""
+    metrics = storage.SQLiteStorage.metrics
+    as_of_time = (now or datetime.utcnow()) - timedelta(seconds=LAG_SECONDS)
+    as_of = partitions.format_timestamp(as_of_time)
+    current = fingerprint(conn)
+    stored = {row[0]: row[1:] for row in conn.execute(
+        'SELECT range, start, as_of, counters, fingerprint, rebuilt_at FROM dashboard_snapshots')}
+
+    # Read everything first, then write in one short transaction
+    summaries = {}
+    rows = []
+    modes = {}
+    for name, days in RANGES.items():
+        started = time.perf_counter()
+        start = partitions.format_timestamp(as_of_time - timedelta(days=days)) if days else None
+        since = start or partitions.format_timestamp(as_of_time - timedelta(days=SUMMARY_DAYS))
+        if since not in summaries:
+            summaries[since] = metrics.summary(conn, since, as_of)
+
+        previous = stored.get(name)
+        rebuild = (full or previous is None or previous[3] != current or previous[4] < time.time() - rebuild_seconds()
+                   or previous[1] > as_of or (start is not None and previous[1] <= start))
+        if rebuild:
+            counters = {key: dict(metrics.count_by(conn, column, start, as_of, filters))
+                        for key, (column, filters) in BREAKDOWNS.items()}
+            rebuilt_at = time.time()
+        else:
+            previous_start, previous_as_of = previous[0], previous[1]
+            counters = json.loads(previous[2])
+            for key, (column, filters) in BREAKDOWNS.items():
+                _apply(counters[key], metrics.count_by(conn, column, previous_as_of, as_of, filters), 1)
+                if start is not None:
+                    _apply(counters[key], metrics.count_by(conn, column, previous_start, start, filters), -1)
+            rebuilt_at = previous[4]
+        modes[name] = 'full' if rebuild else 'delta'
+        rows.append((name, start, as_of, json.dumps(summaries[since]), json.dumps(counters), current, time.time(),
+                     rebuilt_at, round((time.perf_counter() - started) * 1000, 3)))
+
+    conn.execute('BEGIN IMMEDIATE')
+    conn.executemany('''
+        INSERT OR REPLACE INTO dashboard_snapshots
+            (range, start, as_of, summary, counters, fingerprint, computed_at, rebuilt_at, duration_ms)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+    conn.commit()
+    return modes
+
+
+def load(conn, name):
+    """
+    (summary, top_pages, device_breakdown, event_types, freshness) of a
+    snapshot, or None when there is none younger than DASHBOARD_SNAPSHOT_MAX_AGE
+    """
+    row = conn.execute('SELECT summary, counters, as_of, computed_at FROM dashboard_snapshots WHERE range = ?',
+                       (name,)).fetchone()
+    if row is None or row[3] < time.time() - max_age():
+        return None
+    counters = json.loads(row[1])
+    freshness = {'range': name, 'as_of': row[2].replace(' ', 'T'),
+                 'computed_at': datetime.utcfromtimestamp(row[3]).isoformat(),
+                 'age_seconds': round(time.time() - row[3], 1)}
+    return (json.loads(row[0]), _ranked(counters['top_pages'], TOP_PAGES), _ranked(counters['device_breakdown']),
+            _ranked(counters['event_types']), freshness)
+
+
+def status(conn):
+    """Freshness of every stored snapshot"""
+    rows = conn.execute('SELECT range, as_of, computed_at, rebuilt_at, duration_ms FROM dashboard_snapshots').fetchall()
+    return [{'range': name, 'as_of': as_of.replace(' ', 'T'),
+             'computed_at': datetime.utcfromtimestamp(computed_at).isoformat(),
+             'rebuilt_at': datetime.utcfromtimestamp(rebuilt_at).isoformat(),
+             'age_seconds': round(time.time() - computed_at, 1), 'duration_ms': duration_ms}
+            for name, as_of, computed_at, rebuilt_at, duration_ms in sorted(rows, key=lambda r: list(RANGES).index(r[0]))]
+
+
+_scheduled_at = 0.0
+
+
+def schedule():
+    """Make sure a refresh is queued (at most one check a minute per process)"""
+    global _scheduled_at
+    if time.monotonic() - _scheduled_at < 60:
+        return
+    _scheduled_at = time.monotonic()
+    try:
+        jobs.runner.submit('dashboard.refresh', unique=True)
+    except Exception as e:
+        logger.error(f"Could not schedule dashboard snapshots: {str(e)}")
+
+
+@jobs.handler('dashboard.refresh', max_attempts=1)
+def refresh_job(job, full=False):
+    """Refresh the snapshots, then queue the next refresh"""
+    conn = database.connect(job.db_path, timeout=30)
+    try:
+        modes = refresh(conn, full=bool(full))
+    finally:
+        conn.close()
+        job.broker.enqueue('dashboard.refresh', priority='low', delay=interval(), unique=True)
+    return {'ranges': modes}
+
+
+def init_app(app, auth_required, db_path):
+    """Register /internal/dashboard-snapshots; db_path is a callable"""
+
+    @app.route('/internal/dashboard-snapshots', methods=['GET'])
+    @auth_required
+    def snapshot_status():
+        """Freshness of each snapshot and the refresh settings"""
+        try:
+            conn = database.connect(db_path())
+            try:
+                snapshots = status(conn)
+            finally:
+                conn.close()
+            return jsonify({'snapshots': snapshots, 'interval_seconds': interval(), 'max_age_seconds': max_age(),
+                            'rebuild_hours': rebuild_seconds() / 3600})
+        except Exception as e:
+            logger.error(f"Error reading dashboard snapshots: {str(e)}")
+            return jsonify({'error': 'Internal server error'}), 500
+
+    @app.route('/internal/dashboard-snapshots', methods=['POST'])
+    @auth_required
+    def refresh_snapshots():
+        """Queue a refresh now (full=1 rebuilds); 202 with the job"""
+        try:
+            job = jobs.runner.submit('dashboard.refresh', {'full': request.args.get('full') in ('1', 'true')}, 'high')
+        except Exception as e:
+            logger.error(f"Error queueing dashboard snapshot refresh: {str(e)}")
+            return jsonify({'error': 'Internal server error'}), 500
+        response = jsonify(jobs.public(job))
+        response.status_code = 202
+        response.headers['Location'] = f"/internal/jobs/{job['id']}"
+        return response
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Refresh and inspect the dashboard snapshots')
+    parser.add_argument('command', choices=['list', 'refresh'])
+    parser.add_argument('--db', default=os.getenv('DATABASE_URL', 'consultoria.db').replace('sqlite:///', ''),
+                        help='SQLite database file')
+    parser.add_argument('--full', action='store_true', help='refresh: rebuild instead of applying deltas')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    conn = database.connect(args.db)
+    try:
+        if args.command == 'refresh':
+            started = time.perf_counter()
+            modes = refresh(conn, full=args.full)
+            print(f"📸 Snapshots refreshed in {(time.perf_counter() - started) * 1000:.0f} ms: "
+                  f"{', '.join(f'{name} ({mode})' for name, mode in modes.items())}")
+        for entry in status(conn):
+            print(f"   {entry['range']:<5} as of {entry['as_of']}  {entry['age_seconds']:>8.0f}s old  "
+                  f"{entry['duration_ms']:>8.1f} ms")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
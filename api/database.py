@@ -0,0 +1,156 @@
+"""
+SQLite connection helpers for the HHBC Consultancy backends
+Connections opened through connect() report every statement to the
+registered query listeners (request DB time, slow-query log)
+"""
+import time
+import sqlite3
+import logging
+
+logger = logging.getLogger(__name__)
+
+_query_listeners = []
+
+
+def add_query_listener(listener):
+    """
+    Register listener(connection, sql, params, seconds, phase), called after every
+    statement. phase is 'execute', 'executemany' or 'fetch' (row retrieval of
+    `sql`); connection is the underlying sqlite3 (or DBAPI) connection.
+    """
+    if listener not in _query_listeners:
+        _query_listeners.append(listener)
+
+
+def remove_query_listener(listener):
+    if listener in _query_listeners:
+        _query_listeners.remove(listener)
+
+
+def _notify(connection, sql, params, seconds, phase):
+    for listener in _query_listeners:
+        try:
+            listener(connection, sql, params, seconds, phase)
+        except Exception as e:
+            logger.error(f"Query listener error: {str(e)}")
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that times statements and row fetches when listeners are registered"""
+
+    _sql = None
+    _params = None
+
+    def execute(self, sql, parameters=()):
+        if not _query_listeners:
+            return super().execute(sql, parameters)
+        self._sql = sql
+        self._params = parameters
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _notify(self.connection, sql, parameters, time.perf_counter() - start, 'execute')
+
+    def executemany(self, sql, seq_of_parameters):
+        if not _query_listeners:
+            return super().executemany(sql, seq_of_parameters)
+        self._sql = sql
+        self._params = None
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _notify(self.connection, sql, None, time.perf_counter() - start, 'executemany')
+
+    def _timed_fetch(self, fetch, *args):
+        if not _query_listeners or self._sql is None:
+            return fetch(*args)
+        start = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            _notify(self.connection, self._sql, self._params, time.perf_counter() - start, 'fetch')
+
+    def fetchone(self):
+        return self._timed_fetch(super().fetchone)
+
+    def fetchmany(self, size=None):
+        if size is None:
+            return self._timed_fetch(super().fetchmany)
+        return self._timed_fetch(super().fetchmany, size)
+
+    def fetchall(self):
+        return self._timed_fetch(super().fetchall)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection whose cursors (including execute() shortcuts) are instrumented"""
+
+    _transaction_callbacks = ()
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def after_transaction(self, callback):
+        """Call callback(committed) when the open transaction commits or rolls back"""
+        self._transaction_callbacks = self._transaction_callbacks + (callback,)
+
+    def _end_transaction(self, committed):
+        callbacks, self._transaction_callbacks = self._transaction_callbacks, ()
+        for callback in callbacks:
+            callback(committed)
+
+    def commit(self):
+        super().commit()
+        self._end_transaction(True)
+
+    def rollback(self):
+        super().rollback()
+        self._end_transaction(False)
+
+    def close(self):
+        # Closing with a transaction open discards it
+        super().close()
+        self._end_transaction(False)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def connect(path, **kwargs):
+    """Open an instrumented SQLite connection; conn.path is the database file it was opened with"""
+    conn = sqlite3.connect(path, factory=InstrumentedConnection, **kwargs)
+    conn.path = path
+    return conn
+
+
+def instrument_sqlalchemy():
+    """Report statements from every SQLAlchemy engine to the query listeners"""
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    if getattr(instrument_sqlalchemy, 'installed', False):
+        return
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info['query_start'].pop()
+        if _query_listeners:
+            _notify(cursor.connection, statement, None if executemany else parameters,
+                    time.perf_counter() - start, 'executemany' if executemany else 'execute')
+
+    @event.listens_for(Engine, 'handle_error')
+    def _handle_error(exception_context):
+        conn = exception_context.connection
+        if conn is not None and conn.info.get('query_start'):
+            conn.info['query_start'].pop()
+
+    instrument_sqlalchemy.installed = True
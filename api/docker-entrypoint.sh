@@ -36,17 +36,6 @@ except Exception as e:
 PY
 fi
 
-# Initialize database
-echo "🔧 Initializing database..."
-python -c "
-import sys
-sys.path.append('/app')
-from app_production import init_db, create_default_admin, create_sample_data
-init_db()
-create_default_admin()
-create_sample_data()
-print('✅ Database initialization complete!')
-"
-
-echo "🌐 Starting Gunicorn WSGI server..."
-exec gunicorn --bind 0.0.0.0:5000 --workers 4 --timeout 120 --access-logfile - --error-logfile - app_production:app
\ No newline at end of file
+# serve.py initializes the database once in the master, then forks the workers
+echo "🌐 Starting pre-forking WSGI server..."
+exec python serve.py --bind 0.0.0.0:5000 --workers "${WEB_CONCURRENCY:-4}" --sample-data
@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+"""
+Synthetic data generator for the HHBC Consultancy backend
+Bulk-loads realistic metrics, sessions and contact requests into either the
+raw-sqlite schema (app_production.py) or the SQLAlchemy schema (models.py)
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import calendar
+import random
+import argparse
+from datetime import datetime, timedelta
+
+import database
+import partitions
+
+# Site pages ranked by popularity; traffic follows a Zipf distribution over this list
+PAGES = [
+    '/', '/servicios', '/contacto', '/nosotros', '/servicios/legal', '/servicios/it',
+    '/servicios/contable', '/blog', '/blog/transformacion-digital', '/blog/ley-de-datos-personales',
+    '/blog/impuestos-pyme', '/equipo', '/casos-de-exito', '/preguntas-frecuentes',
+    '/blog/ciberseguridad', '/blog/contabilidad-remota', '/politica-de-privacidad', '/terminos',
+    '/servicios/legal/contratos', '/servicios/it/cloud', '/servicios/contable/auditoria',
+    '/blog/factura-electronica', '/blog/teletrabajo', '/trabaja-con-nosotros',
+]
+ZIPF_EXPONENT = 1.1
+
+# (device, weight, [(browser, weight), ...])
+DEVICE_MIX = [
+    ('desktop', 55, [('Chrome', 64), ('Edge', 14), ('Safari', 10), ('Firefox', 10), ('Opera', 2)]),
+    ('mobile', 40, [('Chrome', 58), ('Safari', 36), ('Samsung Internet', 4), ('Firefox', 2)]),
+    ('tablet', 5, [('Safari', 60), ('Chrome', 38), ('Firefox', 2)]),
+]
+
+USER_AGENTS = {
+    'desktop': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36',
+    'mobile': 'Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) AppleWebKit/605.1.15 Mobile/15E148',
+    'tablet': 'Mozilla/5.0 (iPad; CPU OS 17_0 like Mac OS X) AppleWebKit/605.1.15 Mobile/15E148',
+}
+
+REFERRERS = [
+    (None, 35), ('https://www.google.com/', 40), ('https://www.linkedin.com/', 10),
+    ('https://www.facebook.com/', 6), ('https://www.bing.com/', 4), ('https://www.instagram.com/', 5),
+]
+
+COUNTRIES = [('Chile', 78), ('Argentina', 6), ('Perú', 5), ('Colombia', 4), ('México', 4), ('España', 3)]
+
+# Relative traffic per hour of day (local business hours peak, quiet nights)
+DIURNAL_WEIGHTS = [
+    1.0, 0.6, 0.4, 0.3, 0.3, 0.5, 1.2, 2.5, 4.5, 6.5, 7.5, 7.8,
+    7.0, 6.2, 7.0, 7.4, 7.0, 6.0, 4.8, 4.0, 3.6, 3.0, 2.2, 1.5,
+]
+# Monday..Sunday
+WEEKDAY_WEIGHTS = [1.15, 1.2, 1.15, 1.1, 1.0, 0.55, 0.45]
+
+# Events after the landing page_view within a session
+FOLLOWUP_EVENTS = [('page_view', 55), ('click', 22), ('scroll', 18), ('form_start', 3), ('form_submit', 2)]
+MEAN_SESSION_LENGTH = 4.0
+
+FIRST_NAMES = [
+    'Juan', 'María', 'José', 'Francisca', 'Matías', 'Camila', 'Benjamín', 'Valentina', 'Diego',
+    'Catalina', 'Sebastián', 'Fernanda', 'Tomás', 'Javiera', 'Felipe', 'Constanza', 'Ignacio',
+    'Daniela', 'Cristóbal', 'Antonia', 'Rodrigo', 'Paula', 'Andrés', 'Carolina',
+]
+LAST_NAMES = [
+    'González', 'Muñoz', 'Rojas', 'Díaz', 'Pérez', 'Soto', 'Contreras', 'Silva', 'Martínez',
+    'Sepúlveda', 'Morales', 'Rodríguez', 'López', 'Fuentes', 'Hernández', 'Torres', 'Araya',
+    'Flores', 'Espinoza', 'Valenzuela', 'Castillo', 'Tapia', 'Reyes', 'Gutiérrez',
+]
+COMPANY_PREFIXES = ['Inversiones', 'Comercial', 'Constructora', 'Transportes', 'Servicios', 'Agrícola', 'Tecnología', 'Importadora']
+COMPANY_NAMES = ['del Sur', 'Andina', 'Pacífico', 'Los Robles', 'Cordillera', 'Austral', 'Nova', 'Horizonte', 'Maipo', 'Atacama']
+COMPANY_SUFFIXES = ['SpA', 'Ltda.', 'S.A.', 'EIRL']
+
+LEAD_TOPICS = [
+    ('legal', 'Asesoría Legal', [
+        'Necesitamos revisar los contratos con nuestros proveedores antes de renovarlos.',
+        'Queremos constituir una nueva sociedad y no sabemos qué tipo nos conviene.',
+        'Tenemos dudas sobre el cumplimiento de la nueva ley de protección de datos personales.',
+        'Recibimos una demanda laboral y buscamos orientación para responderla.',
+    ]),
+    ('it', 'Consultoría en Transformación Digital', [
+        'Estamos evaluando migrar nuestros sistemas a la nube y necesitamos un diagnóstico.',
+        'Queremos mejorar la ciberseguridad de la empresa después de un intento de phishing.',
+        'Buscamos apoyo para implementar un ERP y capacitar a nuestro equipo.',
+        'Nuestra página web es lenta y queremos modernizar la infraestructura.',
+    ]),
+    ('contable', 'Servicios Contables', [
+        'Necesitamos externalizar la contabilidad mensual y las declaraciones de IVA.',
+        'Queremos una auditoría de nuestros estados financieros del último año.',
+        'Tenemos atrasos con la factura electrónica y requerimos regularizar la situación.',
+        'Buscamos planificación tributaria para el próximo ejercicio.',
+    ]),
+    ('general', 'Análisis de Negocio', [
+        'Nos interesa un análisis de nuestro modelo de negocio para expandirnos a regiones.',
+        'Queremos conocer sus servicios y tarifas para una pyme de 20 personas.',
+    ]),
+]
+MESSAGE_CLOSINGS = [
+    'Quedo atento a su respuesta.', 'Agradecería que me contactaran a la brevedad.',
+    '¿Podrían enviarme una cotización?', 'Me acomoda una reunión por videollamada.', '',
+]
+URGENCIES = [('low', 25), ('medium', 50), ('high', 25)]
+BUDGET_RANGES = [('<$1k', 15), ('$1k-$5k', 35), ('$5k-$20k', 30), ('$10k-$50k', 15), ('>$50k', 5)]
+
+
+def _weights(pairs):
+    return [value for value, _ in pairs], [weight for _, weight in pairs]
+
+
+def _cumulative(weights):
+    total = 0.0
+    cumulative = []
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    return cumulative
+
+
+def zipf_weights(n, exponent=ZIPF_EXPONENT):
+    """Relative Zipf weights for ranks 1..n"""
+    return [1.0 / (rank ** exponent) for rank in range(1, n + 1)]
+
+
+class Generator:
+    """Deterministic synthetic traffic for a given seed"""
+
+    def __init__(self, schema='raw', seed=42, days=365, end=None):
+        self.schema = schema
+        self.rng = random.Random(seed)
+        self.days = days
+        self.end = (end or datetime.utcnow()).replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+        self.start = self.end - timedelta(days=days)
+
+        self.page_cum = _cumulative(zipf_weights(len(PAGES)))
+        self.hour_cum = _cumulative(DIURNAL_WEIGHTS)
+        self.devices, device_weights = _weights([(d, w) for d, w, _ in DEVICE_MIX])
+        self.device_cum = _cumulative(device_weights)
+        self.browsers = {d: _weights(browsers) for d, _, browsers in DEVICE_MIX}
+        self.referrers, self.referrer_weights = _weights(REFERRERS)
+        self.countries, self.country_weights = _weights(COUNTRIES)
+        followups, followup_weights = _weights(FOLLOWUP_EVENTS)
+        if schema == 'models':
+            followups = ['contact_form_submit' if e == 'form_submit' else e for e in followups]
+        self.followups = followups
+        self.followup_cum = _cumulative(followup_weights)
+
+        # Constant payloads are serialized once, not per row
+        self.custom_data = {
+            'form_submit': json.dumps({'form_type': 'contact', 'success': True}),
+            'contact_form_submit': json.dumps({'form_type': 'contact', 'success': True}),
+            'form_start': json.dumps({'form_type': 'contact'}),
+            'scroll': json.dumps({'depth': 75}),
+        }
+
+    def day_budgets(self, total_events):
+        """Split total_events over the days, weighted by weekday"""
+        weights = [WEEKDAY_WEIGHTS[(self.start + timedelta(days=d)).weekday()] for d in range(self.days)]
+        scale = total_events / sum(weights)
+        budgets = [int(w * scale) for w in weights]
+        budgets[-1] += total_events - sum(budgets)
+        return budgets
+
+    def session_starts(self, day_start, count):
+        """Sorted epoch seconds for `count` sessions, following the diurnal curve"""
+        rng = self.rng
+        hours = rng.choices(range(24), cum_weights=self.hour_cum, k=count)
+        base = calendar.timegm(day_start.timetuple())
+        return sorted(base + h * 3600 + rng.randrange(3600) for h in hours)
+
+    def events(self, total_events):
+        """
+        Yield (session, events) where session is a dict and events is a list of
+        (event_type, page_url, epoch_seconds, custom_data) tuples
+        """
+        rng = self.rng
+        n_users = max(total_events // 12, 1)
+        mean_extra = MEAN_SESSION_LENGTH - 1
+        for day_index, budget in enumerate(self.day_budgets(total_events)):
+            if budget <= 0:
+                continue
+            day_start = self.start + timedelta(days=day_index)
+            lengths = []
+            remaining = budget
+            while remaining > 0:
+                length = min(1 + int(rng.expovariate(1.0 / mean_extra)), remaining, 60)
+                lengths.append(length)
+                remaining -= length
+            starts = self.session_starts(day_start, len(lengths))
+            for start, length in zip(starts, lengths):
+                # Returning visitors: low user ids are much more frequent
+                user = int(n_users * rng.random() ** 2)
+                device = rng.choices(self.devices, cum_weights=self.device_cum)[0]
+                browsers, browser_weights = self.browsers[device]
+                session = {
+                    'session_id': '%016x' % rng.getrandbits(64),
+                    'user_id': f"user_{user}",
+                    'device_type': device,
+                    'browser': rng.choices(browsers, browser_weights)[0],
+                    'ip_address': f"190.{(user >> 16) & 255}.{(user >> 8) & 255}.{user & 255}",
+                    'referrer': rng.choices(self.referrers, self.referrer_weights)[0],
+                    'country': rng.choices(self.countries, self.country_weights)[0],
+                    'user_agent': USER_AGENTS[device],
+                    'start': start,
+                }
+
+                pages = rng.choices(PAGES, cum_weights=self.page_cum, k=length)
+                types = ['page_view']
+                if length > 1:
+                    types += rng.choices(self.followups, cum_weights=self.followup_cum, k=length - 1)
+                ts = start
+                events = []
+                for event_type, page in zip(types, pages):
+                    events.append((event_type, page, ts, self.custom_data.get(event_type)))
+                    ts += 5 + int(rng.expovariate(1 / 40.0))
+                session['end'] = ts
+                yield session, events
+
+    def contact(self, created):
+        """One Spanish-language contact request created at `created` (datetime)"""
+        rng = self.rng
+        first = rng.choice(FIRST_NAMES)
+        last = rng.choice(LAST_NAMES)
+        company = f"{rng.choice(COMPANY_PREFIXES)} {rng.choice(COMPANY_NAMES)} {rng.choice(COMPANY_SUFFIXES)}"
+        topic, subject, bodies = rng.choice(LEAD_TOPICS)
+        message = f"Hola, mi nombre es {first} {last} de {company}. {rng.choice(bodies)} {rng.choice(MESSAGE_CLOSINGS)}".strip()
+        email_user = f"{first}.{last}".lower().translate(str.maketrans('áéíóúñ', 'aeioun'))
+        age_days = (self.end - created).days
+        if age_days > 30:
+            status = rng.choices(['resolved', 'closed', 'in_progress'], [55, 40, 5])[0]
+        elif age_days > 7:
+            status = rng.choices(['new', 'in_progress', 'resolved', 'closed'], [15, 40, 30, 15])[0]
+        else:
+            status = rng.choices(['new', 'in_progress'], [75, 25])[0]
+        return {
+            'first_name': first,
+            'last_name': last,
+            'email': f"{email_user}{rng.randrange(100)}@{rng.choice(['gmail.com', 'empresa.cl', 'outlook.com'])}",
+            'phone': f"+569{rng.randrange(10 ** 7, 10 ** 8)}",
+            'company': company,
+            'topic': topic,
+            'subject': subject,
+            'message': message,
+            'status': status,
+            'urgency': rng.choices(*_weights(URGENCIES))[0],
+            'budget_range': rng.choices(*_weights(BUDGET_RANGES))[0],
+            'created': created,
+        }
+
+    def contacts(self, count):
+        """Contact requests spread over the range, in chronological order"""
+        span = (self.end - self.start).total_seconds()
+        offsets = sorted(self.rng.random() * span for _ in range(count))
+        for offset in offsets:
+            yield self.contact(self.start + timedelta(seconds=offset))
+
+
+def _format_ts(epoch, fmt_cache={}):
+    """Fast 'YYYY-MM-DD HH:MM:SS' formatting with a per-day prefix cache"""
+    day, seconds = divmod(epoch, 86400)
+    prefix = fmt_cache.get(day)
+    if prefix is None:
+        prefix = fmt_cache[day] = datetime.utcfromtimestamp(day * 86400).strftime('%Y-%m-%d ')
+    h, rem = divmod(seconds, 3600)
+    m, s = divmod(rem, 60)
+    return f"{prefix}{h:02d}:{m:02d}:{s:02d}"
+
+
+def create_schema(db_path, schema):
+    """Create the target tables using the owning application's own DDL"""
+    if schema == 'raw':
+        os.environ['DATABASE_URL'] = db_path
+        import app_production
+        app_production.DB_PATH = db_path
+        app_production.init_db()
+    else:
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.abspath(db_path)
+        from app import app, db
+        app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DATABASE_URL']
+        with app.app_context():
+            db.create_all()
+
+
+def _bulk_connection(db_path):
+    # database.connect: the lookup-id cache (lookups.py) is keyed by conn.path and commits
+    conn = database.connect(db_path)
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('PRAGMA journal_mode = MEMORY')
+    conn.execute('PRAGMA cache_size = -262144')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    return conn
+
+
+RAW_SQL = {
+    # Rows are in partitions.INSERT_COLUMNS order; partitions.insert_many interns the strings
+    # and routes each row to the monthly partition of its timestamp
+    'metrics': None,
+    'sessions': '''
+        INSERT OR IGNORE INTO user_sessions (session_id, user_id, ip_address, user_agent, device_type, browser, first_seen, last_seen)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''',
+    'contacts': '''
+        INSERT INTO contact_requests (name, email, phone, company, subject, message, status, ip_address, user_agent, referrer, custom_data, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''',
+}
+
+MODELS_SQL = {
+    'metrics': '''
+        INSERT INTO metrics (event_type, page_url, user_id, session_id, ip_address, user_agent, referrer, timestamp, country, device_type, additional_data)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''',
+    'sessions': '''
+        INSERT OR IGNORE INTO user_sessions (id, user_id, started_at, last_activity, ip_address, user_agent, device_info, is_active)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''',
+    'contacts': '''
+        INSERT INTO contact_requests (id, first_name, last_name, email, phone, company, subject, message, status, priority, created_at, updated_at, responded_at, source)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''',
+}
+
+
+def _metric_rows(schema, session, events):
+    s = session
+    if schema == 'raw':
+        return [
+            (event_type, page, s['user_id'], s['session_id'], s['device_type'], s['browser'],
+             s['ip_address'], s['referrer'], custom, _format_ts(ts))
+            for event_type, page, ts, custom in events
+        ]
+    return [
+        (event_type, page, s['user_id'], s['session_id'], s['ip_address'], s['user_agent'],
+         s['referrer'], _format_ts(ts) + '.000000', s['country'], s['device_type'], custom)
+        for event_type, page, ts, custom in events
+    ]
+
+
+def _session_row(schema, s):
+    if schema == 'raw':
+        return (s['session_id'], s['user_id'], s['ip_address'], s['user_agent'], s['device_type'],
+                s['browser'], _format_ts(s['start']), _format_ts(s['end']))
+    return (s['session_id'], s['user_id'], _format_ts(s['start']) + '.000000', _format_ts(s['end']) + '.000000',
+            s['ip_address'], s['user_agent'],
+            json.dumps({'device_type': s['device_type'], 'browser': s['browser']}), 0)
+
+
+def _contact_row(schema, c, rng):
+    created = c['created'].strftime('%Y-%m-%d %H:%M:%S')
+    if schema == 'raw':
+        custom = json.dumps({'form_type': c['topic'], 'urgency': c['urgency'], 'budget_range': c['budget_range']})
+        ip = f"200.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(1, 255)}"
+        return (f"{c['first_name']} {c['last_name']}", c['email'], c['phone'], c['company'], c['subject'],
+                c['message'], c['status'], ip, USER_AGENTS['desktop'], 'https://hhbc.com/contacto', custom,
+                created, created)
+    created_us = created + '.000000'
+    responded = None
+    if c['status'] in ('resolved', 'closed'):
+        responded = (c['created'] + timedelta(hours=rng.randint(2, 72))).strftime('%Y-%m-%d %H:%M:%S.000000')
+    return (str(uuid.UUID(int=rng.getrandbits(128), version=4)), c['first_name'], c['last_name'], c['email'],
+            c['phone'], c['company'], c['topic'], c['message'], c['status'], c['urgency'], created_us,
+            responded or created_us, responded, 'website')
+
+
+def generate(db_path, events, contacts=None, schema='raw', seed=42, days=365, end=None,
+             batch_size=50000, create=True, progress=None):
+    """
+    Bulk-load `events` metrics (plus their sessions) and `contacts` contact
+    requests into db_path. Returns a dict with row counts and timings.
+    """
+    if contacts is None:
+        contacts = max(events // 2000, 1)
+    if create:
+        create_schema(db_path, schema)
+
+    sql = RAW_SQL if schema == 'raw' else MODELS_SQL
+    gen = Generator(schema=schema, seed=seed, days=days, end=end)
+    conn = _bulk_connection(db_path)
+    started = time.perf_counter()
+
+    metric_batch = []
+    session_batch = []
+    written = 0
+    sessions = 0
+
+    def flush():
+        if schema == 'raw':
+            partitions.metrics_partitions.insert_many(conn, metric_batch)
+        else:
+            conn.executemany(sql['metrics'], metric_batch)
+        conn.executemany(sql['sessions'], session_batch)
+        conn.commit()
+        metric_batch.clear()
+        session_batch.clear()
+
+    conn.execute('BEGIN')
+    for session, session_events in gen.events(events):
+        metric_batch.extend(_metric_rows(schema, session, session_events))
+        session_batch.append(_session_row(schema, session))
+        sessions += 1
+        if len(metric_batch) >= batch_size:
+            written += len(metric_batch)
+            flush()
+            conn.execute('BEGIN')
+            if progress:
+                progress(written, events, time.perf_counter() - started)
+    written += len(metric_batch)
+    flush()
+    metrics_elapsed = time.perf_counter() - started
+
+    contact_rows = [_contact_row(schema, c, gen.rng) for c in gen.contacts(contacts)]
+    conn.executemany(sql['contacts'], contact_rows)
+    conn.commit()
+    conn.close()
+
+    return {
+        'schema': schema,
+        'metrics': written,
+        'sessions': sessions,
+        'contacts': len(contact_rows),
+        'seconds': round(time.perf_counter() - started, 2),
+        'metrics_per_second': round(written / metrics_elapsed) if metrics_elapsed else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic HHBC traffic and leads')
+    parser.add_argument('--db', default='consultoria.db', help='SQLite database file to fill')
+    parser.add_argument('--schema', choices=['raw', 'models'], default='raw',
+                        help='raw: app_production.py tables, models: SQLAlchemy models.py tables')
+    parser.add_argument('--events', type=int, default=1000000, help='metric events to generate')
+    parser.add_argument('--contacts', type=int, help='contact requests (default: events / 2000)')
+    parser.add_argument('--days', type=int, default=365, help='days of history ending today')
+    parser.add_argument('--end', type=lambda v: datetime.strptime(v, '%Y-%m-%d'),
+                        help='last day of history, YYYY-MM-DD (default: today; fix it for byte-identical runs)')
+    parser.add_argument('--seed', type=int, default=42, help='RNG seed for deterministic output')
+    parser.add_argument('--batch-size', type=int, default=50000, help='rows per transaction')
+    args = parser.parse_args()
+
+    def progress(done, total, elapsed):
+        print(f"   {done:>12,} / {total:,} events  ({done / elapsed:,.0f}/s)", flush=True)
+
+    print(f"🌱 Generating {args.events:,} events over {args.days} days into {args.db} ({args.schema} schema, seed {args.seed})")
+    stats = generate(args.db, args.events, args.contacts, schema=args.schema, seed=args.seed,
+                     days=args.days, end=args.end, batch_size=args.batch_size, progress=progress)
+    print(f"✅ {stats['metrics']:,} metrics, {stats['sessions']:,} sessions, {stats['contacts']:,} contacts "
+          f"in {stats['seconds']}s ({stats['metrics_per_second']:,} events/s)")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Idempotency keys for ingestion endpoints
+A client-supplied key (Idempotency-Key header, or event_id in the body) is
+stored in idempotency_keys together with the response it produced, in the
+same transaction as the row it guards. A retry with the same key gets the
+original response back and nothing is inserted twice.
+
+Recent keys are also kept in a bounded in-process map so most retries are
+answered without touching the database; the (scope, key) primary key is
+what makes deduplication hold across workers. Keys expire after
+IDEMPOTENCY_WINDOW_HOURS (default 24).
+"""
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+MAX_KEY_LENGTH = 255
+
+# Expired keys are deleted once every this many recorded keys
+PRUNE_EVERY = 1000
+
+
+def window_seconds():
+    return float(os.getenv('IDEMPOTENCY_WINDOW_HOURS', '24') or 24) * 3600
+
+
+def request_key(headers, data):
+    """Idempotency-Key header or event_id field; None when absent, ValueError when unusable"""
+    key = headers.get('Idempotency-Key')
+    if key is None and isinstance(data, dict):
+        key = data.get('event_id')
+    if key is None:
+        return None
+    key = str(key).strip()
+    if not key or len(key) > MAX_KEY_LENGTH:
+        raise ValueError(f'Idempotency key must be 1-{MAX_KEY_LENGTH} characters')
+    return key
+
+
+class IdempotencyKeys:
+    """Stored responses by (scope, key), with a bounded cache of recent ones"""
+
+    def __init__(self, max_cached=None):
+        self.max_cached = max_cached or int(os.getenv('IDEMPOTENCY_CACHE_SIZE', '10000'))
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+        self._recorded = 0
+
+    def create(self, conn):
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                scope TEXT NOT NULL,
+                key TEXT NOT NULL,
+                status INTEGER NOT NULL,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (scope, key)
+            ) WITHOUT ROWID
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created_at ON idempotency_keys (created_at)')
+
+    def _cached(self, path, scope, key):
+        with self._lock:
+            entry = self._recent.get((path, scope, key))
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self._recent[(path, scope, key)]
+                return None
+            return entry[1], entry[2]
+
+    def _cache(self, path, scope, key, created_at, body, status):
+        with self._lock:
+            self._recent[(path, scope, key)] = (created_at + window_seconds(), body, status)
+            self._recent.move_to_end((path, scope, key))
+            while len(self._recent) > self.max_cached:
+                self._recent.popitem(last=False)
+
+    def invalidate(self):
+        with self._lock:
+            self._recent.clear()
+
+    def lookup(self, conn, scope, key):
+        """(body, status) stored for key within the window, or None"""
+        path = getattr(conn, 'path', None)
+        found = self._cached(path, scope, key)
+        if found is not None:
+            return found
+        row = conn.execute('SELECT response, status, created_at FROM idempotency_keys WHERE scope = ? AND key = ?',
+                           (scope, key)).fetchone()
+        if row is None or row[2] < time.time() - window_seconds():
+            return None
+        body = json.loads(row[0])
+        if not conn.in_transaction:
+            self._cache(path, scope, key, row[2], body, row[1])
+        return body, row[1]
+
+    def record(self, conn, scope, key, body, status, replace_expired=True):
+        """
+        Store key in conn's open transaction; returns False when it is already
+        taken (so the guarded write must be skipped). The cache is only filled
+        once the transaction commits.
+        """
+        now = time.time()
+        if replace_expired:
+            conn.execute('DELETE FROM idempotency_keys WHERE scope = ? AND key = ? AND created_at < ?',
+                         (scope, key, now - window_seconds()))
+        cursor = conn.execute('''
+            INSERT OR IGNORE INTO idempotency_keys (scope, key, status, response, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (scope, key, status, json.dumps(body), now))
+        if cursor.rowcount != 1:
+            return False
+        path = getattr(conn, 'path', None)
+
+        def finish(committed):
+            if committed:
+                self._cache(path, scope, key, now, body, status)
+        if hasattr(conn, 'after_transaction'):
+            conn.after_transaction(finish)
+        self._recorded += 1
+        if self._recorded % PRUNE_EVERY == 0:
+            self.prune(conn)
+        return True
+
+    def run(self, conn, scope, key, write):
+        """
+        Call write() -> (body, status) and commit, unless key was already used.
+        Returns (body, status, replayed); without a key this is just write() + commit.
+        """
+        if key is not None:
+            stored = self.lookup(conn, scope, key)
+            if stored is not None:
+                return stored + (True,)
+        body, status = write()
+        if key is not None and not self.record(conn, scope, key, body, status):
+            # Another request with the same key committed first
+            conn.rollback()
+            stored = self.lookup(conn, scope, key)
+            if stored is None:
+                raise sqlite3.IntegrityError(f"Idempotency key {key!r} vanished")
+            return stored + (True,)
+        conn.commit()
+        return body, status, False
+
+    def prune(self, conn, now=None):
+        """Delete keys older than the window; returns how many were removed"""
+        cutoff = (now or time.time()) - window_seconds()
+        removed = conn.execute('DELETE FROM idempotency_keys WHERE created_at < ?', (cutoff,)).rowcount
+        if removed:
+            logger.info(f"Pruned {removed} expired idempotency keys")
+        return removed
+
+
+idempotency_keys = IdempotencyKeys()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Metric ingestion rules shared by app_production.py and ingest_server.py
+Validation of /metrics/track and /metrics/track/batch bodies, the stored
+event built from them, and the batch write (each event's idempotency key is
+recorded before its row, so a taken key skips the event). Nothing here
+commits.
+"""
+import idempotency
+
+MAX_BATCH_EVENTS = 500
+
+TRACKED_RESPONSE = {'message': 'Metric tracked successfully'}
+
+BOT_RESPONSE = {'message': 'Metric not stored (automated traffic)'}
+
+
+def parse_track(data, headers):
+    """Idempotency key of a /metrics/track body (or None); ValueError with the 400 message"""
+    if not isinstance(data, dict) or not data.get('event_type'):
+        raise ValueError('event_type is required')
+    return idempotency.request_key(headers, data)
+
+
+def parse_batch(data, headers):
+    """(events, per-event keys, batch key) of a /metrics/track/batch body; ValueError with the 400 message"""
+    events = data.get('events') if isinstance(data, dict) else None
+    if not isinstance(events, list) or not events:
+        raise ValueError('events must be a non-empty list')
+    if len(events) > MAX_BATCH_EVENTS:
+        raise ValueError(f'At most {MAX_BATCH_EVENTS} events per batch')
+    event_keys = []
+    for index, event in enumerate(events):
+        if not isinstance(event, dict) or not event.get('event_type'):
+            raise ValueError(f'events[{index}]: event_type is required')
+        try:
+            event_keys.append(idempotency.request_key({}, event))
+        except ValueError as e:
+            raise ValueError(f'events[{index}]: {e}')
+    return events, event_keys, idempotency.request_key(headers, None)
+
+
+def sample(policy, events, keys):
+    """(event, key, weight) for the events the sampling policy keeps"""
+    kept = []
+    for event, key in zip(events, keys):
+        weight = policy.weight(event.get('event_type'))
+        if weight is not None:
+            kept.append((event, key, weight))
+    return kept
+
+
+def metric_event(data, ip_address, now, weight):
+    """Metrics repository event for one tracked event kept with sample weight"""
+    return {
+        'event_type': data.get('event_type'),
+        'page_url': data.get('page_url'),
+        'user_id': data.get('user_id'),
+        'session_id': data.get('session_id'),
+        'device_type': data.get('device_type'),
+        'browser': data.get('browser'),
+        'ip_address': ip_address,
+        'referrer': data.get('referrer'),
+        'custom_data': data.get('custom_data'),
+        'timestamp': now,
+        'sample_weight': weight
+    }
+
+
+def store_events(conn, metrics, kept, ip_address, now):
+    """Insert kept (event, key, weight) triples in conn's transaction; returns the stored events"""
+    rows = []
+    for event, key, weight in kept:
+        # Skipped when the key is taken, including by an earlier event of the same write
+        if key is not None and not idempotency.idempotency_keys.record(conn, 'metrics', key, TRACKED_RESPONSE, 201):
+            continue
+        rows.append(metric_event(event, ip_address, now, weight))
+    metrics.insert_many(conn, rows)
+    return rows
+
+
+def batch_response(events, kept, tracked):
+    return {'message': 'Metrics tracked successfully', 'tracked': tracked,
+            'duplicates': len(kept) - tracked, 'sampled_out': len(events) - len(kept)}
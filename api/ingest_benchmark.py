@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+Connection-scaling benchmark for the metric ingest path
+Opens many concurrent keep-alive connections (10,000 by default) from one
+asyncio client and has each of them post a /metrics/track beacon every
+--think seconds on average, like a crowd of open browser tabs. Run it
+against ingest_server.py, the threaded Flask server or serve.py; it reports
+connect failures, latency percentiles, errors, the server's peak memory and
+how many 201s actually ended up as stored rows.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import sqlite3
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime
+from urllib.parse import urlparse
+
+from benchmark import (RESULTS_DIR, EVENT_TYPES, PAGES, DEVICES, BROWSERS, git_commit, percentile,
+                       start_server, start_prefork_server, stop_server, wait_until_ready, _free_port)
+from ingest_server import raise_fd_limit
+
+SERVERS = ('ingest', 'threaded', 'prefork')
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64; rv:120.0) Gecko/20100101 Firefox/120.0'
+
+
+def start_ingest_server(db_path):
+    """Start ingest_server.py (built-in asyncio server) on a free local port"""
+    port = _free_port()
+    env = dict(os.environ, DATABASE_URL=db_path)
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ingest_server.py'),
+           '--bind', f'127.0.0.1:{port}', '--builtin']
+    proc = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return proc, f"http://127.0.0.1:{port}"
+
+
+def create_database(db_path):
+    """Empty database with the production schema (the Flask servers do not create it)"""
+    import app_production
+    app_production.DB_PATH = db_path
+    app_production.init_db()
+
+
+def process_rss_kb(pid):
+    """Resident memory of pid and its direct children (prefork workers), in KiB"""
+    total = 0
+    pids = [pid]
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            pids += [int(child) for child in f.read().split()]
+    except OSError:
+        pass
+    for p in pids:
+        try:
+            with open(f'/proc/{p}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total
+
+
+def beacon(rng, n):
+    return json.dumps({
+        'event_type': rng.choice(EVENT_TYPES),
+        'page_url': rng.choice(PAGES),
+        'session_id': f"session_{n}",
+        'device_type': rng.choice(DEVICES),
+        'browser': rng.choice(BROWSERS),
+        'event_id': f"bench-{n}-{rng.getrandbits(48):x}",
+    }).encode()
+
+
+class Client:
+    """One keep-alive connection posting beacons until the deadline"""
+
+    def __init__(self, host, port, path, n, rng, stats):
+        self.host, self.port, self.path = host, port, path
+        self.n = n
+        self.rng = rng
+        self.stats = stats
+        self.reader = self.writer = None
+
+    async def connect(self, timeout):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, limit=65536), timeout)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+    async def post(self, timeout):
+        """(status, keep-alive) of one beacon post on this connection"""
+        body = beacon(self.rng, self.n)
+        head = (f"POST {self.path} HTTP/1.1\r\nHost: {self.host}\r\nUser-Agent: {USER_AGENT}\r\n"
+                f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n")
+        self.writer.write(head.encode() + body)
+        response = await asyncio.wait_for(self.reader.readuntil(b'\r\n\r\n'), timeout)
+        lines = response.decode('latin-1').split('\r\n')
+        status = int(lines[0].split(' ')[1])
+        fields = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            fields[name.strip().lower()] = value.strip().lower()
+        length = int(fields.get('content-length', '0') or 0)
+        if length:
+            await asyncio.wait_for(self.reader.readexactly(length), timeout)
+        keep_alive = fields.get('connection') != 'close' and lines[0].startswith('HTTP/1.1')
+        return status, keep_alive
+
+    async def run(self, start_at, deadline, think, timeout):
+        await asyncio.sleep(max(0.0, start_at - time.monotonic()))
+        while True:
+            # Exponential gaps: beacons from independent users, not a synchronized wave
+            gap = self.rng.expovariate(1.0 / think)
+            if time.monotonic() + gap >= deadline:
+                break
+            await asyncio.sleep(gap)
+            started = time.perf_counter()
+            try:
+                if self.writer is None:
+                    await self.connect(timeout)
+                    self.stats['reconnects'] += 1
+                status, keep_alive = await self.post(timeout)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError, IndexError):
+                status, keep_alive = 0, False
+            self.stats['samples'].append((time.perf_counter() - started, status))
+            if not keep_alive:
+                self.close()
+        self.close()
+
+
+async def drive(base_url, path, connections, duration, think, connect_rate, timeout, seed):
+    """Open the connections (at most connect_rate per second), then post until the deadline"""
+    url = urlparse(base_url)
+    stats = {'samples': [], 'reconnects': 0, 'connect_failures': 0}
+    clients = [Client(url.hostname, url.port, path, n, random.Random(seed + n), stats) for n in range(connections)]
+
+    opened = 0
+    ramp_start = time.monotonic()
+    pending = set()
+    for n, client in enumerate(clients):
+        await asyncio.sleep(max(0.0, ramp_start + n / connect_rate - time.monotonic()))
+        pending.add(asyncio.ensure_future(client.connect(timeout)))
+        if len(pending) >= 256:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+    if pending:
+        await asyncio.wait(pending)
+    for client in clients:
+        if client.writer is not None:
+            opened += 1
+        else:
+            stats['connect_failures'] += 1
+    ramp = time.monotonic() - ramp_start
+
+    start = time.monotonic()
+    deadline = start + duration
+    await asyncio.gather(*(client.run(start, deadline, think, timeout) for client in clients))
+    elapsed = time.monotonic() - start
+    return stats, opened, ramp, elapsed
+
+
+def summarize(samples, elapsed):
+    latencies = sorted(seconds for seconds, _ in samples)
+    statuses = {}
+    for _, status in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        'requests': len(samples),
+        'rps': round(len(samples) / elapsed, 1) if elapsed else 0.0,
+        'created': statuses.get('201', 0),
+        'errors': sum(count for status, count in statuses.items() if status == '0' or int(status) >= 500),
+        'statuses': statuses,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'max_ms': round(latencies[-1] * 1000, 2) if latencies else 0.0,
+    }
+
+
+def stored_rows(db_path):
+    """Rows the server stored (all partitions) through the storage layer"""
+    import storage
+    store = storage.SQLiteStorage(db_path)
+    conn = store.connect()
+    try:
+        return round(store.metrics.summary(conn)['total_events'])
+    finally:
+        conn.close()
+
+
+async def sample_rss(pid, peak, stop):
+    while not stop.is_set():
+        peak[0] = max(peak[0], process_rss_kb(pid))
+        try:
+            await asyncio.wait_for(stop.wait(), 0.5)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def measure(base_url, pid, args):
+    peak = [0]
+    stop = asyncio.Event()
+    sampler = asyncio.ensure_future(sample_rss(pid, peak, stop)) if pid else None
+    try:
+        return await drive(base_url, args.path, args.connections, args.duration, args.think,
+                           args.connect_rate, args.timeout, args.seed), peak[0]
+    finally:
+        stop.set()
+        if sampler is not None:
+            await sampler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark metric ingestion at high connection counts')
+    parser.add_argument('--server', choices=SERVERS, default='ingest', help='server to start (ignored with --url)')
+    parser.add_argument('--workers', type=int, default=2, help='serve.py workers for --server prefork')
+    parser.add_argument('--threads', type=int, default=8, help='threads per serve.py worker for --server prefork')
+    parser.add_argument('--url', help='benchmark an already running server instead of starting one')
+    parser.add_argument('--path', default='/metrics/track', help='ingest path to post to')
+    parser.add_argument('--connections', type=int, default=10000, help='concurrent keep-alive connections')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds of measured load')
+    parser.add_argument('--think', type=float, default=10.0, help='mean seconds between beacons per connection')
+    parser.add_argument('--connect-rate', type=float, default=2000.0, help='new connections per second while ramping up')
+    parser.add_argument('--timeout', type=float, default=30.0, help='per-request timeout in seconds')
+    parser.add_argument('--seed', type=int, default=42, help='RNG seed for the workload')
+    parser.add_argument('--output', help='where to write the JSON results')
+    args = parser.parse_args()
+
+    limit = raise_fd_limit()
+    if limit is not None and limit < args.connections + 64:
+        print(f"⚠️  Open file limit {limit} is below {args.connections} connections; expect connect failures")
+
+    workdir = None
+    proc = None
+    db_path = None
+    base_url = args.url
+    if not base_url:
+        workdir = tempfile.mkdtemp(prefix='hhbc-ingest-')
+        db_path = os.path.join(workdir, 'ingest.db')
+        create_database(db_path)
+        if args.server == 'ingest':
+            proc, base_url = start_ingest_server(db_path)
+        elif args.server == 'prefork':
+            proc, base_url = start_prefork_server(db_path, args.workers, args.threads)
+        else:
+            proc, base_url = start_server(db_path, threaded=True)
+    try:
+        wait_until_ready(base_url)
+        label = args.url or args.server
+        print(f"🚀 {label}: {args.connections} connections, one beacon per {args.think}s each, {args.duration}s")
+        (stats, opened, ramp, elapsed), rss_kb = asyncio.run(measure(base_url, proc.pid if proc else None, args))
+        results = summarize(stats['samples'], elapsed)
+        results.update({
+            'connections_opened': opened,
+            'connect_failures': stats['connect_failures'],
+            'reconnects': stats['reconnects'],
+            'ramp_s': round(ramp, 2),
+            'server_peak_rss_mb': round(rss_kb / 1024, 1) if rss_kb else None,
+        })
+    finally:
+        if proc is not None:
+            stop_server(proc)
+    if db_path:
+        # Every 201 must be a stored row (event ids are unique, sampling off by default)
+        results['stored_rows'] = stored_rows(db_path)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for name, value in results.items():
+        print(f"   {name:<22} {value}")
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'server': args.url or args.server,
+            'connections': args.connections,
+            'duration': args.duration,
+            'think': args.think,
+            'path': args.path,
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        output = os.path.join(RESULTS_DIR, f"ingest-{stamp}-{report['meta']['commit'] or 'nogit'}.json")
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\n💾 Results saved to {output}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,455 @@
+#!/usr/bin/env python3
+"""
+asyncio ingest server for beacon traffic
+Serves POST /metrics/track and /metrics/track/batch (plus GET /health) from
+one event loop, so thousands of mostly idle keep-alive connections cost a
+socket and a coroutine each instead of a WSGI thread. The validation,
+sampling, bot filtering and idempotency rules are the ones app_production.py
+applies (ingest.py).
+
+Requests never touch SQLite themselves: they are queued for a single writer
+thread that commits up to INGEST_MAX_GROUP requests per transaction. A
+response is sent once its transaction committed, so 201 still means stored.
+When INGEST_QUEUE_SIZE requests are waiting, new ones get 503 with
+Retry-After.
+
+`app` is a plain ASGI application (uvicorn ingest_server:app works); without
+an ASGI server installed, `python ingest_server.py` runs it on the built-in
+HTTP/1.1 server below. Run it next to the Flask admin app on the same
+DATABASE_URL and route the two ingest paths to it.
+"""
+import os
+import sys
+import json
+import signal
+import asyncio
+import logging
+import argparse
+from datetime import datetime
+from urllib.parse import urlsplit
+from http import HTTPStatus
+from concurrent.futures import ThreadPoolExecutor
+
+import bot_filter
+import idempotency
+import ingest
+import sampling
+import storage
+
+try:
+    import uvicorn
+except ImportError:  # optional, the built-in server is used without it
+    uvicorn = None
+
+logger = logging.getLogger('ingest_server')
+
+DB_PATH = os.getenv('DATABASE_URL', 'consultoria.db').replace('sqlite:///', '')
+
+MAX_BODY = 1024 * 1024
+MAX_HEADER = 16384
+PATHS = {'/metrics/track': 'track', '/metrics/track/batch': 'batch'}
+
+
+class Headers(dict):
+    """Request headers by lowercased name, looked up case-insensitively like Flask's"""
+
+    def get(self, name, default=None):
+        return super().get(name.lower(), default)
+
+
+class Job:
+    """One queued ingest request; the writer resolves `future` with (body, status, replayed)"""
+    __slots__ = ('kind', 'data', 'key', 'kept', 'events', 'ip', 'user_agent', 'future')
+
+    def __init__(self, kind, ip, user_agent, future, data=None, key=None, kept=(), events=()):
+        self.kind = kind
+        self.ip = ip
+        self.user_agent = user_agent
+        self.future = future
+        self.data = data
+        self.key = key
+        self.kept = kept
+        self.events = events
+
+
+class Writer:
+    """Single SQLite writer fed by a bounded queue; commits requests in groups"""
+
+    def __init__(self, db_path, queue_size=None, max_group=None):
+        self.db_path = db_path
+        self.queue_size = queue_size or int(os.getenv('INGEST_QUEUE_SIZE', '10000'))
+        self.max_group = max_group or int(os.getenv('INGEST_MAX_GROUP', '512'))
+        self.queue = None
+        self.task = None
+        self.conn = None
+        # One thread, so every write runs on the same connection, one transaction at a time
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ingest-writer')
+        self.transactions = 0
+        self.requests = 0
+        self.rejected = 0
+
+    def start(self):
+        self.queue = asyncio.Queue(self.queue_size)
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    def submit(self, job):
+        """Queue a job; False when the queue is full (the caller answers 503)"""
+        try:
+            self.queue.put_nowait(job)
+            return True
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            jobs = [await self.queue.get()]
+            while len(jobs) < self.max_group and not self.queue.empty():
+                jobs.append(self.queue.get_nowait())
+            results = await loop.run_in_executor(self.executor, self._write, jobs)
+            for job, result in zip(jobs, results):
+                if not job.future.done():
+                    if isinstance(result, Exception):
+                        job.future.set_exception(result)
+                    else:
+                        job.future.set_result(result)
+                self.queue.task_done()
+
+    def _write(self, jobs):
+        """Writer thread: all jobs in one transaction, or one by one when that fails"""
+        if self.conn is None:
+            self.conn = storage.SQLiteStorage(self.db_path).connect(check_same_thread=False)
+        try:
+            self.conn.execute('BEGIN IMMEDIATE')
+            results = [self._apply(job) for job in jobs]
+            self.conn.commit()
+            self.transactions += 1
+            self.requests += len(jobs)
+            bot_filter.bot_filter.flush_due(self.conn)
+            return results
+        except Exception as e:
+            self.conn.rollback()
+            if len(jobs) == 1:
+                logger.error(f"Error writing {jobs[0].kind} request: {str(e)}")
+                return [e]
+        # Isolate the failing request so the rest of the group is still stored
+        return [self._write([job])[0] for job in jobs]
+
+    def _apply(self, job):
+        conn = self.conn
+        events = round(job.kept[0][2]) if job.kind == 'track' else round(sum(weight for _, _, weight in job.kept))
+        if bot_filter.bot_filter.check(job.user_agent, job.ip, events) is not None:
+            return ingest.BOT_RESPONSE, 202, False
+        metrics = storage.SQLiteStorage.metrics
+        now = datetime.utcnow()
+        if job.kind == 'track':
+            if ingest.store_events(conn, metrics, job.kept, job.ip, now):
+                return ingest.TRACKED_RESPONSE, 201, False
+            # The key was already used
+            stored = idempotency.idempotency_keys.lookup(conn, 'metrics', job.key)
+            return (stored or (ingest.TRACKED_RESPONSE, 201)) + (True,)
+        if job.key is not None:
+            stored = idempotency.idempotency_keys.lookup(conn, 'metrics_batch', job.key)
+            if stored is not None:
+                return stored + (True,)
+        body = ingest.batch_response(job.events, job.kept, len(ingest.store_events(conn, metrics, job.kept, job.ip, now)))
+        if job.key is not None:
+            idempotency.idempotency_keys.record(conn, 'metrics_batch', job.key, body, 201)
+        return body, 201, False
+
+    async def drain(self):
+        """Wait for queued requests to be written, then stop the writer"""
+        if self.task is None:
+            return
+        await self.queue.join()
+        self.task.cancel()
+        await asyncio.get_running_loop().run_in_executor(self.executor, self._close)
+        self.executor.shutdown()
+
+    def _close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def stats(self):
+        return {
+            'queued': self.queue.qsize() if self.queue is not None else 0,
+            'queue_size': self.queue_size,
+            'transactions': self.transactions,
+            'requests': self.requests,
+            'rejected': self.rejected,
+            'requests_per_transaction': round(self.requests / self.transactions, 2) if self.transactions else 0.0,
+        }
+
+
+class IngestApp:
+    """ASGI application for the ingest endpoints"""
+
+    def __init__(self, db_path=None):
+        self.db_path = db_path or DB_PATH
+        self.writer = None
+        cors_origins = os.getenv('CORS_ORIGINS', 'http://localhost:3000,http://localhost:5000').split(',')
+        self.cors_origins = {origin.strip() for origin in cors_origins}
+
+    async def startup(self):
+        # Same schema setup as the admin app (a no-op when it already ran)
+        import app_production
+        app_production.DB_PATH = self.db_path
+        app_production.init_db()
+        self.writer = Writer(self.db_path)
+        self.writer.start()
+        logger.info(f"Ingest writer started on {self.db_path}")
+
+    async def shutdown(self):
+        if self.writer is not None:
+            await self.writer.drain()
+            logger.info(f"Ingest writer stopped: {self.writer.stats()}")
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.startup()
+                except Exception as e:
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _http(self, scope, receive, send):
+        headers = Headers((name.decode('latin-1').lower(), value.decode('latin-1')) for name, value in scope['headers'])
+        cors = self._cors_headers(headers.get('origin'))
+        method, path = scope['method'], scope['path']
+        if method == 'OPTIONS' and path in PATHS:
+            await _respond(send, 204, None, cors + [(b'access-control-allow-methods', b'POST, OPTIONS'),
+                                                    (b'access-control-allow-headers', b'Content-Type, Idempotency-Key'),
+                                                    (b'access-control-max-age', b'86400')])
+            return
+        if method == 'GET' and path == '/health':
+            await _respond(send, 200, {'status': 'healthy', 'writer': self.writer.stats() if self.writer else None})
+            return
+        if path not in PATHS:
+            await _respond(send, 404, {'error': 'Not found'})
+            return
+        if method != 'POST':
+            await _respond(send, 405, {'error': 'Method not allowed'}, [(b'allow', b'POST, OPTIONS')])
+            return
+
+        body = b''
+        more = True
+        while more:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            more = message.get('more_body', False)
+            if len(body) > MAX_BODY:
+                await _respond(send, 413, {'error': 'Request body too large'}, cors)
+                return
+        try:
+            data = json.loads(body) if body else None
+        except ValueError:
+            await _respond(send, 400, {'error': 'Invalid JSON'}, cors)
+            return
+
+        client = scope.get('client')
+        status, response, extra = await self.ingest(PATHS[path], data, headers, client[0] if client else None)
+        await _respond(send, status, response, cors + extra)
+
+    async def ingest(self, kind, data, headers, ip):
+        """(status, body, extra headers) for one request"""
+        policy = sampling.policy_for(sampling.default_path(self.db_path))
+        try:
+            if kind == 'track':
+                key = ingest.parse_track(data, headers)
+                events, kept = [data], ingest.sample(policy, [data], [key])
+                # Sampled-out events are answered like stored ones, before any database work
+                if not kept:
+                    return 201, ingest.TRACKED_RESPONSE, []
+            else:
+                events, event_keys, key = ingest.parse_batch(data, headers)
+                kept = ingest.sample(policy, events, event_keys)
+        except ValueError as e:
+            return 400, {'error': str(e)}, []
+
+        future = asyncio.get_running_loop().create_future()
+        job = Job(kind, ip, headers.get('user-agent'), future, data=data, key=key, kept=kept, events=events)
+        if not self.writer.submit(job):
+            # A full queue drains within a few group commits
+            return 503, {'error': 'Server busy, retry later', 'reason': 'queue'}, [(b'retry-after', b'1')]
+        try:
+            body, status, replayed = await future
+        except Exception as e:
+            logger.error(f"Error tracking metric: {str(e)}")
+            return 500, {'error': 'Internal server error'}, []
+        return status, body, [(b'idempotent-replayed', b'true')] if replayed else []
+
+    def _cors_headers(self, origin):
+        if origin and origin in self.cors_origins:
+            return [(b'access-control-allow-origin', origin.encode('latin-1')),
+                    (b'access-control-allow-credentials', b'true'), (b'vary', b'Origin')]
+        return []
+
+
+async def _respond(send, status, body, headers=()):
+    payload = json.dumps(body).encode() if body is not None else b''
+    response_headers = [(b'content-length', str(len(payload)).encode())] + list(headers)
+    if body is not None:
+        response_headers.append((b'content-type', b'application/json'))
+    await send({'type': 'http.response.start', 'status': status, 'headers': response_headers})
+    await send({'type': 'http.response.body', 'body': payload})
+
+
+app = IngestApp()
+
+
+# Built-in HTTP/1.1 server (keep-alive, Content-Length bodies) for running without an ASGI server
+
+class HTTPServer:
+
+    def __init__(self, app, keepalive_timeout=None):
+        self.app = app
+        self.keepalive_timeout = keepalive_timeout or float(os.getenv('INGEST_KEEPALIVE_TIMEOUT', '75'))
+        self.connections = 0
+        self.peak_connections = 0
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        self.peak_connections = max(self.peak_connections, self.connections)
+        peer = writer.get_extra_info('peername')
+        client = tuple(peer[:2]) if isinstance(peer, tuple) else None
+        try:
+            while await self._handle_request(reader, writer, client):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+            pass
+        except Exception as e:
+            logger.error(f"Error serving {client}: {str(e)}")
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def _handle_request(self, reader, writer, client):
+        """Serve one request; False when the connection should be closed"""
+        head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.keepalive_timeout)
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ')
+        except ValueError:
+            await self._write_simple(writer, 400)
+            return False
+        headers = []
+        for line in lines[1:]:
+            if line:
+                name, _, value = line.partition(':')
+                headers.append((name.strip().lower().encode('latin-1'), value.strip().encode('latin-1')))
+        fields = dict(headers)
+        connection = fields.get(b'connection', b'').lower()
+        keep_alive = connection != b'close' if version == 'HTTP/1.1' else connection == b'keep-alive'
+        if b'chunked' in fields.get(b'transfer-encoding', b'').lower():
+            await self._write_simple(writer, 411)
+            return False
+        length = int(fields.get(b'content-length', b'0') or 0)
+        if length > MAX_BODY:
+            await self._write_simple(writer, 413)
+            return False
+        body = await reader.readexactly(length) if length else b''
+
+        url = urlsplit(target)
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': version.split('/')[-1],
+            'method': method.upper(), 'scheme': 'http', 'path': url.path, 'raw_path': url.path.encode('latin-1'),
+            'query_string': url.query.encode('latin-1'), 'root_path': '', 'headers': headers,
+            'client': client, 'server': writer.get_extra_info('sockname'),
+        }
+        received = False
+
+        async def receive():
+            nonlocal received
+            if received:
+                return {'type': 'http.disconnect'}
+            received = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        response = []
+
+        async def send(message):
+            response.append(message)
+
+        await self.app(scope, receive, send)
+        start = next(m for m in response if m['type'] == 'http.response.start')
+        payload = b''.join(m.get('body', b'') for m in response if m['type'] == 'http.response.body')
+        lines = [f"HTTP/1.1 {start['status']} {HTTPStatus(start['status']).phrase}"]
+        lines += [f"{name.decode('latin-1')}: {value.decode('latin-1')}" for name, value in start['headers']]
+        lines.append('Connection: keep-alive' if keep_alive else 'Connection: close')
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + payload)
+        await writer.drain()
+        return keep_alive
+
+    async def _write_simple(self, writer, status):
+        writer.write(f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n".encode())
+        await writer.drain()
+
+
+def raise_fd_limit():
+    """Allow as many open sockets as the hard limit permits; returns the new soft limit"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        soft = hard
+    return soft
+
+
+async def serve(app, host, port, backlog=4096):
+    """Run app on the built-in server until SIGINT/SIGTERM"""
+    server = HTTPServer(app)
+    await app.startup()
+    listener = await asyncio.start_server(server.handle, host, port, backlog=backlog, limit=MAX_HEADER)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    logger.info(f"Ingest server listening on http://{host}:{port}")
+    try:
+        await stop.wait()
+    finally:
+        listener.close()
+        await app.shutdown()
+        logger.info(f"Ingest server stopped (peak {server.peak_connections} connections)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='asyncio ingest server for /metrics/track')
+    parser.add_argument('--bind', default=f"0.0.0.0:{os.getenv('INGEST_PORT', '5001')}", help='host:port to listen on')
+    parser.add_argument('--backlog', type=int, default=4096, help='listen backlog')
+    parser.add_argument('--builtin', action='store_true', help='use the built-in server even when uvicorn is installed')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    host, _, port = args.bind.rpartition(':')
+    limit = raise_fd_limit()
+    logger.info(f"Open file limit: {limit}")
+    if uvicorn is not None and not args.builtin:
+        uvicorn.run(app, host=host or '0.0.0.0', port=int(port), backlog=args.backlog,
+                    timeout_keep_alive=int(os.getenv('INGEST_KEEPALIVE_TIMEOUT', '75')), access_log=False)
+    else:
+        asyncio.run(serve(app, host or '0.0.0.0', int(port), args.backlog))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
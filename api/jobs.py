@@ -0,0 +1,686 @@
+#!/usr/bin/env python3
+"""
+Background jobs for heavy admin work
+Retention, archiving, exports and VACUUM run on a small pool of worker
+threads instead of inside the request that asked for them. Jobs are rows of
+the `jobs` table, so queued work survives restarts and any worker process
+can run it. A claim is a lease that the job renews whenever it reports
+progress; when a process dies, its job is claimed again once the lease
+expires. Failed jobs are retried with exponential backoff up to
+max_attempts.
+
+Handlers are registered with @handler('kind') and called as
+fn(job, **params). job.progress(fraction, message) reports progress and
+raises Cancelled once the job was cancelled. The return value (JSON) is
+stored as the job's result.
+
+SQLiteBroker is the queue; JOBS_BROKER selects the implementation from
+BROKERS (only 'sqlite' so far) so another backend can be added there.
+"""
+import os
+import sys
+import csv
+import json
+import time
+import socket
+import logging
+import argparse
+import threading
+from datetime import datetime
+
+from flask import request, jsonify, send_file
+
+import archive
+import database
+import partitions
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+STATUSES = (QUEUED, RUNNING, SUCCEEDED, FAILED, CANCELLED)
+
+# Lower runs first
+PRIORITIES = {'high': 0, 'normal': 5, 'low': 9}
+
+# Progress reports closer together than this are not written (the last one always is)
+PROGRESS_INTERVAL = 1.0
+
+
+def lease_seconds():
+    return float(os.getenv('JOBS_LEASE_SECONDS', '300') or 300)
+
+
+def retry_delay(attempts):
+    """Seconds before retry number `attempts` (1, 2, ...): JOBS_RETRY_DELAY doubled per attempt"""
+    return float(os.getenv('JOBS_RETRY_DELAY', '30') or 30) * 2 ** (attempts - 1)
+
+
+def parse_priority(value):
+    if value is None:
+        return PRIORITIES['normal']
+    if isinstance(value, str) and value in PRIORITIES:
+        return PRIORITIES[value]
+    if isinstance(value, int) and not isinstance(value, bool) and 0 <= value <= 9:
+        return value
+    raise ValueError(f"priority must be one of {', '.join(PRIORITIES)} or 0-9")
+
+
+def _iso(epoch):
+    return datetime.utcfromtimestamp(epoch).isoformat() if epoch is not None else None
+
+
+class Cancelled(Exception):
+    """Raised by Job.progress() when the job was cancelled"""
+
+
+_handlers = {}
+
+
+def handler(kind, max_attempts=3):
+    """Register fn(job, **params) as the handler of a job kind"""
+    def decorator(fn):
+        _handlers[kind] = (fn, max_attempts)
+        return fn
+    return decorator
+
+
+def kinds():
+    return sorted(_handlers)
+
+
+class SQLiteBroker:
+    """Job queue in the application database; records are dicts with the jobs table columns"""
+
+    COLUMNS = ('id', 'kind', 'params', 'priority', 'status', 'attempts', 'max_attempts', 'progress', 'message',
+               'result', 'error', 'worker', 'cancel_requested', 'run_after', 'lease_until', 'created_at',
+               'started_at', 'finished_at')
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+    @staticmethod
+    def create(conn):
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                params TEXT NOT NULL DEFAULT '{}',
+                priority INTEGER NOT NULL DEFAULT 5,
+                status TEXT NOT NULL DEFAULT 'queued',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                max_attempts INTEGER NOT NULL DEFAULT 3,
+                progress REAL NOT NULL DEFAULT 0,
+                message TEXT,
+                result TEXT,
+                error TEXT,
+                worker TEXT,
+                cancel_requested INTEGER NOT NULL DEFAULT 0,
+                run_after REAL NOT NULL,
+                lease_until REAL,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_runnable ON jobs (status, priority, id)')
+
+    def _connect(self):
+        return database.connect(self.db_path, timeout=30)
+
+    def _row(self, row):
+        job = dict(zip(self.COLUMNS, row))
+        job['params'] = json.loads(job['params'])
+        job['result'] = json.loads(job['result']) if job['result'] is not None else None
+        return job
+
+    def _select(self, conn, where, params=(), suffix=''):
+        rows = conn.execute(f"SELECT {', '.join(self.COLUMNS)} FROM jobs WHERE {where} {suffix}", params).fetchall()
+        return [self._row(row) for row in rows]
+
+    def enqueue(self, kind, params=None, priority=None, max_attempts=None, delay=0, unique=False):
+        """
+        Queue a job to run after `delay` seconds; returns its id (ValueError for
+        an unknown kind or bad arguments). With unique, a job of the same kind
+        that is already queued is returned instead.
+        """
+        if kind not in _handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        if params is not None and not isinstance(params, dict):
+            raise ValueError('params must be an object')
+        if max_attempts is not None and (not isinstance(max_attempts, int) or max_attempts < 1):
+            raise ValueError('max_attempts must be a positive integer')
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            if unique:
+                row = conn.execute("SELECT id FROM jobs WHERE kind = ? AND status = 'queued' ORDER BY id LIMIT 1",
+                                   (kind,)).fetchone()
+                if row is not None:
+                    conn.commit()
+                    return row[0]
+            cursor = conn.execute('''
+                INSERT INTO jobs (kind, params, priority, max_attempts, run_after, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (kind, json.dumps(params or {}), parse_priority(priority), max_attempts or _handlers[kind][1],
+                  now + delay, now))
+            conn.commit()
+            return cursor.lastrowid
+        finally:
+            conn.close()
+
+    def claim(self, worker):
+        """Lease the next runnable job to worker; the job dict, or None"""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            # Workers that died with their last attempt leased
+            conn.execute('''
+                UPDATE jobs SET status = 'failed', error = 'Worker lost (lease expired)', finished_at = ?
+                WHERE status = 'running' AND lease_until < ? AND attempts >= max_attempts
+            ''', (now, now))
+            row = conn.execute('''
+                SELECT id FROM jobs
+                WHERE (status = 'queued' AND run_after <= ?) OR (status = 'running' AND lease_until < ?)
+                ORDER BY priority, id LIMIT 1
+            ''', (now, now)).fetchone()
+            if row is None:
+                conn.commit()
+                return None
+            conn.execute('''
+                UPDATE jobs SET status = 'running', attempts = attempts + 1, worker = ?, lease_until = ?,
+                                started_at = ?, error = NULL
+                WHERE id = ?
+            ''', (worker, now + lease_seconds(), now, row[0]))
+            job = self._select(conn, 'id = ?', (row[0],))[0]
+            conn.commit()
+            return job
+        finally:
+            conn.close()
+
+    def heartbeat(self, job_id, progress=None, message=None):
+        """Renew the lease (and record progress); False when the job was cancelled"""
+        conn = self._connect()
+        try:
+            conn.execute('''
+                UPDATE jobs SET lease_until = ?, progress = COALESCE(?, progress), message = COALESCE(?, message)
+                WHERE id = ? AND status = 'running'
+            ''', (time.time() + lease_seconds(), progress, message, job_id))
+            row = conn.execute('SELECT cancel_requested FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            conn.commit()
+            return not (row and row[0])
+        finally:
+            conn.close()
+
+    def _finish(self, job_id, status, **fields):
+        assignments = ''.join(f", {name} = ?" for name in fields)
+        conn = self._connect()
+        try:
+            conn.execute(f"UPDATE jobs SET status = ?, finished_at = ?, lease_until = NULL{assignments} WHERE id = ?",
+                         (status, time.time(), *fields.values(), job_id))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def succeed(self, job_id, result):
+        self._finish(job_id, SUCCEEDED, progress=1.0, result=json.dumps(result))
+
+    def finish_cancelled(self, job_id):
+        self._finish(job_id, CANCELLED, message='Cancelled')
+
+    def fail(self, job_id, error):
+        """Record a failed attempt: queued again after a backoff, or failed for good"""
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            attempts, max_attempts = conn.execute('SELECT attempts, max_attempts FROM jobs WHERE id = ?',
+                                                  (job_id,)).fetchone()
+            if attempts < max_attempts:
+                conn.execute('''
+                    UPDATE jobs SET status = 'queued', error = ?, run_after = ?, lease_until = NULL WHERE id = ?
+                ''', (error, time.time() + retry_delay(attempts), job_id))
+            else:
+                conn.execute('''
+                    UPDATE jobs SET status = 'failed', error = ?, finished_at = ?, lease_until = NULL WHERE id = ?
+                ''', (error, time.time(), job_id))
+            conn.commit()
+            return attempts < max_attempts
+        finally:
+            conn.close()
+
+    def cancel(self, job_id):
+        """Cancel a queued job or ask a running one to stop; the job dict, or None when unknown"""
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute("UPDATE jobs SET status = 'cancelled', finished_at = ?, message = 'Cancelled' "
+                         "WHERE id = ? AND status = 'queued'", (time.time(), job_id))
+            conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = 'running'", (job_id,))
+            jobs = self._select(conn, 'id = ?', (job_id,))
+            conn.commit()
+            return jobs[0] if jobs else None
+        finally:
+            conn.close()
+
+    def get(self, job_id):
+        conn = self._connect()
+        try:
+            jobs = self._select(conn, 'id = ?', (job_id,))
+            return jobs[0] if jobs else None
+        finally:
+            conn.close()
+
+    def list(self, status=None, kind=None, limit=50):
+        """Newest jobs first"""
+        conn = self._connect()
+        try:
+            return self._select(conn, '(? IS NULL OR status = ?) AND (? IS NULL OR kind = ?)',
+                                (status, status, kind, kind), f'ORDER BY id DESC LIMIT {int(limit)}')
+        finally:
+            conn.close()
+
+    def counts(self):
+        """{status: jobs}"""
+        conn = self._connect()
+        try:
+            counts = dict.fromkeys(STATUSES, 0)
+            counts.update(conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+            return counts
+        finally:
+            conn.close()
+
+
+BROKERS = {'sqlite': SQLiteBroker}
+
+
+def broker_for(db_path):
+    """Broker selected by JOBS_BROKER (default sqlite) for a database"""
+    name = os.getenv('JOBS_BROKER', 'sqlite') or 'sqlite'
+    if name not in BROKERS:
+        raise ValueError(f"Unknown JOBS_BROKER: {name}")
+    return BROKERS[name](db_path)
+
+
+def public(job):
+    """Job dict for API responses"""
+    return {
+        'id': job['id'],
+        'kind': job['kind'],
+        'params': job['params'],
+        'priority': job['priority'],
+        'status': job['status'],
+        'attempts': job['attempts'],
+        'max_attempts': job['max_attempts'],
+        'progress': round(job['progress'], 4),
+        'message': job['message'],
+        'result': job['result'],
+        'error': job['error'],
+        'cancel_requested': bool(job['cancel_requested']),
+        'created_at': _iso(job['created_at']),
+        'started_at': _iso(job['started_at']),
+        'finished_at': _iso(job['finished_at']),
+        'next_attempt_at': _iso(job['run_after']) if job['status'] == QUEUED else None,
+    }
+
+
+class Job:
+    """What a handler sees of the job it runs"""
+
+    def __init__(self, broker, record):
+        self.broker = broker
+        self.id = record['id']
+        self.kind = record['kind']
+        self.attempt = record['attempts']
+        self.db_path = getattr(broker, 'db_path', None)
+        self._reported = 0.0
+
+    def progress(self, fraction, message=None):
+        """Report progress (0-1) and renew the lease; raises Cancelled once the job was cancelled"""
+        now = time.monotonic()
+        if now - self._reported < PROGRESS_INTERVAL and fraction < 1:
+            return
+        self._reported = now
+        if not self.broker.heartbeat(self.id, max(0.0, min(1.0, fraction)), message):
+            raise Cancelled()
+
+
+class JobRunner:
+    """Worker threads of this process claiming jobs from the broker"""
+
+    def __init__(self, workers=None, poll_interval=None):
+        self.workers = workers if workers is not None else int(os.getenv('JOBS_WORKERS', '2'))
+        self.poll_interval = poll_interval or float(os.getenv('JOBS_POLL_INTERVAL', '2'))
+        self.db_path = None
+        self._pid = None
+        self._checked_pid = None
+        self._threads = []
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self.running = 0
+        self.finished = {}
+
+    def configure(self, db_path):
+        """db_path is a callable, read whenever a worker looks for work"""
+        self.db_path = db_path
+
+    def broker(self):
+        return broker_for(self.db_path())
+
+    def start(self):
+        """Start this process's worker threads (again after a fork)"""
+        with self._lock:
+            if self._pid == os.getpid() or self.workers <= 0 or self.db_path is None:
+                return
+            self._pid = os.getpid()
+            self._threads = [threading.Thread(target=self._work, name=f'job-worker-{n}', daemon=True)
+                             for n in range(self.workers)]
+            for thread in self._threads:
+                thread.start()
+        logger.info(f"Started {self.workers} job workers in process {os.getpid()}")
+
+    def start_if_pending(self):
+        """Once per process: start the workers when jobs are waiting (e.g. queued before a restart)"""
+        if self._checked_pid == os.getpid() or self.db_path is None:
+            return
+        self._checked_pid = os.getpid()
+        try:
+            counts = self.broker().counts()
+        except Exception as e:
+            logger.error(f"Could not check for pending jobs: {str(e)}")
+            return
+        if counts[QUEUED] or counts[RUNNING]:
+            self.start()
+
+    def submit(self, kind, params=None, priority=None, max_attempts=None, delay=0, unique=False):
+        """Queue a job and wake the workers; returns the job dict"""
+        broker = self.broker()
+        job_id = broker.enqueue(kind, params, priority, max_attempts, delay, unique)
+        self.start()
+        self._wake.set()
+        return broker.get(job_id)
+
+    def _work(self):
+        worker = f"{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}"
+        while True:
+            try:
+                ran = self.run_one(worker)
+            except Exception as e:
+                logger.error(f"Job worker error: {str(e)}")
+                ran = False
+            if not ran:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    def run_one(self, worker=None):
+        """Claim and run one job; False when there was nothing to run"""
+        broker = self.broker()
+        record = broker.claim(worker or f"{socket.gethostname()}:{os.getpid()}")
+        if record is None:
+            return False
+        entry = _handlers.get(record['kind'])
+        job = Job(broker, record)
+        with self._lock:
+            self.running += 1
+        started = time.perf_counter()
+        status = SUCCEEDED
+        try:
+            if entry is None:
+                raise ValueError(f"No handler for job kind {record['kind']}")
+            result = entry[0](job, **record['params'])
+            broker.succeed(job.id, result)
+        except Cancelled:
+            status = CANCELLED
+            broker.finish_cancelled(job.id)
+        except Exception as e:
+            status = QUEUED if broker.fail(job.id, f"{type(e).__name__}: {e}") else FAILED
+            logger.error(f"Job {job.id} ({job.kind}) attempt {job.attempt} failed: {str(e)}")
+        finally:
+            with self._lock:
+                self.running -= 1
+                key = (record['kind'], 'retried' if status == QUEUED else status)
+                self.finished[key] = self.finished.get(key, 0) + 1
+        logger.info(f"Job {job.id} ({job.kind}) {status} after {time.perf_counter() - started:.2f}s")
+        return True
+
+    def run_pending(self, limit=None):
+        """Run runnable jobs in the calling thread until none are left; returns how many ran"""
+        ran = 0
+        while (limit is None or ran < limit) and self.run_one():
+            ran += 1
+        return ran
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers if self._pid == os.getpid() else 0,
+                'running': self.running,
+                'finished': {f"{kind}:{status}": count for (kind, status), count in sorted(self.finished.items())},
+            }
+
+    def render_prometheus(self, prefix='hhbc'):
+        """Job metrics of this process as Prometheus text lines (collected by runtime_stats)"""
+        with self._lock:
+            finished = dict(self.finished)
+            running = self.running
+        lines = [
+            f"# HELP {prefix}_jobs_finished_total Job attempts run in this process by kind and outcome.",
+            f"# TYPE {prefix}_jobs_finished_total counter",
+        ]
+        lines += [f'{prefix}_jobs_finished_total{{kind="{kind}",status="{status}"}} {count}'
+                  for (kind, status), count in sorted(finished.items())]
+        lines += [
+            f"# HELP {prefix}_jobs_running Jobs running in this process.",
+            f"# TYPE {prefix}_jobs_running gauge",
+            f"{prefix}_jobs_running {running}",
+        ]
+        return lines
+
+
+runner = JobRunner()
+
+
+# Handlers
+
+def export_directory(db_path):
+    return os.getenv('JOBS_EXPORT_DIR') or os.path.join(os.path.dirname(os.path.abspath(db_path)), 'exports')
+
+
+@handler('metrics.export')
+def export_metrics(job, start=None, end=None, columns=None):
+    """Write metrics in [start, end) (archived months included) to a CSV file"""
+    columns = list(columns or archive.COLUMN_NAMES)
+    unknown = [c for c in columns if c not in archive.COLUMN_NAMES]
+    if unknown:
+        raise ValueError(f"Unknown columns: {', '.join(unknown)}")
+    directory = export_directory(job.db_path)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"metrics-job-{job.id}.csv")
+    conn = database.connect(job.db_path)
+    try:
+        total = conn.execute(f'''
+            SELECT COUNT(*) FROM {partitions.metrics_partitions.source(conn, start, end)}
+            WHERE (? IS NULL OR timestamp >= ?) AND (? IS NULL OR timestamp < ?)
+        ''', (start, start, end, end)).fetchone()[0]
+        # Archive files overlapping the range, whole: only an estimate for progress
+        total += sum(f.rows for f in archive.store_for(archive.default_directory(job.db_path)).files_for_range(
+            start, end, conn=conn))
+        rows = 0
+        with open(path + '.tmp', 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for row in archive.metrics_rows(conn, archive.default_directory(job.db_path), columns, start, end):
+                writer.writerow(row)
+                rows += 1
+                if rows % 10000 == 0:
+                    job.progress(min(rows / max(total, 1), 0.99), f"{rows} rows written")
+        os.replace(path + '.tmp', path)
+    finally:
+        conn.close()
+    return {'file': os.path.basename(path), 'rows': rows, 'bytes': os.path.getsize(path)}
+
+
+@handler('partitions.retain')
+def retain_partitions(job, months):
+    """Drop monthly partitions older than the last `months` and hand the pages back to the OS"""
+    conn = database.connect(job.db_path, timeout=30)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        dropped = partitions.metrics_partitions.apply_retention(conn, int(months))
+        conn.commit()
+        conn.executescript('PRAGMA incremental_vacuum;')  # execute() frees a single page
+    finally:
+        conn.close()
+    return {'dropped': dropped}
+
+
+@handler('archive.run')
+def archive_partitions(job, hot_months=None):
+    """Move closed partitions older than the last `hot_months` to columnar archive files"""
+    hot_months = int(hot_months or os.getenv('METRICS_HOT_MONTHS', '4') or 4)
+    conn = database.connect(job.db_path, timeout=30)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        archived = archive.archive_before(conn, archive.default_directory(job.db_path),
+                                          partitions.months_back(hot_months - 1))
+        conn.commit()
+        conn.executescript('PRAGMA incremental_vacuum;')
+    finally:
+        conn.close()
+    return {'archived': archived}
+
+
+@handler('db.vacuum', max_attempts=1)
+def vacuum(job):
+    """Rebuild the database file and refresh planner statistics"""
+    before = os.path.getsize(job.db_path)
+    conn = database.connect(job.db_path, timeout=60)
+    try:
+        job.progress(0.0, 'VACUUM')
+        conn.execute('VACUUM')
+        job.progress(0.9, 'ANALYZE')
+        conn.execute('PRAGMA optimize')
+        conn.commit()
+    finally:
+        conn.close()
+    return {'bytes_before': before, 'bytes_after': os.path.getsize(job.db_path)}
+
+
+def init_app(app, auth_required, db_path):
+    """Register /internal/jobs and run job workers in each serving process; db_path is a callable"""
+    runner.configure(db_path)
+
+    # Threads do not survive fork, so workers start in the process that serves requests
+    app.before_request(runner.start_if_pending)
+
+    @app.route('/internal/jobs', methods=['GET'])
+    @auth_required
+    def list_jobs():
+        """Latest jobs (status, kind, limit), counts per status and this process's workers"""
+        status = request.args.get('status')
+        if status is not None and status not in STATUSES:
+            return jsonify({'error': f"status must be one of {', '.join(STATUSES)}"}), 400
+        try:
+            limit = min(int(request.args.get('limit', 50)), 500)
+            broker = runner.broker()
+            return jsonify({'jobs': [public(job) for job in broker.list(status, request.args.get('kind'), limit)],
+                            'counts': broker.counts(), 'kinds': kinds(), 'runner': runner.stats()})
+        except ValueError:
+            return jsonify({'error': 'limit must be an integer'}), 400
+        except Exception as e:
+            logger.error(f"Error listing jobs: {str(e)}")
+            return jsonify({'error': 'Internal server error'}), 500
+
+    @app.route('/internal/jobs', methods=['POST'])
+    @auth_required
+    def submit_job():
+        """Queue {kind, params, priority, max_attempts}; 202 with the job"""
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or not data.get('kind'):
+            return jsonify({'error': 'kind is required'}), 400
+        try:
+            job = runner.submit(data['kind'], data.get('params'), data.get('priority'), data.get('max_attempts'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        except Exception as e:
+            logger.error(f"Error queueing job: {str(e)}")
+            return jsonify({'error': 'Internal server error'}), 500
+        logger.info(f"Job {job['id']} ({job['kind']}) queued by {getattr(request, 'user', None)}")
+        response = jsonify(public(job))
+        response.status_code = 202
+        response.headers['Location'] = f"/internal/jobs/{job['id']}"
+        return response
+
+    @app.route('/internal/jobs/<int:job_id>', methods=['GET', 'DELETE'])
+    @auth_required
+    def job_status(job_id):
+        """Status and progress of a job; DELETE cancels it"""
+        try:
+            broker = runner.broker()
+            job = broker.cancel(job_id) if request.method == 'DELETE' else broker.get(job_id)
+        except Exception as e:
+            logger.error(f"Error reading job {job_id}: {str(e)}")
+            return jsonify({'error': 'Internal server error'}), 500
+        if job is None:
+            return jsonify({'error': 'Job not found'}), 404
+        if request.method == 'DELETE' and job['status'] in (SUCCEEDED, FAILED):
+            return jsonify({'error': f"Job already {job['status']}"}), 409
+        return jsonify(public(job))
+
+    @app.route('/internal/jobs/<int:job_id>/download', methods=['GET'])
+    @auth_required
+    def job_download(job_id):
+        """File written by a finished export job"""
+        job = runner.broker().get(job_id)
+        if job is None or job['status'] != SUCCEEDED or not (job['result'] or {}).get('file'):
+            return jsonify({'error': 'No file for this job'}), 404
+        path = os.path.join(export_directory(db_path()), job['result']['file'])
+        if not os.path.exists(path):
+            return jsonify({'error': 'File no longer available'}), 410
+        return send_file(path, mimetype='text/csv', as_attachment=True, download_name=job['result']['file'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Queue, list and run background jobs')
+    parser.add_argument('command', choices=['list', 'enqueue', 'work'])
+    parser.add_argument('kind', nargs='?', help='enqueue: job kind')
+    parser.add_argument('--db', default=os.getenv('DATABASE_URL', 'consultoria.db').replace('sqlite:///', ''),
+                        help='SQLite database file')
+    parser.add_argument('--params', default='{}', help='enqueue: JSON object of handler arguments')
+    parser.add_argument('--priority', default='normal', help='enqueue: high, normal, low or 0-9')
+    parser.add_argument('--workers', type=int, default=None, help='work: worker threads (default JOBS_WORKERS)')
+    parser.add_argument('--once', action='store_true', help='work: run what is runnable now, then exit')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    runner.configure(lambda: args.db)
+    broker = runner.broker()
+    if args.command == 'enqueue':
+        if not args.kind:
+            parser.error(f"enqueue needs a kind: {', '.join(kinds())}")
+        priority = int(args.priority) if args.priority.isdigit() else args.priority
+        job_id = broker.enqueue(args.kind, json.loads(args.params), priority)
+        print(f"📋 Job {job_id} queued ({args.kind})")
+    elif args.command == 'work':
+        if args.once:
+            print(f"✅ {runner.run_pending()} jobs run")
+            return
+        if args.workers is not None:
+            runner.workers = args.workers
+        runner.start()
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            return
+    for job in broker.list(limit=20):
+        print(f"   {job['id']:>6} {job['kind']:<20}{job['status']:<11}{job['attempts']}/{job['max_attempts']} "
+              f"{job['progress'] * 100:>5.0f}%  {job['error'] or job['message'] or ''}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
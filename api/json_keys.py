@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Promoted custom_data keys
+Selected keys of the custom_data JSON are exposed as generated (virtual)
+columns named after the key, each with its own index, so they can be
+filtered and grouped in SQL without parsing JSON in Python. SQLite computes
+them on insert, so writers do not change.
+
+Configured per table with METRICS_JSON_KEYS and CONTACT_JSON_KEYS
+(comma-separated); keys added to the configuration are applied at startup.
+"""
+import os
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+KEY_RE = re.compile(r'^[a-z][a-z0-9_]{0,39}$')
+
+# table -> (environment variable, default keys)
+PROMOTED = {
+    'metrics': ('METRICS_JSON_KEYS', 'form_type,country'),
+    'contact_requests': ('CONTACT_JSON_KEYS', 'urgency,budget_range'),
+}
+
+# Real columns of either table; a key with one of these names is never promoted
+RESERVED = {
+    'id', 'event_type', 'page_url', 'user_id', 'session_id', 'device_type', 'browser', 'ip_address', 'referrer',
+    'custom_data', 'timestamp', 'name', 'email', 'phone', 'company', 'subject', 'message', 'status',
+    'user_agent', 'created_at', 'updated_at',
+}
+
+
+def promoted_keys(table):
+    """Configured keys for 'metrics' or 'contact_requests', invalid names dropped"""
+    variable, default = PROMOTED[table]
+    keys = []
+    for key in os.getenv(variable, default).split(','):
+        key = key.strip()
+        if not key:
+            continue
+        if not KEY_RE.match(key) or key.endswith('_id') or key in RESERVED:
+            logger.warning(f"Ignoring custom_data key {key!r} in {variable}")
+            continue
+        if key not in keys:
+            keys.append(key)
+    return tuple(keys)
+
+
+def expression(key, source='custom_data'):
+    """SQL for one key of a JSON column; NULL for missing keys and invalid JSON"""
+    return f"(CASE WHEN json_valid({source}) THEN json_extract({source}, '$.{key}') END)"
+
+
+def apply(conn, table, keys):
+    """Add missing generated columns and their indexes to table; returns the keys added"""
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_xinfo({table})")}
+    indexes = {row[1] for row in conn.execute(f"PRAGMA index_list({table})")}
+    added = [key for key in keys if key not in existing]
+    for key in added:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {key} GENERATED ALWAYS AS {expression(key)} VIRTUAL")
+    for key in keys:
+        if f"idx_{table}_{key}" not in indexes:
+            conn.execute(f"CREATE INDEX idx_{table}_{key} ON {table} ({key})")
+    if added:
+        logger.info(f"Promoted custom_data keys on {table}: {', '.join(added)}")
+    return added
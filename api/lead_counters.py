@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+Lead pipeline counters (/contact/summary)
+contact_status_counts holds the number of contact requests per status and
+contact_daily_counts the number per (day created, status). Triggers on
+contact_requests keep both up to date in the transaction of every insert,
+status change and delete, whichever code path writes, so the summary is a
+read of a handful of counter rows instead of a scan of the leads.
+
+`python lead_counters.py reconcile` recounts from contact_requests and
+reports any drift (e.g. after a restore or a manual edit with triggers
+dropped); the schema migration that adds the counters does the same.
+"""
+import os
+import sys
+import logging
+import argparse
+from datetime import datetime, timedelta
+
+from flask import jsonify, request
+
+import database
+
+logger = logging.getLogger(__name__)
+
+STATUSES = ('new', 'in_progress', 'resolved', 'closed')
+
+DEFAULT_DAYS = 30
+MAX_DAYS = 366
+
+# Statements adding / removing one lead (prefix NEW / OLD) to the counters
+_ADD = '''
+    INSERT INTO contact_status_counts (status, count)
+    SELECT {row}.status, 1 WHERE {row}.status IS NOT NULL
+    ON CONFLICT (status) DO UPDATE SET count = count + 1;
+    INSERT INTO contact_daily_counts (day, status, count)
+    SELECT date({row}.created_at), {row}.status, 1 WHERE {row}.status IS NOT NULL AND {row}.created_at IS NOT NULL
+    ON CONFLICT (day, status) DO UPDATE SET count = count + 1;
+'''
+_REMOVE = '''
+    UPDATE contact_status_counts SET count = count - 1 WHERE status = {row}.status;
+    UPDATE contact_daily_counts SET count = count - 1 WHERE day = date({row}.created_at) AND status = {row}.status;
+'''
+
+
+def create(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS contact_status_counts (
+            status TEXT PRIMARY KEY,
+            count INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS contact_daily_counts (
+            day TEXT NOT NULL,
+            status TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (day, status)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS contact_counts_insert AFTER INSERT ON contact_requests
+        BEGIN {_ADD.format(row='NEW')} END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS contact_counts_update AFTER UPDATE OF status, created_at ON contact_requests
+        WHEN OLD.status IS NOT NEW.status OR OLD.created_at IS NOT NEW.created_at
+        BEGIN {_REMOVE.format(row='OLD')} {_ADD.format(row='NEW')} END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS contact_counts_delete AFTER DELETE ON contact_requests
+        BEGIN {_REMOVE.format(row='OLD')} END
+    ''')
+
+
+def _stored(conn):
+    statuses = dict(conn.execute('SELECT status, count FROM contact_status_counts WHERE count != 0'))
+    days = {(day, status): count for day, status, count in conn.execute(
+        'SELECT day, status, count FROM contact_daily_counts WHERE count != 0')}
+    return statuses, days
+
+
+def _counted(conn):
+    statuses = dict(conn.execute('''
+        SELECT status, COUNT(*) FROM contact_requests WHERE status IS NOT NULL GROUP BY status
+    '''))
+    days = {(day, status): count for day, status, count in conn.execute('''
+        SELECT date(created_at), status, COUNT(*) FROM contact_requests
+        WHERE status IS NOT NULL AND created_at IS NOT NULL
+        GROUP BY 1, 2
+    ''')}
+    return statuses, days
+
+
+def reconcile(conn):
+    """
+    Recount the counters from contact_requests in the caller's transaction;
+    returns the drift as [(key, stored, counted)]
+    """
+    stored, counted = _stored(conn), _counted(conn)
+    drift = []
+    for kind, have, want in (('status', stored[0], counted[0]), ('day', stored[1], counted[1])):
+        for key in sorted(set(have) | set(want), key=str):
+            if have.get(key, 0) != want.get(key, 0):
+                drift.append(((kind,) + (key if isinstance(key, tuple) else (key,)), have.get(key, 0), want.get(key, 0)))
+    conn.execute('DELETE FROM contact_status_counts')
+    conn.execute('DELETE FROM contact_daily_counts')
+    conn.executemany('INSERT INTO contact_status_counts (status, count) VALUES (?, ?)', counted[0].items())
+    conn.executemany('INSERT INTO contact_daily_counts (day, status, count) VALUES (?, ?, ?)',
+                     [(day, status, count) for (day, status), count in counted[1].items()])
+    return drift
+
+
+def status_counts(conn):
+    """{status: leads} for every known status (zeros included) plus any other stored value"""
+    counts = dict.fromkeys(STATUSES, 0)
+    counts.update(conn.execute('SELECT status, count FROM contact_status_counts WHERE count != 0'))
+    return counts
+
+
+def daily_counts(conn, days=DEFAULT_DAYS, today=None):
+    """[{'day', 'total', 'by_status'}] for each of the last `days` days with leads, oldest first"""
+    first = ((today or datetime.utcnow()) - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+    result = {}
+    for day, status, count in conn.execute('''
+        SELECT day, status, count FROM contact_daily_counts
+        WHERE day >= ? AND count != 0
+        ORDER BY day
+    ''', (first,)):
+        entry = result.setdefault(day, {'day': day, 'total': 0, 'by_status': {}})
+        entry['total'] += count
+        entry['by_status'][status] = count
+    return list(result.values())
+
+
+def init_app(app, auth_required, db_path):
+    """Register /contact/summary; db_path is a callable"""
+
+    @app.route('/contact/summary', methods=['GET'])
+    @auth_required
+    def contact_summary():
+        """Leads per status and per day created (days, default 30), from the counters"""
+        try:
+            days = int(request.args.get('days', DEFAULT_DAYS))
+        except ValueError:
+            return jsonify({'error': 'days must be an integer'}), 400
+        if not 1 <= days <= MAX_DAYS:
+            return jsonify({'error': f'days must be between 1 and {MAX_DAYS}'}), 400
+        try:
+            conn = database.connect(db_path())
+            try:
+                conn.execute('BEGIN')
+                counts = status_counts(conn)
+                daily = daily_counts(conn, days)
+            finally:
+                conn.rollback()
+                conn.close()
+            return jsonify({'status_counts': counts, 'total': sum(counts.values()), 'days': daily})
+        except Exception as e:
+            logger.error(f"Error reading contact summary: {str(e)}")
+            return jsonify({'error': 'Internal server error'}), 500
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Show or reconcile the lead pipeline counters')
+    parser.add_argument('command', choices=['show', 'reconcile'])
+    parser.add_argument('--db', default=os.getenv('DATABASE_URL', 'consultoria.db').replace('sqlite:///', ''),
+                        help='SQLite database file')
+    parser.add_argument('--days', type=int, default=DEFAULT_DAYS, help='show: days of daily counts')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    conn = database.connect(args.db)
+    try:
+        if args.command == 'reconcile':
+            conn.execute('BEGIN IMMEDIATE')
+            drift = reconcile(conn)
+            conn.commit()
+            for key, stored, counted in drift:
+                print(f"   {' '.join(key)}: {stored} -> {counted}")
+            print(f"{'🔧' if drift else '✅'} Counters reconciled ({len(drift)} corrected)")
+        counts = status_counts(conn)
+        print(f"📋 {sum(counts.values())} leads: {', '.join(f'{status} {count}' for status, count in counts.items())}")
+        if args.command == 'show':
+            for entry in daily_counts(conn, args.days):
+                print(f"   {entry['day']}  {entry['total']:>5}  "
+                      f"{', '.join(f'{status} {count}' for status, count in sorted(entry['by_status'].items()))}")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+"""
+Live updates for the admin dashboards as server-sent events (/metrics/stream)
+Instead of re-running the analytics and contact queries on a timer, a
+dashboard loads them once and then applies what this stream pushes:
+
+    event: metrics   counter deltas (events, page views, form submissions,
+                     per event type, page and device) since the last message
+    event: lead      a new contact request
+    event: reset     updates were missed; reload the full state
+
+Every message is built and serialized once, in a ring buffer shared by all
+subscribers of the process, so N open dashboards cost one message per event
+batch rather than N sets of queries. Deltas are coalesced for
+STREAM_FLUSH_INTERVAL seconds. Messages carry ids; a client reconnecting with
+Last-Event-ID gets what it missed while that is still buffered (same process),
+and a reset otherwise. Idle streams get a comment line every STREAM_HEARTBEAT
+seconds, streams end after STREAM_MAX_SECONDS so workers can be recycled (the
+client reconnects), and at most STREAM_MAX_SUBSCRIBERS streams are open per
+process (503 beyond that).
+
+An open stream occupies a server thread for as long as it lasts. Under
+serve.py, a worker accepts streams on at most half of its threads
+(WORKER_THREADS), so its other requests and /health keep being served.
+Single-threaded workers refuse the route, and so does any other pre-forked
+server without threads.
+
+The hub is fed by the ingest path of this process (STREAM_SOURCE=process).
+When metrics are ingested elsewhere (ingest_server.py, several serve.py
+workers), STREAM_SOURCE=database has one thread per process read new rows
+from the database every flush interval instead.
+"""
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from collections import Counter, deque
+
+from flask import Response, jsonify, request
+
+import database
+import partitions
+
+logger = logging.getLogger(__name__)
+
+SOURCES = ('process', 'database')
+
+# Lead fields pushed to the dashboards (no message body or contact details)
+LEAD_FIELDS = ('id', 'name', 'company', 'subject', 'status', 'created_at')
+
+RETRY_MS = 3000
+
+
+def _setting(name, default):
+    return float(os.getenv(name, default) or default)
+
+
+class Hub:
+    """In-process pub/sub of dashboard updates with a replay buffer"""
+
+    def __init__(self):
+        self.source = os.getenv('STREAM_SOURCE', 'process')
+        if self.source not in SOURCES:
+            raise ValueError(f"STREAM_SOURCE must be one of {', '.join(SOURCES)}")
+        self.max_subscribers = int(_setting('STREAM_MAX_SUBSCRIBERS', '50'))
+        self.flush_interval = _setting('STREAM_FLUSH_INTERVAL', '1')
+        self.heartbeat = _setting('STREAM_HEARTBEAT', '15')
+        self.max_seconds = _setting('STREAM_MAX_SECONDS', '300')
+        self.db_path = None
+        self._cond = threading.Condition()
+        self._buffer = deque(maxlen=int(_setting('STREAM_BUFFER', '1000')))
+        self._pid = None
+        self._tail = None
+        self.stats = Counter()
+        self._reset()
+
+    def configure(self, db_path):
+        """db_path: callable returning the database file (read by the database source)"""
+        self.db_path = db_path
+
+    def _reset(self):
+        # Ids are only meaningful within one process (and one run of it)
+        self._pid = os.getpid()
+        self.epoch = uuid.uuid4().hex[:8]
+        self._seq = 0
+        self._buffer.clear()
+        self._pending = None
+        self._pending_since = None
+        self.subscribers = 0
+        self._tail = None
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _append(self, event, data):
+        """Buffer one message (caller holds the lock) and wake the subscribers"""
+        self._seq += 1
+        frame = f"id: {self.epoch}-{self._seq}\nevent: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+        self._buffer.append((self._seq, frame))
+        self.stats[event] += 1
+        self._cond.notify_all()
+
+    def _flush(self, force=False):
+        """Turn pending deltas into a metrics message once they are flush_interval old (caller holds the lock)"""
+        if self._pending is None:
+            return
+        if not force and time.monotonic() - self._pending_since < self.flush_interval:
+            return
+        pending, self._pending = self._pending, None
+        self._append('metrics', {
+            'total_events': round(pending['total'], 3),
+            'page_views': round(pending['event_types'].get('page_view', 0), 3),
+            'form_submissions': round(pending['event_types'].get('form_submit', 0), 3),
+            'event_types': {k: round(v, 3) for k, v in pending['event_types'].items()},
+            'top_pages': {k: round(v, 3) for k, v in pending['pages'].items()},
+            'device_breakdown': {k: round(v, 3) for k, v in pending['devices'].items()},
+        })
+
+    def flush(self):
+        with self._cond:
+            self._check_pid()
+            self._flush()
+
+    def _add_events(self, events):
+        if self._pending is None:
+            self._pending = {'total': 0.0, 'event_types': Counter(), 'pages': Counter(), 'devices': Counter()}
+            self._pending_since = time.monotonic()
+        pending = self._pending
+        for event in events:
+            weight = event.get('sample_weight') or 1
+            pending['total'] += weight
+            pending['event_types'][event.get('event_type')] += weight
+            if event.get('event_type') == 'page_view' and event.get('page_url'):
+                pending['pages'][event['page_url']] += weight
+            if event.get('device_type'):
+                pending['devices'][event['device_type']] += weight
+        pending['event_types'].pop(None, None)
+        self._flush()
+
+    def _add_lead(self, contact):
+        # Keep the order: deltas from before the lead are sent first
+        self._flush(force=True)
+        self._append('lead', {name: contact.get(name) for name in LEAD_FIELDS})
+
+    def publish_events(self, events):
+        """Metric events (dicts as stored) committed by this process"""
+        if self.source != 'process' or not events:
+            return
+        with self._cond:
+            self._check_pid()
+            self._add_events(events)
+
+    def publish_lead(self, contact):
+        """A contact request committed by this process"""
+        if self.source != 'process':
+            return
+        with self._cond:
+            self._check_pid()
+            self._add_lead(contact)
+
+    def subscribe(self, limit=None):
+        """
+        Take a subscriber slot; False when STREAM_MAX_SUBSCRIBERS (or the given
+        lower limit) streams are open. The caller releases it with unsubscribe()
+        """
+        with self._cond:
+            self._check_pid()
+            cap = self.max_subscribers if limit is None else min(self.max_subscribers, limit)
+            if self.subscribers >= cap:
+                self.stats['rejected'] += 1
+                return False
+            self.subscribers += 1
+            self.stats['subscriptions'] += 1
+            if self.source == 'database' and (self._tail is None or not self._tail.is_alive()):
+                self._tail = DatabaseTail(self, self.db_path())
+                self._tail.start()
+            return True
+
+    def unsubscribe(self):
+        with self._cond:
+            if self._pid == os.getpid():
+                self.subscribers -= 1
+
+    def _cursor(self, last_event_id):
+        """(seq to continue after, whether the client missed messages) for a Last-Event-ID"""
+        epoch, _, seq = (last_event_id or '').partition('-')
+        if not last_event_id:
+            return self._seq, False
+        oldest = self._buffer[0][0] if self._buffer else self._seq + 1
+        if epoch != self.epoch or not seq.isdigit() or int(seq) > self._seq or int(seq) < oldest - 1:
+            return self._seq, True
+        return int(seq), False
+
+    def stream(self, last_event_id=None):
+        """SSE frames for one subscriber (counted by subscribe()) until STREAM_MAX_SECONDS"""
+        started = last_sent = time.monotonic()
+        with self._cond:
+            cursor, missed = self._cursor(last_event_id)
+            epoch = self.epoch
+        yield f"retry: {RETRY_MS}\n\n"
+        if missed:
+            yield f"id: {epoch}-{cursor}\nevent: reset\ndata: {{}}\n\n"
+        while time.monotonic() - started < self.max_seconds:
+            with self._cond:
+                if self._seq == cursor:
+                    self._cond.wait(min(self.flush_interval, self.heartbeat))
+                self._flush()
+                oldest = self._buffer[0][0] if self._buffer else self._seq + 1
+                if cursor < oldest - 1:
+                    # Too slow for the buffer: the deltas in between are gone
+                    frames = [f"id: {self.epoch}-{self._seq}\nevent: reset\ndata: {{}}\n\n"]
+                else:
+                    frames = [frame for seq, frame in self._buffer if seq > cursor]
+                cursor = self._seq
+            if frames:
+                yield ''.join(frames)
+                last_sent = time.monotonic()
+            elif time.monotonic() - last_sent >= self.heartbeat:
+                yield ': heartbeat\n\n'
+                last_sent = time.monotonic()
+
+    def render_prometheus(self, prefix='hhbc'):
+        """Stream metrics of this process as Prometheus text lines (collected by runtime_stats)"""
+        with self._cond:
+            subscribers = self.subscribers if self._pid == os.getpid() else 0
+            stats = dict(self.stats)
+        lines = [
+            f"# HELP {prefix}_stream_subscribers Open /metrics/stream connections in this process",
+            f"# TYPE {prefix}_stream_subscribers gauge",
+            f"{prefix}_stream_subscribers {subscribers}",
+            f"# HELP {prefix}_stream_messages_total Messages published to /metrics/stream subscribers",
+            f"# TYPE {prefix}_stream_messages_total counter",
+        ]
+        for event in ('metrics', 'lead'):
+            lines.append(f'{prefix}_stream_messages_total{{event="{event}"}} {stats.get(event, 0)}')
+        lines += [
+            f"# HELP {prefix}_stream_rejected_total Streams refused because the open stream limit was reached",
+            f"# TYPE {prefix}_stream_rejected_total counter",
+            f"{prefix}_stream_rejected_total {stats.get('rejected', 0)}",
+        ]
+        return lines
+
+
+class DatabaseTail(threading.Thread):
+    """Publishes rows committed by any process (STREAM_SOURCE=database) while the hub has subscribers"""
+
+    def __init__(self, hub, db_path):
+        super().__init__(name='stream-tail', daemon=True)
+        self.hub = hub
+        self.db_path = db_path
+
+    def _latest(self, conn):
+        contact_id = conn.execute('SELECT MAX(id) FROM contact_requests').fetchone()[0]
+        return partitions.metrics_partitions.high_water(conn), contact_id or 0
+
+    def poll(self, conn, metric_id, contact_id):
+        """Publish rows after the given ids; returns the new ids"""
+        if metric_id < partitions.metrics_partitions.backdated_mark(conn):
+            # Rows were stored into an older month, below metric_id: deltas cannot cover them
+            with self.hub._cond:
+                self.hub._pending = None
+                self.hub._append('reset', {})
+            metric_id = partitions.metrics_partitions.high_water(conn)
+        # Partition ids grow with the month (partitions.id_base), so only the newest months can hold new rows
+        months = [m for m in partitions.metrics_partitions.months(conn)
+                  if partitions.id_base(m) + partitions.ID_SPAN > metric_id]
+        events = []
+        for month in months:
+            rows = conn.execute(f"SELECT id, event_type, page_url, device_type, sample_weight "
+                                f"FROM ({partitions.compat_select(partitions.partition_name(month))}) "
+                                f"WHERE id > ? ORDER BY id", (metric_id,)).fetchall()
+            for row in rows:
+                events.append(dict(zip(('id', 'event_type', 'page_url', 'device_type', 'sample_weight'), row)))
+            if rows:
+                metric_id = rows[-1][0]
+        leads = conn.execute(f"SELECT {', '.join(LEAD_FIELDS)} FROM contact_requests WHERE id > ? ORDER BY id",
+                             (contact_id,)).fetchall()
+        with self.hub._cond:
+            if events:
+                self.hub._add_events(events)
+            for lead in leads:
+                self.hub._add_lead(dict(zip(LEAD_FIELDS, lead)))
+        return metric_id, leads[-1][0] if leads else contact_id
+
+    def _keep_running(self):
+        """Whether there are subscribers; otherwise gives up the hub's tail slot (under the lock,
+        so a subscribe() that comes later always starts a new tail)"""
+        with self.hub._cond:
+            if self.hub.subscribers > 0 and self.hub._tail is self:
+                return True
+            if self.hub._tail is self:
+                self.hub._tail = None
+            return False
+
+    def run(self):
+        conn = database.connect(self.db_path, timeout=30)
+        try:
+            metric_id, contact_id = self._latest(conn)
+            while self._keep_running():
+                time.sleep(self.hub.flush_interval)
+                try:
+                    metric_id, contact_id = self.poll(conn, metric_id, contact_id)
+                except Exception as e:
+                    logger.error(f"Stream tail error: {str(e)}")
+        finally:
+            conn.close()
+
+
+hub = Hub()
+
+
+def thread_limit(environ):
+    """
+    Streams one worker may hold without starving its other requests; None when
+    the server does not say. serve.py reports its threads per worker, other
+    pre-forked servers without threads cannot spare any
+    """
+    threads = environ.get('serve.threads')
+    if threads is not None:
+        return threads // 2
+    if environ.get('wsgi.multiprocess') and not environ.get('wsgi.multithread'):
+        return 0
+    return None
+
+
+def init_app(app, auth_required, db_path):
+    """Register /metrics/stream; db_path is a callable"""
+    hub.configure(db_path)
+
+    @app.route('/metrics/stream', methods=['GET'])
+    @auth_required
+    def metrics_stream():
+        """Server-sent events: metrics deltas and new leads (Last-Event-ID resumes)"""
+        limit = thread_limit(request.environ)
+        if limit == 0:
+            # A stream would hold the only thread of this worker for STREAM_MAX_SECONDS
+            return jsonify({'error': 'Streams need threaded workers (serve.py --threads 2 or more)'}), 501
+        if not hub.subscribe(limit):
+            response = jsonify({'error': 'Too many open streams'})
+            response.status_code = 503
+            response.headers['Retry-After'] = str(int(hub.max_seconds // 10) or 1)
+            return response
+        last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+        response = Response(hub.stream(last_event_id), mimetype='text/event-stream')
+        # Released when the server closes the response, whether or not the body was ever iterated
+        response.call_on_close(hub.unsubscribe)
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Interned lookup tables for repetitive metric strings
+event_type, page_url, device_type, browser and referrer are stored once in
+lookup_<column> (id, value) and metric rows keep the integer id in
+<column>_id. Ids are resolved through an in-process cache per database file.
+Ids first seen inside a transaction stay private to that connection until it
+commits, so a rollback can never leave a cached id without its row.
+"""
+import threading
+
+LOOKUP_COLUMNS = ('event_type', 'page_url', 'device_type', 'browser', 'referrer')
+
+
+def table_name(column):
+    return f"lookup_{column}"
+
+
+def id_column(column):
+    return f"{column}_id"
+
+
+class StringLookups:
+    """value <-> id maps for the lookup tables, cached per database file"""
+
+    def __init__(self):
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self._cache = {}
+
+    def create(self, conn):
+        for column in LOOKUP_COLUMNS:
+            conn.execute(f'''
+                CREATE TABLE IF NOT EXISTS {table_name(column)} (
+                    id INTEGER PRIMARY KEY,
+                    value TEXT NOT NULL UNIQUE
+                )
+            ''')
+
+    def _shared(self, conn, column):
+        path = getattr(conn, 'path', None)
+        with self._lock:
+            maps = self._cache.get(path)
+            if maps is None:
+                maps = {name: ({}, {}) for name in LOOKUP_COLUMNS}
+                if path is not None:
+                    self._cache[path] = maps
+            return maps[column]
+
+    def _publish(self, conn, column, value, id_):
+        ids, values = self._shared(conn, column)
+        ids[value] = id_
+        values[id_] = value
+
+    def _pending(self, conn):
+        """{column: {value: id}} seen in conn's open transaction, or None when it cannot be tracked"""
+        pending = getattr(conn, 'pending_lookups', None)
+        if pending is None and conn.in_transaction and hasattr(conn, 'after_transaction'):
+            pending = conn.pending_lookups = {name: {} for name in LOOKUP_COLUMNS}
+
+            def finish(committed):
+                conn.pending_lookups = None
+                if committed:
+                    for column, ids in pending.items():
+                        for value, id_ in ids.items():
+                            self._publish(conn, column, value, id_)
+            conn.after_transaction(finish)
+        return pending
+
+    def _remember(self, conn, column, value, id_):
+        if not conn.in_transaction:
+            self._publish(conn, column, value, id_)
+            return
+        pending = self._pending(conn)
+        if pending is not None:
+            pending[column][value] = id_
+
+    def find(self, conn, column, value):
+        """Id of value, or None when it has never been stored (nothing is created)"""
+        if value is None:
+            return None
+        id_ = self._shared(conn, column)[0].get(value)
+        if id_ is not None:
+            return id_
+        pending = getattr(conn, 'pending_lookups', None)
+        if pending is not None and value in pending[column]:
+            return pending[column][value]
+        row = conn.execute(f"SELECT id FROM {table_name(column)} WHERE value = ?", (value,)).fetchone()
+        if row is None:
+            return None
+        self._remember(conn, column, value, row[0])
+        return row[0]
+
+    def resolve(self, conn, column, value):
+        """Id of value, inserting it into the lookup table when it is new"""
+        id_ = self.find(conn, column, value)
+        if id_ is not None or value is None:
+            return id_
+        cursor = conn.execute(f"INSERT OR IGNORE INTO {table_name(column)} (value) VALUES (?)", (value,))
+        if cursor.rowcount == 1:
+            id_ = cursor.lastrowid
+        else:
+            id_ = conn.execute(f"SELECT id FROM {table_name(column)} WHERE value = ?", (value,)).fetchone()[0]
+        self._remember(conn, column, value, id_)
+        return id_
+
+    def values(self, conn, column, ids):
+        """{id: value} for the given ids"""
+        shared = self._shared(conn, column)[1]
+        found = {id_: shared[id_] for id_ in ids if id_ in shared}
+        missing = [id_ for id_ in ids if id_ is not None and id_ not in found]
+        for start in range(0, len(missing), 500):
+            chunk = missing[start:start + 500]
+            rows = conn.execute(f"SELECT id, value FROM {table_name(column)} WHERE id IN ({', '.join('?' * len(chunk))})",
+                                chunk).fetchall()
+            for id_, value in rows:
+                found[id_] = value
+                self._remember(conn, column, value, id_)
+        return found
+
+
+string_lookups = StringLookups()
@@ -76,6 +76,17 @@ class ContactRequest(db.Model):
             'source': self.source
         }
 
+class AdminUser(db.Model):
+    __tablename__ = 'admin_users'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(100), unique=True, nullable=False)
+    password_hash = db.Column(db.String(255), nullable=False)
+    email = db.Column(db.String(120))
+    is_active = db.Column(db.Boolean, default=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_login = db.Column(db.DateTime)
+
 class ContactFormMetric(db.Model):
     __tablename__ = 'contact_form_metrics'
     
@@ -0,0 +1,492 @@
+#!/usr/bin/env python3
+"""
+Monthly partitions for the metrics table of the raw-sqlite backends
+Each calendar month (UTC) lives in its own table, metrics_YYYY_MM, and
+`metrics` is a UNION ALL view over all of them, so existing readers keep
+working. Writes go to the partition of the row's timestamp, range queries read
+only the partitions that overlap the range, and retention drops whole tables
+instead of running a long DELETE.
+
+Ids stay unique across partitions: every partition's AUTOINCREMENT sequence
+starts at its own base (months since 2000 * ID_SPAN), so rows inserted in a
+later month always get larger ids. Dropping a partition keeps its sequence, so
+a month recreated later (e.g. by a backfill) continues after the ids it had,
+including the ones in its archive file (archive.py).
+
+The catch is that a row stored into an older month (a backfill, a late event)
+gets an id below high_water() marks already handed out as delta tokens, so
+readers continuing from such a mark would never see it. insert_many() records
+these backdated writes: it skips one id of the newest sequence and keeps that
+new high water as backdated_mark(). Marks below it are stale; the metrics
+repository reports it as low_water(), /metrics/analytics answers older since=
+tokens with 410 and the database stream tail sends a reset.
+
+Partitions store event_type, page_url, device_type, browser and referrer as
+ids into interned lookup tables (lookups.py); `metrics` and source() join
+them back, so readers still see the original text columns. Write through
+insert()/insert_many(), which resolve the ids. Promoted custom_data keys
+(json_keys.py) are indexed generated columns of every partition.
+
+sample_weight is the number of events a row stands for (1 / sampling rate,
+see sampling.py); aggregates sum it instead of counting rows.
+"""
+import os
+import re
+import sys
+import logging
+import argparse
+import threading
+from datetime import datetime
+
+import database
+import json_keys
+import lookups
+from lookups import string_lookups
+
+logger = logging.getLogger(__name__)
+
+VIEW_NAME = 'metrics'
+PARTITION_RE = re.compile(r'^metrics_(\d{4})_(\d{2})$')
+MONTH_RE = re.compile(r'^\d{4}-\d{2}$')
+ID_SPAN = 2 ** 32
+EPOCH_YEAR = 2000
+
+# Storage layout of a partition table
+METRICS_COLUMNS = '''
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    event_type_id INTEGER NOT NULL,
+    page_url_id INTEGER,
+    user_id TEXT,
+    session_id TEXT,
+    device_type_id INTEGER,
+    browser_id INTEGER,
+    ip_address TEXT,
+    referrer_id INTEGER,
+    custom_data TEXT,
+    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+    sample_weight REAL NOT NULL DEFAULT 1
+'''
+
+# Columns as readers (the `metrics` view, source()) and insert() see them
+COLUMNS = ('id', 'event_type', 'page_url', 'user_id', 'session_id', 'device_type', 'browser',
+           'ip_address', 'referrer', 'custom_data', 'timestamp', 'sample_weight')
+INSERT_COLUMNS = COLUMNS[1:]
+# Added in schema version 6; ALTER TABLE appends it to older partitions
+SAMPLE_WEIGHT_DDL = 'sample_weight REAL NOT NULL DEFAULT 1'
+STORAGE_COLUMNS = tuple(lookups.id_column(c) if c in lookups.LOOKUP_COLUMNS else c for c in COLUMNS)
+
+
+def promoted_keys():
+    """custom_data keys exposed as generated columns of every partition"""
+    return json_keys.promoted_keys(VIEW_NAME)
+
+
+def compat_select(table):
+    """SELECT over one partition with the lookup ids joined back to their text values"""
+    fields = ', '.join(
+        f"{lookups.table_name(c)}.value AS {c}" if c in lookups.LOOKUP_COLUMNS else f"m.{c}"
+        for c in COLUMNS + promoted_keys()
+    )
+    joins = ' '.join(
+        f"LEFT JOIN {lookups.table_name(c)} ON {lookups.table_name(c)}.id = m.{lookups.id_column(c)}"
+        for c in lookups.LOOKUP_COLUMNS
+    )
+    return f"SELECT {fields} FROM {table} m {joins}"
+
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def month_of(value=None):
+    """'YYYY-MM' for a datetime or a 'YYYY-MM-DD...' string (default: now, UTC)"""
+    if value is None:
+        value = datetime.utcnow()
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m')
+    return str(value)[:7]
+
+
+def partition_name(month):
+    return f"metrics_{month[:4]}_{month[5:7]}"
+
+
+def next_month(month):
+    year, mon = int(month[:4]), int(month[5:7])
+    return f"{year + mon // 12:04d}-{mon % 12 + 1:02d}"
+
+
+def previous_month(month):
+    year, mon = int(month[:4]), int(month[5:7])
+    return f"{year - (mon == 1):04d}-{12 if mon == 1 else mon - 1:02d}"
+
+
+def months_back(count, month=None):
+    """The month `count` months before month (default: the current month)"""
+    month = month_of(month)
+    for _ in range(count):
+        month = previous_month(month)
+    return month
+
+
+def month_bounds(month):
+    """[start, end) timestamps of a month, in the stored text format"""
+    return f"{month}-01 00:00:00", f"{next_month(month)}-01 00:00:00"
+
+
+def id_base(month):
+    return ((int(month[:4]) - EPOCH_YEAR) * 12 + int(month[5:7]) - 1) * ID_SPAN
+
+
+def format_timestamp(value=None):
+    return (value or datetime.utcnow()).strftime(TIMESTAMP_FORMAT)
+
+
+class MetricsPartitions:
+    """Routes metrics reads and writes to monthly partition tables"""
+
+    def __init__(self):
+        # Partition months known to exist (committed), per database file (see database.connect)
+        self._known = {}
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self._known = {}
+
+    def months(self, conn):
+        """Existing partition months, oldest first"""
+        rows = conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB 'metrics_[0-9]*'"
+        ).fetchall()
+        months = sorted(f"{m.group(1)}-{m.group(2)}" for m in (PARTITION_RE.match(r[0]) for r in rows) if m)
+        path = getattr(conn, 'path', None)
+        # Only committed state is cached: a partition created in a transaction that rolls back must not stick
+        if path is not None and not conn.in_transaction:
+            with self._lock:
+                self._known[path] = frozenset(months)
+        return months
+
+    def _is_known(self, conn, month):
+        path = getattr(conn, 'path', None)
+        return path is not None and month in self._known.get(path, ())
+
+    def _create(self, conn, month):
+        table = partition_name(month)
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {table} ({METRICS_COLUMNS})")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_timestamp ON {table} (timestamp)")
+        json_keys.apply(conn, table, promoted_keys())
+        conn.execute('''
+            INSERT INTO sqlite_sequence (name, seq)
+            SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?)
+        ''', (table, id_base(month), table))
+        return table
+
+    def rebuild_view(self, conn):
+        """Point the `metrics` view at the current set of partitions"""
+        months = self.months(conn)
+        conn.execute(f"DROP VIEW IF EXISTS {VIEW_NAME}")
+        if months:
+            union = ' UNION ALL '.join(compat_select(partition_name(m)) for m in months)
+            conn.execute(f"CREATE VIEW {VIEW_NAME} AS {union}")
+
+    def promote_keys(self, conn):
+        """Add newly configured custom_data keys to every partition; returns the keys added"""
+        keys = promoted_keys()
+        added = set()
+        for month in self.months(conn):
+            added.update(json_keys.apply(conn, partition_name(month), keys))
+        view_columns = [row[1] for row in conn.execute(f"PRAGMA table_info({VIEW_NAME})")]
+        if view_columns and view_columns[len(COLUMNS):] != list(keys):
+            self.rebuild_view(conn)
+        return sorted(added)
+
+    def ensure(self, conn, month=None):
+        """Name of the partition for month, creating it (and updating the view) if needed"""
+        month = month_of(month)
+        if not MONTH_RE.match(month):
+            raise ValueError(f"Invalid partition month: {month}")
+        if self._is_known(conn, month) or month in self.months(conn):
+            return partition_name(month)
+        conn.execute('SAVEPOINT metrics_partition')
+        try:
+            table = self._create(conn, month)
+            self.rebuild_view(conn)
+            conn.execute('RELEASE metrics_partition')
+        except Exception:
+            conn.execute('ROLLBACK TO metrics_partition')
+            conn.execute('RELEASE metrics_partition')
+            raise
+        logger.info(f"Metrics partition ready: {table}")
+        return table
+
+    def table_for(self, conn, timestamp=None):
+        """Insert target for a row with this timestamp (default: now)"""
+        return self.ensure(conn, month_of(timestamp))
+
+    def insert_many(self, conn, rows):
+        """
+        Insert rows of INSERT_COLUMNS values, each into the partition of its
+        timestamp (None: now); text values are replaced by their lookup ids.
+        Rows may leave off the trailing sample_weight (1).
+        """
+        positions = [INSERT_COLUMNS.index(c) for c in lookups.LOOKUP_COLUMNS]
+        timestamp_index = INSERT_COLUMNS.index('timestamp')
+        groups = {}
+        for row in rows:
+            row = list(row)
+            if len(row) == len(INSERT_COLUMNS) - 1:
+                row.append(1)
+            for position, column in zip(positions, lookups.LOOKUP_COLUMNS):
+                row[position] = string_lookups.resolve(conn, column, row[position])
+            if row[timestamp_index] is None:
+                row[timestamp_index] = format_timestamp()
+            groups.setdefault(month_of(row[timestamp_index]), []).append(row)
+        sql = f"INSERT INTO {{table}} ({', '.join(STORAGE_COLUMNS[1:])}) VALUES ({', '.join('?' * len(INSERT_COLUMNS))})"
+        backdated = False
+        for month, group in sorted(groups.items()):
+            table = self.ensure(conn, month)
+            if not backdated:
+                # Does this partition's sequence hand out ids below the high water?
+                backdated = conn.execute('''
+                    SELECT (SELECT seq FROM sqlite_sequence WHERE name = ?) < MAX(seq)
+                    FROM sqlite_sequence WHERE name GLOB 'metrics_[0-9]*'
+                ''', (table,)).fetchone()[0] == 1
+            conn.executemany(sql.format(table=table), group)
+        if backdated:
+            self._mark_backdated(conn)
+
+    def _mark_backdated(self, conn):
+        """
+        Skip one id of the newest sequence, so marks handed out before this
+        write are below the new high water and marks handed out after are not,
+        and record that high water
+        """
+        conn.execute('''
+            UPDATE sqlite_sequence SET seq = seq + 1
+            WHERE name = (SELECT name FROM sqlite_sequence WHERE name GLOB 'metrics_[0-9]*' ORDER BY seq DESC LIMIT 1)
+        ''')
+        conn.execute('''
+            INSERT INTO metrics_backdated (id, mark) VALUES (1, ?)
+            ON CONFLICT (id) DO UPDATE SET mark = excluded.mark
+        ''', (self.high_water(conn),))
+
+    def backdated_mark(self, conn):
+        """High water right after the latest write into an older month (0: none); older marks miss rows"""
+        row = conn.execute('SELECT mark FROM metrics_backdated WHERE id = 1').fetchone()
+        return row[0] if row is not None else 0
+
+    def insert(self, conn, row):
+        self.insert_many(conn, [row])
+
+    def tables_for_range(self, conn, start=None, end=None, after_id=None):
+        """
+        Partitions overlapping [start, end) and, with after_id, able to hold
+        larger ids; bounds are datetimes or timestamp strings
+        """
+        first = month_of(start) if start is not None else None
+        last = month_of(end) if end is not None else None
+        return [
+            partition_name(m) for m in self.months(conn)
+            if (first is None or m >= first) and (last is None or m <= last)
+            and (after_id is None or id_base(m) + ID_SPAN > after_id)
+        ]
+
+    def high_water(self, conn):
+        """Largest id handed out so far (ids grow with the month, see backdated_mark() for the exception)"""
+        row = conn.execute("SELECT MAX(seq) FROM sqlite_sequence WHERE name GLOB 'metrics_[0-9]*'").fetchone()
+        return row[0] if row[0] is not None else id_base(month_of())
+
+    def source(self, conn, start=None, end=None, raw=False, after_id=None):
+        """
+        FROM-clause source holding only the partitions a range query needs;
+        raw=True exposes the stored lookup ids (<column>_id) instead of the text columns
+        """
+        if start is None and end is None and after_id is None and not raw:
+            return VIEW_NAME
+        tables = self.tables_for_range(conn, start, end, after_id)
+        if not tables:
+            return '(SELECT ' + ', '.join(f"NULL AS {c}" for c in (STORAGE_COLUMNS if raw else COLUMNS) + promoted_keys()) + ' WHERE 0)'
+        raw_columns = ', '.join(STORAGE_COLUMNS + promoted_keys())
+        select = (lambda t: f"SELECT {raw_columns} FROM {t}") if raw else compat_select
+        if raw and len(tables) == 1:
+            return tables[0]
+        return '(' + ' UNION ALL '.join(select(t) for t in tables) + ')'
+
+    def _copy_rows(self, conn, source, table, where='1', params=()):
+        """Copy text-layout rows from source into a partition, interning their strings"""
+        available = {row[1] for row in conn.execute(f"PRAGMA table_info({source})")}
+        columns = [c for c in COLUMNS if c in available]
+        for column in lookups.LOOKUP_COLUMNS:
+            conn.execute(f'''
+                INSERT OR IGNORE INTO {lookups.table_name(column)} (value)
+                SELECT DISTINCT {column} FROM {source} WHERE ({where}) AND {column} IS NOT NULL
+            ''', params)
+        fields = ', '.join(
+            f"(SELECT id FROM {lookups.table_name(c)} WHERE value = s.{c})" if c in lookups.LOOKUP_COLUMNS else f"s.{c}"
+            for c in columns
+        )
+        targets = ', '.join(STORAGE_COLUMNS[COLUMNS.index(c)] for c in columns)
+        conn.execute(f"INSERT INTO {table} ({targets}) SELECT {fields} FROM {source} s WHERE {where}", params)
+
+    def _text_layout(self, conn, table):
+        return any(row[1] == 'event_type' for row in conn.execute(f"PRAGMA table_info({table})"))
+
+    def migrate(self, conn):
+        """
+        Bring metrics storage to the current layout: move an unpartitioned
+        metrics table into monthly partitions, convert partitions that still
+        store text columns to lookup ids and add sample_weight where missing
+        (also creates the metrics_backdated mark, see backdated_mark())
+        """
+        string_lookups.create(conn)
+        # WITHOUT ROWID: recording a mark must not change the last_insert_rowid() of the insert
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS metrics_backdated (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                mark INTEGER NOT NULL
+            ) WITHOUT ROWID
+        ''')
+        row = conn.execute("SELECT type FROM sqlite_master WHERE name = ?", (VIEW_NAME,)).fetchone()
+        if row is None:
+            self.ensure(conn)
+            return 0
+        if row[0] != 'table':
+            converted = self._convert_partitions(conn)
+            self._add_sample_weight(conn)
+            return converted
+
+        conn.execute(f"ALTER TABLE {VIEW_NAME} RENAME TO metrics_unpartitioned")
+        months = [r[0] for r in conn.execute(
+            "SELECT DISTINCT substr(timestamp, 1, 7) FROM metrics_unpartitioned WHERE timestamp IS NOT NULL"
+        ).fetchall() if r[0] and MONTH_RE.match(r[0])]
+        for month in sorted(months):
+            table = self._create(conn, month)
+            self._copy_rows(conn, 'metrics_unpartitioned', table, 'substr(timestamp, 1, 7) = ?', (month,))
+        # Rows without a usable timestamp go to the current month
+        table = self._create(conn, month_of())
+        placeholders = ', '.join('?' for _ in months) or "''"
+        self._copy_rows(conn, 'metrics_unpartitioned', table,
+                        f"timestamp IS NULL OR substr(timestamp, 1, 7) NOT IN ({placeholders})", months)
+        moved = conn.execute("SELECT COUNT(*) FROM metrics_unpartitioned").fetchone()[0]
+        conn.execute("DROP TABLE metrics_unpartitioned")
+        self.rebuild_view(conn)
+        logger.info(f"Migrated {moved} metrics into {len(self.months(conn))} monthly partitions")
+        return moved
+
+    def _convert_partitions(self, conn):
+        """Rewrite text-layout partitions (schema version 2) with lookup ids"""
+        converted = 0
+        tables = [partition_name(m) for m in self.months(conn)]
+        old = [t for t in tables if self._text_layout(conn, t)]
+        if not old:
+            return 0
+        conn.execute(f"DROP VIEW IF EXISTS {VIEW_NAME}")
+        for table in old:
+            conn.execute(f"ALTER TABLE {table} RENAME TO {table}_text")
+            conn.execute(f"DROP INDEX IF EXISTS idx_{table}_timestamp")
+            self._create(conn, month_of(table[8:15].replace('_', '-')))
+            self._copy_rows(conn, f"{table}_text", table)
+            converted += conn.execute(f"SELECT COUNT(*) FROM {table}_text").fetchone()[0]
+            conn.execute(f"DROP TABLE {table}_text")
+        self.rebuild_view(conn)
+        logger.info(f"Converted {converted} metrics in {len(old)} partitions to lookup ids")
+        return converted
+
+    def _add_sample_weight(self, conn):
+        """Schema version 6: existing rows get weight 1 without being rewritten"""
+        tables = [partition_name(m) for m in self.months(conn)]
+        missing = [t for t in tables
+                   if 'sample_weight' not in {row[1] for row in conn.execute(f"PRAGMA table_info({t})")}]
+        for table in missing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {SAMPLE_WEIGHT_DDL}")
+        if missing:
+            self.rebuild_view(conn)
+            logger.info(f"Added sample_weight to {len(missing)} metrics partitions")
+        return missing
+
+    def drop(self, conn, months):
+        """Drop the given partition months (never the current one); returns dropped tables"""
+        current = month_of()
+        existing = set(self.months(conn))
+        dropped = [partition_name(m) for m in sorted(months) if m in existing and m != current]
+        if not dropped:
+            return []
+        conn.execute('SAVEPOINT metrics_retention')
+        try:
+            for table in dropped:
+                sequence = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,)).fetchone()
+                conn.execute(f"DROP TABLE {table}")
+                # DROP TABLE forgets the sequence; keep it for a later recreation of the month
+                if sequence is not None:
+                    conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table, sequence[0]))
+            if current in existing:
+                self.rebuild_view(conn)
+            else:
+                # The view needs at least one partition behind it
+                self._create(conn, current)
+                self.rebuild_view(conn)
+            conn.execute('RELEASE metrics_retention')
+        except Exception:
+            conn.execute('ROLLBACK TO metrics_retention')
+            conn.execute('RELEASE metrics_retention')
+            raise
+        # ensure() must not trust a cached month that is gone (a backfill recreates it)
+        self.invalidate()
+        logger.info(f"Dropped metrics partitions: {', '.join(dropped)}")
+        return dropped
+
+    def drop_before(self, conn, month):
+        """Drop every partition older than month (never the current one); returns dropped tables"""
+        month = min(month_of(month), month_of())
+        return self.drop(conn, [m for m in self.months(conn) if m < month])
+
+    def apply_retention(self, conn, months):
+        """Keep the current month plus the `months - 1` before it"""
+        if months <= 0:
+            return []
+        return self.drop_before(conn, months_back(months - 1))
+
+    def stats(self, conn):
+        return [
+            {'partition': partition_name(m), 'month': m,
+             'rows': conn.execute(f"SELECT COUNT(*) FROM {partition_name(m)}").fetchone()[0]}
+            for m in self.months(conn)
+        ]
+
+
+metrics_partitions = MetricsPartitions()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect and prune monthly metrics partitions')
+    parser.add_argument('command', choices=['list', 'migrate', 'retain'])
+    parser.add_argument('--db', default=os.getenv('DATABASE_URL', 'consultoria.db').replace('sqlite:///', ''),
+                        help='SQLite database file')
+    parser.add_argument('--months', type=int, default=int(os.getenv('METRICS_RETENTION_MONTHS', '0') or 0),
+                        help='retain: months to keep, including the current one')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    conn = database.connect(args.db)
+    try:
+        if args.command == 'migrate':
+            conn.execute('BEGIN IMMEDIATE')
+            moved = metrics_partitions.migrate(conn)
+            conn.commit()
+            print(f"✅ {moved} rows migrated")
+        elif args.command == 'retain':
+            if args.months <= 0:
+                parser.error('retain needs --months (or METRICS_RETENTION_MONTHS)')
+            conn.execute('BEGIN IMMEDIATE')
+            dropped = metrics_partitions.apply_retention(conn, args.months)
+            conn.commit()
+            conn.executescript('PRAGMA incremental_vacuum;')  # execute() frees a single page
+            print(f"🗑️  Dropped {len(dropped)} partitions: {', '.join(dropped) or '-'}")
+        for entry in metrics_partitions.stats(conn):
+            print(f"   {entry['partition']:<18}{entry['rows']:>12,} rows")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
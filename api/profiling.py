@@ -0,0 +1,257 @@
+"""
+On-demand request profiling for the HHBC Consultancy Flask apps
+Samples a fraction of requests (or requests carrying a trigger header) under a
+stack sampler or cProfile and aggregates the results per route. While
+profiling is disabled the app's WSGI callable is left untouched.
+
+Profiling state is per process: with several workers, set PROFILING_SAMPLE_RATE
+to enable it everywhere at startup, or toggle each worker through the endpoint.
+"""
+import io
+import os
+import sys
+import time
+import random
+import pstats
+import cProfile
+import logging
+import threading
+from flask import request, jsonify, Response
+from werkzeug.exceptions import HTTPException
+
+logger = logging.getLogger(__name__)
+
+MODES = ('sampler', 'cprofile')
+MAX_STACK_DEPTH = 128
+
+
+def _frame_label(code):
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+class RequestProfiler:
+    """Per-route stack samples and cProfile statistics for sampled requests"""
+
+    def __init__(self, app):
+        self.app = app
+        self._wsgi_app = app.wsgi_app
+        self.enabled = False
+        self.mode = 'sampler'
+        self.sample_rate = 0.0
+        self.header = 'X-Profile-Request'
+        self.interval = 0.005
+        self._environ_header = self._environ_key(self.header)
+        self._lock = threading.Lock()
+        self._active = {}
+        self._stop = threading.Event()
+        self._sampler = None
+        self.reset()
+
+    @staticmethod
+    def _environ_key(header):
+        return 'HTTP_' + header.upper().replace('-', '_')
+
+    def reset(self):
+        with self._lock:
+            self.stacks = {}
+            self.profiles = {}
+            self.sampled_requests = {}
+            self.started_at = time.time()
+
+    def enable(self, sample_rate=None, mode=None, header=None, interval_ms=None):
+        if mode is not None:
+            if mode not in MODES:
+                raise ValueError(f"mode must be one of {MODES}")
+            if mode != self.mode:
+                self.reset()
+            self.mode = mode
+        if sample_rate is not None:
+            sample_rate = float(sample_rate)
+            if not 0.0 <= sample_rate <= 1.0:
+                raise ValueError('sample_rate must be between 0 and 1')
+            self.sample_rate = sample_rate
+        if header:
+            self.header = header
+            self._environ_header = self._environ_key(header)
+        if interval_ms is not None:
+            self.interval = max(float(interval_ms), 1.0) / 1000.0
+
+        self.disable()
+        if self.mode == 'sampler':
+            self._stop.clear()
+            self._sampler = threading.Thread(target=self._sample_loop, name='request-profiler', daemon=True)
+            self._sampler.start()
+        self.app.wsgi_app = self._profiled_wsgi_app
+        self.enabled = True
+        logger.info(f"Request profiling enabled ({self.mode}, rate={self.sample_rate}, header={self.header})")
+
+    def disable(self):
+        self.app.wsgi_app = self._wsgi_app
+        if self._sampler is not None:
+            self._stop.set()
+            self._sampler.join()
+            self._sampler = None
+        if self.enabled:
+            logger.info("Request profiling disabled")
+        self.enabled = False
+
+    def _route_for(self, environ):
+        try:
+            rule, _ = self.app.url_map.bind_to_environ(environ).match(return_rule=True)
+            return f"{environ.get('REQUEST_METHOD', 'GET')} {rule.rule}"
+        except HTTPException:
+            return f"{environ.get('REQUEST_METHOD', 'GET')} <unmatched>"
+
+    def _profiled_wsgi_app(self, environ, start_response):
+        if not (self._environ_header in environ or (self.sample_rate and random.random() < self.sample_rate)):
+            return self._wsgi_app(environ, start_response)
+
+        route = self._route_for(environ)
+        with self._lock:
+            self.sampled_requests[route] = self.sampled_requests.get(route, 0) + 1
+
+        if self.mode == 'cprofile':
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                return self._wsgi_app(environ, start_response)
+            finally:
+                profile.disable()
+                self._add_profile(route, profile)
+
+        thread_id = threading.get_ident()
+        self._active[thread_id] = (route, sys._getframe())
+        try:
+            return self._wsgi_app(environ, start_response)
+        finally:
+            self._active.pop(thread_id, None)
+
+    def _add_profile(self, route, profile):
+        with self._lock:
+            stats = self.profiles.get(route)
+            if stats is None:
+                self.profiles[route] = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+
+    def _sample_loop(self):
+        while not self._stop.wait(self.interval):
+            if not self._active:
+                continue
+            frames = sys._current_frames()
+            for thread_id, (route, stop_frame) in list(self._active.items()):
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None and frame is not stop_frame and len(stack) < MAX_STACK_DEPTH:
+                    stack.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                if not stack:
+                    continue
+                stack.append(route)
+                key = ';'.join(reversed(stack))
+                with self._lock:
+                    route_stacks = self.stacks.setdefault(route, {})
+                    route_stacks[key] = route_stacks.get(key, 0) + 1
+
+    def collapsed(self, route=None):
+        """Brendan Gregg collapsed-stack format, one 'frame;frame;... count' per line"""
+        with self._lock:
+            lines = [
+                f"{stack} {count}"
+                for name, stacks in sorted(self.stacks.items()) if route is None or name == route
+                for stack, count in sorted(stacks.items(), key=lambda item: -item[1])
+            ]
+        return '\n'.join(lines) + ('\n' if lines else '')
+
+    def cprofile_report(self, route=None, limit=40, sort='cumulative'):
+        """pstats text report per route"""
+        out = io.StringIO()
+        with self._lock:
+            for name, stats in sorted(self.profiles.items()):
+                if route is not None and name != route:
+                    continue
+                out.write(f"===== {name} ({self.sampled_requests.get(name, 0)} requests) =====\n")
+                stats.stream = out
+                stats.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+    def status(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'mode': self.mode,
+                'sample_rate': self.sample_rate,
+                'header': self.header,
+                'interval_ms': round(self.interval * 1000, 3),
+                'since': self.started_at,
+                'routes': {
+                    route: {
+                        'requests': count,
+                        'samples': sum(self.stacks.get(route, {}).values()),
+                    }
+                    for route, count in sorted(self.sampled_requests.items())
+                },
+            }
+
+
+def init_app(app, auth_required):
+    """
+    Attach a RequestProfiler to app and register the admin endpoints under
+    /internal/profiling, protected by the auth_required decorator
+    """
+    profiler = RequestProfiler(app)
+    app.extensions['request_profiler'] = profiler
+
+    rate = float(os.getenv('PROFILING_SAMPLE_RATE', '0') or 0)
+    if rate > 0:
+        profiler.enable(sample_rate=rate, mode=os.getenv('PROFILING_MODE', 'sampler'),
+                        header=os.getenv('PROFILING_HEADER'),
+                        interval_ms=os.getenv('PROFILING_INTERVAL_MS'))
+
+    @app.route('/internal/profiling', methods=['GET'])
+    @auth_required
+    def profiling_status():
+        """Current profiling configuration and per-route sample counts"""
+        return jsonify(profiler.status())
+
+    @app.route('/internal/profiling', methods=['POST'])
+    @auth_required
+    def profiling_configure():
+        """Enable/disable profiling: {enabled, sample_rate, mode, header, interval_ms}"""
+        data = request.get_json(silent=True) or {}
+        try:
+            if data.get('enabled', True):
+                profiler.enable(sample_rate=data.get('sample_rate'), mode=data.get('mode'),
+                                header=data.get('header'), interval_ms=data.get('interval_ms'))
+            else:
+                profiler.disable()
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify(profiler.status())
+
+    @app.route('/internal/profiling', methods=['DELETE'])
+    @auth_required
+    def profiling_reset():
+        """Discard collected samples"""
+        profiler.reset()
+        return jsonify(profiler.status())
+
+    @app.route('/internal/profiling/collapsed', methods=['GET'])
+    @auth_required
+    def profiling_collapsed():
+        """Collapsed stacks (flamegraph.pl / speedscope input), optionally for one route"""
+        return Response(profiler.collapsed(request.args.get('route')), mimetype='text/plain')
+
+    @app.route('/internal/profiling/cprofile', methods=['GET'])
+    @auth_required
+    def profiling_cprofile():
+        """Aggregated cProfile statistics per route"""
+        limit = request.args.get('limit', 40, type=int)
+        sort = request.args.get('sort', 'cumulative')
+        try:
+            report = profiler.cprofile_report(request.args.get('route'), limit=limit, sort=sort)
+        except KeyError:
+            return jsonify({'error': f'Invalid sort key: {sort}'}), 400
+        return Response(report, mimetype='text/plain')
+
+    return profiler
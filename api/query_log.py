@@ -0,0 +1,215 @@
+"""
+SQL slow-query log for the HHBC Consultancy backends
+Times every statement reported by the database module, aggregates them by
+normalized fingerprint and captures EXPLAIN QUERY PLAN for slow statements
+(on a read-only connection of its own), flagging plans that scan whole tables
+"""
+import os
+import re
+import time
+import pathlib
+import sqlite3
+import logging
+import threading
+from flask import request, jsonify
+
+import database
+
+logger = logging.getLogger(__name__)
+
+_COMMENT_RE = re.compile(r'--[^\n]*|/\*.*?\*/', re.S)
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?(?![\w.])')
+_PLACEHOLDER_LIST_RE = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_VALUES_LIST_RE = re.compile(r'(VALUES\s*\(\.\.\.\))(?:\s*,\s*\(\.\.\.\))+', re.I)
+_NAMED_PARAM_RE = re.compile(r'[:@$]\w+|%\(\w+\)s|%s')
+_WHITESPACE_RE = re.compile(r'\s+')
+
+FINGERPRINT_CACHE_SIZE = 2048
+
+
+def fingerprint(sql):
+    """Normalize a statement: literals and parameters become ?, whitespace collapses"""
+    text = _COMMENT_RE.sub(' ', sql)
+    text = _STRING_RE.sub('?', text)
+    text = _NAMED_PARAM_RE.sub('?', text)
+    text = _NUMBER_RE.sub('?', text)
+    text = _PLACEHOLDER_LIST_RE.sub('(...)', text)
+    text = _VALUES_LIST_RE.sub(r'\1', text)
+    return _WHITESPACE_RE.sub(' ', text).strip()
+
+
+def is_full_scan(detail):
+    """True for plan steps that read a whole table ('SCAN metrics'), not via an index"""
+    detail = detail.upper()
+    return detail.startswith('SCAN') and ' USING ' not in detail and 'VIRTUAL TABLE' not in detail
+
+
+class _QueryStats:
+    __slots__ = ('fingerprint', 'example', 'count', 'total', 'max', 'fetch', 'slow', 'last_seen', 'plan', 'full_scan')
+
+    def __init__(self, fp, example):
+        self.fingerprint = fp
+        self.example = example
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.fetch = 0.0
+        self.slow = 0
+        self.last_seen = 0.0
+        self.plan = None
+        self.full_scan = False
+
+    def to_dict(self):
+        return {
+            'fingerprint': self.fingerprint,
+            'example': self.example,
+            'count': self.count,
+            'total_ms': round(self.total * 1000, 3),
+            'mean_ms': round(self.total / self.count * 1000, 3) if self.count else 0.0,
+            'max_ms': round(self.max * 1000, 3),
+            'fetch_ms': round(self.fetch * 1000, 3),
+            'slow_count': self.slow,
+            'last_seen': self.last_seen,
+            'plan': self.plan,
+            'full_scan': self.full_scan,
+        }
+
+
+class QueryLog:
+    """Statement statistics keyed by fingerprint, with plans for slow statements"""
+
+    def __init__(self, slow_threshold_ms=100.0, max_fingerprints=1000):
+        self.slow_threshold = slow_threshold_ms / 1000.0
+        self.max_fingerprints = max_fingerprints
+        self._lock = threading.Lock()
+        self._fingerprints = {}
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.queries = {}
+            self.started_at = time.time()
+
+    def _fingerprint(self, sql):
+        fp = self._fingerprints.get(sql)
+        if fp is None:
+            fp = fingerprint(sql)
+            if len(self._fingerprints) >= FINGERPRINT_CACHE_SIZE:
+                self._fingerprints.clear()
+            self._fingerprints[sql] = fp
+        return fp
+
+    def on_query(self, connection, sql, params, seconds, phase):
+        """database query listener"""
+        if sql is None:
+            return
+        fp = self._fingerprint(sql)
+        with self._lock:
+            stats = self.queries.get(fp)
+            if stats is None:
+                if len(self.queries) >= self.max_fingerprints:
+                    return
+                stats = self.queries[fp] = _QueryStats(fp, _WHITESPACE_RE.sub(' ', sql).strip())
+            if phase == 'fetch':
+                stats.fetch += seconds
+                stats.total += seconds
+            else:
+                stats.count += 1
+                stats.total += seconds
+                stats.last_seen = time.time()
+            if seconds > stats.max:
+                stats.max = seconds
+            is_slow = seconds >= self.slow_threshold
+            if is_slow:
+                stats.slow += 1
+            needs_plan = is_slow and stats.plan is None and phase != 'executemany'
+
+        if is_slow:
+            logger.warning(f"Slow query ({seconds * 1000:.1f} ms, {phase}): {fp}")
+        if needs_plan:
+            self._capture_plan(stats, connection, sql, params)
+
+    def _capture_plan(self, stats, connection, sql, params):
+        """
+        EXPLAIN the statement on a separate read-only connection to the same
+        file, outside the caller's transaction (tables it has not committed yet
+        cannot be explained)
+        """
+        if not isinstance(connection, sqlite3.Connection):
+            return
+        # The base-class execute() bypasses instrumentation, so this is not logged itself
+        path = next((row[2] for row in sqlite3.Connection.execute(connection, 'PRAGMA database_list')
+                     if row[1] == 'main'), '')
+        if not path:
+            # In-memory and temporary databases cannot be opened a second time
+            return
+        try:
+            # A plain sqlite3 connection: its statements do not reach the query listeners
+            plan_conn = sqlite3.connect(pathlib.Path(path).as_uri() + '?mode=ro', uri=True, timeout=1)
+            try:
+                rows = plan_conn.execute('EXPLAIN QUERY PLAN ' + sql, params if params is not None else ()).fetchall()
+            finally:
+                plan_conn.close()
+            plan = [{'id': row[0], 'parent': row[1], 'detail': row[3]} for row in rows]
+        except sqlite3.Error as e:
+            logger.info(f"Could not explain query: {str(e)}")
+            return
+
+        with self._lock:
+            stats.plan = plan
+            stats.full_scan = any(is_full_scan(step['detail']) for step in plan)
+        if stats.full_scan:
+            logger.warning(f"Full table scan in slow query: {stats.fingerprint}")
+
+    def report(self, sort='total', limit=50, slow_only=False):
+        keys = {
+            'total': lambda q: q.total,
+            'max': lambda q: q.max,
+            'count': lambda q: q.count,
+            'mean': lambda q: q.total / q.count if q.count else 0.0,
+        }
+        if sort not in keys:
+            raise ValueError(f"sort must be one of {sorted(keys)}")
+        with self._lock:
+            queries = [q for q in self.queries.values() if q.slow or not slow_only]
+            queries.sort(key=keys[sort], reverse=True)
+            return {
+                'since': self.started_at,
+                'slow_threshold_ms': round(self.slow_threshold * 1000, 3),
+                'fingerprints': len(self.queries),
+                'full_scans': sum(1 for q in self.queries.values() if q.full_scan),
+                'queries': [q.to_dict() for q in queries[:limit]],
+            }
+
+
+query_log = QueryLog(slow_threshold_ms=float(os.getenv('SLOW_QUERY_MS', '100')))
+
+
+def init_app(app, auth_required, log=None):
+    """Start recording statements and register the admin endpoint /internal/queries"""
+    log = log or query_log
+    database.add_query_listener(log.on_query)
+
+    @app.route('/internal/queries', methods=['GET'])
+    @auth_required
+    def query_report():
+        """Statement fingerprints with counts, total/max time and captured plans"""
+        try:
+            report = log.report(
+                sort=request.args.get('sort', 'total'),
+                limit=request.args.get('limit', 50, type=int),
+                slow_only=request.args.get('slow') in ('1', 'true'),
+            )
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify(report)
+
+    @app.route('/internal/queries', methods=['DELETE'])
+    @auth_required
+    def query_report_reset():
+        """Discard collected statement statistics"""
+        log.reset()
+        return jsonify({'message': 'Query log reset'})
+
+    return log
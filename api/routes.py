@@ -1,6 +1,4 @@
-# Google Sheets integration
-import gspread
-from google.oauth2.service_account import Credentials
+# Google Sheets integration (gspread and google-auth are imported on first use)
 import datetime
 import os  # Added import for os
 
@@ -11,6 +9,9 @@ SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
 SERVICE_ACCOUNT_FILE = os.path.join(os.path.dirname(__file__), "../clave.json")
 
 def append_to_sheet(data):
+    import gspread
+    from google.oauth2.service_account import Credentials
+
     creds = Credentials.from_service_account_file(
         SERVICE_ACCOUNT_FILE, scopes=SCOPES)
     gc = gspread.authorize(creds)
@@ -20,16 +21,38 @@ def append_to_sheet(data):
 
 from flask import Blueprint, request, jsonify
 from flask_jwt_extended import jwt_required, get_jwt_identity, create_access_token
-from models import Metric, ContactRequest, ContactFormMetric, UserSession, db
+from werkzeug.security import check_password_hash
+from models import ContactFormMetric, db
 from datetime import datetime, timedelta
-import uuid
 import logging
+import storage
 from utils import get_client_ip, parse_user_agent, validate_email
 
 api = Blueprint('api', __name__)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def _storage():
+    """Repositories over the app's engine (SQLAlchemy Core, see storage.py)"""
+    return storage.CoreStorage(db.engine)
+
+def _date_range(args):
+    """
+    start_date/end_date as the [start, end) bounds of the repositories; end_date
+    stays inclusive: a plain date covers that whole day, a datetime includes itself
+    """
+    start_date, end_date = args.get('start_date'), args.get('end_date')
+    start = datetime.fromisoformat(start_date) if start_date else None
+    end = None
+    if end_date:
+        end = datetime.fromisoformat(end_date)
+        end += timedelta(days=1) if len(end_date) == 10 else timedelta(microseconds=1)
+    return start, end
+
+def _contact_dict(row):
+    """Contact row as JSON (datetimes in ISO format, like ContactRequest.to_dict)"""
+    return {name: value.isoformat() if isinstance(value, datetime) else value for name, value in row.items()}
+
 # Metrics endpoints
 @api.route('/metrics/track', methods=['POST'])
 def track_metric():
@@ -41,33 +64,32 @@ def track_metric():
             return jsonify({'error': 'event_type is required'}), 400
         
         # Create metric
-        metric = Metric(
-            event_type=data['event_type'],
-            page_url=data.get('page_url'),
-            user_id=data.get('user_id'),
-            session_id=data.get('session_id'),
-            ip_address=get_client_ip(request),
-            user_agent=request.headers.get('User-Agent'),
-            referrer=data.get('referrer'),
-            country=data.get('country'),
-            device_type=data.get('device_type'),
-            additional_data=data.get('additional_data')
-        )
-        
-        db.session.add(metric)
-        db.session.commit()
+        store = _storage()
+        with store.connect() as conn:
+            metric_id = store.metrics.insert(conn, {
+                'event_type': data['event_type'],
+                'page_url': data.get('page_url'),
+                'user_id': data.get('user_id'),
+                'session_id': data.get('session_id'),
+                'ip_address': get_client_ip(request),
+                'user_agent': request.headers.get('User-Agent'),
+                'referrer': data.get('referrer'),
+                'country': data.get('country'),
+                'device_type': data.get('device_type'),
+                'custom_data': data.get('additional_data')
+            })
+            conn.commit()
         
         logger.info(f"Metric tracked: {data['event_type']} - {data.get('page_url', 'N/A')}")
         
         return jsonify({
             'success': True,
-            'metric_id': metric.id,
+            'metric_id': metric_id,
             'message': 'Metric tracked successfully'
         }), 201
         
     except Exception as e:
         logger.error(f"Error tracking metric: {str(e)}")
-        db.session.rollback()
         return jsonify({'error': 'Internal server error'}), 500
 
 @api.route('/metrics/analytics', methods=['GET'])
@@ -75,60 +97,28 @@ def track_metric():
 def get_analytics():
     try:
         # Get query parameters
-        start_date = request.args.get('start_date')
-        end_date = request.args.get('end_date')
         event_type = request.args.get('event_type')
         
-        # Build query
-        query = Metric.query
-        
-        if start_date:
-            query = query.filter(Metric.timestamp >= datetime.fromisoformat(start_date))
-        if end_date:
-            query = query.filter(Metric.timestamp <= datetime.fromisoformat(end_date))
-        if event_type:
-            query = query.filter(Metric.event_type == event_type)
-        
-        # Get metrics
-        metrics = query.all()
+        start, end = _date_range(request.args)
+        filters = {'event_type': event_type} if event_type else {}
+        
+        # Aggregated in SQL instead of loading every row
+        store = _storage()
+        with store.connect() as conn:
+            summary = store.metrics.summary(conn, start, end, filters)
+            breakdowns = {
+                name: dict(store.metrics.count_by(conn, column, start, end, filters))
+                for name, column in (('events_by_type', 'event_type'), ('page_views', 'page_url'),
+                                     ('device_breakdown', 'device_type'), ('country_breakdown', 'country'))
+            }
         
-        # Calculate analytics
         analytics = {
-            'total_events': len(metrics),
-            'events_by_type': {},
-            'page_views': {},
-            'unique_sessions': set(),
-            'unique_users': set(),
-            'device_breakdown': {},
-            'country_breakdown': {}
+            'total_events': summary['total_events'],
+            'unique_sessions': summary['unique_sessions'],
+            'unique_users': summary['unique_users'],
+            **breakdowns
         }
         
-        for metric in metrics:
-            # Events by type
-            analytics['events_by_type'][metric.event_type] = analytics['events_by_type'].get(metric.event_type, 0) + 1
-            
-            # Page views
-            if metric.page_url:
-                analytics['page_views'][metric.page_url] = analytics['page_views'].get(metric.page_url, 0) + 1
-            
-            # Unique sessions and users
-            if metric.session_id:
-                analytics['unique_sessions'].add(metric.session_id)
-            if metric.user_id:
-                analytics['unique_users'].add(metric.user_id)
-            
-            # Device breakdown
-            if metric.device_type:
-                analytics['device_breakdown'][metric.device_type] = analytics['device_breakdown'].get(metric.device_type, 0) + 1
-            
-            # Country breakdown
-            if metric.country:
-                analytics['country_breakdown'][metric.country] = analytics['country_breakdown'].get(metric.country, 0) + 1
-        
-        # Convert sets to counts
-        analytics['unique_sessions'] = len(analytics['unique_sessions'])
-        analytics['unique_users'] = len(analytics['unique_users'])
-        
         return jsonify(analytics), 200
         
     except Exception as e:
@@ -151,57 +141,55 @@ def submit_contact_form():
         if not validate_email(data['email']):
             return jsonify({'error': 'Invalid email format'}), 400
         
-        # Create contact request
-        contact_request = ContactRequest(
-            first_name=data['first_name'].strip(),
-            last_name=data['last_name'].strip(),
-            email=data['email'].strip().lower(),
-            phone=data.get('phone', '').strip(),
-            company=data.get('company', '').strip(),
-            subject=data['subject'],
-            message=data['message'].strip(),
-            priority='high' if data.get('urgent') else 'medium',
-            source='website'
-        )
-        
-        db.session.add(contact_request)
-        db.session.commit()
-        
-        # Track form submission metric
-        form_metric = ContactFormMetric(
-            form_id=contact_request.id,
-            completion_time_seconds=data.get('completion_time_seconds'),
-            field_interactions=data.get('field_interactions'),
-            conversion_rate_data=data.get('conversion_data'),
-            abandonment_point=data.get('abandonment_point')
-        )
-        
-        db.session.add(form_metric)
-        db.session.commit()
-        
-        # Track general metric for form submission
-        track_metric_internal('contact_form_submit', {
-            'page_url': data.get('current_page'),
-            'session_id': data.get('session_id'),
-            'user_id': data.get('user_id'),
-            'additional_data': {
-                'form_id': contact_request.id,
-                'subject': contact_request.subject,
-                'priority': contact_request.priority
-            }
-        })
-        
-        logger.info(f"Contact form submitted: {contact_request.id} - {contact_request.email}")
+        # Create contact request, its form metric and the submit event in one transaction
+        priority = 'high' if data.get('urgent') else 'medium'
+        store = _storage()
+        with store.connect() as conn:
+            request_id = store.contacts.create(conn, {
+                'first_name': data['first_name'].strip(),
+                'last_name': data['last_name'].strip(),
+                'email': data['email'].strip().lower(),
+                'phone': data.get('phone', '').strip(),
+                'company': data.get('company', '').strip(),
+                'subject': data['subject'],
+                'message': data['message'].strip(),
+                'priority': priority,
+                'source': 'website'
+            })
+            
+            # Track form submission metric
+            conn.execute(ContactFormMetric.__table__.insert().values(
+                form_id=request_id,
+                completion_time_seconds=data.get('completion_time_seconds'),
+                field_interactions=data.get('field_interactions'),
+                conversion_rate_data=data.get('conversion_data'),
+                abandonment_point=data.get('abandonment_point')
+            ))
+            
+            # Track general metric for form submission
+            store.metrics.insert(conn, {
+                'event_type': 'contact_form_submit',
+                'page_url': data.get('current_page'),
+                'session_id': data.get('session_id'),
+                'user_id': data.get('user_id'),
+                'custom_data': {
+                    'form_id': request_id,
+                    'subject': data['subject'],
+                    'priority': priority
+                }
+            })
+            conn.commit()
+        
+        logger.info(f"Contact form submitted: {request_id} - {data['email'].strip().lower()}")
         
         return jsonify({
             'success': True,
-            'request_id': contact_request.id,
+            'request_id': request_id,
             'message': 'Contact form submitted successfully. We will respond within 24 hours.'
         }), 201
         
     except Exception as e:
         logger.error(f"Error submitting contact form: {str(e)}")
-        db.session.rollback()
         return jsonify({'error': 'Internal server error'}), 500
 
 # Nuevo endpoint: guarda en Google Sheets
@@ -224,26 +212,17 @@ def get_contact_requests():
         # Get query parameters
         status = request.args.get('status')
         priority = request.args.get('priority')
-        start_date = request.args.get('start_date')
-        end_date = request.args.get('end_date')
-        
-        # Build query
-        query = ContactRequest.query
         
-        if status:
-            query = query.filter(ContactRequest.status == status)
-        if priority:
-            query = query.filter(ContactRequest.priority == priority)
-        if start_date:
-            query = query.filter(ContactRequest.created_at >= datetime.fromisoformat(start_date))
-        if end_date:
-            query = query.filter(ContactRequest.created_at <= datetime.fromisoformat(end_date))
+        filters = {name: value for name, value in (('status', status), ('priority', priority)) if value}
+        start, end = _date_range(request.args)
         
-        # Get requests ordered by created date (newest first)
-        requests = query.order_by(ContactRequest.created_at.desc()).all()
+        # Newest first
+        store = _storage()
+        with store.connect() as conn:
+            requests = store.contacts.list(conn, filters, start, end)
         
         return jsonify({
-            'requests': [req.to_dict() for req in requests],
+            'requests': [_contact_dict(req) for req in requests],
             'total': len(requests)
         }), 200
         
@@ -255,8 +234,12 @@ def get_contact_requests():
 @jwt_required()
 def get_contact_request(request_id):
     try:
-        request_obj = ContactRequest.query.get_or_404(request_id)
-        return jsonify(request_obj.to_dict()), 200
+        store = _storage()
+        with store.connect() as conn:
+            request_obj = store.contacts.get(conn, request_id)
+        if request_obj is None:
+            return jsonify({'error': 'Contact request not found'}), 404
+        return jsonify(_contact_dict(request_obj)), 200
         
     except Exception as e:
         logger.error(f"Error getting contact request: {str(e)}")
@@ -277,29 +260,34 @@ def update_request_status(request_id):
         if new_status not in valid_statuses:
             return jsonify({'error': f'Invalid status. Must be one of: {valid_statuses}'}), 400
         
-        request_obj = ContactRequest.query.get_or_404(request_id)
-        old_status = request_obj.status
-        request_obj.status = new_status
-        
-        if notes:
-            request_obj.notes = notes
-        
-        if new_status == 'resolved' and old_status != 'resolved':
-            request_obj.responded_at = datetime.utcnow()
-        
-        db.session.commit()
+        store = _storage()
+        with store.connect() as conn:
+            request_obj = store.contacts.get(conn, request_id)
+            if request_obj is None:
+                return jsonify({'error': 'Contact request not found'}), 404
+            old_status = request_obj['status']
+            changes = {'status': new_status}
+            
+            if notes:
+                changes['notes'] = notes
+            
+            if new_status == 'resolved' and old_status != 'resolved':
+                changes['responded_at'] = datetime.utcnow()
+            
+            store.contacts.update(conn, request_id, changes)
+            request_obj = store.contacts.get(conn, request_id)
+            conn.commit()
         
         logger.info(f"Contact request status updated: {request_id} - {old_status} -> {new_status}")
         
         return jsonify({
             'success': True,
             'message': 'Status updated successfully',
-            'request': request_obj.to_dict()
+            'request': _contact_dict(request_obj)
         }), 200
         
     except Exception as e:
         logger.error(f"Error updating request status: {str(e)}")
-        db.session.rollback()
         return jsonify({'error': 'Internal server error'}), 500
 
 # Authentication endpoints
@@ -313,8 +301,15 @@ def login():
         if not username or not password:
             return jsonify({'error': 'Username and password are required'}), 400
         
-        # Simple authentication (replace with proper user management)
-        if username == os.getenv('ADMIN_USERNAME', 'admin') and password == os.getenv('ADMIN_PASSWORD', 'admin123'):
+        # Accounts in admin_users; without one, the ADMIN_USERNAME/ADMIN_PASSWORD pair
+        store = _storage()
+        with store.connect() as conn:
+            user = store.admins.find(conn, username)
+        if user is not None:
+            valid = check_password_hash(user['password_hash'], password)
+        else:
+            valid = username == os.getenv('ADMIN_USERNAME', 'admin') and password == os.getenv('ADMIN_PASSWORD', 'admin123')
+        if valid:
             access_token = create_access_token(identity=username, expires_delta=timedelta(hours=24))
             return jsonify({
                 'success': True,
@@ -327,19 +322,3 @@ def login():
     except Exception as e:
         logger.error(f"Error during login: {str(e)}")
         return jsonify({'error': 'Internal server error'}), 500
-
-# Helper function to track metrics internally
-def track_metric_internal(event_type, data):
-    try:
-        metric = Metric(
-            event_type=event_type,
-            page_url=data.get('page_url'),
-            user_id=data.get('user_id'),
-            session_id=data.get('session_id'),
-            additional_data=data.get('additional_data')
-        )
-        db.session.add(metric)
-        db.session.commit()
-    except Exception as e:
-        logger.error(f"Error tracking internal metric: {str(e)}")
-        db.session.rollback()
\ No newline at end of file
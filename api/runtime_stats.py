@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+Per-route runtime statistics for the HHBC Consultancy Flask apps
+Records latency and DB-time histograms, status counts, in-flight requests and
+payload sizes, and exports them at /internal/metrics in Prometheus text format
+"""
+import os
+import time
+import bisect
+import logging
+import threading
+from flask import request, Response, jsonify
+
+import database
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (128, 512, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+UNMATCHED_ROUTE = '<unmatched>'
+
+# Shards of exited threads are folded in when this many shards exist (and at export time),
+# so servers that start a thread per request do not grow without a scrape
+PRUNE_SHARDS_AT = 64
+
+_collectors = []
+
+
+def add_collector(collector):
+    """Register collector(prefix) -> list of Prometheus text lines, appended to /internal/metrics"""
+    if collector not in _collectors:
+        _collectors.append(collector)
+
+
+class _Histogram:
+    """Fixed-bucket histogram; counts are per bucket (not cumulative) until export"""
+
+    __slots__ = ('buckets', 'counts', 'total', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def merge(self, other):
+        for i, value in enumerate(other.counts):
+            self.counts[i] += value
+        self.total += other.total
+        self.count += other.count
+
+
+class _RouteStats:
+    __slots__ = ('latency', 'db_time', 'request_size', 'response_size')
+
+    def __init__(self):
+        self.latency = _Histogram(LATENCY_BUCKETS)
+        self.db_time = _Histogram(LATENCY_BUCKETS)
+        self.request_size = _Histogram(SIZE_BUCKETS)
+        self.response_size = _Histogram(SIZE_BUCKETS)
+
+    def merge(self, other):
+        self.latency.merge(other.latency)
+        self.db_time.merge(other.db_time)
+        self.request_size.merge(other.request_size)
+        self.response_size.merge(other.response_size)
+
+
+class _Shard:
+    """Statistics written by a single thread, so recording never takes a lock"""
+
+    __slots__ = ('thread', 'routes', 'statuses', 'in_flight', 'db_time')
+
+    def __init__(self, thread):
+        self.thread = thread
+        self.routes = {}
+        self.statuses = {}
+        self.in_flight = 0
+        self.db_time = 0.0
+
+    def merge(self, other):
+        for key, stats in list(other.routes.items()):
+            self.routes.setdefault(key, _RouteStats()).merge(stats)
+        for key, count in list(other.statuses.items()):
+            self.statuses[key] = self.statuses.get(key, 0) + count
+        self.in_flight += other.in_flight
+
+
+class RequestStats:
+    """
+    Thread-sharded request statistics. Each thread records into its own shard;
+    shards of finished threads are folded into a retired shard at export time
+    and whenever the number of shards doubles past PRUNE_SHARDS_AT.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._retired = _Shard(None)
+        self._lock = threading.Lock()
+        self._prune_at = PRUNE_SHARDS_AT
+
+    def shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = _Shard(threading.current_thread())
+            with self._lock:
+                self._shards.append(shard)
+                if len(self._shards) >= self._prune_at:
+                    self._retire_exited()
+        return shard
+
+    def _retire_exited(self):
+        """Fold shards of exited threads into the retired shard (caller holds the lock)"""
+        live = []
+        for shard in self._shards:
+            if shard.thread.is_alive():
+                live.append(shard)
+            else:
+                self._retired.merge(shard)
+        self._shards = live
+        # Amortized: the next pass waits until the live shards have doubled
+        self._prune_at = max(PRUNE_SHARDS_AT, 2 * len(live))
+
+    def on_query(self, connection, sql, params, seconds, phase):
+        """Query listener: attribute statement time to the current request"""
+        self.shard().db_time += seconds
+
+    def begin(self):
+        shard = self.shard()
+        shard.in_flight += 1
+        shard.db_time = 0.0
+        return shard
+
+    def end(self, shard, method, route, status, seconds, request_bytes, response_bytes):
+        shard.in_flight -= 1
+        key = (method, route)
+        stats = shard.routes.get(key)
+        if stats is None:
+            stats = shard.routes[key] = _RouteStats()
+        stats.latency.observe(seconds)
+        stats.db_time.observe(shard.db_time)
+        stats.request_size.observe(request_bytes)
+        stats.response_size.observe(response_bytes)
+        status_key = (method, route, status)
+        shard.statuses[status_key] = shard.statuses.get(status_key, 0) + 1
+
+    def snapshot(self):
+        """Merge all shards into one; retires shards whose thread has exited"""
+        merged = _Shard(None)
+        with self._lock:
+            self._retire_exited()
+            merged.merge(self._retired)
+            for shard in self._shards:
+                merged.merge(shard)
+        return merged
+
+    def reset(self):
+        with self._lock:
+            self._shards = []
+            self._retired = _Shard(None)
+            self._prune_at = PRUNE_SHARDS_AT
+        self._local = threading.local()
+
+    def render_prometheus(self, prefix='hhbc'):
+        """Prometheus text exposition format (version 0.0.4)"""
+        snap = self.snapshot()
+        lines = []
+
+        def histogram(name, help_text, attr):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} histogram")
+            for (method, route), stats in sorted(snap.routes.items()):
+                hist = getattr(stats, attr)
+                labels = f'method="{method}",route="{_escape(route)}"'
+                cumulative = 0
+                for bound, count in zip(hist.buckets, hist.counts):
+                    cumulative += count
+                    lines.append(f'{prefix}_{name}_bucket{{{labels},le="{bound:g}"}} {cumulative}')
+                lines.append(f'{prefix}_{name}_bucket{{{labels},le="+Inf"}} {hist.count}')
+                lines.append(f'{prefix}_{name}_sum{{{labels}}} {hist.total:.6f}')
+                lines.append(f'{prefix}_{name}_count{{{labels}}} {hist.count}')
+
+        histogram('http_request_duration_seconds', 'Request latency by route.', 'latency')
+        histogram('http_request_db_seconds', 'Time spent in database calls per request.', 'db_time')
+        histogram('http_request_size_bytes', 'Request body size by route.', 'request_size')
+        histogram('http_response_size_bytes', 'Response body size by route.', 'response_size')
+
+        lines.append(f"# HELP {prefix}_http_requests_total Requests by route and status.")
+        lines.append(f"# TYPE {prefix}_http_requests_total counter")
+        for (method, route, status), count in sorted(snap.statuses.items()):
+            lines.append(f'{prefix}_http_requests_total{{method="{method}",route="{_escape(route)}",status="{status}"}} {count}')
+
+        lines.append(f"# HELP {prefix}_http_requests_in_flight Requests currently being served.")
+        lines.append(f"# TYPE {prefix}_http_requests_in_flight gauge")
+        lines.append(f"{prefix}_http_requests_in_flight {snap.in_flight}")
+        for collector in _collectors:
+            try:
+                lines.extend(collector(prefix))
+            except Exception as e:
+                logger.error(f"Metrics collector error: {str(e)}")
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+request_stats = RequestStats()
+
+
+def init_app(app, auth_required=None, stats=None):
+    """
+    Install the request middleware and the /internal/metrics endpoint on a Flask
+    app. The endpoint takes the app's admin auth (auth_required) or, for
+    scrapers, the METRICS_TOKEN bearer token; with neither it is refused
+    """
+    stats = stats or request_stats
+    database.add_query_listener(stats.on_query)
+    token = os.getenv('METRICS_TOKEN')
+
+    @app.before_request
+    def _stats_before_request():
+        request.environ['hhbc.stats'] = (stats.begin(), time.perf_counter())
+
+    @app.after_request
+    def _stats_after_request(response):
+        environ = request.environ
+        environ['hhbc.status'] = response.status_code
+        environ['hhbc.response_bytes'] = response.content_length or 0
+        return response
+
+    @app.teardown_request
+    def _stats_teardown_request(exc):
+        environ = request.environ
+        started = environ.pop('hhbc.stats', None)
+        if started is None:
+            return
+        shard, start = started
+        elapsed = time.perf_counter() - start
+        rule = request.url_rule
+        try:
+            request_bytes = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            request_bytes = 0
+        stats.end(
+            shard,
+            environ.get('REQUEST_METHOD', 'GET'),
+            rule.rule if rule is not None else UNMATCHED_ROUTE,
+            environ.get('hhbc.status', 500),
+            elapsed,
+            request_bytes,
+            environ.get('hhbc.response_bytes', 0),
+        )
+
+    def render():
+        return Response(stats.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+    admin_render = auth_required(render) if auth_required is not None else None
+
+    @app.route('/internal/metrics')
+    def internal_metrics():
+        """Runtime statistics in Prometheus text format (admin auth or METRICS_TOKEN)"""
+        if token and request.headers.get('Authorization') == f"Bearer {token}":
+            return render()
+        if admin_render is not None:
+            return admin_render()
+        return jsonify({'error': 'Invalid token' if token else 'Set METRICS_TOKEN to scrape /internal/metrics'}), 401
+
+    return stats
+
+
+def measure_overhead(iterations=100000):
+    """Per-request cost of the middleware hooks, in microseconds"""
+    from flask import Flask
+
+    app = Flask(__name__)
+    stats = RequestStats()
+    init_app(app, stats)
+
+    @app.route('/ping/<int:n>')
+    def ping(n):
+        return 'ok'
+
+    before = app.before_request_funcs[None][-1]
+    after = app.after_request_funcs[None][-1]
+    teardown = app.teardown_request_funcs[None][-1]
+    response = app.response_class('ok')
+
+    with app.test_request_context('/ping/1', method='POST', data='{}'):
+        request.url_rule, request.view_args = app.url_map.bind('localhost').match('/ping/1', return_rule=True)
+        start = time.perf_counter()
+        for _ in range(iterations):
+            before()
+            after(response)
+            teardown(None)
+        hooks_us = (time.perf_counter() - start) / iterations * 1e6
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        shard = stats.begin()
+        stats.end(shard, 'GET', '/ping/<int:n>', 200, 0.004, 0, 2)
+    record_us = (time.perf_counter() - start) / iterations * 1e6
+
+    return {'hooks_us': round(hooks_us, 2), 'record_us': round(record_us, 2)}
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    result = measure_overhead()
+    print(f"Middleware hooks per request:  {result['hooks_us']} µs")
+    print(f"Histogram recording alone:     {result['record_us']} µs")
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Per-event-type sampling for metric ingestion
+High-volume event types (scroll, click, ...) can be stored at a rate below 1:
+a kept event is written with sample_weight = 1 / rate and analytics sum the
+weights, so totals stay unbiased estimates. The decision is made before any
+database work, so dropped events cost nothing.
+
+The policy is a JSON object of {event_type: rate} (rates in (0, 1], "*" for
+every other type) in METRICS_SAMPLING_FILE (default: sampling.json next to
+the database). The file is re-read when it changes, at most once per
+RELOAD_INTERVAL seconds, so every worker picks up edits without a restart;
+without a file, METRICS_SAMPLING ("scroll=0.05,click=0.2") is used.
+"""
+import os
+import json
+import time
+import random
+import logging
+import threading
+
+from flask import request, jsonify
+
+logger = logging.getLogger(__name__)
+
+RELOAD_INTERVAL = 1.0
+DEFAULT_KEY = '*'
+
+
+def parse_rates(value):
+    """{event_type: rate} from a dict or 'type=rate,...'; ValueError when a rate is not in (0, 1]"""
+    if isinstance(value, str):
+        pairs = [item.split('=', 1) for item in value.split(',') if item.strip()]
+        if any(len(pair) != 2 for pair in pairs):
+            raise ValueError("Expected event_type=rate pairs")
+        value = {name.strip(): rate.strip() for name, rate in pairs}
+    if not isinstance(value, dict):
+        raise ValueError("Sampling policy must be an object of event_type: rate")
+    rates = {}
+    for event_type, rate in value.items():
+        try:
+            rate = float(rate)
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid rate for {event_type}: {rate!r}")
+        if not 0 < rate <= 1:
+            raise ValueError(f"Rate for {event_type} must be in (0, 1]")
+        rates[str(event_type)] = rate
+    return rates
+
+
+def default_path(db_path):
+    return os.getenv('METRICS_SAMPLING_FILE') or os.path.join(os.path.dirname(os.path.abspath(db_path)), 'sampling.json')
+
+
+class SamplingPolicy:
+    """Sampling rates from a watched JSON file, plus kept/dropped counters per event type"""
+
+    def __init__(self, path):
+        self.path = path
+        self.rates = {}
+        self.source = None
+        self._version = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        self.kept = {}
+        self.dropped = {}
+        self._load()
+
+    def _file_version(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _load(self):
+        version = self._file_version()
+        self._version = version
+        if version is None:
+            try:
+                self.rates = parse_rates(os.getenv('METRICS_SAMPLING', ''))
+                self.source = 'METRICS_SAMPLING'
+            except ValueError as e:
+                logger.warning(f"Ignoring METRICS_SAMPLING: {e}")
+                self.rates, self.source = {}, None
+            return
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                rates = parse_rates(json.load(f))
+        except (OSError, ValueError) as e:
+            # A half-written or invalid file keeps the previous policy
+            logger.warning(f"Ignoring sampling policy {self.path}: {e}")
+            return
+        if rates != self.rates:
+            logger.info(f"Sampling policy loaded from {self.path}: {rates or 'keep everything'}")
+        self.rates, self.source = rates, self.path
+
+    def current(self):
+        """Rates in effect, re-reading the file when it changed"""
+        now = time.monotonic()
+        if now - self._checked >= RELOAD_INTERVAL:
+            with self._lock:
+                if now - self._checked >= RELOAD_INTERVAL:
+                    self._checked = now
+                    if self._file_version() != self._version:
+                        self._load()
+        return self.rates
+
+    def weight(self, event_type):
+        """sample_weight for a kept event, or None when this event is dropped"""
+        rates = self.current()
+        rate = rates.get(event_type, rates.get(DEFAULT_KEY, 1.0))
+        kept = rate >= 1 or random.random() < rate
+        counters = self.kept if kept else self.dropped
+        with self._lock:
+            counters[event_type] = counters.get(event_type, 0) + 1
+        return 1.0 / rate if kept else None
+
+    def update(self, rates):
+        """Replace the policy (validated) and write it to the watched file for every worker"""
+        rates = parse_rates(rates)
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(rates, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+        with self._lock:
+            self._load()
+            self._checked = time.monotonic()
+        return self.rates
+
+    def stats(self):
+        with self._lock:
+            return {
+                'rates': dict(self.rates),
+                'source': self.source,
+                'path': self.path,
+                'kept': dict(self.kept),
+                'dropped': dict(self.dropped),
+            }
+
+
+_policies = {}
+_policies_lock = threading.Lock()
+
+
+def policy_for(path):
+    """Shared policy per file, so counters and the parsed file survive across requests"""
+    with _policies_lock:
+        policy = _policies.get(path)
+        if policy is None:
+            policy = _policies[path] = SamplingPolicy(path)
+        return policy
+
+
+def init_app(app, auth_required, db_path):
+    """Register /internal/sampling (GET the policy and counters, PUT new rates); db_path is a callable"""
+
+    @app.route('/internal/sampling', methods=['GET', 'PUT'])
+    @auth_required
+    def sampling_policy():
+        """Current sampling rates and per-type kept/dropped counts; PUT {event_type: rate} replaces the rates"""
+        policy = policy_for(default_path(db_path()))
+        if request.method == 'PUT':
+            try:
+                policy.update(request.get_json(silent=True))
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            except OSError as e:
+                logger.error(f"Error writing sampling policy: {str(e)}")
+                return jsonify({'error': 'Internal server error'}), 500
+        policy.current()
+        return jsonify(policy.stats())
@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+"""
+Multi-process production server for the HHBC Consultancy backend
+The master imports the app and initializes the database once, then forks
+worker processes that accept on one shared listening socket. Workers are
+recycled after --max-requests and replaced gracefully on SIGHUP.
+
+Signals (master):
+    SIGHUP           reload: check that the app imports in a fresh interpreter,
+                     then re-exec the master on the same socket, so code and
+                     configuration are loaded again; it forks a new generation
+                     of workers and retires the old one (which finishes its
+                     in-flight requests). When the check fails, the running
+                     workers are kept
+    SIGTERM/SIGINT   graceful shutdown (workers finish their current request)
+"""
+import os
+import sys
+import time
+import errno
+import random
+import selectors
+import signal
+import socket
+import logging
+import argparse
+import importlib
+import traceback
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+# Passed to the re-executed master on reload: the listening socket and the workers to retire
+LISTEN_FD_ENV = 'SERVE_LISTEN_FD'
+OLD_WORKERS_ENV = 'SERVE_OLD_WORKERS'
+
+logger = logging.getLogger('serve')
+access_logger = logging.getLogger('serve.access')
+
+
+class AccessLogHandler(WSGIRequestHandler):
+    """One access log line per request; HTTP/1.0 so sync workers are never held by keep-alive"""
+
+    protocol_version = 'HTTP/1.0'
+    access_log = True
+
+    def make_environ(self):
+        environ = super().make_environ()
+        # Lets the app keep long responses (e.g. /metrics/stream) from taking every thread
+        environ['serve.threads'] = self.server.threads
+        return environ
+
+    def log_request(self, code='-', size='-'):
+        if self.access_log:
+            access_logger.info(f"{self.address_string()} \"{self.command} {self.path} {self.request_version}\" {code} {size}")
+
+    def log_error(self, format, *args):
+        logger.error(f"{self.address_string()} {format % args}")
+
+
+class WorkerServer(BaseWSGIServer):
+    """Accepts on an inherited non-blocking socket and counts handled requests"""
+
+    multiprocess = True
+
+    def __init__(self, host, port, app, fd, handler, threads=1):
+        super().__init__(host, port, app, handler=handler, fd=fd)
+        self.socket.setblocking(False)
+        self.requests_handled = 0
+        self.threads = threads
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='worker') if threads > 1 else None
+        self.multithread = threads > 1
+
+    def get_request(self):
+        conn, address = self.socket.accept()
+        conn.setblocking(True)
+        return conn, address
+
+    def serve_until(self, should_stop, poll_interval=0.5):
+        """Accept connections until should_stop() is true; losing an accept race to a sibling is fine"""
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.socket, selectors.EVENT_READ)
+            while not should_stop():
+                if selector.select(poll_interval):
+                    self._handle_request_noblock()
+
+    def process_request(self, request, client_address):
+        self.requests_handled += 1
+        if self.pool is None:
+            return super().process_request(request, client_address)
+        self.pool.submit(self._process_pooled, request, client_address)
+
+    def _process_pooled(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def handle_error(self, request, client_address):
+        logger.error(f"Error handling request from {client_address}:\n{traceback.format_exc()}")
+
+
+def load_app(spec):
+    """Import 'module:attribute' and return the WSGI app and its module"""
+    module_name, _, attr = spec.partition(':')
+    module = importlib.import_module(module_name)
+    return getattr(module, attr or 'app'), module
+
+
+def initialize(module, sample_data=False):
+    """Run the app's one-time database setup in the master before forking"""
+    if hasattr(module, 'startup'):
+        module.startup(sample_data=sample_data)
+        return
+    if hasattr(module, 'init_db'):
+        module.init_db()
+    if hasattr(module, 'create_default_admin'):
+        module.create_default_admin()
+    if sample_data and hasattr(module, 'create_sample_data'):
+        module.create_sample_data()
+
+
+def inherited_socket():
+    """The listening socket handed over by a reloading master, or None"""
+    fd = os.environ.pop(LISTEN_FD_ENV, None)
+    if fd is None:
+        return None
+    sock = socket.socket(fileno=int(fd))
+    sock.setblocking(False)
+    sock.set_inheritable(True)
+    host, port = sock.getsockname()[:2]
+    return sock, host, port
+
+
+def bind_socket(bind, backlog=2048):
+    host, _, port = bind.rpartition(':')
+    host = host.strip('[]') or '0.0.0.0'
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.create_server((host, int(port)), family=family, backlog=backlog)
+    sock.setblocking(False)
+    sock.set_inheritable(True)
+    return sock, host, int(port)
+
+
+class Worker:
+    """Serves requests in a forked child until told to stop or max_requests is reached"""
+
+    def __init__(self, app, sock, host, port, threads, max_requests, access_log):
+        self.app = app
+        self.sock = sock
+        self.host = host
+        self.port = port
+        self.threads = threads
+        self.max_requests = max_requests
+        self.access_log = access_log
+        self.alive = True
+
+    def _stop(self, signum, frame):
+        self.alive = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+        # Background threads started at import time do not survive fork
+        profiler = getattr(self.app, 'extensions', {}).get('request_profiler')
+        if profiler is not None and profiler.enabled:
+            profiler.enable()
+
+        handler = type('WorkerRequestHandler', (AccessLogHandler,), {
+            'access_log': self.access_log,
+            'protocol_version': 'HTTP/1.1' if self.threads > 1 else 'HTTP/1.0',
+        })
+        server = WorkerServer(self.host, self.port, self.app, self.sock.fileno(), handler, self.threads)
+        logger.info(f"Worker {os.getpid()} serving (max_requests={self.max_requests or 'unlimited'})")
+
+        def should_stop():
+            return not self.alive or (self.max_requests and server.requests_handled >= self.max_requests)
+
+        server.serve_until(should_stop)
+        if self.alive:
+            logger.info(f"Worker {os.getpid()} reached {server.requests_handled} requests, recycling")
+
+        if server.pool is not None:
+            server.pool.shutdown(wait=True)
+        return 0
+
+
+class Arbiter:
+    """Master process: forks, monitors, recycles and reloads workers"""
+
+    def __init__(self, app, sock, host, port, workers, threads=1, max_requests=0, max_requests_jitter=0,
+                 graceful_timeout=30, access_log=True, app_spec=None, argv=None, old_workers=()):
+        self.app = app
+        # What a reload re-executes: serve.py with these arguments, after checking that app_spec imports
+        self.app_spec = app_spec
+        self.argv = argv
+        self.old_workers = list(old_workers)
+        self.sock = sock
+        self.host = host
+        self.port = port
+        self.num_workers = workers
+        self.threads = threads
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.graceful_timeout = graceful_timeout
+        self.access_log = access_log
+        self.generation = 0
+        self.workers = {}
+        self.signals = []
+        self.stopping = False
+
+    def _queue_signal(self, signum, frame):
+        self.signals.append(signum)
+
+    def spawn_worker(self):
+        max_requests = self.max_requests
+        if max_requests and self.max_requests_jitter:
+            max_requests += random.randint(0, self.max_requests_jitter)
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = (self.generation, time.monotonic())
+            return pid
+
+        code = 1
+        try:
+            code = Worker(self.app, self.sock, self.host, self.port, self.threads,
+                          max_requests, self.access_log).run()
+        except Exception:
+            logger.error(f"Worker {os.getpid()} crashed:\n{traceback.format_exc()}")
+        finally:
+            os._exit(code)
+
+    def reap_workers(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            generation, started = self.workers.pop(pid, (None, None))
+            code = os.waitstatus_to_exitcode(status)
+            if code != 0 and not self.stopping:
+                logger.warning(f"Worker {pid} exited with status {code}")
+            # Avoid a tight respawn loop when workers die at startup
+            if started is not None and code != 0 and time.monotonic() - started < 1.0:
+                time.sleep(1.0)
+
+    def manage_workers(self):
+        current = sum(1 for generation, _ in self.workers.values() if generation == self.generation)
+        for _ in range(self.num_workers - current):
+            self.spawn_worker()
+
+    def app_imports(self):
+        """Whether the app (new code and configuration) imports in a fresh interpreter"""
+        try:
+            result = subprocess.run(
+                [sys.executable, '-c', 'import sys, serve; serve.load_app(sys.argv[1])', self.app_spec],
+                cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, timeout=120)
+        except subprocess.TimeoutExpired:
+            logger.error(f"Reload aborted: importing {self.app_spec} took too long")
+            return False
+        if result.returncode != 0:
+            logger.error(f"Reload aborted, {self.app_spec} does not import:\n{result.stderr.strip()}")
+            return False
+        return True
+
+    def reload(self):
+        """
+        Re-exec the master with the same arguments and socket (the workers stay
+        children of this pid); the new master starts a generation of workers
+        with the freshly imported app and retires these ones
+        """
+        logger.info("SIGHUP received, reloading")
+        if self.argv is None or not self.app_imports():
+            return
+        env = dict(os.environ)
+        env[LISTEN_FD_ENV] = str(self.sock.fileno())
+        env[OLD_WORKERS_ENV] = ','.join(str(pid) for pid in self.workers)
+        for handler in logging.getLogger().handlers:
+            handler.flush()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.execve(sys.executable, [sys.executable, os.path.abspath(__file__)] + self.argv, env)
+
+    def retire_old_workers(self):
+        """Workers of the master this one replaced: finish their requests and exit"""
+        for pid in self.old_workers:
+            self.workers[pid] = (self.generation - 1, time.monotonic())
+        self.kill_workers(signal.SIGTERM, self.old_workers)
+        self.old_workers = []
+
+    def kill_workers(self, sig, pids=None):
+        for pid in list(self.workers if pids is None else pids):
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                self.workers.pop(pid, None)
+
+    def shutdown(self):
+        self.stopping = True
+        logger.info("Shutting down, waiting for workers to finish")
+        self.kill_workers(signal.SIGTERM)
+        deadline = time.monotonic() + self.graceful_timeout
+        while self.workers and time.monotonic() < deadline:
+            self.reap_workers()
+            time.sleep(0.1)
+        if self.workers:
+            logger.warning(f"Killing {len(self.workers)} workers after {self.graceful_timeout}s")
+            self.kill_workers(signal.SIGKILL)
+            while self.workers:
+                self.reap_workers()
+                time.sleep(0.05)
+        self.sock.close()
+
+    def run(self):
+        for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(sig, self._queue_signal)
+        logger.info(f"Master {os.getpid()} listening on {self.host}:{self.port} with {self.num_workers} workers")
+        self.manage_workers()
+        self.retire_old_workers()
+
+        while True:
+            while self.signals:
+                sig = self.signals.pop(0)
+                if sig == signal.SIGHUP:
+                    self.reload()
+                else:
+                    self.shutdown()
+                    return 0
+            self.reap_workers()
+            self.manage_workers()
+            time.sleep(0.2)
+
+
+def default_workers():
+    return int(os.getenv('WEB_CONCURRENCY', (os.cpu_count() or 1) * 2 + 1))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pre-forking production server for the HHBC backend')
+    parser.add_argument('app', nargs='?', default='app_production:app', help='WSGI app as module:attribute')
+    parser.add_argument('--bind', default=f"0.0.0.0:{os.getenv('PORT', '5000')}", help='host:port to listen on')
+    parser.add_argument('--workers', type=int, default=default_workers(), help='worker processes')
+    parser.add_argument('--threads', type=int, default=int(os.getenv('WORKER_THREADS', '1')),
+                        help='threads per worker (1 = synchronous worker)')
+    parser.add_argument('--max-requests', type=int, default=int(os.getenv('MAX_REQUESTS', '10000')),
+                        help='recycle a worker after this many requests (0 = never)')
+    parser.add_argument('--max-requests-jitter', type=int, default=int(os.getenv('MAX_REQUESTS_JITTER', '1000')),
+                        help='random extra requests so workers do not all recycle at once')
+    parser.add_argument('--graceful-timeout', type=float, default=30.0, help='seconds to wait for workers on shutdown')
+    parser.add_argument('--sample-data', action='store_true', help='also create the demo sample data at startup')
+    parser.add_argument('--no-access-log', action='store_true', help='do not log every request')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    inherited = inherited_socket()
+    old_workers = [int(pid) for pid in os.environ.pop(OLD_WORKERS_ENV, '').split(',') if pid]
+    app, module = load_app(args.app)
+    # A reload runs the (idempotent) database setup again, but not the sample data
+    initialize(module, sample_data=args.sample_data and inherited is None)
+    sock, host, port = inherited or bind_socket(args.bind)
+
+    arbiter = Arbiter(app, sock, host, port, args.workers, threads=args.threads,
+                      max_requests=args.max_requests, max_requests_jitter=args.max_requests_jitter,
+                      graceful_timeout=args.graceful_timeout, access_log=not args.no_access_log,
+                      app_spec=args.app, argv=list(sys.argv[1:] if argv is None else argv),
+                      old_workers=old_workers)
+    return arbiter.run()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
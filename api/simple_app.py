@@ -4,15 +4,16 @@ Simple Flask backend for HHBC Consultancy - Bypass SQLAlchemy for now
 """
 import os
 import sys
-import json
-import sqlite3
-from datetime import datetime
+from datetime import datetime, timedelta
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 from functools import wraps
 import jwt
 import logging
 
+import runtime_stats
+import storage
+
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev-secret-key-12345')
 CORS(app)
@@ -24,62 +25,17 @@ logger = logging.getLogger(__name__)
 # Database setup
 DB_PATH = 'consultoria.db'
 
+def _storage():
+    """Repositories over DB_PATH (storage.py, shared with app_production)"""
+    return storage.SQLiteStorage(DB_PATH)
+
 def init_db():
     """Initialize SQLite database with tables"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    # Create metrics table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS metrics (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            event_type TEXT NOT NULL,
-            page_url TEXT,
-            user_id TEXT,
-            session_id TEXT,
-            device_type TEXT,
-            browser TEXT,
-            ip_address TEXT,
-            referrer TEXT,
-            custom_data TEXT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Create contact_requests table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS contact_requests (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            email TEXT NOT NULL,
-            phone TEXT,
-            company TEXT,
-            subject TEXT NOT NULL,
-            message TEXT NOT NULL,
-            status TEXT DEFAULT 'new',
-            ip_address TEXT,
-            user_agent TEXT,
-            referrer TEXT,
-            custom_data TEXT,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
+    store = _storage()
+    conn = store.connect()
     
-    # Create user_sessions table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS user_sessions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            session_id TEXT UNIQUE NOT NULL,
-            user_id TEXT,
-            ip_address TEXT,
-            user_agent TEXT,
-            device_type TEXT,
-            browser TEXT,
-            first_seen DATETIME DEFAULT CURRENT_TIMESTAMP,
-            last_seen DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
+    # Same tables as app_production, metrics in monthly partitions behind the `metrics` view
+    store.create_schema(conn)
     
     conn.commit()
     conn.close()
@@ -87,7 +43,8 @@ def init_db():
 
 def create_sample_data():
     """Create sample data for demonstration"""
-    conn = sqlite3.connect(DB_PATH)
+    store = _storage()
+    conn = store.connect()
     cursor = conn.cursor()
     
     # Check if data already exists
@@ -104,10 +61,8 @@ def create_sample_data():
         ('form_submit', '/contacto', 'user_456', 'session_def', 'mobile', 'Safari', '192.168.1.2', 'https://hhbc.com/contacto', '{"form_type": "contact", "success": true}')
     ]
     
-    cursor.executemany('''
-        INSERT INTO metrics (event_type, page_url, user_id, session_id, device_type, browser, ip_address, referrer, custom_data)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', sample_metrics)
+    metric_fields = ('event_type', 'page_url', 'user_id', 'session_id', 'device_type', 'browser', 'ip_address', 'referrer', 'custom_data')
+    store.metrics.insert_many(conn, [dict(zip(metric_fields, row)) for row in sample_metrics])
     
     # Insert sample contact requests
     sample_contacts = [
@@ -115,10 +70,9 @@ def create_sample_data():
         ('María Rodríguez', 'maria.rodriguez@email.com', '+56987654321', 'Inversiones ABC', 'Análisis de Negocio', 'Necesitamos un análisis detallado de nuestro modelo de negocio actual y recomendaciones para optimizarlo.', 'in_progress', '192.168.1.3', 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36', 'https://hhbc.com/contacto', '{"urgency": "medium", "budget_range": "$5k-$20k"}')
     ]
     
-    cursor.executemany('''
-        INSERT INTO contact_requests (name, email, phone, company, subject, message, status, ip_address, user_agent, referrer, custom_data)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', sample_contacts)
+    contact_fields = ('name', 'email', 'phone', 'company', 'subject', 'message', 'status', 'ip_address', 'user_agent', 'referrer', 'custom_data')
+    for row in sample_contacts:
+        store.contacts.create(conn, dict(zip(contact_fields, row)))
     
     conn.commit()
     conn.close()
@@ -149,6 +103,9 @@ def require_auth(f):
     
     return decorated_function
 
+# Per-route latency histograms, exported at /internal/metrics (admin auth or METRICS_TOKEN)
+runtime_stats.init_app(app, require_auth)
+
 # Routes
 @app.route('/')
 def index():
@@ -169,24 +126,22 @@ def track_metric():
         if not data.get('event_type'):
             return jsonify({'error': 'event_type is required'}), 400
         
-        # Insert metric into database
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO metrics (event_type, page_url, user_id, session_id, device_type, browser, ip_address, referrer, custom_data)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            data.get('event_type'),
-            data.get('page_url'),
-            data.get('user_id'),
-            data.get('session_id'),
-            data.get('device_type'),
-            data.get('browser'),
-            request.remote_addr,
-            data.get('referrer'),
-            json.dumps(data.get('custom_data', {})) if data.get('custom_data') else None
-        ))
+        # Insert metric into the current month's partition (strings resolved to lookup ids)
+        store = _storage()
+        conn = store.connect()
+        
+        store.metrics.insert(conn, {
+            'event_type': data.get('event_type'),
+            'page_url': data.get('page_url'),
+            'user_id': data.get('user_id'),
+            'session_id': data.get('session_id'),
+            'device_type': data.get('device_type'),
+            'browser': data.get('browser'),
+            'ip_address': request.remote_addr,
+            'referrer': data.get('referrer'),
+            'custom_data': data.get('custom_data'),
+            'timestamp': datetime.utcnow()
+        })
         
         conn.commit()
         conn.close()
@@ -203,58 +158,27 @@ def track_metric():
 def get_analytics():
     """Get analytics data"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # Get metrics summary
-        cursor.execute('''
-            SELECT 
-                COUNT(*) as total_events,
-                COUNT(DISTINCT session_id) as unique_sessions,
-                COUNT(DISTINCT user_id) as unique_users,
-                COUNT(CASE WHEN event_type = 'page_view' THEN 1 END) as page_views,
-                COUNT(CASE WHEN event_type = 'form_submit' THEN 1 END) as form_submissions
-            FROM metrics
-            WHERE timestamp >= datetime('now', '-30 days')
-        ''')
-        
-        summary = cursor.fetchone()
+        store = _storage()
+        conn = store.connect()
         
-        # Get top pages
-        cursor.execute('''
-            SELECT page_url, COUNT(*) as views
-            FROM metrics
-            WHERE event_type = 'page_view' AND page_url IS NOT NULL
-            GROUP BY page_url
-            ORDER BY views DESC
-            LIMIT 10
-        ''')
-        
-        top_pages = cursor.fetchall()
-        
-        # Get device breakdown
-        cursor.execute('''
-            SELECT device_type, COUNT(*) as count
-            FROM metrics
-            WHERE device_type IS NOT NULL
-            GROUP BY device_type
-            ORDER BY count DESC
-        ''')
-        
-        device_breakdown = cursor.fetchall()
+        # Metrics summary (last 30 days, read from the overlapping partitions only);
+        # rows count as their sample_weight, set by app_production's sampling
+        summary = store.metrics.summary(conn, start=datetime.utcnow() - timedelta(days=30))
+        top_pages = store.metrics.count_by(conn, 'page_url', filters={'event_type': 'page_view'}, limit=10)
+        device_breakdown = store.metrics.count_by(conn, 'device_type')
         
         conn.close()
         
         return jsonify({
             'summary': {
-                'total_events': summary[0] or 0,
-                'unique_sessions': summary[1] or 0,
-                'unique_users': summary[2] or 0,
-                'page_views': summary[3] or 0,
-                'form_submissions': summary[4] or 0
+                'total_events': round(summary['total_events']),
+                'unique_sessions': summary['unique_sessions'],
+                'unique_users': summary['unique_users'],
+                'page_views': round(summary['page_views']),
+                'form_submissions': round(summary['form_submissions'])
             },
-            'top_pages': [{'page': page[0], 'views': page[1]} for page in top_pages],
-            'device_breakdown': [{'device': device[0], 'count': device[1]} for device in device_breakdown]
+            'top_pages': [{'page': page[0], 'views': round(page[1])} for page in top_pages],
+            'device_breakdown': [{'device': device[0], 'count': round(device[1])} for device in device_breakdown]
         })
         
     except Exception as e:
@@ -280,26 +204,22 @@ def submit_contact_form():
             return jsonify({'error': 'Invalid email format'}), 400
         
         # Insert contact request into database
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO contact_requests (name, email, phone, company, subject, message, status, ip_address, user_agent, referrer, custom_data)
-            VALUES (?, ?, ?, ?, ?, ?, 'pending', ?, ?, ?, ?)
-        ''', (
-            data.get('name'),
-            data.get('email'),
-            data.get('phone'),
-            data.get('company'),
-            data.get('subject'),
-            data.get('message'),
-            request.remote_addr,
-            request.headers.get('User-Agent'),
-            request.headers.get('Referer'),
-            json.dumps(data.get('custom_data', {})) if data.get('custom_data') else None
-        ))
-        
-        contact_id = cursor.lastrowid
+        store = _storage()
+        conn = store.connect()
+        
+        contact_id = store.contacts.create(conn, {
+            'name': data.get('name'),
+            'email': data.get('email'),
+            'phone': data.get('phone'),
+            'company': data.get('company'),
+            'subject': data.get('subject'),
+            'message': data.get('message'),
+            'status': 'pending',
+            'ip_address': request.remote_addr,
+            'user_agent': request.headers.get('User-Agent'),
+            'referrer': request.headers.get('Referer'),
+            'custom_data': data.get('custom_data')
+        })
         conn.commit()
         conn.close()
         
@@ -320,33 +240,11 @@ def submit_contact_form():
 def get_contact_requests():
     """Get all contact requests"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT id, name, email, phone, company, subject, message, status, created_at, updated_at
-            FROM contact_requests
-            ORDER BY created_at DESC
-        ''')
-        
-        requests = cursor.fetchall()
+        store = _storage()
+        conn = store.connect()
+        contact_requests = store.contacts.list(conn, columns=storage.SQLiteContacts.LISTED)
         conn.close()
         
-        contact_requests = []
-        for req in requests:
-            contact_requests.append({
-                'id': req[0],
-                'name': req[1],
-                'email': req[2],
-                'phone': req[3],
-                'company': req[4],
-                'subject': req[5],
-                'message': req[6],
-                'status': req[7],
-                'created_at': req[8],
-                'updated_at': req[9]
-            })
-        
         return jsonify({'contact_requests': contact_requests})
         
     except Exception as e:
@@ -368,16 +266,10 @@ def update_contact_status(request_id):
         if new_status not in valid_statuses:
             return jsonify({'error': 'Invalid status'}), 400
         
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            UPDATE contact_requests 
-            SET status = ?, updated_at = CURRENT_TIMESTAMP
-            WHERE id = ?
-        ''', (new_status, request_id))
+        store = _storage()
+        conn = store.connect()
         
-        if cursor.rowcount == 0:
+        if not store.contacts.update(conn, request_id, {'status': new_status}):
             conn.close()
             return jsonify({'error': 'Contact request not found'}), 404
         
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Cold-start benchmark for the HHBC Consultancy backends
+Every measurement runs in a fresh interpreter: module import time for each app,
+database initialization on a new and on an existing database file, and the
+time until serve.py answers /health
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+import http.client
+from datetime import datetime
+
+from benchmark import RESULTS_DIR, git_commit
+
+API_DIR = os.path.dirname(os.path.abspath(__file__))
+
+IMPORT_PROBE = '''
+import sys, time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+print(int('gspread' in sys.modules), int('flask_migrate' in sys.modules))
+'''
+
+# Prefers the single-transaction startup() and falls back to the separate init functions
+INIT_PROBE = '''
+import logging, time
+logging.disable(logging.CRITICAL)
+import database, app_production
+opened = []
+connect = database.connect
+database.connect = lambda *args, **kwargs: opened.append(1) or connect(*args, **kwargs)
+start = time.perf_counter()
+if hasattr(app_production, 'startup'):
+    app_production.startup(sample_data=True)
+else:
+    app_production.init_db()
+    app_production.create_default_admin()
+    app_production.create_sample_data()
+print(time.perf_counter() - start)
+print(len(opened))
+'''
+
+
+def _run_probe(code, env):
+    result = subprocess.run([sys.executable, '-c', code], cwd=API_DIR, env=env,
+                            capture_output=True, text=True, check=True)
+    return result.stdout.split()
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def measure_import(module, env, repeat):
+    timings = []
+    for _ in range(repeat):
+        seconds, gspread, migrate = _run_probe(IMPORT_PROBE.format(module=module), env)
+        timings.append(float(seconds))
+    return {'median_ms': round(statistics.median(timings) * 1000, 1),
+            'min_ms': round(min(timings) * 1000, 1),
+            'gspread_loaded': gspread == '1', 'flask_migrate_loaded': migrate == '1'}
+
+
+def measure_init(env, workdir, repeat):
+    cold, warm, connections = [], [], {}
+    for i in range(repeat):
+        db_path = os.path.join(workdir, f'startup-{i}.db')
+        env = dict(env, DATABASE_URL=db_path)
+        seconds, opened = _run_probe(INIT_PROBE, env)
+        cold.append(float(seconds))
+        connections['cold'] = int(opened)
+        seconds, opened = _run_probe(INIT_PROBE, env)
+        warm.append(float(seconds))
+        connections['warm'] = int(opened)
+    return {'cold_median_ms': round(statistics.median(cold) * 1000, 1),
+            'warm_median_ms': round(statistics.median(warm) * 1000, 1),
+            'connections': connections}
+
+
+def measure_ready(env, workdir, repeat, timeout=60):
+    """Spawn serve.py with one worker and time until /health returns 200"""
+    timings = []
+    db_path = os.path.join(workdir, 'serve.db')
+    for _ in range(repeat):
+        port = _free_port()
+        start = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, os.path.join(API_DIR, 'serve.py'), '--bind', f'127.0.0.1:{port}',
+                                 '--workers', '1', '--no-access-log', '--sample-data'],
+                                cwd=API_DIR, env=dict(env, DATABASE_URL=db_path),
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            while time.perf_counter() - start < timeout:
+                try:
+                    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+                    conn.request('GET', '/health')
+                    if conn.getresponse().status == 200:
+                        timings.append(time.perf_counter() - start)
+                        break
+                except OSError:
+                    time.sleep(0.005)
+            else:
+                raise RuntimeError('serve.py did not become ready')
+        finally:
+            proc.terminate()
+            proc.wait(timeout=30)
+    return {'median_ms': round(statistics.median(timings) * 1000, 1), 'min_ms': round(min(timings) * 1000, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure backend cold-start time')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per measurement (median reported)')
+    parser.add_argument('--output', help='where to write the JSON results')
+    args = parser.parse_args()
+
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1')
+    workdir = tempfile.mkdtemp(prefix='hhbc-startup-')
+    try:
+        results = {
+            'import_app_production': measure_import('app_production', env, args.repeat),
+            'import_app': measure_import('app', env, args.repeat),
+            'init': measure_init(env, workdir, args.repeat),
+            'serve_ready': measure_ready(env, workdir, args.repeat),
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{'measurement':<28}{'median ms':>12}")
+    print(f"{'import app_production':<28}{results['import_app_production']['median_ms']:>12.1f}")
+    print(f"{'import app (SQLAlchemy)':<28}{results['import_app']['median_ms']:>12.1f}")
+    print(f"{'init, new database':<28}{results['init']['cold_median_ms']:>12.1f}")
+    print(f"{'init, existing database':<28}{results['init']['warm_median_ms']:>12.1f}")
+    print(f"{'serve.py ready (/health)':<28}{results['serve_ready']['median_ms']:>12.1f}")
+    print(f"connections opened by init: {results['init']['connections']}")
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        output = os.path.join(RESULTS_DIR, f"startup-{stamp}-{report['meta']['commit'] or 'nogit'}.json")
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\n💾 Results saved to {output}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,718 @@
+#!/usr/bin/env python3
+"""
+Storage layer shared by the backends
+One interface - abstract metrics, contacts and admin users repositories - with two
+implementations:
+    SQLiteStorage - raw sqlite3 over the tuned schema (monthly partitions,
+                    lookup tables, archived months, promoted custom_data
+                    keys); used by app_production.py and simple_app.py
+    CoreStorage   - SQLAlchemy Core over the models.py tables; used by
+                    app.py/routes.py
+
+Repository methods take a connection from storage.connect() as their first
+argument and never commit, so callers keep control of transactions (and can
+add their own statements, e.g. idempotency keys, to the same one).
+
+Records are plain dicts. Metric events use the METRIC_FIELDS names; fields a
+schema has no column for are not stored (the models.py table has no browser
+or sample_weight, the partitions keep country inside custom_data). Contacts
+come back with the columns of the implementation's table; both accept `name`
+or `first_name`/`last_name` on create. Time bounds are datetimes or stored
+timestamp strings, ranges are [start, end). Event counts are sums of sample
+weights (floats) in the SQLite implementation and row counts in Core.
+"""
+import json
+import uuid
+from abc import ABC, abstractmethod
+from datetime import datetime
+
+import archive
+import analytics_engine
+import database
+import json_keys
+import lookups
+import partitions
+
+try:
+    import sqlalchemy as sa
+except ImportError:
+    sa = None
+
+METRIC_FIELDS = ('event_type', 'page_url', 'user_id', 'session_id', 'device_type', 'browser', 'ip_address',
+                 'user_agent', 'referrer', 'country', 'custom_data', 'timestamp', 'sample_weight')
+
+SUMMARY_FIELDS = ('total_events', 'unique_sessions', 'unique_users', 'page_views', 'form_submissions')
+
+# Schema of the raw-sqlite backends besides the metrics partitions (partitions.py)
+SQLITE_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS contact_requests (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        email TEXT NOT NULL,
+        phone TEXT,
+        company TEXT,
+        subject TEXT NOT NULL,
+        message TEXT NOT NULL,
+        status TEXT DEFAULT 'new',
+        ip_address TEXT,
+        user_agent TEXT,
+        referrer TEXT,
+        custom_data TEXT,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        responded_at DATETIME,
+        notes TEXT
+    )
+    ''',
+    # Range scans for changed rows (list(changed_since=...))
+    'CREATE INDEX IF NOT EXISTS idx_contact_requests_updated_at ON contact_requests (updated_at)',
+    # Newest-first pages (list(limit=...)) without sorting the table
+    'CREATE INDEX IF NOT EXISTS idx_contact_requests_created_at ON contact_requests (created_at)',
+    '''
+    CREATE TABLE IF NOT EXISTS user_sessions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT UNIQUE NOT NULL,
+        user_id TEXT,
+        ip_address TEXT,
+        user_agent TEXT,
+        device_type TEXT,
+        browser TEXT,
+        first_seen DATETIME DEFAULT CURRENT_TIMESTAMP,
+        last_seen DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS admin_users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE NOT NULL,
+        password_hash TEXT NOT NULL,
+        email TEXT,
+        is_active BOOLEAN DEFAULT 1,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        last_login DATETIME
+    )
+    ''',
+]
+
+
+def _json_text(value):
+    """custom_data as stored text: dicts are serialized, empty values become NULL"""
+    if not value:
+        return None
+    return value if isinstance(value, str) else json.dumps(value)
+
+
+def _json_object(value):
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            return None
+    return value or None
+
+
+def _full_name(fields):
+    name = fields.get('name')
+    if name is None and (fields.get('first_name') or fields.get('last_name')):
+        name = ' '.join(part for part in (fields.get('first_name'), fields.get('last_name')) if part)
+    return name
+
+
+def _check_column(column, allowed):
+    """Column names are interpolated into SQL, so only known ones get through"""
+    if column not in allowed:
+        raise ValueError(f"Unknown column: {column}")
+    return column
+
+
+# Interface
+
+class MetricsRepository(ABC):
+    """Tracked events: writes and the aggregates the analytics endpoints need"""
+
+    @abstractmethod
+    def dimensions(self):
+        """Columns usable in filters and count_by"""
+
+    @abstractmethod
+    def insert(self, conn, event):
+        """Store one event dict; returns its id"""
+
+    @abstractmethod
+    def insert_many(self, conn, events):
+        """Store event dicts"""
+
+    @abstractmethod
+    def summary(self, conn, start=None, end=None, filters=None, after_id=None):
+        """
+        {SUMMARY_FIELDS: value} for events in [start, end) matching {dimension: value}
+        filters; with after_id only events stored after that high_water() mark
+        """
+
+    @abstractmethod
+    def count_by(self, conn, column, start=None, end=None, filters=None, limit=None, after_id=None):
+        """[(value, count)] per value of a dimension, largest first"""
+
+    @abstractmethod
+    def high_water(self, conn):
+        """Id of the newest stored event: after_id for the next delta query"""
+
+    @abstractmethod
+    def low_water(self, conn):
+        """
+        Oldest after_id deltas can still be computed from (older events were
+        archived or dropped, or events were since stored below that mark)
+        """
+
+
+class ContactsRepository(ABC):
+    """Contact form submissions"""
+
+    @abstractmethod
+    def columns(self):
+        """Columns of the contacts table"""
+
+    @abstractmethod
+    def create(self, conn, fields):
+        """Store a submission; returns its id"""
+
+    @abstractmethod
+    def list(self, conn, filters=None, start=None, end=None, columns=None, changed_since=None, limit=None, offset=0):
+        """
+        Row dicts matching {column: value} filters, created in [start, end), newest
+        first (limit/offset for one page); with changed_since only rows created or
+        updated at or after that high_water() mark
+        """
+
+    @abstractmethod
+    def high_water(self, conn):
+        """Newest updated_at (changed_since for the next query); None without contacts"""
+
+    @abstractmethod
+    def get(self, conn, contact_id):
+        """Row dict, or None"""
+
+    @abstractmethod
+    def update(self, conn, contact_id, fields):
+        """Set fields (updated_at is refreshed); False when there is no such contact"""
+
+    @abstractmethod
+    def update_statuses(self, conn, changes):
+        """
+        Apply [(contact_id, status, notes)] with one executemany (notes are kept
+        when None, responded_at is set when a contact becomes resolved); returns
+        {contact_id: previous status} of the contacts that exist
+        """
+
+    @abstractmethod
+    def count_by(self, conn, column, filters=None):
+        """[(value, count)] per non-NULL value of a column, largest first"""
+
+
+class AdminUsers(ABC):
+    """Accounts allowed to log in"""
+
+    @abstractmethod
+    def find(self, conn, username):
+        """Active user as {id, username, password_hash, email}, or None"""
+
+    @abstractmethod
+    def exists(self, conn, username):
+        """Whether the username is taken"""
+
+    @abstractmethod
+    def create(self, conn, username, password_hash, email=None):
+        """False when the username is taken"""
+
+
+class Storage(ABC):
+    """A database plus the repositories reading and writing it"""
+    name = None
+    metrics = None
+    contacts = None
+    admins = None
+
+    @abstractmethod
+    def connect(self):
+        """A new connection to the database"""
+
+    @abstractmethod
+    def create_schema(self, conn):
+        """Create the tables; does not commit"""
+
+
+# Raw sqlite3
+
+class SQLiteMetrics(MetricsRepository):
+    """Metrics in monthly partitions with interned strings; archived months (archive.py) are merged in"""
+
+    def dimensions(self):
+        return analytics_engine.dimensions()
+
+    def _row(self, event):
+        custom_data = event.get('custom_data')
+        if event.get('country') is not None:
+            # country is a custom_data key here (promoted to a column by default)
+            custom_data = dict(_json_object(custom_data) or {}, country=event['country'])
+        timestamp = event.get('timestamp')
+        return (
+            event.get('event_type'),
+            event.get('page_url'),
+            event.get('user_id'),
+            event.get('session_id'),
+            event.get('device_type'),
+            event.get('browser'),
+            event.get('ip_address'),
+            event.get('referrer'),
+            _json_text(custom_data),
+            partitions.format_timestamp(timestamp) if isinstance(timestamp, datetime) else timestamp,
+            event.get('sample_weight', 1),
+        )
+
+    def insert(self, conn, event):
+        partitions.metrics_partitions.insert_many(conn, [self._row(event)])
+        return conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+
+    def insert_many(self, conn, events):
+        partitions.metrics_partitions.insert_many(conn, [self._row(event) for event in events])
+
+    def _bound(self, value):
+        return partitions.format_timestamp(value) if isinstance(value, datetime) else value
+
+    def _lookup_id(self, conn, column, value):
+        """Lookup id of a stored string; -1 (matches nothing) when it was never stored"""
+        id_ = lookups.string_lookups.find(conn, column, value)
+        return -1 if id_ is None else id_
+
+    def _expression(self, name):
+        """Stored column of a dimension: interned strings are compared and grouped by id"""
+        _check_column(name, self.dimensions())
+        return lookups.id_column(name) if name in lookups.LOOKUP_COLUMNS else analytics_engine.column_sql(name)
+
+    def _where(self, conn, filters, start=None, end=None, after_id=None):
+        """WHERE clause and params over partitions.source(raw=True)"""
+        clauses, params = [], []
+        if after_id is not None:
+            clauses.append('id > ?')
+            params.append(after_id)
+        if start is not None:
+            clauses.append('timestamp >= ?')
+            params.append(start)
+        if end is not None:
+            clauses.append('timestamp < ?')
+            params.append(end)
+        for name, value in filters.items():
+            clauses.append(f"{self._expression(name)} = ?")
+            params.append(self._lookup_id(conn, name, value) if name in lookups.LOOKUP_COLUMNS else value)
+        return ' AND '.join(clauses) or '1', params
+
+    def _archive(self, conn):
+        store = archive.store_for(archive.default_directory(conn.path))
+        return store if store.files(conn) else None
+
+    def summary(self, conn, start=None, end=None, filters=None, after_id=None):
+        filters = filters or {}
+        start, end = self._bound(start), self._bound(end)
+        cursor = conn.cursor()
+        where, params = self._where(conn, filters, start, end, after_id)
+        source = partitions.metrics_partitions.source(conn, start=start, end=end, raw=True, after_id=after_id)
+        cursor.execute(f'''
+            SELECT
+                TOTAL(sample_weight) as total_events,
+                COUNT(DISTINCT session_id) as unique_sessions,
+                COUNT(DISTINCT user_id) as unique_users,
+                TOTAL(CASE WHEN event_type_id = ? THEN sample_weight END) as page_views,
+                TOTAL(CASE WHEN event_type_id = ? THEN sample_weight END) as form_submissions
+            FROM {source}
+            WHERE {where}
+        ''', [self._lookup_id(conn, 'event_type', 'page_view'), self._lookup_id(conn, 'event_type', 'form_submit')] + params)
+
+        summary = [value or 0 for value in cursor.fetchone()]
+        # Archived months are older than any low_water() mark
+        store = self._archive(conn) if after_id is None else None
+        if store is not None and store.files_for_range(start, end, conn=conn):
+            events = store.count_by('event_type', start=start, end=end, where=filters, conn=conn)
+            summary[0] += sum(events.values())
+            summary[3] += events['page_view']
+            summary[4] += events['form_submit']
+            for position, column in ((1, 'session_id'), (2, 'user_id')):
+                hot = {row[0] for row in cursor.execute(
+                    f"SELECT DISTINCT {column} FROM {source} WHERE {where} AND {column} IS NOT NULL", params)}
+                summary[position] = len(hot | store.distinct(column, start=start, end=end, where=filters, conn=conn))
+        return dict(zip(SUMMARY_FIELDS, summary))
+
+    def count_by(self, conn, column, start=None, end=None, filters=None, limit=None, after_id=None):
+        filters = filters or {}
+        start, end = self._bound(start), self._bound(end)
+        expression = self._expression(column)
+        where, params = self._where(conn, filters, start, end, after_id)
+        rows = conn.execute(f'''
+            SELECT {expression}, TOTAL(sample_weight) as count
+            FROM {partitions.metrics_partitions.source(conn, start, end, raw=True, after_id=after_id)}
+            WHERE {where} AND {expression} IS NOT NULL
+            GROUP BY {expression}
+        ''', params).fetchall()
+        if column in lookups.LOOKUP_COLUMNS:
+            values = lookups.string_lookups.values(conn, column, [row[0] for row in rows])
+            rows = [(values.get(id_), count) for id_, count in rows]
+        # Archived months are merged before the limit
+        store = self._archive(conn) if after_id is None else None
+        archived = store.count_by(column, start, end, where=filters, conn=conn) if store is not None else {}
+        return archive.merge_counts(rows, archived, limit=limit)
+
+    def high_water(self, conn):
+        return partitions.metrics_partitions.high_water(conn)
+
+    def low_water(self, conn):
+        router = partitions.metrics_partitions
+        months = router.months(conn)
+        # Writes into an older month get ids below the marks handed out before them
+        return max(partitions.id_base(months[0]) if months else 0, router.backdated_mark(conn))
+
+
+class SQLiteContacts(ContactsRepository):
+    STORED = ('name', 'email', 'phone', 'company', 'subject', 'message', 'status', 'ip_address', 'user_agent',
+              'referrer', 'custom_data', 'responded_at', 'notes')
+    LISTED = ('id', 'name', 'email', 'phone', 'company', 'subject', 'message', 'status', 'created_at', 'updated_at',
+              'responded_at', 'notes')
+    # Added in schema version 12; ALTER TABLE appends them to older tables
+    ADDED = (('responded_at', 'DATETIME'), ('notes', 'TEXT'))
+
+    def columns(self):
+        """Listed columns plus the promoted custom_data keys (json_keys.py)"""
+        return self.LISTED + json_keys.promoted_keys('contact_requests')
+
+    def _filterable(self):
+        return self.columns() + ('ip_address', 'user_agent', 'referrer', 'custom_data')
+
+    def create(self, conn, fields):
+        values = dict(fields, name=_full_name(fields))
+        values['custom_data'] = _json_text(values.get('custom_data'))
+        names = [name for name in self.STORED if values.get(name) is not None]
+        cursor = conn.execute(f'''
+            INSERT INTO contact_requests ({', '.join(names)})
+            VALUES ({', '.join('?' * len(names))})
+        ''', [values[name] for name in names])
+        return cursor.lastrowid
+
+    def _where(self, filters, start=None, end=None, changed_since=None):
+        clauses = [f"{_check_column(name, self._filterable())} = ?" for name in filters]
+        params = list(filters.values())
+        for column, operator, bound in (('created_at', '>=', start), ('created_at', '<', end),
+                                        ('updated_at', '>=', changed_since)):
+            if bound is not None:
+                clauses.append(f"{column} {operator} ?")
+                params.append(partitions.format_timestamp(bound) if isinstance(bound, datetime) else bound)
+        return ' AND '.join(clauses) or '1', params
+
+    def list(self, conn, filters=None, start=None, end=None, columns=None, changed_since=None, limit=None, offset=0):
+        columns = [_check_column(c, self._filterable()) for c in columns or self.columns()]
+        where, params = self._where(filters or {}, start, end, changed_since)
+        rows = conn.execute(f'''
+            SELECT {', '.join(columns)}
+            FROM contact_requests
+            WHERE {where}
+            ORDER BY created_at DESC, id DESC
+            LIMIT ? OFFSET ?
+        ''', params + [-1 if limit is None else limit, offset]).fetchall()
+        return [dict(zip(columns, row)) for row in rows]
+
+    def get(self, conn, contact_id):
+        found = self.list(conn, {'id': contact_id})
+        return found[0] if found else None
+
+    def high_water(self, conn):
+        return conn.execute('SELECT MAX(updated_at) FROM contact_requests').fetchone()[0]
+
+    def update(self, conn, contact_id, fields):
+        names = [_check_column(name, self.STORED) for name in fields]
+        cursor = conn.execute(f'''
+            UPDATE contact_requests
+            SET {''.join(f"{name} = ?, " for name in names)}updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', [fields[name] for name in names] + [contact_id])
+        return cursor.rowcount > 0
+
+    def update_statuses(self, conn, changes):
+        ids = [change[0] for change in changes]
+        previous = {}
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            previous.update(conn.execute(
+                f"SELECT id, status FROM contact_requests WHERE id IN ({', '.join('?' * len(chunk))})", chunk))
+        # Right-hand sides see the row as it was before the update
+        conn.executemany('''
+            UPDATE contact_requests
+            SET status = ?1,
+                notes = COALESCE(?2, notes),
+                responded_at = CASE WHEN ?1 = 'resolved' AND status IS NOT 'resolved'
+                                    THEN CURRENT_TIMESTAMP ELSE responded_at END,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?3
+        ''', [(status, notes, contact_id) for contact_id, status, notes in changes if contact_id in previous])
+        return previous
+
+    def add_columns(self, conn):
+        """Schema version 12: columns missing from an older contact_requests table"""
+        existing = {row[1] for row in conn.execute('PRAGMA table_info(contact_requests)')}
+        missing = [(name, kind) for name, kind in self.ADDED if name not in existing]
+        for name, kind in missing:
+            conn.execute(f"ALTER TABLE contact_requests ADD COLUMN {name} {kind}")
+        return [name for name, _ in missing]
+
+    def count_by(self, conn, column, filters=None):
+        _check_column(column, self._filterable())
+        where, params = self._where(filters or {})
+        return [tuple(row) for row in conn.execute(f'''
+            SELECT {column}, COUNT(*) as count
+            FROM contact_requests
+            WHERE {where} AND {column} IS NOT NULL
+            GROUP BY {column}
+            ORDER BY count DESC, {column}
+        ''', params)]
+
+
+class SQLiteAdminUsers(AdminUsers):
+
+    def find(self, conn, username):
+        row = conn.execute('''
+            SELECT id, username, password_hash, email FROM admin_users
+            WHERE username = ? AND is_active = 1
+        ''', (username,)).fetchone()
+        return dict(zip(('id', 'username', 'password_hash', 'email'), row)) if row else None
+
+    def exists(self, conn, username):
+        return conn.execute('SELECT 1 FROM admin_users WHERE username = ?', (username,)).fetchone() is not None
+
+    def create(self, conn, username, password_hash, email=None):
+        cursor = conn.execute('''
+            INSERT OR IGNORE INTO admin_users (username, password_hash, email)
+            VALUES (?, ?, ?)
+        ''', (username, password_hash, email))
+        return cursor.rowcount == 1
+
+
+class SQLiteStorage(Storage):
+    """Raw sqlite3 on a database file (app_production.py, simple_app.py)"""
+    name = 'sqlite'
+    metrics = SQLiteMetrics()
+    contacts = SQLiteContacts()
+    admins = SQLiteAdminUsers()
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+    def connect(self, **kwargs):
+        return database.connect(self.db_path, **kwargs)
+
+    def create_schema(self, conn):
+        """Tables and the metrics partitions; does not commit"""
+        for statement in SQLITE_SCHEMA:
+            conn.execute(statement)
+        self.contacts.add_columns(conn)
+        partitions.metrics_partitions.migrate(conn)
+        json_keys.apply(conn, 'contact_requests', json_keys.promoted_keys('contact_requests'))
+
+
+# SQLAlchemy Core
+
+def _datetime(value):
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+class CoreMetrics(MetricsRepository):
+    """The models.py metrics table; custom_data is stored as additional_data"""
+
+    def __init__(self, table):
+        self.table = table
+
+    def dimensions(self):
+        return ('event_type', 'page_url', 'device_type', 'country')
+
+    def _values(self, event):
+        return {
+            'event_type': event.get('event_type'),
+            'page_url': event.get('page_url'),
+            'user_id': event.get('user_id'),
+            'session_id': event.get('session_id'),
+            'ip_address': event.get('ip_address'),
+            'user_agent': event.get('user_agent'),
+            'referrer': event.get('referrer'),
+            'timestamp': _datetime(event.get('timestamp')) or datetime.utcnow(),
+            'country': event.get('country'),
+            'device_type': event.get('device_type'),
+            'additional_data': _json_object(event.get('custom_data')),
+        }
+
+    def insert(self, conn, event):
+        return conn.execute(self.table.insert().values(self._values(event))).inserted_primary_key[0]
+
+    def insert_many(self, conn, events):
+        rows = [self._values(event) for event in events]
+        if rows:
+            conn.execute(self.table.insert(), rows)
+
+    def _conditions(self, filters, start=None, end=None, after_id=None):
+        c = self.table.c
+        conditions = [c[_check_column(name, self.dimensions())] == value for name, value in (filters or {}).items()]
+        if start is not None:
+            conditions.append(c.timestamp >= _datetime(start))
+        if end is not None:
+            conditions.append(c.timestamp < _datetime(end))
+        if after_id is not None:
+            conditions.append(c.id > after_id)
+        return conditions
+
+    def summary(self, conn, start=None, end=None, filters=None, after_id=None):
+        c = self.table.c
+        count_type = lambda event_type: sa.func.count(sa.case((c.event_type == event_type, 1)))
+        row = conn.execute(sa.select(
+            sa.func.count(),
+            sa.func.count(sa.distinct(c.session_id)),
+            sa.func.count(sa.distinct(c.user_id)),
+            count_type('page_view'),
+            count_type('form_submit'),
+        ).where(*self._conditions(filters, start, end, after_id))).one()
+        return dict(zip(SUMMARY_FIELDS, row))
+
+    def count_by(self, conn, column, start=None, end=None, filters=None, limit=None, after_id=None):
+        dimension = self.table.c[_check_column(column, self.dimensions())]
+        count = sa.func.count().label('count')
+        query = (sa.select(dimension, count)
+                 .where(dimension.isnot(None), *self._conditions(filters, start, end, after_id))
+                 .group_by(dimension)
+                 .order_by(count.desc(), dimension))
+        if limit is not None:
+            query = query.limit(limit)
+        return [tuple(row) for row in conn.execute(query)]
+
+    def high_water(self, conn):
+        # Sequence ids of concurrent PostgreSQL transactions may commit out of order
+        return conn.execute(sa.select(sa.func.max(self.table.c.id))).scalar() or 0
+
+    def low_water(self, conn):
+        return 0
+
+
+class CoreContacts(ContactsRepository):
+    """The models.py contact_requests table (UUID ids, first and last name)"""
+
+    def __init__(self, table):
+        self.table = table
+
+    def columns(self):
+        return tuple(self.table.c.keys())
+
+    def create(self, conn, fields):
+        values = {name: value for name, value in fields.items() if name in self.table.c and value is not None}
+        if 'first_name' not in values and fields.get('name'):
+            first, _, last = fields['name'].strip().partition(' ')
+            values.update(first_name=first, last_name=last)
+        values.setdefault('id', str(uuid.uuid4()))
+        conn.execute(self.table.insert().values(values))
+        return values['id']
+
+    def _conditions(self, filters, start=None, end=None, changed_since=None):
+        c = self.table.c
+        conditions = [c[_check_column(name, self.columns())] == value for name, value in (filters or {}).items()]
+        if start is not None:
+            conditions.append(c.created_at >= _datetime(start))
+        if end is not None:
+            conditions.append(c.created_at < _datetime(end))
+        if changed_since is not None:
+            conditions.append(c.updated_at >= _datetime(changed_since))
+        return conditions
+
+    def list(self, conn, filters=None, start=None, end=None, columns=None, changed_since=None, limit=None, offset=0):
+        selected = [self.table.c[_check_column(name, self.columns())] for name in columns or self.columns()]
+        query = (sa.select(*selected)
+                 .where(*self._conditions(filters, start, end, changed_since))
+                 .order_by(self.table.c.created_at.desc())
+                 .limit(limit)
+                 .offset(offset or None))
+        return [dict(row._mapping) for row in conn.execute(query)]
+
+    def get(self, conn, contact_id):
+        found = self.list(conn, {'id': contact_id})
+        return found[0] if found else None
+
+    def high_water(self, conn):
+        return conn.execute(sa.select(sa.func.max(self.table.c.updated_at))).scalar()
+
+    def update(self, conn, contact_id, fields):
+        for name in fields:
+            _check_column(name, self.columns())
+        # updated_at is refreshed by the column's onupdate
+        result = conn.execute(self.table.update().where(self.table.c.id == contact_id).values(fields))
+        return result.rowcount > 0
+
+    def update_statuses(self, conn, changes):
+        c = self.table.c
+        previous = dict(conn.execute(sa.select(c.id, c.status).where(c.id.in_([change[0] for change in changes]))).all())
+        status = sa.bindparam('new_status')
+        statement = (self.table.update()
+                     .where(c.id == sa.bindparam('contact_id'))
+                     .values(status=status,
+                             notes=sa.func.coalesce(sa.bindparam('new_notes', type_=c.notes.type), c.notes),
+                             responded_at=sa.case((sa.and_(status == 'resolved', sa.or_(c.status.is_(None), c.status != 'resolved')),
+                                                   sa.bindparam('now', type_=c.responded_at.type)),
+                                                  else_=c.responded_at)))
+        now = datetime.utcnow()
+        rows = [{'contact_id': contact_id, 'new_status': new_status, 'new_notes': notes, 'now': now}
+                for contact_id, new_status, notes in changes if contact_id in previous]
+        if rows:
+            conn.execute(statement, rows)
+        return previous
+
+    def count_by(self, conn, column, filters=None):
+        selected = self.table.c[_check_column(column, self.columns())]
+        count = sa.func.count().label('count')
+        query = (sa.select(selected, count)
+                 .where(selected.isnot(None), *self._conditions(filters))
+                 .group_by(selected)
+                 .order_by(count.desc(), selected))
+        return [tuple(row) for row in conn.execute(query)]
+
+
+class CoreAdminUsers(AdminUsers):
+
+    def __init__(self, table):
+        self.table = table
+
+    def find(self, conn, username):
+        c = self.table.c
+        row = conn.execute(sa.select(c.id, c.username, c.password_hash, c.email)
+                           .where(c.username == username, c.is_active.is_(True))).first()
+        return dict(row._mapping) if row else None
+
+    def exists(self, conn, username):
+        return conn.execute(sa.select(self.table.c.id).where(self.table.c.username == username)).first() is not None
+
+    def create(self, conn, username, password_hash, email=None):
+        if self.exists(conn, username):
+            return False
+        conn.execute(self.table.insert().values(username=username, password_hash=password_hash, email=email))
+        return True
+
+
+class CoreStorage(Storage):
+    """SQLAlchemy Core on an Engine (app.py passes db.engine)"""
+    name = 'core'
+
+    def __init__(self, engine):
+        if sa is None:
+            raise RuntimeError('CoreStorage requires SQLAlchemy')
+        import models
+
+        self.engine = engine
+        self.metadata = models.db.metadata
+        self.metrics = CoreMetrics(models.Metric.__table__)
+        self.contacts = CoreContacts(models.ContactRequest.__table__)
+        self.admins = CoreAdminUsers(models.AdminUser.__table__)
+
+    def connect(self):
+        return self.engine.connect()
+
+    def create_schema(self, conn):
+        self.metadata.create_all(conn)
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+Storage-layer benchmark for the HHBC Consultancy backends
+Runs one workload through the storage.py interface against each
+implementation (raw sqlite3 and SQLAlchemy Core), each on a fresh database
+file: single-event and batched metric writes, the analytics aggregates,
+contact writes and listing, and admin lookups. No HTTP server is involved,
+so the numbers isolate the storage code every backend now shares.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import argparse
+import platform
+import tempfile
+import statistics
+from datetime import datetime, timedelta
+
+from benchmark import RESULTS_DIR, EVENT_TYPES, PAGES, DEVICES, BROWSERS, git_commit
+
+import storage
+
+IMPLEMENTATIONS = ('sqlite', 'core')
+STATUSES = ['new', 'new', 'in_progress', 'resolved', 'closed']
+COUNTRIES = ['CL', 'AR', 'PE', 'ES', 'US']
+
+
+def open_storage(name, db_path):
+    """Storage with its schema created on a new database file"""
+    if name == 'sqlite':
+        store = storage.SQLiteStorage(db_path)
+    else:
+        import sqlalchemy
+        store = storage.CoreStorage(sqlalchemy.create_engine(f"sqlite:///{db_path}"))
+    conn = store.connect()
+    store.create_schema(conn)
+    conn.commit()
+    conn.close()
+    return store
+
+
+def make_events(count, days, seed):
+    """Synthetic events spread over the last `days` days, oldest first"""
+    rng = random.Random(seed)
+    now = datetime.utcnow().replace(microsecond=0)
+    events = []
+    for _ in range(count):
+        events.append({
+            'event_type': rng.choice(EVENT_TYPES),
+            'page_url': rng.choice(PAGES),
+            'user_id': f"user_{rng.randint(1, 5000)}",
+            'session_id': f"session_{rng.randint(1, 20000)}",
+            'device_type': rng.choice(DEVICES),
+            'browser': rng.choice(BROWSERS),
+            'ip_address': f"10.0.{rng.randint(0, 255)}.{rng.randint(1, 254)}",
+            'referrer': 'https://google.com',
+            'country': rng.choice(COUNTRIES),
+            'timestamp': now - timedelta(seconds=rng.randint(0, days * 86400)),
+        })
+    events.sort(key=lambda event: event['timestamp'])
+    return events
+
+
+def make_contact(rng):
+    n = rng.randint(1, 10 ** 6)
+    return {
+        'name': f"Cliente {n}",
+        'email': f"cliente{n}@example.com",
+        'subject': 'Consultoría',
+        'message': 'Mensaje generado por el benchmark de almacenamiento.',
+        'status': rng.choice(STATUSES),
+        'custom_data': {'urgency': rng.choice(['low', 'medium', 'high'])},
+    }
+
+
+def _median_ms(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return round(statistics.median(timings) * 1000, 3)
+
+
+def run(name, db_path, events, single, batch_size, contacts, repeat, seed):
+    """The workload against one implementation; returns {measurement: value}"""
+    rng = random.Random(seed)
+    store = open_storage(name, db_path)
+    conn = store.connect()
+    results = {}
+    try:
+        # One event per transaction, like /metrics/track
+        start = time.perf_counter()
+        for event in events[:single]:
+            store.metrics.insert(conn, event)
+            conn.commit()
+        results['insert_single_per_s'] = round(single / (time.perf_counter() - start), 1)
+
+        # The rest in batches, like /metrics/track/batch
+        rest = events[single:]
+        start = time.perf_counter()
+        for i in range(0, len(rest), batch_size):
+            store.metrics.insert_many(conn, rest[i:i + batch_size])
+            conn.commit()
+        results['insert_batch_per_s'] = round(len(rest) / (time.perf_counter() - start), 1)
+
+        since = datetime.utcnow() - timedelta(days=30)
+        results['summary_30d_ms'] = _median_ms(lambda: store.metrics.summary(conn, since), repeat)
+        results['top_pages_ms'] = _median_ms(lambda: store.metrics.count_by(
+            conn, 'page_url', filters={'event_type': 'page_view'}, limit=10), repeat)
+        results['device_breakdown_ms'] = _median_ms(lambda: store.metrics.count_by(conn, 'device_type'), repeat)
+        results['filtered_summary_ms'] = _median_ms(lambda: store.metrics.summary(
+            conn, since, filters={'country': 'CL', 'event_type': 'page_view'}), repeat)
+
+        start = time.perf_counter()
+        for _ in range(contacts):
+            store.contacts.create(conn, make_contact(rng))
+            conn.commit()
+        results['contact_create_per_s'] = round(contacts / (time.perf_counter() - start), 1)
+        results['contact_list_ms'] = _median_ms(lambda: store.contacts.list(conn, {'status': 'new'}), repeat)
+        results['contact_count_by_ms'] = _median_ms(lambda: store.contacts.count_by(conn, 'status'), repeat)
+
+        store.admins.create(conn, 'admin', 'not-a-real-hash', 'admin@example.com')
+        conn.commit()
+        results['admin_find_ms'] = _median_ms(lambda: store.admins.find(conn, 'admin'), repeat)
+
+        # Both implementations must agree on what they stored
+        summary = store.metrics.summary(conn)
+        results['total_events'] = round(summary['total_events'])
+        results['unique_sessions'] = summary['unique_sessions']
+    finally:
+        conn.close()
+    results['db_size_kb'] = round(os.path.getsize(db_path) / 1024, 1)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the storage implementations on one workload')
+    parser.add_argument('--events', type=int, default=20000, help='metric events to write')
+    parser.add_argument('--single', type=int, default=500, help='of which written one per transaction')
+    parser.add_argument('--batch-size', type=int, default=500, help='events per batched transaction')
+    parser.add_argument('--contacts', type=int, default=200, help='contact requests to write')
+    parser.add_argument('--days', type=int, default=60, help='days the events are spread over')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per read measurement (median reported)')
+    parser.add_argument('--seed', type=int, default=42, help='RNG seed for the workload')
+    parser.add_argument('--storage', choices=IMPLEMENTATIONS, action='append',
+                        help='implementation to run (repeatable; default: all)')
+    parser.add_argument('--output', help='where to write the JSON results')
+    args = parser.parse_args()
+
+    names = args.storage or list(IMPLEMENTATIONS)
+    single = min(args.single, args.events)
+    events = make_events(args.events, args.days, args.seed)
+    workdir = tempfile.mkdtemp(prefix='hhbc-storage-')
+    results = {}
+    try:
+        for name in names:
+            print(f"🚀 {name}: {args.events} events, {args.contacts} contacts")
+            results[name] = run(name, os.path.join(workdir, f'{name}.db'), events, single, args.batch_size,
+                                args.contacts, args.repeat, args.seed)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"\n{'measurement':<24}" + ''.join(f"{name:>14}" for name in names))
+    for measurement in results[names[0]]:
+        print(f"{measurement:<24}" + ''.join(f"{results[name][measurement]:>14}" for name in names))
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'events': args.events,
+            'single': single,
+            'batch_size': args.batch_size,
+            'contacts': args.contacts,
+            'days': args.days,
+            'repeat': args.repeat,
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        output = os.path.join(RESULTS_DIR, f"storage-{stamp}-{report['meta']['commit'] or 'nogit'}.json")
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\n💾 Results saved to {output}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,12 @@
 import unittest
 import json
+import os
+import tempfile
+import time
+from unittest import mock
 from datetime import datetime, timedelta
 from app import app, db
+import app_production
 from models import Metric, ContactRequest, ContactFormMetric
 from utils import validate_email, parse_user_agent, FormValidator
 
@@ -219,5 +224,1117 @@ class TestIntegration(unittest.TestCase):
         
         # Note: This would require authentication in real scenario
 
+class TestProductionBackend(unittest.TestCase):
+    """Tests for the raw-sqlite production backend (app_production.py)"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        app_production.DB_PATH = os.path.join(self.tmpdir.name, 'test.db')
+        app_production.init_db()
+        app_production.create_default_admin()
+        app_production.app.config['TESTING'] = True
+        self.client = app_production.app.test_client()
+        # Jobs queued by requests (e.g. dashboard snapshot refreshes) only run when a test runs them
+        mock.patch.object(app_production.jobs.runner, 'workers', 0).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def auth_headers(self):
+        response = self.client.post('/auth/login', json={'username': 'admin', 'password': 'admin123'})
+        return {'Authorization': f"Bearer {response.get_json()['access_token']}"}
+
+    def test_internal_metrics_exports_route_histograms(self):
+        """Test Prometheus export of per-route latency and status counts"""
+        response = self.client.post('/metrics/track', json={'event_type': 'page_view', 'page_url': '/'})
+        self.assertEqual(response.status_code, 201)
+
+        # Per-route statistics are not public: admin auth, or the METRICS_TOKEN of a scraper
+        self.assertEqual(self.client.get('/internal/metrics').status_code, 401)
+        response = self.client.get('/internal/metrics', headers=self.auth_headers())
+        self.assertEqual(response.status_code, 200)
+        body = response.get_data(as_text=True)
+        self.assertIn('hhbc_http_request_duration_seconds_bucket{method="POST",route="/metrics/track",le="+Inf"}', body)
+        self.assertIn('hhbc_http_request_db_seconds_count{method="POST",route="/metrics/track"}', body)
+        self.assertIn('hhbc_http_requests_total{method="POST",route="/metrics/track",status="201"}', body)
+        self.assertIn('hhbc_http_requests_in_flight', body)
+        from flask import Flask
+        for token, headers, status in ((None, {}, 401), ('scrape', {}, 401), ('scrape', {'Authorization': 'Bearer scrape'}, 200)):
+            scraped = Flask('scraped')
+            with mock.patch.dict(os.environ, {'METRICS_TOKEN': token or ''}):
+                app_production.runtime_stats.init_app(scraped, stats=app_production.runtime_stats.RequestStats())
+            self.assertEqual(scraped.test_client().get('/internal/metrics', headers=headers).status_code, status)
+
+        # A thread per request (threaded dev server) must not grow the shards without a scrape
+        import threading
+        stats = app_production.runtime_stats.RequestStats()
+
+        def handle():
+            stats.end(stats.begin(), 'GET', '/x', 200, 0.001, 0, 10)
+        for _ in range(500):
+            thread = threading.Thread(target=handle)
+            thread.start()
+            thread.join()
+        self.assertLessEqual(len(stats._shards), app_production.runtime_stats.PRUNE_SHARDS_AT)
+        self.assertEqual(stats.snapshot().statuses, {('GET', '/x', 200): 500})
+
+    def test_request_profiling_by_header(self):
+        """Test header-triggered profiling and that disabling unwraps the app"""
+        original_wsgi_app = app_production.app.wsgi_app
+        headers = self.auth_headers()
+        self.assertEqual(self.client.post('/internal/profiling', json={'sample_rate': 0}).status_code, 401)
+
+        response = self.client.post('/internal/profiling',
+                                    json={'mode': 'cprofile', 'sample_rate': 0}, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.client.get('/metrics/analytics', headers=headers)
+        self.client.get('/metrics/analytics', headers={**headers, 'X-Profile-Request': '1'})
+
+        status = self.client.get('/internal/profiling', headers=headers).get_json()
+        self.assertEqual(status['routes'], {'GET /metrics/analytics': {'requests': 1, 'samples': 0}})
+        report = self.client.get('/internal/profiling/cprofile', headers=headers).get_data(as_text=True)
+        self.assertIn('get_analytics', report)
+
+        self.client.post('/internal/profiling', json={'enabled': False}, headers=headers)
+        self.assertEqual(app_production.app.wsgi_app, original_wsgi_app)
+        self.client.delete('/internal/profiling', headers=headers)
+
+    def test_slow_query_log_flags_full_scans(self):
+        """Test query fingerprinting and plan capture for slow statements"""
+        log = app_production.query_log.query_log
+        headers = self.auth_headers()
+        threshold = log.slow_threshold
+        log.slow_threshold = 0.0
+        log.reset()
+        try:
+            self.client.post('/metrics/track', json={'event_type': 'page_view', 'page_url': '/'})
+            self.client.get('/metrics/analytics', headers=headers)
+        finally:
+            log.slow_threshold = threshold
+
+        report = self.client.get('/internal/queries?sort=count', headers=headers).get_json()
+        by_fingerprint = {q['fingerprint']: q for q in report['queries']}
+        partition = app_production.partitions.partition_name(app_production.partitions.month_of())
+        self.assertIn(f'INSERT INTO {partition} (event_type_id, page_url_id, user_id, session_id, device_type_id, browser_id, '
+                      'ip_address, referrer_id, custom_data, timestamp, sample_weight) VALUES (...)', by_fingerprint)
+        top_pages = next(q for fp, q in by_fingerprint.items() if 'GROUP BY page_url' in fp)
+        self.assertEqual(top_pages['count'], 1)
+        self.assertTrue(top_pages['full_scan'])
+        self.assertTrue(any('SCAN' in step['detail'] for step in top_pages['plan']))
+        self.assertFalse(any('EXPLAIN' in fp for fp in by_fingerprint))
+        self.assertEqual(self.client.get('/internal/queries').status_code, 401)
+
+        # Plans come from a read-only connection of their own, outside the caller's transaction
+        conn = app_production.database.connect(app_production.DB_PATH)
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('CREATE TABLE uncommitted (x)')
+        for sql, explained in (('SELECT x FROM uncommitted', False), ('SELECT name FROM contact_requests', True)):
+            stats = app_production.query_log._QueryStats(sql, sql)
+            log._capture_plan(stats, conn, sql, None)
+            self.assertEqual(stats.plan is not None, explained)
+        self.assertTrue(conn.in_transaction)
+        conn.rollback()
+        conn.close()
+
+    def test_startup_skips_ddl_when_schema_is_current(self):
+        """Test single-transaction startup and the schema version check"""
+        statements = []
+        listener = lambda connection, sql, params, seconds, phase: statements.append(sql)
+        app_production.database.add_query_listener(listener)
+        try:
+            app_production.startup(sample_data=True)
+        finally:
+            app_production.database.remove_query_listener(listener)
+
+        self.assertFalse(any('CREATE TABLE' in sql for sql in statements))
+        conn = app_production.database.connect(app_production.DB_PATH)
+        self.assertEqual(conn.execute('PRAGMA user_version').fetchone()[0], app_production.SCHEMA_VERSION)
+        self.assertEqual(conn.execute('SELECT COUNT(*) FROM admin_users').fetchone()[0], 1)
+        self.assertEqual(conn.execute('SELECT COUNT(*) FROM metrics').fetchone()[0], 3)
+        conn.close()
+
+    def test_metrics_partitions_route_migrate_and_retain(self):
+        """Test monthly partition routing, migration of a plain table and retention"""
+        router = app_production.partitions.metrics_partitions
+        path = os.path.join(self.tmpdir.name, 'legacy.db')
+        conn = app_production.database.connect(path)
+        conn.execute("CREATE TABLE metrics (id INTEGER PRIMARY KEY AUTOINCREMENT, event_type TEXT NOT NULL, page_url TEXT, "
+                     "user_id TEXT, session_id TEXT, device_type TEXT, browser TEXT, ip_address TEXT, referrer TEXT, "
+                     "custom_data TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)")
+        conn.executemany("INSERT INTO metrics (event_type, timestamp) VALUES (?, ?)",
+                         [('page_view', '2020-01-15 10:00:00'), ('click', '2020-02-01 00:00:00'), ('scroll', None)])
+        conn.commit()
+
+        self.assertEqual(router.migrate(conn), 3)
+        current = app_production.partitions.month_of()
+        self.assertEqual(router.months(conn), sorted({'2020-01', '2020-02', current}))
+        self.assertEqual(conn.execute('SELECT COUNT(*) FROM metrics').fetchone()[0], 3)
+        self.assertEqual(router.source(conn, '2020-02-01', '2020-02-29', raw=True), 'metrics_2020_02')
+        self.assertEqual(conn.execute("SELECT event_type FROM metrics WHERE timestamp < '2020-02-02'").fetchall(),
+                         [('page_view',), ('click',)])
+
+        router.insert(conn, ('page_view', None, None, None, None, None, None, None, None, '2020-03-05 12:00:00'))
+        ids = [row[0] for row in conn.execute('SELECT id FROM metrics_2020_03')]
+        self.assertEqual(ids, [app_production.partitions.id_base('2020-03') + 1])
+
+        self.assertEqual(router.drop_before(conn, '2020-03'), ['metrics_2020_01', 'metrics_2020_02'])
+        self.assertEqual(conn.execute('SELECT COUNT(*) FROM metrics').fetchone()[0], 2)
+        conn.close()
+
+    def test_metric_strings_interned_in_lookup_tables(self):
+        """Test conversion of text partitions to lookup ids and that rolled-back ids are not cached"""
+        path = os.path.join(self.tmpdir.name, 'v2.db')
+        conn = app_production.database.connect(path)
+        conn.execute("CREATE TABLE metrics_2020_01 (id INTEGER PRIMARY KEY AUTOINCREMENT, event_type TEXT NOT NULL, "
+                     "page_url TEXT, user_id TEXT, session_id TEXT, device_type TEXT, browser TEXT, ip_address TEXT, "
+                     "referrer TEXT, custom_data TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)")
+        conn.executemany("INSERT INTO metrics_2020_01 (event_type, page_url, timestamp) VALUES (?, ?, ?)",
+                         [('page_view', '/', '2020-01-02 00:00:00'), ('page_view', '/blog', '2020-01-03 00:00:00')])
+        conn.execute("CREATE VIEW metrics AS SELECT * FROM metrics_2020_01")
+        conn.execute("PRAGMA user_version = 2")
+        conn.commit()
+        conn.close()
+
+        app_production.DB_PATH = path
+        app_production.init_db()
+        conn = app_production.database.connect(path)
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(metrics_2020_01)')]
+        self.assertIn('page_url_id', columns)
+        self.assertNotIn('page_url', columns)
+        self.assertEqual(conn.execute('SELECT page_url FROM metrics ORDER BY id').fetchall(), [('/',), ('/blog',)])
+        self.assertEqual(conn.execute('SELECT COUNT(*) FROM lookup_event_type').fetchone()[0], 1)
+
+        router = app_production.partitions.metrics_partitions
+        router.insert(conn, ('signup', None, None, None, None, None, None, None, None, None))
+        conn.rollback()
+        other = app_production.database.connect(path)
+        router.insert(other, ('signup', None, None, None, None, None, None, None, None, None))
+        other.commit()
+        other.close()
+        router.insert(conn, ('signup', None, None, None, None, None, None, None, None, None))
+        conn.commit()
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM metrics WHERE event_type = 'signup'").fetchone()[0], 2)
+        conn.close()
+
+    def test_archived_partitions_stay_queryable(self):
+        """Test archiving an old partition to a columnar file and reading it back through the API"""
+        conn = app_production.database.connect(app_production.DB_PATH)
+        table = 'metrics_2020_01'
+        app_production.partitions.metrics_partitions.insert_many(conn, [
+            ('page_view', '/old', None, f's{i}', 'desktop', None, None, None, None, f'2020-01-{i + 1:02d} 12:00:00')
+            for i in range(20)
+        ])
+        conn.commit()
+        directory = app_production.archive.default_directory(app_production.DB_PATH)
+        self.assertEqual(app_production.archive.archive_before(conn, directory, '2020-02'), [table])
+        conn.commit()
+        self.assertNotIn('2020-01', app_production.partitions.metrics_partitions.months(conn))
+        conn.close()
+
+        self.client.post('/metrics/track', json={'event_type': 'page_view', 'page_url': '/new', 'device_type': 'mobile'})
+        headers = self.auth_headers()
+        analytics = self.client.get('/metrics/analytics', headers=headers).get_json()
+        self.assertEqual(analytics['top_pages'][0], {'page': '/old', 'views': 20})
+        self.assertEqual(analytics['summary']['total_events'], 1)
+        self.assertIn({'device': 'desktop', 'count': 20}, analytics['device_breakdown'])
+
+        response = self.client.get('/metrics/export?start_date=2020-01-05&end_date=2020-01-06&columns=page_url,timestamp',
+                                   headers=headers)
+        self.assertEqual(response.status_code, 200)
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(lines, ['page_url,timestamp', '/old,2020-01-05 12:00:00', '/old,2020-01-06 12:00:00'])
+        self.assertEqual(self.client.get('/metrics/export?columns=password', headers=headers).status_code, 400)
+
+        # A backfill recreates the month: the archived rows stay visible, and archiving again appends
+        conn = app_production.database.connect(app_production.DB_PATH)
+        app_production.partitions.metrics_partitions.insert_many(conn, [
+            ('page_view', '/old', None, f'b{i}', 'tablet', None, None, None, None, '2020-01-20 08:00:00') for i in range(5)
+        ])
+        conn.commit()
+        archived = app_production.archive.ArchiveFile(os.path.join(directory, table + '.hcol'))
+        self.assertGreater(conn.execute(f'SELECT MIN(id) FROM {table}').fetchone()[0], archived.max_id)
+        analytics = self.client.get('/metrics/analytics', headers=headers).get_json()
+        self.assertEqual(analytics['top_pages'][0], {'page': '/old', 'views': 25})
+        with mock.patch.object(app_production.archive, 'ROW_GROUP_SIZE', 2):
+            conn.execute('BEGIN IMMEDIATE')
+            self.assertEqual(app_production.archive.archive_before(conn, directory, '2020-02'), [table])
+            # Before the drop commits, the partition's rows are not read twice
+            other = app_production.database.connect(app_production.DB_PATH)
+            self.assertEqual(app_production.archive.ArchiveStore(directory).count_by('page_url', conn=other)['/old'], 20)
+            other.close()
+            conn.commit()
+        conn.close()
+        archived = app_production.archive.ArchiveFile(os.path.join(directory, table + '.hcol'))
+        self.assertEqual((archived.rows, len(archived.footer['row_groups'])), (25, 4))
+        analytics = self.client.get('/metrics/analytics', headers=headers).get_json()
+        self.assertEqual(analytics['top_pages'][0], {'page': '/old', 'views': 25})
+        self.assertIn({'device': 'tablet', 'count': 5}, analytics['device_breakdown'])
+
+    def test_analytics_engine_matches_sql(self):
+        """Test that the in-memory engine answers filters and group_by like the SQL path"""
+        conn = app_production.database.connect(app_production.DB_PATH)
+        app_production.partitions.metrics_partitions.insert_many(conn, [
+            ('page_view', f'/p{i % 3}', None, f's{i}', 'tablet', None, None, None, '{"country": "PE"}', '2020-01-10 12:00:00')
+            for i in range(6)
+        ])
+        conn.commit()
+        app_production.archive.archive_before(conn, app_production.archive.default_directory(app_production.DB_PATH), '2020-02')
+        conn.commit()
+        conn.close()
+        for i, (device, country) in enumerate([('mobile', 'CL'), ('desktop', 'CL'), ('mobile', 'AR'), ('mobile', None)]):
+            self.client.post('/metrics/track', json={'event_type': 'page_view' if i % 2 else 'click', 'page_url': f'/p{i}',
+                                                     'session_id': f'h{i // 2}', 'device_type': device,
+                                                     'custom_data': {'country': country} if country else None})
+        headers = self.auth_headers()
+        queries = ['', '?group_by=country', '?device_type=mobile&group_by=page_url', '?country=CL',
+                   '?start_date=2020-01-01&end_date=2020-01-31&group_by=device_type', '?event_type=click']
+
+        expected = [self.client.get(f'/metrics/analytics{q}', headers=headers).get_json() for q in queries]
+        with mock.patch.dict(os.environ, {'ANALYTICS_ENGINE': 'memory'}):
+            actual = [self.client.get(f'/metrics/analytics{q}', headers=headers).get_json() for q in queries]
+            self.client.post('/metrics/track', json={'event_type': 'page_view', 'page_url': '/p0'})
+            refreshed = self.client.get('/metrics/analytics', headers=headers).get_json()
+            stats = self.client.get('/internal/analytics-engine', headers=headers).get_json()
+        for query, sql, engine in zip(queries, expected, actual):
+            self.assertEqual(sql, engine, query)
+        self.assertEqual(expected[1]['groups'], [{'country': 'PE', 'count': 6}, {'country': 'CL', 'count': 2}, {'country': 'AR', 'count': 1}])
+        self.assertEqual(expected[4]['summary']['total_events'], 6)
+        self.assertEqual(refreshed['summary']['total_events'], 5)
+        self.assertEqual(stats['rows'], 11)
+        self.assertEqual(self.client.get('/metrics/analytics?group_by=password', headers=headers).status_code, 400)
+
+    def test_promoted_custom_data_keys(self):
+        """Test indexed generated columns for custom_data keys and the filter/group_by parameters"""
+        for urgency, budget in [('high', '$10k-$50k'), ('high', '$5k-$20k'), ('low', '$5k-$20k')]:
+            self.client.post('/contact/submit', json={'name': 'Ana', 'email': 'ana@example.com', 'subject': 'Hola',
+                                                      'message': 'Consulta', 'custom_data': {'urgency': urgency, 'budget_range': budget}})
+        for form_type in ['contact', 'contact', 'newsletter', None]:
+            self.client.post('/metrics/track', json={'event_type': 'form_submit', 'page_url': '/contacto',
+                                                     'custom_data': {'form_type': form_type} if form_type else None})
+        headers = self.auth_headers()
+
+        response = self.client.get('/contact/requests?urgency=high&group_by=budget_range', headers=headers).get_json()
+        self.assertEqual(len(response['contact_requests']), 2)
+        self.assertEqual(response['contact_requests'][0]['urgency'], 'high')
+        self.assertEqual(response['groups'], [{'budget_range': '$10k-$50k', 'count': 1}, {'budget_range': '$5k-$20k', 'count': 1}])
+        self.assertEqual(self.client.get('/contact/requests?group_by=email', headers=headers).status_code, 400)
+
+        analytics = self.client.get('/metrics/analytics?group_by=form_type', headers=headers).get_json()
+        self.assertEqual(analytics['groups'], [{'form_type': 'contact', 'count': 2}, {'form_type': 'newsletter', 'count': 1}])
+        analytics = self.client.get('/metrics/analytics?form_type=newsletter', headers=headers).get_json()
+        self.assertEqual(analytics['summary']['form_submissions'], 1)
+
+        conn = app_production.database.connect(app_production.DB_PATH)
+        plan = ' '.join(row[3] for row in conn.execute("EXPLAIN QUERY PLAN SELECT COUNT(*) FROM contact_requests WHERE urgency = 'high'"))
+        self.assertIn('idx_contact_requests_urgency', plan)
+        conn.close()
+
+        # Keys added to the configuration are promoted at the next start, existing rows included
+        with mock.patch.dict(os.environ, {'CONTACT_JSON_KEYS': 'urgency,budget_range,plan', 'METRICS_JSON_KEYS': 'form_type,ab_variant'}):
+            app_production.startup()
+            self.client.post('/metrics/track', json={'event_type': 'click', 'custom_data': {'ab_variant': 'B'}})
+            self.assertEqual(self.client.get('/metrics/analytics?ab_variant=B', headers=headers).get_json()['summary']['total_events'], 1)
+        conn = app_production.database.connect(app_production.DB_PATH)
+        self.assertIn('plan', [row[1] for row in conn.execute('PRAGMA table_xinfo(contact_requests)')])
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM contact_requests WHERE budget_range = '$5k-$20k'").fetchone()[0], 2)
+        conn.close()
+
+    def test_idempotency_keys_deduplicate_retries(self):
+        """Test that retried track, batch and contact requests are not inserted twice"""
+        def count(table):
+            conn = app_production.database.connect(app_production.DB_PATH)
+            try:
+                return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            finally:
+                conn.close()
+
+        event = {'event_type': 'page_view', 'page_url': '/contacto'}
+        first = self.client.post('/metrics/track', json=event, headers={'Idempotency-Key': 'retry-1'})
+        retry = self.client.post('/metrics/track', json=event, headers={'Idempotency-Key': 'retry-1'})
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry.headers.get('Idempotent-Replayed'), 'true')
+        self.assertEqual(count('metrics'), 1)
+
+        # event_id works the same, and is shared with the batch endpoint
+        self.client.post('/metrics/track', json=dict(event, event_id='evt-1'))
+        batch = {'events': [dict(event, event_id='evt-1'), dict(event, event_id='evt-2'), dict(event, event_id='evt-2'), event]}
+        response = self.client.post('/metrics/track/batch', json=batch, headers={'Idempotency-Key': 'batch-1'})
+        self.assertEqual(response.get_json()['tracked'], 2)
+        self.assertEqual(response.get_json()['duplicates'], 2)
+        replay = self.client.post('/metrics/track/batch', json=batch, headers={'Idempotency-Key': 'batch-1'})
+        self.assertEqual(replay.get_json(), response.get_json())
+        self.assertEqual(count('metrics'), 4)
+        self.assertEqual(self.client.post('/metrics/track/batch', json={'events': [{'page_url': '/'}]}).status_code, 400)
+        self.assertEqual(self.client.post('/metrics/track', json=event, headers={'Idempotency-Key': 'x' * 300}).status_code, 400)
+
+        contact = {'name': 'Ana', 'email': 'ana@example.com', 'subject': 'Hola', 'message': 'Consulta'}
+        first = self.client.post('/contact/submit', json=contact, headers={'Idempotency-Key': 'form-1'}).get_json()
+        # A restarted worker has an empty cache and answers from the table
+        app_production.idempotency.idempotency_keys.invalidate()
+        retry = self.client.post('/contact/submit', json=contact, headers={'Idempotency-Key': 'form-1'}).get_json()
+        self.assertEqual(retry['contact_id'], first['contact_id'])
+        self.assertEqual(count('contact_requests'), 1)
+
+        # Expired keys are pruned and may be reused
+        with mock.patch.dict(os.environ, {'IDEMPOTENCY_WINDOW_HOURS': '0'}):
+            app_production.idempotency.idempotency_keys.invalidate()
+            self.client.post('/contact/submit', json=contact, headers={'Idempotency-Key': 'form-1'})
+            self.assertEqual(count('contact_requests'), 2)
+
+    def test_bot_events_filtered_before_storage(self):
+        """Test that crawler traffic is counted per rule instead of stored as metrics"""
+        event = {'event_type': 'page_view', 'page_url': '/'}
+        googlebot = 'Mozilla/5.0 (Linux; Android 6.0.1; Nexus 5X) Mobile Safari/537.36 (compatible; Googlebot/2.1)'
+        with mock.patch.object(app_production.bot_filter, 'bot_filter', app_production.bot_filter.BotFilter('count', flush_interval=60)):
+            self.assertEqual(self.client.post('/metrics/track', json=event, headers={'User-Agent': googlebot}).status_code, 202)
+            self.client.post('/metrics/track', json=event, headers={'User-Agent': 'curl/8.4.0'})
+            self.client.post('/metrics/track/batch', json={'events': [event, event]}, headers={'User-Agent': 'GPTBot/1.1'})
+            # Known crawler address with a browser User-Agent
+            self.client.post('/metrics/track', json=event, environ_base={'REMOTE_ADDR': '66.249.66.1'},
+                             headers={'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) Chrome/120.0'})
+            self.assertEqual(self.client.post('/metrics/track', json=event, headers={
+                'User-Agent': 'Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) Mobile/15E148 Safari/604.1'}).status_code, 201)
+
+            report = self.client.get('/internal/bot-filter', headers=self.auth_headers()).get_json()
+            self.assertEqual(report['hits'], {'googlebot': 2, 'ai_crawler': 2, 'http_library': 1})
+            self.assertEqual(sum(row['count'] for row in report['daily']), 5)
+            self.assertEqual(report['requests_checked'], 5)
+
+            # Counts are kept in memory and written in one batch per flush interval, not per bot request
+            conn = app_production.database.connect(app_production.DB_PATH)
+            stored = lambda: conn.execute('SELECT COALESCE(SUM(count), 0) FROM bot_event_counts').fetchone()[0]
+            self.assertEqual(stored(), 0)
+            filter_ = app_production.bot_filter.bot_filter
+            self.assertEqual(filter_.flush_due(conn), 0)
+            filter_.flush_interval = 0
+            self.assertEqual(filter_.flush_due(conn), 3)
+            self.assertEqual((stored(), filter_.pending()), (5, {}))
+            conn.close()
+
+        analytics = self.client.get('/metrics/analytics', headers=self.auth_headers()).get_json()
+        self.assertEqual(analytics['summary']['total_events'], 1)
+
+        with mock.patch.object(app_production.bot_filter, 'bot_filter', app_production.bot_filter.BotFilter('keep')):
+            self.assertEqual(self.client.post('/metrics/track', json=event, headers={'User-Agent': googlebot}).status_code, 201)
+
+    def test_benchmark_track_requests_are_stored(self):
+        """Test that the load benchmark's track requests reach the metrics write path, not the bot filter"""
+        import random
+        import benchmark
+        method, path, body, headers = benchmark.build_request('track', random.Random(1), None)
+        self.assertIsNone(app_production.bot_filter.user_agent_rule(headers['User-Agent']))
+        response = self.client.open(path, method=method, data=body, headers=headers)
+        self.assertEqual(response.status_code, 201)
+        conn = app_production.database.connect(app_production.DB_PATH)
+        self.assertEqual(conn.execute('SELECT COUNT(*) FROM metrics').fetchone()[0], 1)
+        conn.close()
+
+    def test_sampled_events_are_reweighted(self):
+        """Test per-event-type sampling: dropped before storage, counted back through sample_weight"""
+        headers = self.auth_headers()
+        response = self.client.put('/internal/sampling', json={'scroll': 0.25}, headers=headers)
+        self.assertEqual(response.get_json()['rates'], {'scroll': 0.25})
+        self.assertEqual(self.client.put('/internal/sampling', json={'scroll': 2}, headers=headers).status_code, 400)
+
+        # Two of eight scroll events are kept, each standing for four
+        draws = [0.1, 0.9, 0.9, 0.9, 0.2, 0.9, 0.9, 0.9]
+        with mock.patch.object(app_production.sampling.random, 'random', side_effect=draws):
+            for i in range(8):
+                self.assertEqual(self.client.post('/metrics/track', json={
+                    'event_type': 'scroll', 'page_url': '/', 'device_type': 'mobile'}).status_code, 201)
+        self.client.post('/metrics/track', json={'event_type': 'page_view', 'page_url': '/', 'device_type': 'desktop'})
+
+        # Archived rows keep their weight
+        conn = app_production.database.connect(app_production.DB_PATH)
+        app_production.partitions.metrics_partitions.insert_many(conn, [
+            ('scroll', '/', None, None, 'tablet', None, None, None, None, '2020-01-10 12:00:00', 10.0),
+            ('scroll', '/', None, None, 'tablet', None, None, None, None, '2020-01-11 12:00:00'),
+        ])
+        conn.commit()
+        app_production.archive.archive_before(conn, app_production.archive.default_directory(app_production.DB_PATH), '2020-02')
+        conn.commit()
+        self.assertEqual(conn.execute("SELECT COUNT(*), SUM(sample_weight) FROM metrics").fetchone(), (3, 9.0))
+        conn.close()
+
+        queries = ['', '?group_by=device_type&start_date=2020-01-01', '?event_type=scroll']
+        expected = [self.client.get(f'/metrics/analytics{q}', headers=headers).get_json() for q in queries]
+        self.assertEqual(expected[0]['summary']['total_events'], 9)
+        self.assertEqual(expected[1]['groups'], [{'device_type': 'tablet', 'count': 11}, {'device_type': 'mobile', 'count': 8},
+                                                 {'device_type': 'desktop', 'count': 1}])
+        with mock.patch.dict(os.environ, {'ANALYTICS_ENGINE': 'memory'}):
+            actual = [self.client.get(f'/metrics/analytics{q}', headers=headers).get_json() for q in queries]
+        self.assertEqual(expected, actual)
+
+        # Edits to the policy file are picked up without a restart
+        policy = app_production._sampling_policy()
+        with open(policy.path, 'w') as f:
+            json.dump({'*': 0.5}, f)
+        with mock.patch.object(app_production.sampling, 'RELOAD_INTERVAL', 0):
+            self.assertEqual(policy.current(), {'*': 0.5})
+        stats = self.client.get('/internal/sampling', headers=headers).get_json()
+        self.assertEqual((stats['kept']['scroll'], stats['dropped']['scroll']), (2, 6))
+
+    def test_ingest_shed_under_overload(self):
+        """Test that metric events get 503 + Retry-After under overload while contact submissions go through"""
+        control = app_production.admission.admission_control
+        event = {'event_type': 'page_view', 'page_url': '/'}
+        contact = {'name': 'Ana', 'email': 'ana@example.com', 'subject': 'Hola', 'message': 'Consulta'}
+
+        # Measured DB latency far over budget
+        with mock.patch.object(control, '_latency', 2.0), mock.patch.object(control, '_sampled_at', app_production.admission.time.monotonic()):
+            response = self.client.post('/metrics/track', json=event)
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.get_json()['reason'], 'latency')
+            self.assertGreaterEqual(int(response.headers['Retry-After']), 1)
+            self.assertEqual(self.client.post('/contact/submit', json=contact).status_code, 201)
+
+        # Every slot left is reserved for critical requests
+        with mock.patch.object(control, 'reserved', control.max_in_flight):
+            self.assertEqual(self.client.post('/metrics/track/batch', json={'events': [event]}).status_code, 503)
+            self.assertEqual(self.client.post('/contact/submit', json=contact).status_code, 201)
+
+        # Another connection holds the write lock
+        blocker = app_production.database.connect(app_production.DB_PATH)
+        blocker.execute('BEGIN IMMEDIATE')
+        try:
+            with mock.patch.object(control, 'lock_timeout', 0.05):
+                response = self.client.post('/metrics/track', json=event)
+        finally:
+            blocker.rollback()
+            blocker.close()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.get_json()['reason'], 'locked')
+        self.assertEqual(self.client.post('/metrics/track', json=event).status_code, 201)
+
+        metrics = self.client.get('/internal/metrics', headers=self.auth_headers()).get_data(as_text=True)
+        for reason in ('latency', 'concurrency', 'locked'):
+            self.assertRegex(metrics, f'hhbc_admission_shed_total{{priority="low",reason="{reason}"}} [1-9]')
+        self.assertIn('hhbc_admission_in_flight{priority="critical"} 0', metrics)
+
+    def test_storage_implementations_agree(self):
+        """Test that the raw-SQLite and SQLAlchemy Core storage answer the same workload identically"""
+        import sqlalchemy
+        import storage
+
+        now = datetime.utcnow().replace(microsecond=0)
+        events = [
+            {'event_type': 'page_view', 'page_url': '/', 'session_id': 's1', 'user_id': 'u1', 'device_type': 'desktop', 'country': 'CL', 'timestamp': now - timedelta(days=40)},
+            {'event_type': 'page_view', 'page_url': '/contacto', 'session_id': 's1', 'user_id': 'u1', 'device_type': 'desktop', 'country': 'CL', 'timestamp': now - timedelta(days=2)},
+            {'event_type': 'page_view', 'page_url': '/', 'session_id': 's2', 'device_type': 'mobile', 'country': 'AR', 'timestamp': now - timedelta(days=1)},
+            {'event_type': 'form_submit', 'page_url': '/contacto', 'session_id': 's2', 'device_type': 'mobile', 'custom_data': {'form_type': 'contact'}},
+        ]
+        stores = [
+            storage.SQLiteStorage(os.path.join(self.tmpdir.name, 'raw.db')),
+            storage.CoreStorage(sqlalchemy.create_engine(f"sqlite:///{os.path.join(self.tmpdir.name, 'core.db')}")),
+        ]
+        answers = []
+        for store in stores:
+            conn = store.connect()
+            store.create_schema(conn)
+            store.metrics.insert(conn, events[0])
+            store.metrics.insert_many(conn, events[1:])
+            first = store.contacts.create(conn, {'name': 'Ana Pérez', 'email': 'ana@example.com', 'subject': 'Hola', 'message': 'Consulta'})
+            second = store.contacts.create(conn, {'name': 'Luis Soto', 'email': 'luis@example.com', 'subject': 'Hola', 'message': 'Otra'})
+            self.assertTrue(store.contacts.update(conn, first, {'status': 'resolved'}))
+            self.assertFalse(store.contacts.update(conn, 999999, {'status': 'resolved'}))
+            self.assertTrue(store.admins.create(conn, 'admin', 'hash', 'admin@example.com'))
+            self.assertFalse(store.admins.create(conn, 'admin', 'other'))
+            conn.commit()
+
+            summary = store.metrics.summary(conn, now - timedelta(days=30))
+            answers.append({
+                'summary': {name: round(value) for name, value in summary.items()},
+                'top_pages': [(page, round(count)) for page, count in store.metrics.count_by(
+                    conn, 'page_url', filters={'event_type': 'page_view'}, limit=1)],
+                'countries': sorted((value, round(count)) for value, count in store.metrics.count_by(conn, 'country')),
+                'statuses': store.contacts.count_by(conn, 'status'),
+                'resolved': [row['email'] for row in store.contacts.list(conn, {'status': 'resolved'})],
+                'contact': store.contacts.get(conn, first)['status'],
+                'admin': store.admins.find(conn, 'admin')['password_hash'],
+            })
+            previous = store.contacts.update_statuses(conn, [(second, 'resolved', 'Llamado'), (999999, 'closed', None)])
+            conn.commit()
+            updated = store.contacts.get(conn, second)
+            answers[-1]['bulk'] = (list(previous.values()), updated['status'], updated['notes'], updated['responded_at'] is not None)
+            with self.assertRaises(ValueError):
+                store.metrics.count_by(conn, 'user_id; DROP TABLE x')
+            conn.close()
+
+        self.assertEqual(answers[0], answers[1])
+        self.assertEqual(answers[0]['summary'], {'total_events': 3, 'unique_sessions': 2, 'unique_users': 1, 'page_views': 2, 'form_submissions': 1})
+        self.assertEqual(answers[0]['top_pages'], [('/', 2)])
+        self.assertEqual(answers[0]['statuses'], [('new', 1), ('resolved', 1)])
+        self.assertEqual(answers[0]['bulk'], (['new'], 'resolved', 'Llamado', True))
+
+        # routes.py keeps end_date inclusive over the [start, end) repositories
+        import routes
+        day = events[1]['timestamp'].date().isoformat()
+        core = stores[1]
+        with core.connect() as conn:
+            for end_date in (day, events[1]['timestamp'].isoformat()):
+                start, end = routes._date_range({'start_date': day, 'end_date': end_date})
+                self.assertEqual(core.metrics.summary(conn, start, end)['total_events'], 1)
+
+    def test_serve_reload_hands_over_the_socket(self):
+        """Test what a reloading serve.py master passes to its re-executed self"""
+        import serve
+        sock, host, port = serve.bind_socket('127.0.0.1:0')
+        try:
+            with mock.patch.dict(os.environ, {serve.LISTEN_FD_ENV: str(sock.fileno())}):
+                inherited, _, inherited_port = serve.inherited_socket()
+                self.assertNotIn(serve.LISTEN_FD_ENV, os.environ)
+            self.assertEqual((inherited.fileno(), inherited_port), (sock.fileno(), sock.getsockname()[1]))
+            self.assertTrue(inherited.get_inheritable())
+            inherited.detach()
+            self.assertIsNone(serve.inherited_socket())
+            # Only code that imports is re-executed; otherwise the running workers are kept
+            arbiter = serve.Arbiter(None, sock, host, port, 1, app_spec='no_such_module:app', argv=[])
+            with mock.patch.object(serve.os, 'execve') as execve:
+                arbiter.reload()
+            execve.assert_not_called()
+        finally:
+            sock.close()
+
+    def test_ingest_server_validates_and_group_commits(self):
+        """Test the asyncio ingest app: same validation and dedup as Flask, writes committed in groups"""
+        import asyncio
+        import ingest_server
+
+        browser = 'Mozilla/5.0 (X11; Linux x86_64; rv:120.0) Gecko/20100101 Firefox/120.0'
+
+        async def call(app, path, body, headers=()):
+            scope = {'type': 'http', 'method': 'POST', 'path': path, 'client': ('127.0.0.1', 5000),
+                     'headers': [(b'user-agent', browser.encode())] + [(k.encode(), v.encode()) for k, v in headers]}
+            messages = [{'type': 'http.request', 'body': body if isinstance(body, bytes) else json.dumps(body).encode()}]
+            sent = []
+
+            async def receive():
+                return messages.pop(0)
+
+            async def send(message):
+                sent.append(message)
+            await app(scope, receive, send)
+            headers = dict(sent[0]['headers'])
+            return sent[0]['status'], json.loads(sent[1]['body']), headers.get(b'idempotent-replayed')
+
+        async def scenario():
+            app = ingest_server.IngestApp(app_production.DB_PATH)
+            await app.startup()
+            try:
+                results = {
+                    'missing': await call(app, '/metrics/track', {'page_url': '/'}),
+                    'invalid': await call(app, '/metrics/track', b'{not json'),
+                    'too_many': await call(app, '/metrics/track/batch', {'events': [{'event_type': 'click'}] * 501}),
+                    'first': await call(app, '/metrics/track', {'event_type': 'page_view', 'event_id': 'e1'}),
+                    'retry': await call(app, '/metrics/track', {'event_type': 'page_view', 'event_id': 'e1'}),
+                    'batch': await call(app, '/metrics/track/batch', {'events': [{'event_type': 'click'}, {'event_type': 'click', 'event_id': 'e1'}]},
+                                        [('Idempotency-Key', 'b1')]),
+                    'batch_retry': await call(app, '/metrics/track/batch', {'events': [{'event_type': 'click'}]}, [('Idempotency-Key', 'b1')]),
+                }
+                before = app.writer.transactions
+                burst = await asyncio.gather(*(call(app, '/metrics/track', {'event_type': 'scroll', 'page_url': f'/{i}'}) for i in range(20)))
+                results['burst'] = ([status for status, _, _ in burst], app.writer.transactions - before)
+                results['stats'] = app.writer.stats()
+            finally:
+                await app.shutdown()
+
+            # A full queue sheds with 503 instead of buffering without bound
+            app = ingest_server.IngestApp(app_production.DB_PATH)
+            await app.startup()
+            app.writer.queue = asyncio.Queue(1)
+            try:
+                shed = await asyncio.gather(*(call(app, '/metrics/track', {'event_type': 'scroll'}) for _ in range(2)))
+            finally:
+                await app.shutdown()
+            results['shed'] = [status for status, _, _ in shed]
+            return results
+
+        results = asyncio.run(scenario())
+        self.assertEqual(results['missing'][:2], (400, {'error': 'event_type is required'}))
+        self.assertEqual(results['invalid'][0], 400)
+        self.assertEqual(results['too_many'][1], {'error': 'At most 500 events per batch'})
+        self.assertEqual(results['first'], (201, ingest_server.ingest.TRACKED_RESPONSE, None))
+        self.assertEqual(results['retry'], (201, ingest_server.ingest.TRACKED_RESPONSE, b'true'))
+        self.assertEqual(results['batch'][1]['duplicates'], 1)
+        self.assertEqual(results['batch_retry'], (201, results['batch'][1], b'true'))
+        statuses, transactions = results['burst']
+        self.assertEqual(statuses, [201] * 20)
+        self.assertLess(transactions, 20)
+        self.assertEqual(results['stats']['queued'], 0)
+        self.assertEqual(sorted(results['shed']), [201, 503])
+
+        # Only 201s were stored, and the admin app sees them
+        analytics = self.client.get('/metrics/analytics', headers=self.auth_headers()).get_json()
+        self.assertEqual(analytics['summary']['total_events'], 23)
+
+    def test_background_jobs_retry_cancel_and_export(self):
+        """Test the job runner: priorities, retries with backoff, lost leases, cancellation and a background export"""
+        jobs = app_production.jobs
+        headers = self.auth_headers()
+        for i in range(3):
+            self.client.post('/metrics/track', json={'event_type': 'page_view', 'page_url': f'/{i}'})
+
+        calls = []
+
+        def flaky(job, fail_times=0):
+            calls.append((job.kind, job.attempt))
+            if job.attempt <= fail_times:
+                raise RuntimeError('transient')
+            return {'attempt': job.attempt}
+
+        def cancels_itself(job):
+            jobs.runner.broker().cancel(job.id)
+            job.progress(1.0)
+            return {}
+
+        with mock.patch.object(jobs.runner, 'workers', 0), \
+                mock.patch.dict(jobs._handlers, {'test.flaky': (flaky, 3), 'test.cancel': (cancels_itself, 3)}), \
+                mock.patch.dict(os.environ, {'JOBS_RETRY_DELAY': '0'}):
+            self.assertEqual(self.client.post('/internal/jobs', json={'kind': 'nope'}, headers=headers).status_code, 400)
+            self.assertEqual(self.client.post('/internal/jobs', json={'kind': 'test.flaky', 'priority': 'urgent'},
+                                              headers=headers).status_code, 400)
+
+            low = self.client.post('/internal/jobs', json={'kind': 'test.flaky', 'priority': 'low'}, headers=headers)
+            self.assertEqual(low.status_code, 202)
+            self.assertEqual(low.headers['Location'], f"/internal/jobs/{low.get_json()['id']}")
+            retried = self.client.post('/internal/jobs', json={'kind': 'test.flaky', 'params': {'fail_times': 1}},
+                                       headers=headers).get_json()
+            hopeless = self.client.post('/internal/jobs', json={'kind': 'test.flaky', 'params': {'fail_times': 5},
+                                                                'max_attempts': 2, 'priority': 'high'}, headers=headers).get_json()
+            queued = self.client.post('/internal/jobs', json={'kind': 'test.flaky'}, headers=headers).get_json()
+            cancelled = self.client.delete(f"/internal/jobs/{queued['id']}", headers=headers).get_json()
+            self.assertEqual(cancelled['status'], 'cancelled')
+            running = self.client.post('/internal/jobs', json={'kind': 'test.cancel'}, headers=headers).get_json()
+
+            # A job whose worker died is claimed again once its lease expired
+            lost = jobs.runner.broker().enqueue('test.flaky')
+            self.assertEqual(jobs.runner.broker().claim('dead-worker')['id'], hopeless['id'])
+            conn = app_production.database.connect(app_production.DB_PATH)
+            conn.execute('UPDATE jobs SET lease_until = 0')
+            conn.commit()
+            conn.close()
+
+            self.assertEqual(jobs.runner.run_pending(), 6)
+            # The lost lease (high priority) first, the low-priority job last
+            self.assertEqual(calls[-1], ('test.flaky', 1))
+            results = {job_id: self.client.get(f'/internal/jobs/{job_id}', headers=headers).get_json()
+                       for job_id in (low.get_json()['id'], retried['id'], hopeless['id'], running['id'], lost)}
+            self.assertEqual(results[retried['id']]['status'], 'succeeded')
+            self.assertEqual(results[retried['id']]['result'], {'attempt': 2})
+            self.assertEqual((results[hopeless['id']]['status'], results[hopeless['id']]['attempts']), ('failed', 2))
+            self.assertEqual(results[hopeless['id']]['error'], 'RuntimeError: transient')
+            self.assertEqual(results[running['id']]['status'], 'cancelled')
+            self.assertEqual(results[lost]['status'], 'succeeded')
+            self.assertEqual(self.client.delete(f"/internal/jobs/{retried['id']}", headers=headers).status_code, 409)
+            self.assertEqual(self.client.get('/internal/jobs/999999', headers=headers).status_code, 404)
+
+            # Background export writes the same CSV the streaming export returns
+            streamed = self.client.get('/metrics/export?columns=event_type,page_url', headers=headers).get_data(as_text=True)
+            export = self.client.get('/metrics/export?columns=event_type,page_url&background=1', headers=headers)
+            self.assertEqual(export.status_code, 202)
+            self.assertEqual(self.client.get(f"/internal/jobs/{export.get_json()['id']}/download", headers=headers).status_code, 404)
+            self.assertEqual(jobs.runner.run_pending(), 1)
+            job = self.client.get(export.headers['Location'], headers=headers).get_json()
+            self.assertEqual((job['status'], job['progress'], job['result']['rows']), ('succeeded', 1.0, 3))
+            download = self.client.get(f"/internal/jobs/{job['id']}/download", headers=headers)
+            self.assertEqual(download.get_data(as_text=True).replace('\r\n', '\n'), streamed.replace('\r\n', '\n'))
+            download.close()
+
+            listing = self.client.get('/internal/jobs?status=failed', headers=headers).get_json()
+            self.assertEqual([job['id'] for job in listing['jobs']], [hopeless['id']])
+            self.assertEqual(listing['counts']['succeeded'], 4)
+            self.assertIn('metrics.export', listing['kinds'])
+
+        metrics = self.client.get('/internal/metrics', headers=self.auth_headers()).get_data(as_text=True)
+        self.assertRegex(metrics, 'hhbc_jobs_finished_total{kind="test.flaky",status="retried"} [1-9]')
+        self.assertRegex(metrics, 'hhbc_jobs_finished_total{kind="metrics.export",status="succeeded"} [1-9]')
+
+    def test_dashboard_snapshots_serve_standard_ranges(self):
+        """Test that standard ranges are served from refreshed snapshots equal to the live answer"""
+        snapshots = app_production.dashboard_snapshots
+        headers = self.auth_headers()
+        for page, device in (('/', 'desktop'), ('/', 'mobile'), ('/services', 'desktop')):
+            self.client.post('/metrics/track', json={'event_type': 'page_view', 'page_url': page, 'device_type': device})
+        self.client.post('/metrics/track', json={'event_type': 'form_submit', 'page_url': '/contact'})
+        conn = app_production.database.connect(app_production.DB_PATH)
+        old = app_production.partitions.format_timestamp(datetime.utcnow() - timedelta(days=60))
+        app_production.partitions.metrics_partitions.insert_many(
+            conn, [('page_view', '/old', None, 's-old', 'tablet', None, None, None, None, old)])
+        conn.commit()
+
+        live = {name: self.client.get(f'/metrics/analytics?range={name}', headers=headers).get_json()
+                for name in snapshots.RANGES}
+        self.assertNotIn('snapshot', live['7d'])
+        self.assertEqual(live['7d']['event_types'], [{'event_type': 'page_view', 'count': 3},
+                                                     {'event_type': 'form_submit', 'count': 1}])
+        self.assertIn({'page': '/old', 'views': 1}, live['90d']['top_pages'])
+        self.assertNotIn({'page': '/old', 'views': 1}, live['30d']['top_pages'])
+        self.assertEqual(self.client.get('/metrics/analytics?range=1y', headers=headers).status_code, 400)
+
+        later = datetime.utcnow() + timedelta(seconds=snapshots.LAG_SECONDS + 1)
+        self.assertEqual(snapshots.refresh(conn, now=later), {name: 'full' for name in snapshots.RANGES})
+        for name in snapshots.RANGES:
+            served = self.client.get(f'/metrics/analytics?range={name}', headers=headers).get_json()
+            self.assertEqual(served.pop('snapshot')['range'], name)
+            # Only live answers carry a delta token
+            self.assertEqual(served, {key: value for key, value in live[name].items() if key != 'next'})
+        # The dashboard's own start/end dates match a standard range
+        now = datetime.utcnow()
+        query = f"?start_date={(now - timedelta(days=30)).isoformat()}Z&end_date={now.isoformat()}Z"
+        self.assertEqual(self.client.get(f'/metrics/analytics{query}', headers=headers).get_json()['snapshot']['range'], '30d')
+        self.assertEqual(self.client.get('/metrics/analytics', headers=headers).get_json()['snapshot']['range'], 'all')
+        # Filters, grouping and custom ranges stay live
+        for query in ('?range=7d&device_type=mobile', '?group_by=device_type', '?start_date=2020-01-01'):
+            self.assertNotIn('snapshot', self.client.get(f'/metrics/analytics{query}', headers=headers).get_json())
+        mobile = self.client.get('/metrics/analytics?range=7d&device_type=mobile', headers=headers).get_json()
+        self.assertEqual(mobile['device_breakdown'], [{'device': 'mobile', 'count': 1}])
+
+        # Later refreshes only apply the events that entered or left each window
+        arrived = app_production.partitions.format_timestamp(later + timedelta(seconds=2 - snapshots.LAG_SECONDS))
+        app_production.partitions.metrics_partitions.insert_many(
+            conn, [('page_view', '/services', None, 's-new', 'mobile', None, None, None, None, arrived)])
+        conn.commit()
+        self.assertEqual(set(snapshots.refresh(conn, now=later + timedelta(seconds=5)).values()), {'delta'})
+        served = self.client.get('/metrics/analytics?range=7d', headers=headers).get_json()
+        self.assertEqual(served['top_pages'], [{'page': '/', 'views': 2}, {'page': '/services', 'views': 2}])
+        self.assertIn({'device': 'mobile', 'count': 2}, served['device_breakdown'])
+        self.assertEqual(served['summary']['total_events'], 5)
+        # A refresh after the 60-day-old event left the 90-day window subtracts it
+        snapshots.refresh(conn, now=later + timedelta(days=31))
+        self.assertNotIn({'page': '/old', 'views': 1},
+                         self.client.get('/metrics/analytics?range=90d', headers=headers).get_json()['top_pages'])
+        conn.close()
+
+        # Stale snapshots fall back to the live path and queue the refresh job, which reschedules itself
+        with mock.patch.dict(os.environ, {'DASHBOARD_SNAPSHOT_MAX_AGE': '0'}), \
+                mock.patch.object(snapshots, '_scheduled_at', 0.0):
+            self.assertNotIn('snapshot', self.client.get('/metrics/analytics?range=7d', headers=headers).get_json())
+        self.assertEqual(app_production.jobs.runner.run_pending(), 1)
+        status = self.client.get('/internal/dashboard-snapshots', headers=headers).get_json()
+        self.assertEqual([entry['range'] for entry in status['snapshots']], list(snapshots.RANGES))
+        queued = app_production.jobs.runner.broker().list('queued', 'dashboard.refresh', 10)
+        self.assertEqual(len(queued), 1)
+        self.assertGreater(queued[0]['run_after'], time.time() + 60)
+
+    def test_metrics_stream_pushes_deltas_and_leads(self):
+        """Test the SSE stream: coalesced deltas, leads, heartbeats, Last-Event-ID replay and the subscriber cap"""
+        live_stream = app_production.live_stream
+        hub = live_stream.Hub()
+        mock.patch.object(live_stream, 'hub', hub).start()
+        headers = self.auth_headers()
+
+        def frames(chunk):
+            parsed = []
+            for block in chunk.strip().split('\n\n'):
+                fields = dict(line.split(': ', 1) for line in block.split('\n') if not line.startswith(':'))
+                if 'event' in fields:
+                    parsed.append((fields['id'], fields['event'], json.loads(fields['data'])))
+            return parsed
+
+        with mock.patch.object(hub, 'flush_interval', 0), mock.patch.object(hub, 'heartbeat', 0.05), \
+                mock.patch.object(hub, 'max_seconds', 5), mock.patch.object(hub, 'max_subscribers', 1):
+            stream = self.client.get('/metrics/stream', headers=headers, buffered=False)
+            self.assertEqual(stream.mimetype, 'text/event-stream')
+            chunks = iter(stream.response)
+            self.assertEqual(next(chunks), b'retry: 3000\n\n')
+            self.assertEqual(hub.subscribers, 1)
+            busy = self.client.get('/metrics/stream', headers=headers)
+            self.assertEqual((busy.status_code, busy.headers['Retry-After']), (503, '1'))
+
+            self.client.post('/metrics/track', json={'event_type': 'page_view', 'page_url': '/a', 'device_type': 'mobile'})
+            self.client.post('/metrics/track/batch', json={'events': [
+                {'event_type': 'page_view', 'page_url': '/a', 'event_id': 'e1'},
+                {'event_type': 'click', 'event_id': 'e1'}]})
+            self.client.post('/contact/submit', json={'name': 'Ana', 'email': 'ana@example.com', 'subject': 'Hola',
+                                                      'message': 'Hi', 'company': 'ACME'})
+            received = frames(next(chunks).decode())
+            self.assertEqual([event for _, event, _ in received], ['metrics', 'metrics', 'lead'])
+            self.assertEqual(received[0][2]['top_pages'], {'/a': 1})
+            self.assertEqual(received[0][2]['device_breakdown'], {'mobile': 1})
+            # The duplicate event_id in the batch was not stored, so it is not counted
+            self.assertEqual((received[1][2]['total_events'], received[1][2]['page_views']), (1, 1))
+            self.assertEqual((received[2][2]['name'], received[2][2]['company'], received[2][2]['status']),
+                             ('Ana', 'ACME', 'new'))
+            self.assertNotIn('email', received[2][2])
+            self.assertEqual(next(chunks), b': heartbeat\n\n')
+            stream.close()
+            self.assertEqual(hub.subscribers, 0)
+
+            # Reconnecting replays what came after Last-Event-ID; unknown ids get a reset
+            resumed = self.client.get('/metrics/stream', headers={**headers, 'Last-Event-ID': received[0][0]},
+                                      buffered=False)
+            chunks = iter(resumed.response)
+            next(chunks)
+            self.assertEqual([frame[:2] for frame in frames(next(chunks).decode())], [frame[:2] for frame in received[1:]])
+            resumed.close()
+            stale = self.client.get('/metrics/stream', headers={**headers, 'Last-Event-ID': 'gone-7'}, buffered=False)
+            chunks = iter(stale.response)
+            next(chunks)
+            self.assertEqual(frames(next(chunks).decode())[0][1], 'reset')
+            stale.close()
+            # A response closed before its body was read still gives its slot back
+            unread = self.client.get('/metrics/stream', headers=headers, buffered=False)
+            self.assertEqual(hub.subscribers, 1)
+            unread.close()
+            self.assertEqual(hub.subscribers, 0)
+
+        # serve.py workers keep half of their threads for other requests; single-threaded ones refuse streams
+        self.assertEqual(live_stream.thread_limit({'serve.threads': 8}), 4)
+        self.assertEqual(live_stream.thread_limit({'wsgi.multiprocess': True, 'wsgi.multithread': False}), 0)
+        self.assertIsNone(live_stream.thread_limit({'wsgi.multiprocess': False, 'wsgi.multithread': False}))
+        refused = self.client.get('/metrics/stream', headers=headers, environ_overrides={'serve.threads': 1})
+        self.assertEqual(refused.status_code, 501)
+        with mock.patch.object(hub, 'subscribers', 2):
+            self.assertEqual(self.client.get('/metrics/stream', headers=headers,
+                                             environ_overrides={'serve.threads': 4}).status_code, 503)
+
+        # STREAM_SOURCE=database: rows committed by any process are read back from the database
+        with mock.patch.dict(os.environ, {'STREAM_SOURCE': 'database'}):
+            other = live_stream.Hub()
+        conn = app_production.database.connect(app_production.DB_PATH)
+        tail = live_stream.DatabaseTail(other, app_production.DB_PATH)
+        metric_id, contact_id = tail._latest(conn)
+        self.client.post('/metrics/track', json={'event_type': 'form_submit', 'page_url': '/contact'})
+        self.client.post('/contact/submit', json={'name': 'Bo', 'email': 'bo@example.com', 'subject': 'Hey', 'message': 'Hi'})
+        self.assertEqual(tail.poll(conn, metric_id, contact_id), (metric_id + 1, contact_id + 1))
+        # A tail that finds no subscribers gives up its slot under the lock, so the next subscriber starts a new one
+        other._tail = tail
+        self.assertFalse(tail._keep_running())
+        self.assertIsNone(other._tail)
+        conn.close()
+        published = frames(''.join(frame for _, frame in other._buffer))
+        self.assertEqual([event for _, event, _ in published], ['metrics', 'lead'])
+        self.assertEqual(published[0][2]['form_submissions'], 1)
+        self.assertEqual(published[1][2]['name'], 'Bo')
+
+        metrics = hub.render_prometheus()
+        self.assertIn('hhbc_stream_messages_total{event="lead"} 2', metrics)
+        self.assertIn('hhbc_stream_rejected_total 2', metrics)
+
+    def test_analytics_and_contacts_deltas_since_token(self):
+        """Test since tokens: analytics deltas from an id range scan and changed contact rows"""
+        headers = self.auth_headers()
+        self.client.post('/metrics/track', json={'event_type': 'page_view', 'page_url': '/', 'device_type': 'desktop'})
+        full = self.client.get('/metrics/analytics?start_date=2020-01-01', headers=headers).get_json()
+        self.assertEqual(full['summary']['total_events'], 1)
+
+        unchanged = self.client.get(f"/metrics/analytics?start_date=2020-01-01&since={full['next']}", headers=headers).get_json()
+        self.assertEqual((unchanged['since'], unchanged['next']), (full['next'], full['next']))
+        self.assertEqual(unchanged['summary'], {'total_events': 0, 'page_views': 0, 'form_submissions': 0})
+        self.assertEqual(unchanged['top_pages'], [])
+
+        self.client.post('/metrics/track/batch', json={'events': [
+            {'event_type': 'page_view', 'page_url': '/', 'device_type': 'mobile'},
+            {'event_type': 'page_view', 'page_url': '/about', 'device_type': 'mobile'},
+            {'event_type': 'form_submit', 'page_url': '/contact'}]})
+        delta = self.client.get(f"/metrics/analytics?start_date=2020-01-01&since={full['next']}", headers=headers).get_json()
+        self.assertEqual(delta['summary'], {'total_events': 3, 'page_views': 2, 'form_submissions': 1})
+        self.assertEqual(delta['top_pages'], [{'page': '/', 'views': 1}, {'page': '/about', 'views': 1}])
+        self.assertEqual(delta['device_breakdown'], [{'device': 'mobile', 'count': 2}])
+        self.assertGreater(int(delta['next']), int(full['next']))
+        # Applying the delta gives the new full answer
+        refetched = self.client.get('/metrics/analytics?start_date=2020-01-01', headers=headers).get_json()
+        self.assertEqual(refetched['summary']['total_events'], full['summary']['total_events'] + delta['summary']['total_events'])
+        self.assertEqual(refetched['next'], delta['next'])
+        filtered = self.client.get(f"/metrics/analytics?since={full['next']}&device_type=mobile&group_by=page_url",
+                                   headers=headers).get_json()
+        self.assertEqual(filtered['groups'], [{'page_url': '/', 'count': 1}, {'page_url': '/about', 'count': 1}])
+
+        self.assertEqual(self.client.get('/metrics/analytics?since=abc', headers=headers).status_code, 400)
+        # Tokens from before the oldest hot partition cannot be answered from an id range
+        self.assertEqual(self.client.get('/metrics/analytics?since=1', headers=headers).status_code, 410)
+        # A write into an older month gets an id below the tokens handed out so far, which then expire
+        live_stream = app_production.live_stream
+        with mock.patch.dict(os.environ, {'STREAM_SOURCE': 'database'}):
+            other = live_stream.Hub()
+        tail = live_stream.DatabaseTail(other, app_production.DB_PATH)
+        conn = app_production.database.connect(app_production.DB_PATH)
+        metric_id, contact_id = tail._latest(conn)
+        late_id = app_production._storage().metrics.insert(conn, {'event_type': 'page_view', 'page_url': '/late',
+                                                                   'timestamp': '2020-01-15 10:00:00'})
+        conn.commit()
+        self.assertLess(late_id, int(delta['next']))
+        self.assertEqual(self.client.get(f"/metrics/analytics?since={delta['next']}", headers=headers).status_code, 410)
+        reloaded = self.client.get('/metrics/analytics?start_date=2020-01-01', headers=headers).get_json()
+        self.assertEqual(reloaded['summary']['total_events'], refetched['summary']['total_events'] + 1)
+        caught_up = self.client.get(f"/metrics/analytics?since={reloaded['next']}", headers=headers)
+        self.assertEqual(caught_up.get_json()['summary']['total_events'], 0)
+        # The database stream tail cannot send it as a delta either: subscribers reload
+        self.assertEqual(tail.poll(conn, metric_id, contact_id), (int(reloaded['next']), contact_id))
+        self.assertEqual([frame.split('\n')[1] for _, frame in other._buffer], ['event: reset'])
+        conn.close()
+
+        # Contacts: rows created or updated since the token
+        for name in ('Ana', 'Bo'):
+            self.client.post('/contact/submit', json={'name': name, 'email': f'{name.lower()}@example.com',
+                                                      'subject': 'Hola', 'message': 'Hi'})
+        listing = self.client.get('/contact/requests', headers=headers).get_json()
+        self.assertEqual(len(listing['contact_requests']), 2)
+        conn = app_production.database.connect(app_production.DB_PATH)
+        conn.execute("UPDATE contact_requests SET created_at = datetime('now', (id - 3) || ' days'), updated_at = datetime('now', (id - 3) || ' days')")
+        conn.commit()
+        token = self.client.get('/contact/requests', headers=headers).get_json()['next']
+        conn.close()
+        bo = next(row for row in listing['contact_requests'] if row['name'] == 'Bo')
+        self.client.put(f"/contact/requests/{bo['id']}/status", json={'status': 'resolved'}, headers=headers)
+        changed = self.client.get(f'/contact/requests?since={token}', headers=headers).get_json()
+        self.assertEqual([(row['name'], row['status']) for row in changed['contact_requests']], [('Bo', 'resolved')])
+        self.assertEqual(changed['since'], token)
+        self.assertGreater(changed['next'], token)
+        self.assertEqual(self.client.get('/contact/requests?since=yesterday', headers=headers).status_code, 400)
+        plan = app_production.database.connect(app_production.DB_PATH).execute(
+            'EXPLAIN QUERY PLAN SELECT id FROM contact_requests WHERE updated_at >= ?', (token,)).fetchall()
+        self.assertIn('idx_contact_requests_updated_at', ' '.join(str(row) for row in plan))
+
+    def test_dashboard_bootstrap(self):
+        """Test /dashboard/bootstrap: analytics, first page of leads and status counts from one connection"""
+        headers = self.auth_headers()
+        self.assertEqual(self.client.get('/dashboard/bootstrap').status_code, 401)
+        self.client.post('/metrics/track/batch', json={'events': [
+            {'event_type': 'page_view', 'page_url': '/', 'device_type': 'desktop'},
+            {'event_type': 'form_submit', 'page_url': '/contact'}]})
+        for name in ('Ana', 'Bo', 'Cy'):
+            self.client.post('/contact/submit', json={'name': name, 'email': f'{name.lower()}@example.com',
+                                                      'subject': 'Hola', 'message': 'Hi'})
+        listing = self.client.get('/contact/requests', headers=headers).get_json()['contact_requests']
+        self.client.put(f"/contact/requests/{listing[0]['id']}/status", json={'status': 'resolved'}, headers=headers)
+
+        with mock.patch.object(app_production.storage.SQLiteStorage, 'connect',
+                               autospec=True, side_effect=app_production.storage.SQLiteStorage.connect) as connect:
+            response = self.client.get('/dashboard/bootstrap?limit=2', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(connect.call_count, 1)
+        data = response.get_json()
+        analytics = self.client.get('/metrics/analytics?range=all', headers=headers).get_json()
+        self.assertEqual(data['analytics'], analytics)
+        self.assertEqual(data['leads']['total'], 3)
+        self.assertEqual([row['id'] for row in data['leads']['contact_requests']], [row['id'] for row in listing[:2]])
+        self.assertEqual(data['leads']['next'], self.client.get('/contact/requests', headers=headers).get_json()['next'])
+        self.assertEqual(data['status_counts'], {'new': 2, 'in_progress': 0, 'resolved': 1, 'closed': 0})
+        self.assertEqual(data['freshness']['analytics_source'], 'live')
+        self.assertEqual(data['freshness']['analytics_as_of'], data['freshness']['read_at'])
+        second_page = self.client.get('/dashboard/bootstrap?limit=2&offset=2', headers=headers).get_json()
+        self.assertEqual([row['id'] for row in second_page['leads']['contact_requests']], [listing[2]['id']])
+
+        # Standard ranges come from the precomputed snapshots while fresh
+        conn = app_production.database.connect(app_production.DB_PATH)
+        app_production.dashboard_snapshots.refresh(conn)
+        conn.close()
+        snapshot = self.client.get('/dashboard/bootstrap?range=7d', headers=headers).get_json()
+        self.assertEqual(snapshot['freshness']['analytics_source'], 'snapshot')
+        self.assertEqual(snapshot['freshness']['analytics_as_of'], snapshot['analytics']['snapshot']['as_of'])
+
+        for query in ('range=1y', 'limit=0', 'limit=abc', 'offset=-1'):
+            self.assertEqual(self.client.get(f'/dashboard/bootstrap?{query}', headers=headers).status_code, 400)
+
+    def test_contact_summary_counters(self):
+        """Test /contact/summary: trigger-maintained counters per status and day, and reconciliation"""
+        headers = self.auth_headers()
+        for name in ('Ana', 'Bo', 'Cy'):
+            self.client.post('/contact/submit', json={'name': name, 'email': f'{name.lower()}@example.com',
+                                                      'subject': 'Hola', 'message': 'Hi'})
+        listing = self.client.get('/contact/requests', headers=headers).get_json()['contact_requests']
+        self.client.put(f"/contact/requests/{listing[0]['id']}/status", json={'status': 'resolved'}, headers=headers)
+        self.client.put(f"/contact/requests/{listing[1]['id']}/status", json={'status': 'in_progress'}, headers=headers)
+
+        statements = []
+        listener = lambda conn, sql, params, seconds, phase: statements.append(sql)
+        app_production.database.add_query_listener(listener)
+        try:
+            summary = self.client.get('/contact/summary', headers=headers).get_json()
+        finally:
+            app_production.database.remove_query_listener(listener)
+        self.assertFalse([sql for sql in statements if 'FROM contact_requests' in sql])
+        self.assertEqual(summary['status_counts'], {'new': 1, 'in_progress': 1, 'resolved': 1, 'closed': 0})
+        self.assertEqual(summary['total'], 3)
+        today = datetime.utcnow().strftime('%Y-%m-%d')
+        self.assertEqual(summary['days'], [{'day': today, 'total': 3,
+                                            'by_status': {'new': 1, 'in_progress': 1, 'resolved': 1}}])
+
+        # Moving and deleting rows keeps the counters in step, whoever writes
+        conn = app_production.database.connect(app_production.DB_PATH)
+        conn.execute("UPDATE contact_requests SET created_at = datetime('now', '-2 days') WHERE id = ?", (listing[0]['id'],))
+        conn.execute('DELETE FROM contact_requests WHERE id = ?', (listing[1]['id'],))
+        conn.commit()
+        summary = self.client.get('/contact/summary', headers=headers).get_json()
+        self.assertEqual(summary['status_counts'], {'new': 1, 'in_progress': 0, 'resolved': 1, 'closed': 0})
+        self.assertEqual([(day['total'], day['by_status']) for day in summary['days']],
+                         [(1, {'resolved': 1}), (1, {'new': 1})])
+        self.assertEqual(len(self.client.get('/contact/summary?days=1', headers=headers).get_json()['days']), 1)
+        self.assertEqual(self.client.get('/contact/summary?days=0', headers=headers).status_code, 400)
+        bootstrap = self.client.get('/dashboard/bootstrap', headers=headers).get_json()
+        self.assertEqual(bootstrap['status_counts'], summary['status_counts'])
+
+        # Reconciliation repairs drift and reports it
+        conn.execute("UPDATE contact_status_counts SET count = 7 WHERE status = 'new'")
+        conn.commit()
+        conn.execute('BEGIN IMMEDIATE')
+        drift = app_production.lead_counters.reconcile(conn)
+        conn.commit()
+        self.assertEqual(drift, [(('status', 'new'), 7, 1)])
+        self.assertEqual(app_production.lead_counters.reconcile(conn), [])
+        conn.rollback()
+        conn.close()
+        self.assertEqual(self.client.get('/contact/summary', headers=headers).get_json()['status_counts']['new'], 1)
+
+    def test_bulk_contact_status_update(self):
+        """Test PATCH /contact/requests: many status changes in one transaction with per-id results"""
+        headers = self.auth_headers()
+        for name in ('Ana', 'Bo', 'Cy'):
+            self.client.post('/contact/submit', json={'name': name, 'email': f'{name.lower()}@example.com',
+                                                      'subject': 'Hola', 'message': 'Hi'})
+        ids = {row['name']: row['id'] for row in self.client.get('/contact/requests', headers=headers).get_json()['contact_requests']}
+        self.client.put(f"/contact/requests/{ids['Cy']}/status", json={'status': 'resolved'}, headers=headers)
+        cy = next(row for row in self.client.get('/contact/requests', headers=headers).get_json()['contact_requests']
+                  if row['name'] == 'Cy')
+        self.assertIsNotNone(cy['responded_at'])
+
+        statements = []
+        listener = lambda conn, sql, params, seconds, phase: statements.append((phase, sql))
+        app_production.database.add_query_listener(listener)
+        try:
+            response = self.client.patch('/contact/requests', headers=headers, json={'changes': [
+                {'id': ids['Ana'], 'status': 'resolved', 'notes': 'Llamada hecha'},
+                {'id': ids['Bo'], 'status': 'in_progress'},
+                {'id': ids['Cy'], 'status': 'closed'},
+                {'id': 999999, 'status': 'closed'},
+                {'id': 12345, 'status': 'done'},
+            ]})
+        finally:
+            app_production.database.remove_query_listener(listener)
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertEqual((data['updated'], data['not_found'], data['invalid']), (3, 1, 1))
+        self.assertEqual([(r['id'], r['result']) for r in data['results']],
+                         [(ids['Ana'], 'updated'), (ids['Bo'], 'updated'), (ids['Cy'], 'updated'),
+                          (999999, 'not_found'), (12345, 'invalid')])
+        self.assertEqual([r.get('previous_status') for r in data['results'][:3]], ['new', 'new', 'resolved'])
+        self.assertEqual(len([sql for phase, sql in statements if 'UPDATE contact_requests' in sql]), 1)
+        self.assertIn(('executemany', next(sql for _, sql in statements if 'UPDATE contact_requests' in sql)), statements)
+
+        rows = {row['name']: row for row in self.client.get('/contact/requests', headers=headers).get_json()['contact_requests']}
+        self.assertEqual((rows['Ana']['status'], rows['Ana']['notes']), ('resolved', 'Llamada hecha'))
+        self.assertIsNotNone(rows['Ana']['responded_at'])
+        self.assertIsNone(rows['Bo']['responded_at'])
+        # Already resolved: responded_at keeps its first value
+        self.assertEqual((rows['Cy']['status'], rows['Cy']['responded_at']), ('closed', cy['responded_at']))
+        summary = self.client.get('/contact/summary', headers=headers).get_json()
+        self.assertEqual(summary['status_counts'], {'new': 0, 'in_progress': 1, 'resolved': 1, 'closed': 1})
+
+        self.assertEqual(self.client.patch('/contact/requests', json={'changes': []}).status_code, 401)
+        for body in ({'changes': []}, {'changes': [{'id': 1, 'status': 'new'}] * 2}, [1],
+                     {'changes': [{'id': i, 'status': 'new'} for i in range(501)]}):
+            self.assertEqual(self.client.patch('/contact/requests', json=body, headers=headers).status_code, 400)
+
+        # Missing ids are per-change errors, not duplicates of each other
+        response = self.client.patch('/contact/requests', headers=headers, json={'changes': [
+            {'status': 'closed'}, {'status': 'closed'}, {'id': ids['Bo'], 'status': 'resolved'}]})
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertEqual((data['updated'], data['invalid']), (1, 2))
+        self.assertEqual([r.get('error') for r in data['results'][:2]], ['id must be an integer'] * 2)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -58,7 +58,7 @@ export function ContactPageEnhanced() {
       const sessionId = getOrCreateSessionId();
       const userId = localStorage.getItem('user_id');
 
-      await fetch(`${import.meta.env.VITE_API_URL || 'http://localhost:5000'}/metrics/track`, {
+      await fetch(`${import.meta.env.VITE_INGEST_URL || import.meta.env.VITE_API_URL || 'http://localhost:5000'}/metrics/track`, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
@@ -207,7 +207,7 @@ export function ContactPageEnhanced() {
     try {
       const sessionId = getOrCreateSessionId();
 
-      await fetch(`${import.meta.env.VITE_API_URL || 'http://localhost:5000'}/metrics/track`, {
+      await fetch(`${import.meta.env.VITE_INGEST_URL || import.meta.env.VITE_API_URL || 'http://localhost:5000'}/metrics/track`, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
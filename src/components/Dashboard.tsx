@@ -40,22 +40,23 @@ export function Dashboard({ onNavigate }: DashboardProps) {
     try {
       const token = localStorage.getItem('admin_token');
       
-      // Fetch contacts
-      const contactsResponse = await fetch('http://localhost:5000/contact/requests', {
+      // Leads, status counts and analytics in one request
+      const response = await fetch('http://localhost:5000/dashboard/bootstrap', {
         headers: {
           'Authorization': `Bearer ${token}`,
           'Content-Type': 'application/json'
         }
       });
 
-      if (contactsResponse.ok) {
-        const contactsData = await contactsResponse.json();
-        setContacts(contactsData.requests || []);
+      if (response.ok) {
+        const data = await response.json();
+        setContacts(data.leads.contact_requests || []);
         
-        // Calculate analytics
-        const total = contactsData.requests?.length || 0;
-        const pending = contactsData.requests?.filter((c: any) => c.status === 'pending').length || 0;
-        const completed = contactsData.requests?.filter((c: any) => c.status === 'completed').length || 0;
+        // Calculate analytics from the status counts of all leads
+        const counts = data.status_counts || {};
+        const total = data.leads.total || 0;
+        const pending = (counts.new || 0) + (counts.in_progress || 0);
+        const completed = (counts.resolved || 0) + (counts.closed || 0);
         const conversionRate = total > 0 ? Math.round((completed / total) * 100) : 0;
         
         setAnalytics({
@@ -8,16 +8,7 @@ import { Badge } from "./ui/badge";
 import { BarChart, Bar, XAxis, YAxis, CartesianGrid, Tooltip, ResponsiveContainer, PieChart, Pie, Cell, LineChart, Line } from "recharts";
 import { Calendar, Users, MousePointer, TrendingUp, Download, RefreshCw, Eye, EyeOff } from "lucide-react";
 import { toast } from "sonner";
-
-interface MetricData {
-  total_events: number;
-  events_by_type: Record<string, number>;
-  page_views: Record<string, number>;
-  unique_sessions: number;
-  unique_users: number;
-  device_breakdown: Record<string, number>;
-  country_breakdown: Record<string, number>;
-}
+import { MetricData, toMetricData, applyMetricsDelta } from "./metricsData";
 
 interface ContactRequest {
   id: number;
@@ -75,15 +66,6 @@ export function MetricsDashboard() {
     }
   }, []);
 
-  // Fetch data when authenticated
-  useEffect(() => {
-    if (isAuthenticated && authToken) {
-      console.log('📊 Fetching metrics data...');
-      fetchMetrics();
-      fetchContactRequests();
-    }
-  }, [isAuthenticated, authToken]);
-
   // Fetch metrics data
   const fetchMetrics = async () => {
     if (!isAuthenticated || !authToken) return;
@@ -91,25 +73,8 @@ export function MetricsDashboard() {
     setLoading(true);
     try {
       const params = new URLSearchParams();
-      if (dateRange !== 'all') {
-        const endDate = new Date();
-        const startDate = new Date();
-        
-        switch (dateRange) {
-          case '7d':
-            startDate.setDate(endDate.getDate() - 7);
-            break;
-          case '30d':
-            startDate.setDate(endDate.getDate() - 30);
-            break;
-          case '90d':
-            startDate.setDate(endDate.getDate() - 90);
-            break;
-        }
-        
-        params.append('start_date', startDate.toISOString());
-        params.append('end_date', endDate.toISOString());
-      }
+      // Standard ranges are served from precomputed snapshots while fresh
+      params.append('range', dateRange);
       
       if (eventType !== 'all') {
         params.append('event_type', eventType);
@@ -123,7 +88,7 @@ export function MetricsDashboard() {
 
       if (response.ok) {
         const data = await response.json();
-        setMetrics(data);
+        setMetrics(toMetricData(data));
       } else {
         toast.error('Error al cargar métricas');
       }
@@ -135,6 +100,39 @@ export function MetricsDashboard() {
     }
   };
 
+  // Analytics and contact requests in one request (unfiltered views only)
+  const fetchDashboard = async () => {
+    if (!isAuthenticated || !authToken) return;
+    if (eventType !== 'all') {
+      fetchMetrics();
+      fetchContactRequests();
+      return;
+    }
+
+    setLoading(true);
+    try {
+      const params = new URLSearchParams({ range: dateRange, limit: '100' });
+      const response = await fetch(`${import.meta.env.VITE_API_URL || 'http://localhost:5000'}/dashboard/bootstrap?${params}`, {
+        headers: {
+          'Authorization': `Bearer ${authToken}`,
+        },
+      });
+
+      if (response.ok) {
+        const data = await response.json();
+        setMetrics(toMetricData(data.analytics));
+        setContactRequests(data.leads.contact_requests);
+      } else {
+        toast.error('Error al cargar métricas');
+      }
+    } catch (error) {
+      console.error('Error fetching dashboard:', error);
+      toast.error('Error al conectar con el servidor');
+    } finally {
+      setLoading(false);
+    }
+  };
+
   // Fetch contact requests
   const fetchContactRequests = async () => {
     if (!isAuthenticated || !authToken) return;
@@ -182,11 +180,71 @@ export function MetricsDashboard() {
   // Load data when authenticated
   useEffect(() => {
     if (isAuthenticated) {
-      fetchMetrics();
-      fetchContactRequests();
+      console.log('📊 Fetching metrics data...');
+      fetchDashboard();
     }
   }, [isAuthenticated, authToken, dateRange, eventType]);
 
+  // Live updates: apply /metrics/stream deltas instead of re-running the analytics queries
+  useEffect(() => {
+    if (!isAuthenticated || !authToken) return;
+    const controller = new AbortController();
+    let lastEventId = '';
+
+    const handleEvent = (event: string, data: any) => {
+      if (event === 'metrics') {
+        // Deltas cover every event type; a filtered view is refreshed with the Actualizar button
+        if (eventType !== 'all') return;
+        setMetrics((current) => current && applyMetricsDelta(current, data));
+      } else if (event === 'lead') {
+        toast.info(`Nueva solicitud: ${data.subject}`);
+        fetchContactRequests();
+      } else if (event === 'reset') {
+        fetchDashboard();
+      }
+    };
+
+    const listen = async () => {
+      while (!controller.signal.aborted) {
+        try {
+          const response = await fetch(`${import.meta.env.VITE_API_URL || 'http://localhost:5000'}/metrics/stream`, {
+            headers: {
+              'Authorization': `Bearer ${authToken}`,
+              ...(lastEventId ? { 'Last-Event-ID': lastEventId } : {}),
+            },
+            signal: controller.signal,
+          });
+          if (!response.ok || !response.body) throw new Error(`stream ${response.status}`);
+          const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+          let buffer = '';
+          for (;;) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += value;
+            const blocks = buffer.split('\n\n');
+            buffer = blocks.pop() || '';
+            blocks.forEach((block) => {
+              const fields: Record<string, string> = {};
+              block.split('\n').forEach((line) => {
+                const separator = line.indexOf(': ');
+                if (separator > 0) fields[line.slice(0, separator)] = line.slice(separator + 2);
+              });
+              if (fields.id) lastEventId = fields.id;
+              if (fields.event) handleEvent(fields.event, JSON.parse(fields.data || '{}'));
+            });
+          }
+        } catch (error) {
+          if (controller.signal.aborted) return;
+        }
+        // The server ends streams every few minutes; reconnect and resume after the last id
+        await new Promise((resolve) => setTimeout(resolve, 3000));
+      }
+    };
+
+    listen();
+    return () => controller.abort();
+  }, [isAuthenticated, authToken, dateRange, eventType]);
+
   // Prepare chart data
   const getEventTypeChartData = () => {
     if (!metrics?.events_by_type) return [];
@@ -0,0 +1,39 @@
+import { describe, expect, it } from 'vitest';
+import { applyMetricsDelta, toMetricData } from './metricsData';
+
+const analytics = {
+  summary: { total_events: 10, unique_sessions: 4, unique_users: 3, page_views: 7, form_submissions: 1 },
+  top_pages: [{ page: '/', views: 5 }, { page: '/servicios', views: 2 }],
+  device_breakdown: [{ device: 'desktop', count: 6 }, { device: 'mobile', count: 4 }],
+  event_types: [{ event_type: 'page_view', count: 7 }, { event_type: 'click', count: 2 }, { event_type: 'form_submit', count: 1 }],
+};
+
+describe('metrics dashboard state', () => {
+  it('maps the analytics response into chart data', () => {
+    expect(toMetricData(analytics)).toEqual({
+      total_events: 10,
+      unique_sessions: 4,
+      unique_users: 3,
+      events_by_type: { page_view: 7, click: 2, form_submit: 1 },
+      page_views: { '/': 5, '/servicios': 2 },
+      device_breakdown: { desktop: 6, mobile: 4 },
+      country_breakdown: {},
+    });
+  });
+
+  it('merges stream deltas into the loaded analytics', () => {
+    const merged = applyMetricsDelta(toMetricData(analytics), {
+      total_events: 3,
+      page_views: 2,
+      form_submissions: 1,
+      event_types: { page_view: 2, form_submit: 1 },
+      top_pages: { '/': 1, '/contacto': 1 },
+      device_breakdown: { mobile: 3 },
+    });
+    expect(merged.total_events).toBe(13);
+    expect(merged.events_by_type).toEqual({ page_view: 9, click: 2, form_submit: 2 });
+    expect(merged.page_views).toEqual({ '/': 6, '/servicios': 2, '/contacto': 1 });
+    expect(merged.device_breakdown).toEqual({ desktop: 6, mobile: 7 });
+    expect([merged.unique_sessions, merged.unique_users]).toEqual([4, 3]);
+  });
+});
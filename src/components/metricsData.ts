@@ -0,0 +1,64 @@
+// Dashboard metrics state: built from the /metrics/analytics (or /dashboard/bootstrap)
+// response and kept current with the /metrics/stream deltas
+
+export interface MetricData {
+  total_events: number;
+  events_by_type: Record<string, number>;
+  page_views: Record<string, number>;
+  unique_sessions: number;
+  unique_users: number;
+  device_breakdown: Record<string, number>;
+  country_breakdown: Record<string, number>;
+}
+
+export interface AnalyticsResponse {
+  summary: {
+    total_events: number;
+    unique_sessions?: number;
+    unique_users?: number;
+    page_views: number;
+    form_submissions: number;
+  };
+  top_pages: { page: string; views: number }[];
+  device_breakdown: { device: string; count: number }[];
+  event_types: { event_type: string; count: number }[];
+}
+
+// Payload of an `event: metrics` stream message
+export interface MetricsDelta {
+  total_events: number;
+  page_views: number;
+  form_submissions: number;
+  event_types: Record<string, number>;
+  top_pages: Record<string, number>;
+  device_breakdown: Record<string, number>;
+}
+
+export function toMetricData(data: AnalyticsResponse): MetricData {
+  return {
+    total_events: data.summary.total_events,
+    unique_sessions: data.summary.unique_sessions || 0,
+    unique_users: data.summary.unique_users || 0,
+    events_by_type: Object.fromEntries((data.event_types || []).map((row) => [row.event_type, row.count])),
+    page_views: Object.fromEntries((data.top_pages || []).map((row) => [row.page, row.views])),
+    device_breakdown: Object.fromEntries((data.device_breakdown || []).map((row) => [row.device, row.count])),
+    country_breakdown: {},
+  };
+}
+
+const addCounts = (current: Record<string, number> = {}, delta: Record<string, number> = {}) => {
+  const merged = { ...current };
+  Object.entries(delta).forEach(([key, value]) => { merged[key] = Math.round((merged[key] || 0) + value); });
+  return merged;
+};
+
+// Unique sessions and users do not add up across deltas, so they keep their loaded values
+export function applyMetricsDelta(current: MetricData, delta: MetricsDelta): MetricData {
+  return {
+    ...current,
+    total_events: Math.round((current.total_events || 0) + delta.total_events),
+    events_by_type: addCounts(current.events_by_type, delta.event_types),
+    page_views: addCounts(current.page_views, delta.top_pages),
+    device_breakdown: addCounts(current.device_breakdown, delta.device_breakdown),
+  };
+}